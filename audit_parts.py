@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for auditing logger partitions.
+
+Compares indexes, constraints, inheritance, ownership and tablespace of every partition with the other partitions
+of its service, optionally repairs deviations online. Exits with non-zero status if any deviation remains.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.audit import INHERITANCE, Deviation, audit_tables, get_orphans, get_parents, get_table_states, \
+    repair_tables
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import ConfigError, ConnectionPool, FatalScriptError, LoggerMaintenanceScript
+from logger_maintenance.tier import parse_tiering
+
+
+class AuditPartsScript(LoggerMaintenanceScript):
+    """Script class for auditing logger partitions."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+',
+            help="audit only partitions of the services (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="maximal number of partitions audited or repaired concurrently (default 4)"
+        )
+        parser.add_argument(
+            "--repair", action='store_true',
+            help="repair missing indexes and constraints, owners and unvalidated constraints online"
+        )
+        parser.add_argument(
+            "--lock-timeout", dest="lock_timeout", type=int, default=1000,
+            help="lock timeout in milliseconds of repairs (default 1000)"
+        )
+        parser.add_argument(
+            "--retries", type=int, default=5,
+            help="how many times a repair is retried after lock timeout (default 5)"
+        )
+        parser.add_argument(
+            "--backoff", type=float, default=0.5,
+            help="base delay in seconds of exponential backoff between retries (default 0.5)"
+        )
+        self.args = parser.parse_args(args)
+
+    def read_config(self, config_filename=None):
+        """Read configuration, tablespace of the optional tiering section is expected besides the default one."""
+        config = super(AuditPartsScript, self).read_config(config_filename)
+        try:
+            self.tiering = parse_tiering(config["tiering"]) if "tiering" in config else None
+        except ConfigError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        return config
+
+    def get_deviations(self, pool):
+        """Return list of deviations of audited partitions, raise FatalScriptError if any of them can't be read."""
+        with self.connect_db() as conn:
+            try:
+                partitions = get_partitions(conn)
+                orphans = get_orphans(conn)
+                parents = get_parents(conn, sorted(set(part.parent for part in partitions)))
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+        if self.args.service is not None:
+            partitions = [part for part in partitions if part.service in self.args.service]
+            orphans = [(table, parent) for table, parent in orphans
+                       if any(table.startswith("{}_{}_".format(parent, service)) for service in self.args.service)]
+
+        results, states = get_table_states(pool, partitions)
+        failed = [part for part, error in results.items() if error is not None]
+        if failed:
+            message = "Audit failed for tables: " + ", ".join(part.table for part in failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+        deviations = [Deviation(table, INHERITANCE, "does not inherit from " + parent, ())
+                      for table, parent in orphans]
+        return deviations + audit_tables(states, parents, self.tiering.tablespace if self.tiering else None,
+                                         self.granularity)
+
+    def execute(self):
+        """Audit database partitions, repair deviations if requested."""
+        pool = ConnectionPool(self.connect_db, max(1, self.args.workers))
+        try:
+            deviations = self.get_deviations(pool)
+            results = {}
+            if self.args.repair and deviations:
+                results = repair_tables(pool, deviations, lock_timeout=self.args.lock_timeout,
+                                        retries=self.args.retries, backoff=self.args.backoff)
+        finally:
+            pool.closeall()
+
+        if not deviations:
+            logging.info("No deviations found")
+            return
+        row_format = "{:40} {:14} {:10} {}"
+        print(row_format.format("table", "deviation", "status", "detail"))
+        remaining = []
+        for deviation in deviations:
+            if not deviation.repair:
+                status = "manual"
+            elif deviation.table in results:
+                status = "failed" if results[deviation.table] is not None else "repaired"
+            else:
+                status = "repairable"
+            if status != "repaired":
+                remaining.append(deviation)
+            print(row_format.format(deviation.table, deviation.kind, status, deviation.detail))
+
+        if remaining:
+            message = "Partitions deviate from the template: " + ", ".join(
+                sorted(set(deviation.table for deviation in remaining)))
+            logging.error(message)
+            failed = [error for error in results.values() if error is not None]
+            raise FatalScriptError(failed[0].error if failed else None, message)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = AuditPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
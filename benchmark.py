@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Benchmark of logger maintenance scripts.
+
+Starts a throwaway PostgreSQL cluster in a temporary directory (listening on a unix socket only), loads
+a stand-in logger schema from `benchmark_schema.sql` and measures create, archive, drop and list operations
+for given scales of services x months x rows. Results are written as JSON and may be compared with results
+of another version.
+
+Requires `initdb` and `pg_ctl` binaries, see `--pg-bin`.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager, redirect_stdout
+from datetime import date
+
+import psycopg2
+from psycopg2 import sql
+
+from create_parts import CreatePartsScript
+from drop_parts import DropPartsScript
+from list_parts import ListPartsScript
+from logger_maintenance.archive import archive_tables
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import ConnectionPool, add_months
+
+SCHEMA_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_schema.sql')
+# The first month of benchmark partitions
+BASE_MONTH = date(2001, 1, 1)
+
+Scale = namedtuple('Scale', ['services', 'months', 'rows'])
+Scale.__doc__ = """Benchmark scale, rows are inserted into each request partition."""
+
+
+def parse_scale(value):
+    """Parse scale in `SERVICESxMONTHSxROWS` format."""
+    try:
+        scale = Scale(*(int(item) for item in value.lower().split('x')))
+    except (TypeError, ValueError):
+        raise argparse.ArgumentTypeError("scale has to be in SERVICESxMONTHSxROWS format")
+    if scale.services < 1 or scale.months < 2 or scale.rows < 0:
+        raise argparse.ArgumentTypeError("at least 1 service and 2 months are required")
+    return scale
+
+
+class Cluster(object):
+    """Throwaway PostgreSQL cluster."""
+
+    def __init__(self, base_dir, bin_dir=None, settings=()):
+        """Initialize cluster in the directory.
+
+        :param str base_dir: directory for data and socket
+        :param str bin_dir: directory with PostgreSQL binaries, binaries are searched in PATH if None
+        :param settings: list of `name=value` server settings
+        """
+        self.base_dir = base_dir
+        self.data_dir = os.path.join(base_dir, 'data')
+        self.bin_dir = bin_dir
+        self.settings = settings
+        self.port = 5432
+
+    def _bin(self, name):
+        return os.path.join(self.bin_dir, name) if self.bin_dir else name
+
+    def start(self):
+        """Create and start the cluster."""
+        subprocess.check_call(
+            [self._bin('initdb'), '-D', self.data_dir, '-A', 'trust', '-U', 'postgres', '-E', 'UTF8', '--no-locale'],
+            stdout=subprocess.DEVNULL)
+        options = ["-c listen_addresses=''", "-c unix_socket_directories='{}'".format(self.base_dir),
+                   "-p {}".format(self.port)]
+        options.extend("-c {}".format(setting) for setting in self.settings)
+        subprocess.check_call(
+            [self._bin('pg_ctl'), '-D', self.data_dir, '-l', os.path.join(self.base_dir, 'server.log'), '-w',
+             '-o', ' '.join(options), 'start'],
+            stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        """Stop the cluster."""
+        subprocess.call([self._bin('pg_ctl'), '-D', self.data_dir, '-m', 'immediate', '-w', 'stop'],
+                        stdout=subprocess.DEVNULL)
+
+    def db_config(self, database='postgres'):
+        """Return connection parameters of the database."""
+        return {'host': self.base_dir, 'port': self.port, 'user': 'postgres', 'database': database}
+
+    def connect(self, database='postgres'):
+        """Connect to the database."""
+        return psycopg2.connect(**self.db_config(database))
+
+
+class LockTimesHandler(logging.Handler):
+    """Logging handler collecting lock wait and hold times logged by per-partition drop."""
+
+    def __init__(self):
+        """Initialize empty lists of times."""
+        super(LockTimesHandler, self).__init__()
+        self.waits = []
+        self.holds = []
+
+    def emit(self, record):
+        """Collect times from the record."""
+        if isinstance(record.msg, str) and record.msg.endswith("(lock wait %.3f s, hold %.3f s)"):
+            self.waits.append(record.args[-2])
+            self.holds.append(record.args[-1])
+
+
+@contextmanager
+def collect_lock_times():
+    """Collect lock times logged inside the context."""
+    handler = LockTimesHandler()
+    logging.getLogger().addHandler(handler)
+    try:
+        yield handler
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+
+class Benchmark(object):
+    """Benchmark of a single scale in its own database."""
+
+    def __init__(self, cluster, scale, work_dir):
+        """Initialize benchmark."""
+        self.cluster = cluster
+        self.scale = scale
+        self.work_dir = work_dir
+        self.database = "bench_{}x{}x{}".format(*scale)
+        self.config_filename = os.path.join(work_dir, self.database + '.conf')
+        self.results = []
+
+    def month(self, offset):
+        """Return YYYY-MM of the benchmark month."""
+        return add_months(BASE_MONTH, offset).strftime("%Y-%m")
+
+    def record(self, operation, seconds, partitions, lock_times=None):
+        """Record result of the operation."""
+        result = {
+            'scale': self.scale._asdict(),
+            'operation': operation,
+            'seconds': round(seconds, 6),
+            'partitions': partitions,
+        }
+        if lock_times is not None and lock_times.holds:
+            result['lock_wait_total'] = round(sum(lock_times.waits), 6)
+            result['lock_hold_total'] = round(sum(lock_times.holds), 6)
+            result['lock_hold_max'] = round(max(lock_times.holds), 6)
+        print("{} {}: {:.3f} s".format(self.database, operation, seconds), file=sys.stderr)
+        self.results.append(result)
+
+    def count_partitions(self):
+        """Return number of existing partitions."""
+        with self.cluster.connect(self.database) as conn:
+            count = len(get_partitions(conn))
+        conn.close()
+        return count
+
+    def setup(self):
+        """Create database with the stand-in schema and services."""
+        conn = self.cluster.connect()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(self.database)))
+            cursor.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(self.database)))
+        conn.close()
+
+        with open(SCHEMA_FILENAME) as fschema:
+            schema = fschema.read()
+        with self.cluster.connect(self.database) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(schema)
+                for service_id in range(1, self.scale.services + 1):
+                    cursor.execute(
+                        "INSERT INTO service (id, partition_postfix, name) VALUES (%s, %s, %s)",
+                        (service_id, "svc{:02}_".format(service_id), "Service {}".format(service_id)))
+        conn.close()
+
+        with open(self.config_filename, 'w') as fconf:
+            json.dump({'database': self.cluster.db_config(self.database)}, fconf)
+
+    def load(self, months):
+        """Fill request and request_data partitions of the months."""
+        with self.cluster.connect(self.database) as conn:
+            with conn.cursor() as cursor:
+                for offset in months:
+                    month = add_months(BASE_MONTH, offset)
+                    for service_id in range(1, self.scale.services + 1):
+                        suffix = "svc{:02}_{}".format(service_id, month.strftime("%y_%m"))
+                        cursor.execute(sql.SQL("""
+                            INSERT INTO {} (id, time_begin, time_end, source_ip, service_id, request_type_id,
+                                            user_name, is_monitoring, result_code_id)
+                            SELECT nextval('request_id_seq'), t, t + interval '50 ms', '10.0.0.1'::inet + (i %% 1000),
+                                   %(service)s, 1000 + i %% 20, 'user' || (i %% 100), false, i %% 5
+                              FROM generate_series(1, %(rows)s) i,
+                                   LATERAL (SELECT %(month)s::timestamp + (i %% 2419200) * interval '1 s') t(t)
+                        """).format(sql.Identifier("request_" + suffix)),
+                            {'service': service_id, 'rows': self.scale.rows, 'month': month})
+                        cursor.execute(sql.SQL("""
+                            INSERT INTO {} (request_time_begin, request_service_id, request_monitoring, request_id,
+                                            content, is_response)
+                            SELECT time_begin, service_id, is_monitoring, id, repeat(md5(id::text), 8), false
+                              FROM {}
+                        """).format(sql.Identifier("request_data_" + suffix), sql.Identifier("request_" + suffix)))
+        conn.close()
+
+    def run_script(self, script_class, args):
+        """Run the script with the benchmark configuration, return its run time."""
+        script = script_class(["-c", self.config_filename] + args)
+        script.read_config()
+        with open(os.devnull, 'w') as devnull:
+            with redirect_stdout(devnull):
+                start = time.monotonic()
+                script.execute()
+                return time.monotonic() - start
+
+    def run(self):
+        """Run all benchmark operations.
+
+        First half of the months is created in a single transaction, the second half in chunks. Both halves
+        are loaded, the first half is archived and dropped per partition, the second half is dropped in
+        a single transaction.
+        """
+        half = self.scale.months // 2
+        self.setup()
+
+        seconds = self.run_script(CreatePartsScript, ["-d", self.month(0), "--to-date", self.month(half - 1)])
+        self.record('create', seconds, self.count_partitions())
+        count = self.count_partitions()
+        seconds = self.run_script(
+            CreatePartsScript, ["-d", self.month(half), "--to-date", self.month(self.scale.months - 1), "--chunked"])
+        self.record('create_chunked', seconds, self.count_partitions() - count)
+
+        start = time.monotonic()
+        self.load(range(self.scale.months))
+        self.record('load', time.monotonic() - start, self.count_partitions())
+
+        seconds = self.run_script(ListPartsScript, ["-f", "json"])
+        self.record('list', seconds, self.count_partitions())
+
+        archive_dir = os.path.join(self.work_dir, self.database + '_archive')
+        os.makedirs(archive_dir, exist_ok=True)
+        suffixes = tuple(add_months(BASE_MONTH, offset).strftime("_%y_%m") for offset in range(half))
+        with self.cluster.connect(self.database) as conn:
+            tables = [part.table for part in get_partitions(conn)
+                      if part.table.endswith(suffixes) and part.service]
+        conn.close()
+        pool = ConnectionPool(lambda: self.cluster.connect(self.database), 4)
+        start = time.monotonic()
+        try:
+            archive_tables(pool, tables, archive_dir)
+        finally:
+            pool.closeall()
+        self.record('archive', time.monotonic() - start, len(tables))
+
+        count = self.count_partitions()
+        with collect_lock_times() as lock_times:
+            seconds = self.run_script(
+                DropPartsScript,
+                ["-s", "all", "-d", self.month(0), "--to-date", self.month(half - 1), "--per-partition"])
+        self.record('drop_per_partition', seconds, count - self.count_partitions(), lock_times)
+
+        count = self.count_partitions()
+        seconds = self.run_script(
+            DropPartsScript, ["-s", "all", "-d", self.month(half), "--to-date", self.month(self.scale.months - 1)])
+        self.record('drop', seconds, count - self.count_partitions())
+        return self.results
+
+
+def get_version():
+    """Return version of this tree from git or None."""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current):
+    """Print comparison of results with baseline results."""
+    def key(result):
+        return (tuple(sorted(result['scale'].items())), result['operation'])
+
+    base = {key(result): result for result in baseline['results']}
+    print("{:20} {:20} {:>10} {:>10} {:>8}".format("scale", "operation", "baseline", "current", "ratio"))
+    for result in current['results']:
+        old = base.get(key(result))
+        scale = "{services}x{months}x{rows}".format(**result['scale'])
+        if old is None:
+            print("{:20} {:20} {:>10} {:>10.3f} {:>8}".format(scale, result['operation'], "-", result['seconds'], "-"))
+        else:
+            ratio = result['seconds'] / old['seconds'] if old['seconds'] else float('inf')
+            print("{:20} {:20} {:>10.3f} {:>10.3f} {:>8.2f}".format(
+                scale, result['operation'], old['seconds'], result['seconds'], ratio))
+
+
+def main(args):
+    """Run benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark logger maintenance scripts on a throwaway cluster.")
+    parser.add_argument(
+        "-s", "--scale", type=parse_scale, action='append',
+        help="SERVICESxMONTHSxROWS, may be repeated (default 2x4x1000)"
+    )
+    parser.add_argument(
+        "--pg-bin", dest="pg_bin",
+        help="directory with PostgreSQL binaries (i.e. /usr/lib/postgresql/14/bin), PATH is used by default"
+    )
+    parser.add_argument(
+        "--setting", action='append', default=[],
+        help="server setting in name=value format, may be repeated"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        help="file to write JSON results to (default stdout)"
+    )
+    parser.add_argument(
+        "--compare",
+        help="JSON results of another version to compare results with"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action='store_true',
+        help="log script output"
+    )
+    args = parser.parse_args(args)
+    # Scripts log at INFO level, which is needed to collect lock times
+    logging.basicConfig(level=logging.INFO)
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    base_dir = tempfile.mkdtemp(prefix='logger-benchmark-')
+    cluster = Cluster(base_dir, args.pg_bin, args.setting)
+    try:
+        cluster.start()
+        with cluster.connect() as conn:
+            server_version = conn.server_version
+        conn.close()
+        report = {
+            'version': get_version(),
+            'server_version': server_version,
+            'python': platform.python_version(),
+            'started': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'results': [],
+        }
+        for scale in args.scale or [Scale(2, 4, 1000)]:
+            report['results'].extend(Benchmark(cluster, scale, base_dir).run())
+    finally:
+        cluster.stop()
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as foutput:
+            json.dump(report, foutput, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        print()
+
+    if args.compare:
+        with open(args.compare) as fbaseline:
+            compare(json.load(fbaseline), report)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,265 @@
+--
+-- Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+--
+-- This file is part of FRED.
+--
+-- FRED is free software: you can redistribute it and/or modify
+-- it under the terms of the GNU General Public License as published by
+-- the Free Software Foundation, either version 3 of the License, or
+-- (at your option) any later version.
+--
+-- FRED is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+--
+-- You should have received a copy of the GNU General Public License
+-- along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+-- Stand-in for the logger database schema used by benchmark.py.
+--
+-- Mimics tables and partitioning functions of the logger database, i.e. inherited partitions
+-- `request_<service>_YY_MM`, `request_data_<service>_YY_MM`, `request_property_value_<service>_YY_MM`
+-- and `session_YY_MM` created by `create_parts` and dropped by `drop_parts`. Services with weekly or daily
+-- partitions have partitions suffixed by `_YY_MM_DD` of their first day created and dropped by overloads
+-- of the functions taking granularity. Partitions merged by `merge_parts.py` are suffixed by `_YY_MM_m3`
+-- or `_YY_MM_m12` of their first month; like the production `drop_parts`, the functions here do not know them,
+-- scripts dropping partitions drop merged ones themselves.
+
+CREATE TABLE service (
+    id INTEGER PRIMARY KEY,
+    partition_postfix VARCHAR(10) UNIQUE NOT NULL,
+    name VARCHAR(64) NOT NULL
+);
+
+CREATE TABLE request_type (
+    id INTEGER PRIMARY KEY,
+    name VARCHAR(64) NOT NULL,
+    service_id INTEGER REFERENCES service (id)
+);
+
+CREATE TABLE result_code (
+    id SERIAL PRIMARY KEY,
+    service_id INTEGER REFERENCES service (id),
+    result_code INTEGER NOT NULL,
+    name VARCHAR(64) NOT NULL
+);
+
+CREATE TABLE request_property_name (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(256) UNIQUE NOT NULL
+);
+
+CREATE TABLE session (
+    id BIGSERIAL PRIMARY KEY,
+    user_name VARCHAR(255) NOT NULL,
+    login_date TIMESTAMP NOT NULL DEFAULT now(),
+    logout_date TIMESTAMP,
+    user_id INTEGER
+);
+
+CREATE TABLE request (
+    id BIGSERIAL PRIMARY KEY,
+    time_begin TIMESTAMP NOT NULL,
+    time_end TIMESTAMP,
+    source_ip INET,
+    service_id INTEGER NOT NULL REFERENCES service (id),
+    request_type_id INTEGER DEFAULT 1000,
+    session_id BIGINT,
+    user_name VARCHAR(255),
+    user_id INTEGER,
+    is_monitoring BOOLEAN NOT NULL,
+    result_code_id INTEGER
+);
+
+CREATE TABLE request_data (
+    request_time_begin TIMESTAMP NOT NULL,
+    request_service_id INTEGER NOT NULL,
+    request_monitoring BOOLEAN NOT NULL,
+    request_id BIGINT NOT NULL,
+    content TEXT NOT NULL,
+    is_response BOOLEAN DEFAULT False
+);
+
+CREATE TABLE request_property_value (
+    request_time_begin TIMESTAMP NOT NULL,
+    request_service_id INTEGER NOT NULL,
+    request_monitoring BOOLEAN NOT NULL,
+    id BIGSERIAL PRIMARY KEY,
+    request_id BIGINT NOT NULL,
+    property_name_id INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    output BOOLEAN DEFAULT False,
+    parent_id BIGINT
+);
+
+CREATE OR REPLACE FUNCTION create_service_parts(
+    service_id INTEGER, postfix TEXT, period_begin TIMESTAMP, period_end TIMESTAMP, suffix TEXT)
+RETURNS VOID AS $$
+DECLARE
+    part TEXT;
+BEGIN
+    part := 'request_' || postfix || suffix;
+    IF to_regclass(part) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I (PRIMARY KEY (id), CHECK (time_begin >= %L AND time_begin < %L '
+            'AND service_id = %s)) INHERITS (request)',
+            part, period_begin, period_end, service_id);
+        EXECUTE format('CREATE INDEX %I ON %I (time_begin)', part || '_time_begin_idx', part);
+        EXECUTE format('CREATE INDEX %I ON %I (source_ip)', part || '_source_ip_idx', part);
+        EXECUTE format('CREATE INDEX %I ON %I (request_type_id)', part || '_request_type_id_idx', part);
+        EXECUTE format('CREATE INDEX %I ON %I (user_name)', part || '_user_name_idx', part);
+    END IF;
+
+    part := 'request_data_' || postfix || suffix;
+    IF to_regclass(part) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I (CHECK (request_time_begin >= %L AND request_time_begin < %L '
+            'AND request_service_id = %s)) INHERITS (request_data)',
+            part, period_begin, period_end, service_id);
+        EXECUTE format('CREATE INDEX %I ON %I (request_id)', part || '_request_id_idx', part);
+    END IF;
+
+    part := 'request_property_value_' || postfix || suffix;
+    IF to_regclass(part) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE %I (PRIMARY KEY (id), CHECK (request_time_begin >= %L AND request_time_begin < %L '
+            'AND request_service_id = %s)) INHERITS (request_property_value)',
+            part, period_begin, period_end, service_id);
+        EXECUTE format('CREATE INDEX %I ON %I (request_id)', part || '_request_id_idx', part);
+        EXECUTE format('CREATE INDEX %I ON %I (property_name_id)', part || '_property_name_id_idx', part);
+        EXECUTE format('CREATE INDEX %I ON %I (value)', part || '_value_idx', part);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates monthly partitions of all services except the skipped ones (i.e. those with weekly or daily partitions)
+CREATE OR REPLACE FUNCTION create_parts(date_from TIMESTAMP, date_to TIMESTAMP, skip TEXT[]) RETURNS VOID AS $$
+DECLARE
+    month_begin TIMESTAMP := date_trunc('month', date_from);
+    month_end TIMESTAMP;
+    suffix TEXT;
+    part TEXT;
+    svc RECORD;
+BEGIN
+    WHILE month_begin <= date_trunc('month', date_to) LOOP
+        month_end := month_begin + interval '1 month';
+        suffix := to_char(month_begin, 'YY_MM');
+
+        part := 'session_' || suffix;
+        IF to_regclass(part) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I (PRIMARY KEY (id), CHECK (login_date >= %L AND login_date < %L)) INHERITS (session)',
+                part, month_begin, month_end);
+            EXECUTE format('CREATE INDEX %I ON %I (login_date)', part || '_login_date_idx', part);
+            EXECUTE format('CREATE INDEX %I ON %I (user_name)', part || '_user_name_idx', part);
+        END IF;
+
+        FOR svc IN SELECT id, partition_postfix FROM service
+                    WHERE trim(trailing '_' from partition_postfix) <> ALL(skip) ORDER BY id LOOP
+            PERFORM create_service_parts(svc.id, svc.partition_postfix, month_begin, month_end, suffix);
+        END LOOP;
+
+        month_begin := month_end;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION create_parts(date_from TIMESTAMP, date_to TIMESTAMP) RETURNS VOID AS $$
+BEGIN
+    PERFORM create_parts(date_from, date_to, ARRAY[]::TEXT[]);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates weekly or daily partitions `<table>_<service>_YY_MM_DD` of the service
+CREATE OR REPLACE FUNCTION create_parts(date_from TIMESTAMP, date_to TIMESTAMP, service_name TEXT, granularity TEXT)
+RETURNS VOID AS $$
+DECLARE
+    step INTERVAL := ('1 ' || granularity)::INTERVAL;
+    period_begin TIMESTAMP := date_trunc(granularity, date_from);
+    svc RECORD;
+BEGIN
+    SELECT id, partition_postfix INTO svc FROM service WHERE partition_postfix = service_name || '_';
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Unknown service %', service_name;
+    END IF;
+
+    WHILE period_begin <= date_trunc(granularity, date_to) LOOP
+        PERFORM create_service_parts(
+            svc.id, svc.partition_postfix, period_begin, period_begin + step, to_char(period_begin, 'YY_MM_DD'));
+        period_begin := period_begin + step;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION drop_parts(date_from TIMESTAMP, date_to TIMESTAMP, service_name TEXT, dry_run BOOLEAN)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    month_begin TIMESTAMP := date_trunc('month', date_from);
+    postfix TEXT;
+    prefix TEXT;
+    part TEXT;
+    stmt TEXT;
+BEGIN
+    SELECT partition_postfix INTO postfix FROM service WHERE partition_postfix = service_name || '_';
+    IF postfix IS NULL THEN
+        RAISE EXCEPTION 'Unknown service %', service_name;
+    END IF;
+
+    WHILE month_begin <= date_trunc('month', date_to) LOOP
+        FOREACH prefix IN ARRAY ARRAY['request_property_value_', 'request_data_', 'request_'] LOOP
+            part := prefix || postfix || to_char(month_begin, 'YY_MM');
+            IF to_regclass(part) IS NOT NULL THEN
+                stmt := format('DROP TABLE %I', part);
+                IF NOT dry_run THEN
+                    EXECUTE stmt;
+                END IF;
+                RETURN NEXT stmt;
+            END IF;
+        END LOOP;
+        month_begin := month_begin + interval '1 month';
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Drops weekly or daily partitions of the service
+CREATE OR REPLACE FUNCTION drop_parts(
+    date_from TIMESTAMP, date_to TIMESTAMP, service_name TEXT, dry_run BOOLEAN, granularity TEXT)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    step INTERVAL := ('1 ' || granularity)::INTERVAL;
+    period_begin TIMESTAMP := date_trunc(granularity, date_from);
+    suffixes TEXT[];
+    suffix TEXT;
+    postfix TEXT;
+    prefix TEXT;
+    part TEXT;
+    stmt TEXT;
+BEGIN
+    SELECT partition_postfix INTO postfix FROM service WHERE partition_postfix = service_name || '_';
+    IF postfix IS NULL THEN
+        RAISE EXCEPTION 'Unknown service %', service_name;
+    END IF;
+
+    WHILE period_begin <= date_trunc(granularity, date_to) LOOP
+        suffixes := ARRAY[to_char(period_begin, 'YY_MM_DD')];
+        -- Monthly partitions left from before the granularity was changed
+        IF date_trunc('month', period_begin + step - interval '1 day') >= period_begin THEN
+            suffixes := suffixes || to_char(date_trunc('month', period_begin + step - interval '1 day'), 'YY_MM');
+        END IF;
+        FOREACH suffix IN ARRAY suffixes LOOP
+            FOREACH prefix IN ARRAY ARRAY['request_property_value_', 'request_data_', 'request_'] LOOP
+                part := prefix || postfix || suffix;
+                IF to_regclass(part) IS NOT NULL THEN
+                    stmt := format('DROP TABLE %I', part);
+                    IF NOT dry_run THEN
+                        EXECUTE stmt;
+                    END IF;
+                    RETURN NEXT stmt;
+                END IF;
+            END LOOP;
+        END LOOP;
+        period_begin := period_begin + step;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for rewriting closed logger partitions ordered by time.
+
+Removes bloat of closed partitions and orders their rows by time, so range scans read fewer pages.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+from datetime import date
+
+from psycopg2 import DatabaseError
+
+from list_parts import format_size
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import ConnectionPool, DateAction, FatalScriptError, LoggerMaintenanceScript
+from logger_maintenance.compact import IOBudget, compact_tables, get_compacted_tables, plan_compact
+
+
+class CompactPartsScript(LoggerMaintenanceScript):
+    """Script class for rewriting closed logger partitions."""
+
+    # Name of the operation used in messages
+    operation = "Compacting"
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        self.add_rewrite_arguments(parser)
+        parser.add_argument(
+            "-d", "--from-date", dest="date_from", action=DateAction,
+            help="YYYY-MM date of the first partition (default the oldest one)"
+        )
+        parser.add_argument(
+            "--to-date", dest="date_to", action=DateAction,
+            help="YYYY-MM date of the last partition (default the last closed month)"
+        )
+        parser.add_argument(
+            "--force", action='store_true',
+            help="rewrite also partitions rewritten by previous runs"
+        )
+        parser.add_argument(
+            "--fillfactor", type=int, choices=range(10, 101), metavar="{10..100}",
+            help="fillfactor of rewritten partitions (default server default)"
+        )
+        self.args = parser.parse_args(args)
+
+    def add_rewrite_arguments(self, parser):
+        """Add options common for all scripts rewriting partitions."""
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+',
+            help="rewrite only partitions of the services (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "--dry-run", dest="dry_run", action='store_true',
+            help="Just print the plan"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=2,
+            help="maximal number of partitions rewritten concurrently (default 2)"
+        )
+        parser.add_argument(
+            "--index-workers", dest="index_workers", type=int,
+            help="max_parallel_maintenance_workers of index builds (default server setting)"
+        )
+        parser.add_argument(
+            "--io-budget", dest="io_budget", type=float,
+            help="maximal average rate of rewritten partitions in MB/s (default no limit)"
+        )
+        parser.add_argument(
+            "--lock-timeout", dest="lock_timeout", type=int, default=1000,
+            help="lock timeout in milliseconds of locking a partition and of the swap (default 1000)"
+        )
+        parser.add_argument(
+            "--retries", type=int, default=5,
+            help="how many times the swap is retried after lock timeout (default 5)"
+        )
+        parser.add_argument(
+            "--backoff", type=float, default=0.5,
+            help="base delay in seconds of exponential backoff between retries (default 0.5)"
+        )
+
+    def connect_worker(self):
+        """Connect to the database, set parallel workers of index builds."""
+        conn = self.connect_db()
+        if self.args.index_workers is not None:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT set_config('max_parallel_maintenance_workers', %s, false)",
+                                   (str(self.args.index_workers), ))
+                conn.commit()
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                conn.close()
+                raise FatalScriptError(err)
+        return conn
+
+    def get_plan(self):
+        """Return list of partitions to be rewritten."""
+        with self.connect_db() as conn:
+            try:
+                partitions = get_partitions(conn)
+                compacted = set() if self.args.force else get_compacted_tables(conn)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+        return plan_compact(partitions, date.today(), compacted, self.args.service, self.args.date_from,
+                            self.args.date_to)
+
+    def rewrite_options(self):
+        """Return arguments of `compact_table` specific for the script."""
+        return {'fillfactor': self.args.fillfactor}
+
+    def rewrite(self, pool, partitions, budget):
+        """Rewrite planned partitions, return result of `compact.compact_tables`."""
+        return compact_tables(pool, partitions, budget, self.may_start, lock_timeout=self.args.lock_timeout,
+                              retries=self.args.retries, backoff=self.args.backoff, **self.rewrite_options())
+
+    def may_start(self):
+        """Return whether rewrite of another partition may be started now."""
+        return True
+
+    def execute(self):
+        """Rewrite planned database partitions."""
+        if self.args.dry_run:
+            logging.info("=== DRY-RUN ===")
+
+        partitions = self.get_plan()
+        if not partitions:
+            logging.info("Nothing to do")
+        for part in partitions:
+            logging.info("Plan: %s %s (%s)", self.operation.lower(), part.table,
+                         format_size(part.size + part.index_size))
+        if self.args.dry_run or not partitions:
+            return
+
+        budget = IOBudget(self.args.io_budget * 1024 * 1024 if self.args.io_budget else None)
+        pool = ConnectionPool(self.connect_worker, max(1, min(self.args.workers, len(partitions))))
+        try:
+            results, done, skipped = self.rewrite(pool, partitions, budget)
+        finally:
+            pool.closeall()
+
+        if skipped:
+            logging.warning("Partitions left for the next run: %s", ", ".join(part.table for part in skipped))
+
+        row_format = "{:40} {:>10} {:>10}"
+        print(row_format.format("table", "before", "after"))
+        for result in sorted(done):
+            print(row_format.format(result.table, format_size(result.size_before), format_size(result.size_after)))
+        print(row_format.format("total", format_size(sum(result.size_before for result in done)),
+                                format_size(sum(result.size_after for result in done))))
+
+        failed = [part for part, error in results.items() if error is not None]
+        if failed:
+            message = self.operation + " failed for tables: " + ", ".join(part.table for part in failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = CompactPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
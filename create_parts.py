@@ -25,12 +25,25 @@ Run with -h option to print all available options.
 """
 import argparse
 import logging
+import re
 import sys
-from datetime import date
+from datetime import date, timedelta
 
 from psycopg2 import DatabaseError
 
-from logger_maintenance.common import DateAction, FatalScriptError, LoggerMaintenanceScript, add_months
+from logger_maintenance.catalog import defer_indexes, get_month_partitions, get_services
+from logger_maintenance.common import ConnectionPool, DateAction, FatalScriptError, LoggerMaintenanceScript, \
+    add_journal_arguments, add_metrics_arguments, add_months, add_watchdog_arguments, create_parts_statements, \
+    execute_statement, instrumented, is_monthly, retry_canceled, run_on_pool
+from logger_maintenance.journal import DONE, STARTED
+
+# Start of statements returned by `pg_get_indexdef`
+CREATE_INDEX_RE = re.compile(r'^CREATE (UNIQUE )?INDEX ')
+
+
+def if_not_exists(indexdef):
+    """Return statement creating the index unless it exists."""
+    return CREATE_INDEX_RE.sub(r'CREATE \1INDEX IF NOT EXISTS ', indexdef, count=1)
 
 
 class CreatePartsScript(LoggerMaintenanceScript):
@@ -45,13 +58,25 @@ class CreatePartsScript(LoggerMaintenanceScript):
         )
         parser.add_argument(
             "-d", "--from-date", dest="date_from", action=DateAction,
-            help="YYYY-MM date of log partition to be deleted (or the first one to be deleted, "
+            help="YYYY-MM or YYYY-MM-DD date of log partition to be created (or the first one to be created, "
                  "if --date_to is supplied)"
         )
         parser.add_argument(
             "--to-date", dest="date_to", action=DateAction,
-            help="YYYY-MM date of last log partition to be deleted"
+            help="YYYY-MM or YYYY-MM-DD date of last log partition to be created, month stands for all its days "
+                 "of weekly and daily partitions"
+        )
+        parser.add_argument(
+            "--chunked", action='store_true',
+            help="Create partitions of each month in its own transaction, build indexes concurrently afterwards"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="maximal number of indexes built concurrently (only with --chunked, default 4)"
         )
+        add_metrics_arguments(parser)
+        add_watchdog_arguments(parser)
+        add_journal_arguments(parser)
         self.args = parser.parse_args(args)
         self._set_default_args()
 
@@ -59,6 +84,7 @@ class CreatePartsScript(LoggerMaintenanceScript):
         """Set default values in case that command line arguments are not supplied."""
         # If --from-date not set, add 1 month to the current date
         if self.args.date_from is None:
+            self.passed_dates = {'date_from': None, 'date_to': self.args.date_to}
             self.args.date_from = add_months(date.today(), 1)
 
         # If --to-date not set, let it be equal to --from-date
@@ -69,27 +95,124 @@ class CreatePartsScript(LoggerMaintenanceScript):
         if self.args.date_to < self.args.date_from:
             self.args.date_to = self.args.date_from
 
+    @instrumented('create_parts')
     def execute(self):
         """Create database partitions."""
+        self.check_granularity()
+        if self.args.chunked:
+            self.execute_chunked()
+            return
+
         with self.connect_db() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    sql_func = cursor.mogrify(
-                        "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp)",
-                        {
-                            'from': self.args.date_from.strftime("%Y-%m-01"),
-                            'to': self.args.date_to.strftime("%Y-%m-01"),
-                        }
-                    )
+            self.run_step('create', lambda: retry_canceled(
+                conn, lambda: self.create_parts(conn), self.args.cancel_retries, self.args.cancel_backoff))
+
+    def create_parts_sql(self, cursor, date_from, date_to):
+        """Return `create_parts` calls creating partitions of all services with their granularity."""
+        services = [] if is_monthly(self.granularity) else get_services(cursor)
+        return create_parts_statements(cursor, date_from, date_to, self.granularity, services)
+
+    def create_parts(self, conn):
+        """Create database partitions for all selected months in a single transaction."""
+        with conn.cursor() as cursor:
+            try:
+                for sql_func in self.create_parts_sql(cursor, self.args.date_from, self.args.date_to):
                     logging.info(sql_func.decode())
                     cursor.execute(sql_func)
 
-                except DatabaseError as err:
-                    logging.error("DatabaseError: " + str(err))
-                    conn.rollback()
-                    raise FatalScriptError(err)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                conn.rollback()
+                raise FatalScriptError(err)
+            else:
+                conn.commit()
+
+    def get_month_range(self, month):
+        """Return dates passed to `create_parts` for the month, the selected dates clipped to the month.
+
+        The last month keeps `--to-date` as given, so its first day still stands for the whole month of weekly and
+        daily partitions.
+        """
+        date_from = max(self.args.date_from, month)
+        if add_months(self.args.date_to, 0) == month:
+            return date_from, self.args.date_to
+        return date_from, add_months(month, 1) - timedelta(days=1)
+
+    def create_month(self, conn, month):
+        """Create database partitions for the month without indexes not backing a constraint.
+
+        Statements creating the indexes are recorded in the journal before the transaction is committed, so they
+        are not lost if the run is interrupted before the indexes are built.
+
+        :param date month: the first day of the month
+        :return: list of statements creating indexes of created partitions
+        """
+        date_from, date_to = self.get_month_range(month)
+        with conn.cursor() as cursor:
+            try:
+                existing = set(get_month_partitions(cursor, month))
+                for sql_func in self.create_parts_sql(cursor, date_from, date_to):
+                    logging.info(sql_func.decode())
+                    cursor.execute(sql_func)
+
+                indexdefs = []
+                for table in get_month_partitions(cursor, month):
+                    if table not in existing:
+                        indexdefs.extend(defer_indexes(cursor, table))
+                if indexdefs:
+                    self.start_step(self._month_step(month), indexdefs=indexdefs)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                conn.rollback()
+                raise FatalScriptError(err)
+            else:
+                conn.commit()
+                return indexdefs
+
+    @staticmethod
+    def _month_step(month):
+        return 'create:' + month.isoformat()
+
+    def create_index(self, conn, indexdef):
+        """Build the index, the statement recorded by an interrupted run may have been committed already."""
+        step = 'index:' + indexdef
+        if self.step_state(step) == STARTED:
+            indexdef = if_not_exists(indexdef)
+        self.run_step(step, lambda: execute_statement(conn, indexdef))
+
+    def execute_chunked(self):
+        """Create database partitions month by month, build their indexes concurrently.
+
+        With a journal, months created by an interrupted run are skipped, but indexes they deferred are built.
+        """
+        indexdefs = []
+        month = add_months(self.args.date_from, 0)
+        with self.connect_db() as conn:
+            while month <= self.args.date_to:
+                step = self._month_step(month)
+                # Statements recorded by an interrupted run, its transaction may have been committed
+                recorded = self.journal.data(step).get('indexdefs', []) if self.journal is not None else []
+                if self.step_state(step) == DONE:
+                    logging.info("Partitions of %s created by a previous run", month.strftime("%Y-%m"))
+                    indexdefs.extend(recorded)
                 else:
-                    conn.commit()
+                    created = retry_canceled(conn, lambda: self.create_month(conn, month), self.args.cancel_retries,
+                                             self.args.cancel_backoff)
+                    indexdefs.extend(created + [indexdef for indexdef in recorded if indexdef not in created])
+                    self.finish_step(step)
+                month = add_months(month, 1)
+
+        pool = ConnectionPool(self.connect_db, max(1, self.args.workers))
+        try:
+            results = run_on_pool(pool, self.create_index, indexdefs)
+        finally:
+            pool.closeall()
+
+        failed = [indexdef for indexdef, error in results.items() if error is not None]
+        if failed:
+            message = "Creating indexes failed: " + "; ".join(failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Daemon for scheduled partition maintenance.
+
+Keeps a connection to logger database open and runs create and drop jobs from `schedule` section
+of the configuration file according to their calendar rules and quiet hours. Partitions are created
+and dropped according to retention policies, as by `maintain_parts.py`.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import json
+import logging
+import signal
+import sys
+from datetime import date, datetime
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import ConfigError, FatalScriptError
+from logger_maintenance.retention import plan_retention
+from logger_maintenance.scheduler import PersistentConnection, Scheduler, parse_schedule
+from maintain_parts import MaintainPartsScript
+
+
+class DaemonPartsScript(MaintainPartsScript):
+    """Script class for scheduled partition maintenance."""
+
+    stopping = False
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "--state-file", dest="state_filename",
+            help="file keeping state of jobs between restarts, readable by monitoring"
+        )
+        parser.add_argument(
+            "--tick", type=float, default=30,
+            help="interval in seconds between checks of the schedule (default 30)"
+        )
+        parser.add_argument(
+            "--once", action='store_true',
+            help="check the schedule once and exit"
+        )
+        parser.add_argument(
+            "--status", action='store_true',
+            help="print state of jobs from --state-file and exit"
+        )
+        self.args = parser.parse_args(args)
+        if self.args.status and self.args.state_filename is None:
+            logging.error("--status requires --state-file")
+            raise FatalScriptError(ValueError)
+
+    def read_config(self, config_filename=None):
+        """Read configuration including the schedule."""
+        config = super(DaemonPartsScript, self).read_config(config_filename)
+        try:
+            self.schedule = parse_schedule(config.get("schedule"))
+        except ConfigError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        return config
+
+    def run_job(self, conn, job):
+        """Run actions of the retention plan matching the job."""
+        try:
+            partitions = get_partitions(conn)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            if not conn.closed:
+                conn.rollback()
+            raise FatalScriptError(err)
+        self.set_submonthly_services(partitions)
+        for action in plan_retention(partitions, self.retention, date.today(), self.granularity):
+            if action.kind != job.action or (job.services is not None and action.service not in job.services):
+                continue
+            logging.info("Job %s: %s", job.name, self.describe_action(action))
+            self.run_action(conn, action)
+
+    def stop(self, signum, frame):
+        """Stop the daemon after the running job."""
+        logging.info("Signal %d received, stopping", signum)
+        self.stopping = True
+
+    def print_status(self):
+        """Print state of jobs from the state file."""
+        try:
+            with open(self.args.state_filename) as fstate:
+                print(json.dumps(json.load(fstate), indent=4))
+        except (OSError, ValueError) as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+    def execute(self):
+        """Run scheduled jobs until stopped by SIGTERM or SIGINT."""
+        if self.args.status:
+            self.print_status()
+            return
+        self.check_granularity()
+
+        connection = PersistentConnection(self.connect_db, self.schedule.health_interval)
+        scheduler = Scheduler(self.schedule, self.run_job, connection, self.args.state_filename)
+        if self.args.once:
+            scheduler.check(datetime.now().replace(microsecond=0))
+            connection.close()
+            return
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logging.info("Scheduler started with jobs: %s", ", ".join(job.name for job in self.schedule.jobs))
+        scheduler.run(lambda: self.stopping, self.args.tick)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        script = DaemonPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
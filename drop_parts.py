@@ -27,16 +27,30 @@ Run with -h option to print all available options.
 import argparse
 import logging
 import sys
+from collections import OrderedDict
 from datetime import date
 
 from psycopg2 import DatabaseError
 
-from logger_maintenance.common import DateAction, FatalScriptError, LoggerMaintenanceScript, add_months
+from logger_maintenance.archive import ARCHIVE_FORMAT, COLUMNAR_FORMAT, archive_tables, get_archive_path, \
+    get_drop_tables
+from logger_maintenance.common import ConfigError, ConnectionPool, DateAction, FatalScriptError, \
+    LoggerMaintenanceScript, add_journal_arguments, add_metrics_arguments, add_months, add_watchdog_arguments, \
+    drop_parts_sql, execute_short_transaction, get_granularity, instrumented, retry_canceled, run_on_pool
+from logger_maintenance.detach import DetachedTablesDropper, detach_table, get_detached_tables
+from logger_maintenance.journal import DONE
+from logger_maintenance.merge import get_merged_drops, merged_tables_query
+from logger_maintenance.rollup import create_rollup_table, get_rollup_tables, parse_rollup, rollup_tables
+
+# Values of --archive-format
+ARCHIVE_FORMATS = {'copy': ARCHIVE_FORMAT, 'columnar': COLUMNAR_FORMAT}
 
 
 class DropPartsScript(LoggerMaintenanceScript):
     """Script class for deleting old service logs."""
 
+    dropper = None
+
     def process_args(self, args):
         """Set up long opts and their default values."""
         parser = argparse.ArgumentParser()
@@ -45,22 +59,78 @@ class DropPartsScript(LoggerMaintenanceScript):
             help="json config file"
         )
         parser.add_argument(
-            "-s", "--service",
-            help="service name (i.e. `mojeid`)"
+            "-s", "--service", nargs='+',
+            help="service names (i.e. `mojeid`) or `all` for all services"
         )
         parser.add_argument(
             "-d", "--from-date", dest="date_from", action=DateAction,
-            help="YYYY-MM date of log partition to be deleted (or the first one to be deleted, "
+            help="YYYY-MM or YYYY-MM-DD date of log partition to be deleted (or the first one to be deleted, "
                  "if --date_to is supplied)",
         )
         parser.add_argument(
             "--to-date", dest="date_to", action=DateAction,
-            help="YYYY-MM date of last log partition to be deleted"
+            help="YYYY-MM or YYYY-MM-DD date of last log partition to be deleted, month stands for all its days "
+                 "of weekly and daily partitions"
         )
         parser.add_argument(
             "--dry-run", dest="dry_run", action='store_true',
             help="Just echo the SQL commands to be executed"
         )
+        parser.add_argument(
+            "--per-partition", dest="per_partition", action='store_true',
+            help="Drop each partition in its own short transaction"
+        )
+        parser.add_argument(
+            "--lock-timeout", dest="lock_timeout", type=int, default=1000,
+            help="lock timeout in milliseconds for each transaction (only with --per-partition or --detach, "
+                 "default 1000)"
+        )
+        parser.add_argument(
+            "--retries", type=int, default=5,
+            help="how many times a statement is retried after lock timeout (only with --per-partition or --detach, "
+                 "default 5)"
+        )
+        parser.add_argument(
+            "--backoff", type=float, default=0.5,
+            help="base delay in seconds of exponential backoff between retries (only with --per-partition or "
+                 "--detach, default 0.5)"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="maximal number of services processed concurrently (default 4)"
+        )
+        parser.add_argument(
+            "--archive-dir", dest="archive_dir",
+            help="archive partitions into the directory before they are dropped"
+        )
+        parser.add_argument(
+            "--archive-format", dest="archive_format", choices=sorted(ARCHIVE_FORMATS), default='copy',
+            help="format of archives, `columnar` archives can be queried by query_archives.py (default copy)"
+        )
+        parser.add_argument(
+            "--archive-workers", dest="archive_workers", type=int, default=2,
+            help="maximal number of partitions of a service archived concurrently (default 2)"
+        )
+        parser.add_argument(
+            "--rollup", action='store_true',
+            help="store aggregates of partitions into the summary table configured in `rollup` section "
+                 "before they are dropped"
+        )
+        parser.add_argument(
+            "--rollup-workers", dest="rollup_workers", type=int, default=2,
+            help="maximal number of partitions of a service rolled up concurrently (default 2)"
+        )
+        parser.add_argument(
+            "--detach", action='store_true',
+            help="Detach partitions from their parents first, drop them in background"
+        )
+        parser.add_argument(
+            "--drop-delay", dest="drop_delay", type=float, default=1.0,
+            help="delay in seconds after each dropped detached table (only with --detach, default 1)"
+        )
+        add_metrics_arguments(parser)
+        add_watchdog_arguments(parser)
+        add_journal_arguments(parser)
         self.args = parser.parse_args(args)
         self._set_default_args()
 
@@ -68,6 +138,7 @@ class DropPartsScript(LoggerMaintenanceScript):
         """Set default values in case that command line arguments are not supplied."""
         # If --from-date not set, substract 6 months from the current date
         if self.args.date_from is None:
+            self.passed_dates = {'date_from': None, 'date_to': self.args.date_to}
             self.args.date_from = add_months(date.today(), -6)
 
         # If --to-date not set, let it be equal to --from-date
@@ -78,63 +149,309 @@ class DropPartsScript(LoggerMaintenanceScript):
         if self.args.date_to < self.args.date_from:
             self.args.date_to = self.args.date_from
 
+    def read_config(self, config_filename=None):
+        """Read configuration including the rollup."""
+        config = super(DropPartsScript, self).read_config(config_filename)
+        try:
+            self.rollup = parse_rollup(config.get("rollup", {}))
+        except ConfigError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        return config
+
+    def get_services(self, conn):
+        """Return list of (name, description) of available services."""
+        with conn.cursor() as cursor:
+            try:
+                # NOTE: The `service` table was not originally designed for providing list of
+                # services and may change in the future. We need to strip trailing underscore
+                # from the `partition_postfix` column.
+                cursor.execute(
+                    "SELECT trim(trailing '_' from partition_postfix), name FROM service ORDER BY id"
+                )
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                conn.rollback()
+                raise FatalScriptError(err)
+            else:
+                return cursor.fetchall()
+
     def list_services(self):
         """List available services."""
         with self.connect_db() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    # NOTE: The `service` table was not originally designed for providing list of
-                    # services and may change in the future. We need to strip trailing underscore
-                    # from the `partition_postfix` column.
-                    cursor.execute(
-                        "SELECT trim(trailing '_' from partition_postfix), name FROM service ORDER BY id"
-                    )
-                except DatabaseError as err:
-                    logging.error("DatabaseError: " + str(err))
-                    conn.rollback()
-                    raise FatalScriptError(err)
-                else:
-                    print("You have to pass -s/--service argument. Available choices:")
-                    services = cursor.fetchall()
-                    for name, description in services:
-                        print("  {:15}{}".format(name, description))
+            services = self.get_services(conn)
+        print("You have to pass -s/--service argument. Available choices:")
+        for name, description in services:
+            print("  {:15}{}".format(name, description))
+
+    def resolve_services(self):
+        """Return list of selected services, expand `all` to all available services."""
+        services = []
+        for service in self.args.service:
+            if service == 'all':
+                with self.connect_db() as conn:
+                    services.extend(name for name, _ in self.get_services(conn))
+            else:
+                services.append(service)
+        # Remove duplicates, keep order
+        return list(OrderedDict.fromkeys(services))
 
+    @instrumented('drop_parts')
     def execute(self):
-        """Drop database partitions."""
+        """Drop database partitions of all selected services."""
         if self.args.dry_run:
             logging.info("=== DRY-RUN ===")
 
-        with self.connect_db() as conn:
-            with conn.cursor() as cursor:
-                try:
-                    sql = cursor.mogrify(
-                        "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s)",
-                        {
-                            'from': self.args.date_from.strftime("%Y-%m-01"),
-                            'to': self.args.date_to.strftime("%Y-%m-01"),
-                            'service': self.args.service,
-                            'dry_run': self.args.dry_run
-                        }
-                    )
-                    logging.info(sql.decode())
-                    cursor.execute(sql)
-
-                except DatabaseError as err:
-                    logging.error("DatabaseError: " + str(err))
+        self.check_granularity()
+        services = self.resolve_services()
+        if self.args.rollup and not self.args.dry_run:
+            self.create_rollup_table()
+        if self.args.detach and not self.args.dry_run:
+            self.start_dropper()
+        try:
+            self.drop_services(services)
+        finally:
+            if self.dropper is not None:
+                self.finish_dropper()
+
+    def drop_services(self, services):
+        """Drop database partitions of the services, concurrently if there are more of them."""
+        if len(services) == 1:
+            with self.connect_db() as conn:
+                self.drop_service(conn, services[0])
+            return
+
+        pool = ConnectionPool(self.connect_db, max(1, min(self.args.workers, len(services))))
+        try:
+            results = run_on_pool(pool, self.drop_service, services)
+        finally:
+            pool.closeall()
+
+        failed = [service for service, error in results.items() if error is not None]
+        for service, error in results.items():
+            logging.info("%-15s %s", service, "FAILED" if error is not None else "OK")
+        if failed:
+            message = "Dropping partitions failed for services: " + ", ".join(failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+    def drop_service(self, conn, service):
+        """Drop database partitions of the service."""
+        if self.args.rollup:
+            self.rollup_service(conn, service)
+        if self.args.archive_dir is not None:
+            self.archive_service(conn, service)
+
+        if self.args.detach and not self.args.dry_run:
+            self.drop_service_detach(conn, service)
+            return
+        if self.args.per_partition:
+            self.drop_service_per_partition(conn, service)
+            return
+        self.run_step('drop:' + service, lambda: retry_canceled(
+            conn, lambda: self.drop_service_single(conn, service), self.args.cancel_retries, self.args.cancel_backoff))
+
+    def drop_service_single(self, conn, service):
+        """Drop database partitions of the service in a single transaction."""
+        with conn.cursor() as cursor:
+            try:
+                merged = self._get_merged_drops(cursor, service)
+                sql = self._drop_parts_sql(cursor, service, self.args.dry_run)
+                logging.info(sql.decode())
+                cursor.execute(sql)
+                queries = [query for (query,) in cursor.fetchall()] + merged
+                if not self.args.dry_run:
+                    for query in merged:
+                        cursor.execute(query)
+
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                conn.rollback()
+                raise FatalScriptError(err)
+            else:
+                if queries:
+                    for query in queries:
+                        logging.info(query)
+                else:
+                    logging.info("No such partitions")
+
+                if self.args.dry_run:
                     conn.rollback()
-                    raise FatalScriptError(err)
                 else:
-                    queries = cursor.fetchall()
-                    if queries:
-                        for (query,) in queries:
-                            logging.info(query)
-                    else:
-                        logging.info("No such partitions")
-
-                    if self.args.dry_run:
-                        conn.rollback()
-                    else:
-                        conn.commit()
+                    conn.commit()
+
+    def _drop_parts_sql(self, cursor, service, dry_run):
+        """Return `drop_parts` call for the service and selected dates."""
+        return drop_parts_sql(cursor, self.args.date_from, self.args.date_to, service, dry_run,
+                              get_granularity(self.granularity, service))
+
+    def _get_merged_drops(self, cursor, service):
+        """Return statements dropping merged partitions of the service, `drop_parts` leaves them out."""
+        cursor.execute(*merged_tables_query(service))
+        return get_merged_drops(cursor.fetchall(), service, self.args.date_from, self.args.date_to,
+                                get_granularity(self.granularity, service))
+
+    def get_drop_statements(self, conn, service):
+        """Return list of statements which `drop_parts` would execute for the service and dropping merged ones."""
+        with conn.cursor() as cursor:
+            try:
+                sql = self._drop_parts_sql(cursor, service, True)
+                logging.info(sql.decode())
+                cursor.execute(sql)
+                queries = [query for (query, ) in cursor.fetchall() if query]
+                return queries + self._get_merged_drops(cursor, service)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+            finally:
+                conn.rollback()
+
+    def create_rollup_table(self):
+        """Create the rollup summary table before services are processed concurrently."""
+        with self.connect_db() as conn:
+            try:
+                create_rollup_table(conn, self.rollup)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                conn.rollback()
+                raise FatalScriptError(err)
+
+    def rollup_service(self, conn, service):
+        """Store aggregates of database partitions of the service which are to be dropped.
+
+        :raises FatalScriptError: if any of the partitions is not rolled up
+        """
+        tables = get_rollup_tables(self.rollup, get_drop_tables(self.get_drop_statements(conn, service)), service)
+        tables = self._pending_tables('rollup', tables)
+        if self.args.dry_run:
+            for table in tables:
+                logging.info("Roll up %s into %s", table, self.rollup.table)
+            return
+        if not tables:
+            return
+
+        pool = ConnectionPool(self.connect_db, max(1, min(self.args.rollup_workers, len(tables))))
+        try:
+            results = rollup_tables(pool, self.rollup, tables)
+        finally:
+            pool.closeall()
+        self._finish_tables('rollup', results)
+
+        failed = [table for table, error in results.items() if error is not None]
+        if failed:
+            message = "Rollup failed for tables: {}, partitions of service {} not dropped".format(
+                ", ".join(failed), service)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+    def archive_service(self, conn, service):
+        """Archive database partitions of the service which are to be dropped.
+
+        :raises FatalScriptError: if any of the partitions is not archived and verified
+        """
+        tables = self._pending_tables('archive', get_drop_tables(self.get_drop_statements(conn, service)))
+        if self.args.dry_run:
+            for table in tables:
+                logging.info("Archive %s to %s", table, get_archive_path(
+                    self.args.archive_dir, table, ARCHIVE_FORMATS[self.args.archive_format]))
+            return
+
+        pool = ConnectionPool(self.connect_db, max(1, min(self.args.archive_workers, len(tables))))
+        try:
+            results = archive_tables(pool, tables, self.args.archive_dir,
+                                     archive_format=ARCHIVE_FORMATS[self.args.archive_format])
+        finally:
+            pool.closeall()
+        self._finish_tables('archive', results)
+
+        failed = [table for table, error in results.items() if error is not None]
+        if failed:
+            message = "Archiving failed for tables: {}, partitions of service {} not dropped".format(
+                ", ".join(failed), service)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+    def _pending_tables(self, action, tables):
+        """Return tables whose action was not done by an interrupted run."""
+        pending = []
+        for table in tables:
+            if self.step_state(action + ':' + table) == DONE:
+                logging.info("Step %s:%s done by a previous run, skipped", action, table)
+            else:
+                pending.append(table)
+        return pending
+
+    def _finish_tables(self, action, results):
+        """Record successful actions in the journal, so a rerun after a failure does not repeat them."""
+        for table, error in results.items():
+            if error is None:
+                self.finish_step(action + ':' + table)
+
+    def start_dropper(self):
+        """Start background thread dropping detached tables, schedule tables left by previous runs."""
+        with self.connect_db() as conn:
+            try:
+                tables = get_detached_tables(conn)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+        self.dropper = DetachedTablesDropper(self.connect_db, self.args.drop_delay)
+        self.dropper.start()
+        for table in tables:
+            logging.info("Table %s detached by previous run", table)
+            self.dropper.add(table)
+
+    def finish_dropper(self):
+        """Wait until all detached tables are dropped."""
+        logging.info("Waiting for detached tables to be dropped")
+        self.dropper.finish()
+        if self.dropper.failed:
+            message = "Dropping detached tables failed: " + ", ".join(self.dropper.failed)
+            logging.error(message)
+            raise FatalScriptError(None, message)
+
+    def drop_service_detach(self, conn, service):
+        """Detach database partitions of the service, schedule them to be dropped in background."""
+        tables = get_drop_tables(self.get_drop_statements(conn, service))
+        if not tables:
+            logging.info("No such partitions")
+        for table in tables:
+            self.run_step('detach:' + table, lambda: self.detach_table(conn, table))
+
+    def detach_table(self, conn, table):
+        """Detach the table from its parents, schedule it to be dropped in background."""
+        try:
+            wait, hold = detach_table(conn, table, self.args.lock_timeout, self.args.retries, self.args.backoff)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        logging.info("Detached %s (lock wait %.3f s, hold %.3f s)", table, wait, hold)
+        self.dropper.add(table)
+
+    def drop_service_per_partition(self, conn, service):
+        """Drop database partitions of the service, each statement in its own short transaction.
+
+        Dry run only prints the statements with their transactions.
+        """
+        queries = self.get_drop_statements(conn, service)
+        if not queries:
+            logging.info("No such partitions")
+        for query in queries:
+            if self.args.dry_run:
+                logging.info("Plan: %s in its own transaction (lock timeout %d ms, %d retries)", query,
+                             self.args.lock_timeout, self.args.retries)
+                continue
+            self.run_step('drop:' + query, lambda: self.execute_drop(conn, query))
+
+    def execute_drop(self, conn, query):
+        """Execute the drop statement in a short transaction."""
+        try:
+            wait, hold = execute_short_transaction(
+                conn, query, self.args.lock_timeout, self.args.retries, self.args.backoff)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        logging.info("%s (lock wait %.3f s, hold %.3f s)", query, wait, hold)
 
 
 if __name__ == "__main__":
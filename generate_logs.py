@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for generating synthetic logger data.
+
+Fills partitions of logger database with synthetic requests, their data, properties and sessions for testing
+of maintenance scripts at realistic volumes. Data are loaded by COPY from several worker processes.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import multiprocessing
+import sys
+import time
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.common import DateAction, FatalScriptError, LoggerMaintenanceScript, add_months, \
+    create_parts_sql
+from logger_maintenance.generator import Options, count_sessions, generate_units, plan_units, reserve_ids, split_counts
+
+
+def weighted(value):
+    """Convert NAME[=WEIGHT] string to (name, weight) tuple."""
+    name, _, weight = value.partition('=')
+    try:
+        weight = float(weight) if weight else 1.0
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid weight: {}".format(value))
+    if weight < 0:
+        raise argparse.ArgumentTypeError("negative weight: {}".format(value))
+    return name, weight
+
+
+class GenerateLogsScript(LoggerMaintenanceScript):
+    """Script class for generating synthetic logger data."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-n", "--requests", type=int, required=True,
+            help="total number of generated requests"
+        )
+        parser.add_argument(
+            "-d", "--from-date", dest="date_from", action=DateAction, required=True,
+            help="YYYY-MM date of the first filled partition"
+        )
+        parser.add_argument(
+            "--to-date", dest="date_to", action=DateAction,
+            help="YYYY-MM date of the last filled partition"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+', type=weighted,
+            help="services with optional relative weights (i.e. `mojeid=1 epp=4`), all services equally by default"
+        )
+        parser.add_argument(
+            "--month-weights", dest="month_weights", nargs='+', type=float,
+            help="relative weights of months from --from-date to --to-date, uniform by default"
+        )
+        parser.add_argument(
+            "--payload-size", dest="payload_size", type=int, default=2000,
+            help="mean size of request and response data in bytes (default 2000)"
+        )
+        parser.add_argument(
+            "--properties", type=int, default=4,
+            help="number of properties of each request (default 4)"
+        )
+        parser.add_argument(
+            "--session-size", dest="session_size", type=int, default=10,
+            help="number of consecutive requests sharing a session, 0 for requests without sessions (default 10)"
+        )
+        parser.add_argument(
+            "--rate", type=float,
+            help="maximal number of generated rows of all tables per second, unlimited by default"
+        )
+        parser.add_argument(
+            "--chunk-size", dest="chunk_size", type=int, default=100000,
+            help="maximal number of requests loaded in a single transaction (default 100000)"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="number of worker processes (default 4)"
+        )
+        parser.add_argument(
+            "--create-parts", dest="create_parts", action='store_true',
+            help="create partitions before loading"
+        )
+        self.args = parser.parse_args(args)
+        self._set_default_args()
+
+    def _set_default_args(self):
+        """Set default values in case that command line arguments are not supplied."""
+        if self.args.date_to is None:
+            self.args.date_to = self.args.date_from
+
+        if self.args.date_to < self.args.date_from:
+            logging.error("--to-date cannot preceed --from-date")
+            raise FatalScriptError(ValueError)
+
+        self.months = []
+        month = self.args.date_from
+        while month <= self.args.date_to:
+            self.months.append(month)
+            month = add_months(month, 1)
+        if self.args.month_weights is None:
+            self.args.month_weights = [1.0] * len(self.months)
+        if len(self.args.month_weights) != len(self.months):
+            logging.error("--month-weights requires %d weights", len(self.months))
+            raise FatalScriptError(ValueError)
+
+        if self.args.requests < 0 or self.args.payload_size < 1 or self.args.properties < 0 \
+                or self.args.session_size < 0 or self.args.chunk_size < 1 or self.args.workers < 1:
+            logging.error("Numeric options must be positive")
+            raise FatalScriptError(ValueError)
+
+    def get_metadata(self, cursor):
+        """Return services, request types and property names from the database.
+
+        :return: tuple (list of (service_id, postfix, weight), request types by service, property name ids)
+        """
+        cursor.execute("SELECT id, partition_postfix FROM service ORDER BY id")
+        services = cursor.fetchall()
+        if self.args.service is None:
+            selected = [(service_id, postfix, 1.0) for service_id, postfix in services]
+        else:
+            postfixes = {postfix.rstrip('_'): (service_id, postfix) for service_id, postfix in services}
+            unknown = [name for name, _ in self.args.service if name not in postfixes]
+            if unknown:
+                logging.error("Unknown services: %s", ", ".join(unknown))
+                raise FatalScriptError(ValueError)
+            selected = [postfixes[name] + (weight, ) for name, weight in self.args.service]
+
+        cursor.execute("SELECT service_id, id FROM request_type ORDER BY service_id, id")
+        request_types = {}
+        for service_id, type_id in cursor.fetchall():
+            request_types.setdefault(service_id, []).append(type_id)
+
+        cursor.execute("SELECT id FROM request_property_name ORDER BY id")
+        property_names = [name_id for (name_id, ) in cursor.fetchall()]
+        if self.args.properties and not property_names:
+            logging.warning("No request property names defined, properties are not generated")
+        return selected, request_types, property_names
+
+    def prepare(self):
+        """Read metadata, create partitions and reserve ids.
+
+        :return: tuple (list of units, options)
+        """
+        with self.connect_db() as conn:
+            with conn.cursor() as cursor:
+                try:
+                    services, request_types, property_names = self.get_metadata(cursor)
+                    if self.args.create_parts:
+                        sql = create_parts_sql(cursor, self.args.date_from, self.args.date_to)
+                        logging.info(sql.decode())
+                        cursor.execute(sql)
+
+                    counts = []
+                    for month, month_count in split_counts(self.args.requests,
+                                                           list(zip(self.months, self.args.month_weights))):
+                        weights = [((service_id, postfix, month), weight) for service_id, postfix, weight in services]
+                        counts.extend(split_counts(month_count, weights))
+                    properties = self.args.properties if property_names else 0
+                    first_id = reserve_ids(cursor, 'request', self.args.requests)
+                    first_property_id = 0
+                    if properties:
+                        first_property_id = reserve_ids(cursor, 'request_property_value',
+                                                        self.args.requests * properties)
+                    sessions = sum(count_sessions(0, count, self.args.session_size) for _, count in counts)
+                    first_session_id = reserve_ids(cursor, 'session', sessions) if sessions else 0
+                except DatabaseError as err:
+                    logging.error("DatabaseError: " + str(err))
+                    conn.rollback()
+                    raise FatalScriptError(err)
+                conn.commit()
+
+        rate = self.args.rate / self.args.workers if self.args.rate else None
+        options = Options(self.args.payload_size, properties, request_types, property_names, rate,
+                          self.args.session_size)
+        units = plan_units([item for item in counts if item[1]], first_id, first_property_id, properties,
+                           self.args.chunk_size, first_session_id, self.args.session_size)
+        return units, options
+
+    def execute(self):
+        """Generate synthetic logger data."""
+        if not self.args.requests:
+            logging.info("Nothing to do")
+            return
+        units, options = self.prepare()
+        workers = max(1, min(self.args.workers, len(units)))
+        logging.info("Generating %d requests in %d units by %d workers", self.args.requests, len(units), workers)
+
+        start = time.monotonic()
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.starmap(
+                generate_units, [(self.connect_db, units[worker::workers], options) for worker in range(workers)])
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        finally:
+            pool.terminate()
+            pool.join()
+        elapsed = time.monotonic() - start
+
+        totals = {}
+        for counts in results:
+            for table, rows in counts.items():
+                totals[table] = totals.get(table, 0) + rows
+        for table, rows in sorted(totals.items()):
+            logging.info("%s: %d rows", table, rows)
+        rows = sum(totals.values())
+        logging.info("Loaded %d rows in %.1f s (%.0f rows/s)", rows, elapsed, rows / elapsed if elapsed else 0)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = GenerateLogsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
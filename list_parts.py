@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for listing db partitions.
+
+Lists partitions in logger database with their sizes, row estimates and last vacuum and analyze.
+Reports months missing among existing partitions.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import json
+import logging
+import sys
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.catalog import find_missing, get_partitions_cached, partition_to_dict
+from logger_maintenance.common import FatalScriptError, LoggerMaintenanceScript
+
+
+def format_size(size):
+    """Return human readable size."""
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(size) < 1024:
+            return "{:.0f} {}".format(size, unit)
+        size /= 1024
+    return "{:.0f} TB".format(size)
+
+
+class ListPartsScript(LoggerMaintenanceScript):
+    """Script class for listing db partitions."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-s", "--service",
+            help="list only partitions of the service (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "-f", "--format", choices=('table', 'json'), default='table',
+            help="output format (default table)"
+        )
+        parser.add_argument(
+            "--cache", dest="cache_filename",
+            help="snapshot file, catalog is not read if the snapshot is not older than --max-age"
+        )
+        parser.add_argument(
+            "--max-age", dest="max_age", type=float, default=300,
+            help="maximal age of the snapshot in seconds (default 300)"
+        )
+        self.args = parser.parse_args(args)
+
+    def get_partitions(self):
+        """Return list of partitions, from snapshot if possible."""
+        try:
+            partitions = get_partitions_cached(self.connect_db, self.args.cache_filename, self.args.max_age)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except OSError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        if self.args.service is not None:
+            partitions = [part for part in partitions if part.service == self.args.service]
+        return partitions
+
+    def execute(self):
+        """List database partitions."""
+        partitions = self.get_partitions()
+        missing = find_missing(partitions, self.granularity)
+
+        if self.args.format == 'json':
+            json.dump({
+                'partitions': [partition_to_dict(part) for part in partitions],
+                'missing': [
+                    {'parent': parent, 'service': service, 'month': month.isoformat()}
+                    for parent, service, month in missing
+                ],
+            }, sys.stdout, indent=4)
+            print()
+            return
+
+        row_format = "{:40} {:10} {:7} {:>10} {:>10} {:>12}  {:25} {:25}"
+        print(row_format.format("table", "service", "month", "size", "indexes", "rows", "last vacuum", "last analyze"))
+        for part in partitions:
+            print(row_format.format(
+                part.table, part.service, part.month.strftime("%Y-%m"), format_size(part.size),
+                format_size(part.index_size), part.rows, part.last_vacuum or "-", part.last_analyze or "-"))
+        if missing:
+            print()
+            print("Missing partitions:")
+            for parent, service, month in missing:
+                print("  {:25} {:10} {}".format(parent, service, month.strftime("%Y-%m")))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = ListPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
@@ -0,0 +1,491 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for archiving logger partitions to compressed files.
+
+Every partition is streamed by `COPY ... TO STDOUT` into a gzip compressed file `<table>.copy.gz` or into
+a columnar file `<table>.col` (see `columnar`), which can be queried without loading it into a database.
+Metadata (row count, checksum, size and columns) are stored in `<table>.copy.gz.json` or `<table>.col.json` once
+the archive is verified. Verified archives are recorded in the manifest of the directory (see `manifest`).
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import zlib
+
+from psycopg2 import DatabaseError, sql
+
+from logger_maintenance.catalog import defer_indexes, get_table_month, get_table_service
+from logger_maintenance.columnar import NULL, ColumnarError, ColumnarFile, ColumnarReader, ColumnarWriter
+from logger_maintenance.common import FatalScriptError, run_on_pool
+from logger_maintenance.compact import TIME_COLUMNS
+from logger_maintenance.manifest import BloomFilter, load_manifest, update_manifest
+
+# Size of chunks in which data are compressed and read (in bytes)
+CHUNK_SIZE = 1024 * 1024
+ARCHIVE_SUFFIX = '.copy.gz'
+META_SUFFIX = '.json'
+ARCHIVE_FORMAT = 'copy-text+gzip'
+COLUMNAR_SUFFIX = '.col'
+COLUMNAR_FORMAT = 'columnar+zlib'
+ARCHIVE_SUFFIXES = {ARCHIVE_FORMAT: ARCHIVE_SUFFIX, COLUMNAR_FORMAT: COLUMNAR_SUFFIX}
+# Window bits for gzip container in zlib
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Columns with request ids indexed by bloom filters of the manifest
+REQUEST_ID_COLUMNS = {
+    'request': 'id',
+    'request_data': 'request_id',
+    'request_property_value': 'request_id',
+}
+
+# Schema of a qualified name is skipped
+DROP_TABLE_RE = re.compile(r'\bDROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:"?\w+"?\.)?"?(\w+)"?', re.IGNORECASE)
+
+
+class ArchiveError(Exception):
+    """Raised when archive does not match the archived data."""
+
+    def __init__(self, message):
+        """Initialize error message."""
+        self.message = message
+
+    def __str__(self):
+        """Return error message."""
+        return self.message
+
+
+class ArchiveWriter(object):
+    """File-like object compressing written data in fixed-size chunks.
+
+    Counts rows and computes checksum of the compressed data on the fly.
+    """
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        """Initialize writer.
+
+        :param fileobj: binary file object to write compressed data to
+        :param int chunk_size: size of chunks to be compressed
+        """
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, GZIP_WBITS)
+
+    def write(self, data):
+        """Write data, each row has to be terminated by a newline."""
+        if isinstance(data, str):
+            data = data.encode()
+        self.rows += data.count(b'\n')
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._output(self._compressor.compress(bytes(self._buffer[:self.chunk_size])))
+            del self._buffer[:self.chunk_size]
+
+    def close(self):
+        """Compress remaining data and finish the compressed stream."""
+        self._output(self._compressor.compress(bytes(self._buffer)))
+        self._output(self._compressor.flush())
+        self._buffer = bytearray()
+
+    def _output(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+
+class ArchiveReader(object):
+    """File-like object decompressing archive file in chunks.
+
+    Counts rows and computes checksum of the compressed data on the fly.
+    """
+
+    def __init__(self, fileobj, chunk_size=CHUNK_SIZE):
+        """Initialize reader.
+
+        :param fileobj: binary file object to read compressed data from
+        :param int chunk_size: size of chunks to be read
+        """
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._tail = b''
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    def read(self, size=-1):
+        """Return at most `size` bytes of decompressed data, empty bytes at the end of archive."""
+        if size is None or size < 0:
+            size = self.chunk_size
+        while True:
+            if not self._tail:
+                self._tail = self.fileobj.read(self.chunk_size)
+                if not self._tail:
+                    return b''
+                self.sha256.update(self._tail)
+                self.size += len(self._tail)
+            data = self._decompressor.decompress(self._tail, size)
+            self._tail = self._decompressor.unconsumed_tail
+            if data:
+                self.rows += data.count(b'\n')
+                return data
+
+    @property
+    def eof(self):
+        """Return whether the end of compressed stream was reached."""
+        return self._decompressor.eof
+
+
+def get_drop_tables(queries):
+    """Return names of tables dropped by the given statements."""
+    tables = []
+    for query in queries:
+        tables.extend(DROP_TABLE_RE.findall(query))
+    return tables
+
+
+def get_archive_path(directory, table, archive_format=ARCHIVE_FORMAT):
+    """Return path of archive file for the table."""
+    return os.path.join(directory, table + ARCHIVE_SUFFIXES[archive_format])
+
+
+def find_archive(directory, table):
+    """Return path of the finished archive file of the table in any format, path of `copy` archive if none."""
+    for archive_format in (COLUMNAR_FORMAT, ARCHIVE_FORMAT):
+        path = get_archive_path(directory, table, archive_format)
+        if os.path.exists(path + META_SUFFIX):
+            return path
+    return get_archive_path(directory, table)
+
+
+def list_archives(directory):
+    """Return list of names of tables with a finished archive in the directory."""
+    tables = set()
+    for name in os.listdir(directory):
+        for suffix in ARCHIVE_SUFFIXES.values():
+            if name.endswith(suffix + META_SUFFIX):
+                tables.add(name[:-len(suffix + META_SUFFIX)])
+    return sorted(tables)
+
+
+def get_table_parent(table):
+    """Return the parent of the partition or None if the partition has no known parent."""
+    parents = [parent for parent in TIME_COLUMNS if table.startswith(parent + '_')]
+    return max(parents, key=len) if parents else None
+
+
+def get_time_column(table):
+    """Return the time column of the partition or None if the partition has none."""
+    return TIME_COLUMNS.get(get_table_parent(table))
+
+
+def read_meta(path):
+    """Return metadata of the archive file or None if archive is not finished."""
+    try:
+        with open(path + META_SUFFIX) as fmeta:
+            return json.load(fmeta)
+    except FileNotFoundError:
+        return None
+
+
+def verify_archive(path, meta, chunk_size=CHUNK_SIZE):
+    """Verify the archive file matches its metadata.
+
+    The file is read (and decompressed) in chunks, so memory usage does not depend on the file size.
+
+    :raises ArchiveError: if checksum, size or number of rows does not match
+    """
+    sha256 = hashlib.sha256()
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    columnar = meta.get('format') == COLUMNAR_FORMAT
+    size = 0
+    rows = 0
+    with open(path, 'rb') as farchive:
+        for chunk in iter(lambda: farchive.read(chunk_size), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+            while chunk and not columnar:
+                rows += decompressor.decompress(chunk, chunk_size).count(b'\n')
+                chunk = decompressor.unconsumed_tail
+    if columnar:
+        try:
+            with ColumnarFile(path) as archive:
+                rows = archive.rows
+        except ColumnarError as err:
+            raise ArchiveError(str(err))
+    elif not decompressor.eof:
+        raise ArchiveError("Archive {} is truncated".format(path))
+    if (size, sha256.hexdigest()) != (meta['size'], meta['sha256']):
+        raise ArchiveError("Checksum of archive {} does not match".format(path))
+    if rows != meta['rows']:
+        raise ArchiveError("Archive {} contains {} rows, expected {}".format(path, rows, meta['rows']))
+
+
+def _fsync_directory(directory):
+    """Flush the directory, so files created or replaced in it survive a crash."""
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def archive_table(conn, table, directory, chunk_size=CHUNK_SIZE, archive_format=ARCHIVE_FORMAT):
+    """Stream the table into an archive file and verify it.
+
+    :param conn: database connection
+    :param str table: name of the table
+    :param str directory: directory for archive files
+    :param int chunk_size: size of chunks to be compressed
+    :param str archive_format: `ARCHIVE_FORMAT` or `COLUMNAR_FORMAT`
+
+    :return: archive metadata
+    :raises ArchiveError: if archive could not be verified
+    """
+    path = get_archive_path(directory, table, archive_format)
+    with open(path, 'wb') as farchive:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT * FROM {} LIMIT 0").format(sql.Identifier(table)))
+            columns = [column[0] for column in cursor.description]
+            if archive_format == COLUMNAR_FORMAT:
+                writer = ColumnarWriter(farchive, columns, get_time_column(table))
+            else:
+                writer = ArchiveWriter(farchive, chunk_size)
+            try:
+                cursor.copy_expert(sql.SQL("COPY {} TO STDOUT").format(sql.Identifier(table)), writer, chunk_size)
+                copied = cursor.rowcount
+                writer.close()
+            except ColumnarError as err:
+                raise ArchiveError("Table {} can not be archived: {}".format(table, err))
+        farchive.flush()
+        os.fsync(farchive.fileno())
+    conn.rollback()
+
+    if copied not in (-1, writer.rows):
+        raise ArchiveError("Table {} copied {} rows, archived {}".format(table, copied, writer.rows))
+    meta = {
+        'table': table,
+        'format': archive_format,
+        'rows': writer.rows,
+        'size': writer.size,
+        'sha256': writer.sha256.hexdigest(),
+        'columns': columns,
+    }
+    verify_archive(path, meta, chunk_size)
+
+    # Metadata are written only for verified archives, atomically; both files are durable before the table is dropped
+    with open(path + META_SUFFIX + '.tmp', 'w') as fmeta:
+        json.dump(meta, fmeta, indent=4, sort_keys=True)
+        fmeta.flush()
+        os.fsync(fmeta.fileno())
+    os.replace(path + META_SUFFIX + '.tmp', path + META_SUFFIX)
+    _fsync_directory(directory)
+    return meta
+
+
+def _iter_values(path, meta, columns, chunk_size=CHUNK_SIZE):
+    """Yield tuples of values of the columns of all rows of the archive in `COPY` text format."""
+    if meta.get('format') == COLUMNAR_FORMAT:
+        with ColumnarFile(path) as archive:
+            for rows in archive.iter_blocks(columns):
+                yield from rows
+        return
+
+    indexes = [meta['columns'].index(column) for column in columns]
+    tail = b''
+    with open(path, 'rb') as farchive:
+        reader = ArchiveReader(farchive, chunk_size)
+        for data in iter(reader.read, b''):
+            lines = (tail + data).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                row = line.split(b'\t')
+                yield tuple(row[index] for index in indexes)
+
+
+def get_manifest_entry(path, meta, chunk_size=CHUNK_SIZE):
+    """Return manifest entry of the verified archive.
+
+    The archive is read once to find the time range of its rows and to fill the bloom filter of request ids.
+    Time range and bloom filter are None if the archive lacks the columns, e.g. `copy` archives written
+    before columns were stored in metadata.
+    """
+    table = meta['table']
+    parent = get_table_parent(table)
+    month = get_table_month(table)
+    entry = {
+        'table': table,
+        'file': os.path.basename(path),
+        'format': meta.get('format', ARCHIVE_FORMAT),
+        'service': get_table_service(table, parent) if parent is not None and month is not None else None,
+        'month': month.isoformat() if month is not None else None,
+        'rows': meta['rows'],
+        'size': meta['size'],
+        'sha256': meta['sha256'],
+        'time_min': None,
+        'time_max': None,
+        'bloom': None,
+    }
+    if meta.get('format') == COLUMNAR_FORMAT:
+        with ColumnarFile(path) as archive:
+            available = archive.columns
+    else:
+        available = meta.get('columns', ())
+    time_column = TIME_COLUMNS.get(parent)
+    id_column = REQUEST_ID_COLUMNS.get(parent)
+    columns = [column for column in (time_column, id_column) if column is not None and column in available]
+    if not columns:
+        return entry
+
+    bloom = BloomFilter.for_capacity(meta['rows']) if id_column in columns else None
+    time_min = time_max = None
+    for row in _iter_values(path, meta, columns, chunk_size):
+        values = dict(zip(columns, row))
+        value = values.get(time_column, NULL)
+        if value != NULL:
+            time_min = value if time_min is None else min(time_min, value)
+            time_max = value if time_max is None else max(time_max, value)
+        if bloom is not None and values[id_column] != NULL:
+            bloom.add(values[id_column].decode())
+    if time_column in columns and time_min is not None:
+        entry['time_min'], entry['time_max'] = time_min.decode(), time_max.decode()
+    if bloom is not None:
+        entry['bloom'] = bloom.to_dict()
+    return entry
+
+
+def sync_manifest(directory, chunk_size=CHUNK_SIZE):
+    """Record finished archives missing in the manifest or changed since, forget removed archives.
+
+    :return: number of recorded archives
+    """
+    manifest = load_manifest(directory)
+    tables = list_archives(directory)
+    entries = []
+    for table in tables:
+        path = find_archive(directory, table)
+        meta = read_meta(path)
+        if table not in manifest or manifest[table]['sha256'] != meta['sha256']:
+            entries.append(get_manifest_entry(path, meta, chunk_size))
+    removed = set(manifest) - set(tables)
+    if entries or removed:
+        update_manifest(directory, entries, removed)
+    return len(entries)
+
+
+def archive_tables(pool, tables, directory, chunk_size=CHUNK_SIZE, archive_format=ARCHIVE_FORMAT):
+    """Archive tables concurrently, each table using its own connection from the pool.
+
+    Every verified archive is recorded in the manifest of the directory as soon as it is finished.
+
+    :return: ordered dictionary mapping tables to FatalScriptError or None
+    """
+    def archive(conn, table):
+        try:
+            meta = archive_table(conn, table, directory, chunk_size, archive_format)
+            path = get_archive_path(directory, table, archive_format)
+            update_manifest(directory, [get_manifest_entry(path, meta, chunk_size)])
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except (OSError, ArchiveError, ColumnarError) as err:
+            logging.error("Archive of %s failed: %s", table, err)
+            raise FatalScriptError(err)
+        logging.info("Archived %s (%d rows, %d bytes, sha256 %s)", table, meta['rows'], meta['size'], meta['sha256'])
+
+    return run_on_pool(pool, archive, tables)
+
+
+def restore_table(conn, table, directory, chunk_size=CHUNK_SIZE):
+    """Load the archive file into an empty table.
+
+    Indexes which do not back a constraint are dropped before the data are loaded, so they can be built
+    afterwards. Everything is done in a single transaction, which is rolled back if the archive does not
+    match its metadata. Columnar archives are verified before they are loaded.
+
+    :param conn: database connection
+    :param str table: name of the table
+    :param str directory: directory with archive files
+    :param int chunk_size: size of chunks to be read
+
+    :return: list of statements creating dropped indexes
+    :raises ArchiveError: if table is not empty or archive does not match its metadata
+    """
+    path = find_archive(directory, table)
+    meta = read_meta(path)
+    if meta is None:
+        raise ArchiveError("Archive {} is not finished".format(path))
+    if meta.get('format') == COLUMNAR_FORMAT:
+        return _restore_columnar(conn, table, path, meta, chunk_size)
+
+    with conn.cursor() as cursor:
+        indexdefs = _prepare_restore(conn, cursor, table)
+
+        with open(path, 'rb') as farchive:
+            reader = ArchiveReader(farchive, chunk_size)
+            cursor.copy_expert(_copy_from_sql(table, meta.get('columns')), reader, chunk_size)
+            copied = cursor.rowcount
+
+    if not reader.eof or (reader.size, reader.sha256.hexdigest()) != (meta['size'], meta['sha256']):
+        conn.rollback()
+        raise ArchiveError("Checksum of archive {} does not match".format(path))
+    if copied not in (-1, meta['rows']) or reader.rows != meta['rows']:
+        conn.rollback()
+        raise ArchiveError("Table {} loaded {} rows, expected {}".format(table, copied, meta['rows']))
+    conn.commit()
+    return indexdefs
+
+
+def _copy_from_sql(table, columns):
+    """Return `COPY ... FROM STDIN` loading the archived columns, all columns in table order if they are unknown.
+
+    Archives written before columns were stored in metadata have no columns.
+    """
+    if not columns:
+        return sql.SQL("COPY {} FROM STDIN").format(sql.Identifier(table))
+    return sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier(table), sql.SQL(', ').join(sql.Identifier(column) for column in columns))
+
+
+def _prepare_restore(conn, cursor, table):
+    """Check the table is empty and defer its indexes, return statements creating them."""
+    cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(sql.Identifier(table)))
+    if cursor.fetchone()[0]:
+        conn.rollback()
+        raise ArchiveError("Table {} is not empty".format(table))
+    return defer_indexes(cursor, table)
+
+
+def _restore_columnar(conn, table, path, meta, chunk_size):
+    verify_archive(path, meta, chunk_size)
+    with conn.cursor() as cursor:
+        indexdefs = _prepare_restore(conn, cursor, table)
+        with ColumnarFile(path) as archive:
+            reader = ColumnarReader(archive)
+            cursor.copy_expert(_copy_from_sql(table, archive.columns), reader, chunk_size)
+            copied = cursor.rowcount
+    if copied not in (-1, meta['rows']) or reader.rows != meta['rows']:
+        conn.rollback()
+        raise ArchiveError("Table {} loaded {} rows, expected {}".format(table, copied, meta['rows']))
+    conn.commit()
+    return indexdefs
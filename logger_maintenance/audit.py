@@ -0,0 +1,438 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for auditing logger partitions against the template of their service.
+
+Partitions of a parent and a service are expected to share indexes and constraints. The template of a service
+consists of indexes and constraints present in at least half of its partitions; CHECK constraints are compared
+with their literals ignored. Every partition of a parent with a time column also needs a validated CHECK
+constraint of its time range, otherwise constraint exclusion can not skip it. Partitions are expected to be owned
+by the owner of their parent and to be in the tablespace of their parent or in the tiering tablespace.
+
+Missing indexes are built concurrently, missing constraints are added as `NOT VALID` and validated afterwards,
+so repairs do not block writes for longer than a catalog update.
+"""
+import logging
+import re
+import time
+from collections import namedtuple
+
+from psycopg2 import DatabaseError, sql
+
+from logger_maintenance.catalog import PARTITION_MONTH_RE, get_table_month, get_table_span
+from logger_maintenance.common import DAY, WEEK, FatalScriptError, add_months, add_periods, execute_short_transaction, \
+    get_granularity, run_on_pool
+from logger_maintenance.compact import INDEX_DEF_RE, TIME_COLUMNS
+from logger_maintenance.detach import DETACHED_COMMENT
+from logger_maintenance.merge import LITERAL_RE, UPPER_BOUND_RE, _rename
+
+# Kinds of deviations
+INDEX = 'index'
+INVALID_INDEX = 'invalid index'
+CONSTRAINT = 'constraint'
+NOT_VALIDATED = 'not validated'
+TIME_RANGE = 'time range'
+OWNER = 'owner'
+TABLESPACE = 'tablespace'
+INHERITANCE = 'inheritance'
+
+TABLE_SQL = """
+    SELECT pg_get_userbyid(c.relowner), t.spcname
+      FROM pg_class c
+      LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+     WHERE c.oid = %s::regclass
+"""
+AUDIT_CONSTRAINTS_SQL = """
+    SELECT conname, contype, pg_get_constraintdef(oid), convalidated
+      FROM pg_constraint
+     WHERE conrelid = %s::regclass AND contype IN ('c', 'p', 'u', 'x', 'f')
+     ORDER BY conname
+"""
+AUDIT_INDEXES_SQL = """
+    SELECT c.relname, pg_get_indexdef(i.indexrelid), i.indisvalid
+      FROM pg_index i
+      JOIN pg_class c ON c.oid = i.indexrelid
+     WHERE i.indrelid = %s::regclass
+       AND NOT EXISTS (SELECT 1 FROM pg_constraint n WHERE n.conindid = i.indexrelid AND n.conrelid = i.indrelid)
+     ORDER BY c.relname
+"""
+# Tables named as partitions which do not inherit from any table and were not detached on purpose
+ORPHANS_SQL = r"""
+    SELECT c.relname
+      FROM pg_class c
+     WHERE c.relkind = 'r'
+       AND c.relname ~ '_\d{2}_\d{2}(_\d{2}|_m\d{1,2})?$'
+       AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)
+       AND obj_description(c.oid, 'pg_class') IS DISTINCT FROM %s
+     ORDER BY c.relname
+"""
+LOWER_BOUND_RE = re.compile(r'>=?\s*\(?$')
+DATE_LITERAL_RE = re.compile(r"^'(\d{4}-\d{2}-\d{2})((?: 00:00:00)?')$")
+KEY_RE = re.compile(r'^(PRIMARY KEY|UNIQUE) (\([^)]*\))$')
+
+TableState = namedtuple('TableState', ['table', 'parent', 'service', 'month', 'owner', 'tablespace', 'constraints',
+                                       'indexes'])
+TableState.__doc__ = """Catalog state of a partition.
+
+Constraints are tuples (name, type, definition, validated), indexes tuples (name, definition, valid) of indexes
+not backing a constraint. Tablespace is None for the default tablespace.
+"""
+
+Template = namedtuple('Template', ['indexes', 'constraints'])
+Template.__doc__ = """Indexes and constraints expected in partitions of a parent and a service.
+
+Both map keys independent of names to tuples (table, name, definition) taken from the newest partition having
+them, constraints additionally contain the constraint type before the definition.
+"""
+
+Deviation = namedtuple('Deviation', ['table', 'kind', 'detail', 'repair'])
+Deviation.__doc__ = """Deviation of a partition from the template.
+
+Repair is a tuple of (statement, concurrently) steps executed in order, empty if the deviation is not repaired
+automatically. Statements executed concurrently can not run inside a transaction block.
+"""
+
+
+def get_orphans(conn, parents=TIME_COLUMNS):
+    """Return list of (table, parent) of tables named as partitions of the parents but inheriting from none.
+
+    Tables detached by `drop_parts.py` and not dropped yet are not orphans.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(ORPHANS_SQL, (DETACHED_COMMENT, ))
+        tables = [table for (table, ) in cursor.fetchall()]
+    conn.rollback()
+    orphans = []
+    for table in tables:
+        candidates = [parent for parent in parents if table.startswith(parent + '_')]
+        if candidates:
+            orphans.append((table, max(candidates, key=len)))
+    return orphans
+
+
+def get_owner_tablespace(cursor, table):
+    """Return tuple (owner, tablespace) of the table, tablespace is None for the default tablespace."""
+    cursor.execute(TABLE_SQL, (table, ))
+    return cursor.fetchone()
+
+
+def get_table_state(conn, part):
+    """Return TableState of the partition.
+
+    :param part: `catalog.Partition`
+    """
+    with conn.cursor() as cursor:
+        owner, tablespace = get_owner_tablespace(cursor, part.table)
+        cursor.execute(AUDIT_CONSTRAINTS_SQL, (part.table, ))
+        constraints = [tuple(row) for row in cursor.fetchall()]
+        cursor.execute(AUDIT_INDEXES_SQL, (part.table, ))
+        indexes = [tuple(row) for row in cursor.fetchall()]
+    conn.rollback()
+    return TableState(part.table, part.parent, part.service, part.month, owner, tablespace, constraints, indexes)
+
+
+def get_table_states(pool, partitions):
+    """Inspect partitions concurrently, each one using its own connection from the pool.
+
+    :return: tuple (ordered dictionary mapping partitions to FatalScriptError or None, list of TableState)
+    """
+    states = []
+
+    def work(conn, part):
+        try:
+            states.append(get_table_state(conn, part))
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+
+    results = run_on_pool(pool, work, partitions)
+    return results, sorted(states, key=lambda state: (state.month, state.table))
+
+
+def get_period(table, service, granularity=None):
+    """Return tuple (first day, first day after) of the time range of the partition.
+
+    :param dict granularity: granularity of services as returned by `common.parse_granularity`, sub-monthly
+                             partitions of services not configured as weekly are daily
+    """
+    first = get_table_month(table)
+    if PARTITION_MONTH_RE.search(table).group(3) is not None:
+        step = WEEK if get_granularity(granularity or {None: DAY}, service) == WEEK else DAY
+        return first, add_periods(first, 1, step)
+    return first, add_months(first, get_table_span(table))
+
+
+def _literal_date(literal):
+    match = DATE_LITERAL_RE.match(literal)
+    return match.group(1) if match is not None else literal
+
+
+def get_time_bounds(definition, column):
+    """Return tuple (lower, upper) of bounds of the column in the CHECK constraint or None if it lacks any of them.
+
+    Bounds are ISO formatted dates, or quoted literals if they are not midnights.
+    """
+    lower = upper = None
+    for part, literal in zip(LITERAL_RE.split(definition), LITERAL_RE.findall(definition)):
+        if column not in part:
+            continue
+        if lower is None and LOWER_BOUND_RE.search(part):
+            lower = _literal_date(literal)
+        elif upper is None and UPPER_BOUND_RE.search(part):
+            upper = _literal_date(literal)
+    if lower is None or upper is None:
+        return None
+    return lower, upper
+
+
+def with_time_bounds(definition, column, lower, upper):
+    """Return the CHECK constraint with date bounds of the column replaced by the dates."""
+    parts, literals = LITERAL_RE.split(definition), LITERAL_RE.findall(definition)
+    result = [parts[0]]
+    for preceding, literal, part in zip(parts, literals, parts[1:]):
+        match = DATE_LITERAL_RE.match(literal)
+        if match is not None and column in preceding:
+            if LOWER_BOUND_RE.search(preceding):
+                literal = "'" + lower.isoformat() + match.group(2)
+            elif UPPER_BOUND_RE.search(preceding):
+                literal = "'" + upper.isoformat() + match.group(2)
+        result.append(literal)
+        result.append(part)
+    return ''.join(result)
+
+
+def _index_key(indexdef):
+    """Return key of the index independent of its name and table."""
+    match = INDEX_DEF_RE.match(indexdef)
+    if match is None:
+        return '?', indexdef
+    return match.group(1) or '', match.group(3)
+
+
+def _constraint_key(contype, definition):
+    """Return key of the constraint independent of its name and literals."""
+    return contype, LITERAL_RE.sub("''", definition)
+
+
+def get_templates(states):
+    """Return dictionary mapping (parent, service) to Template of their partitions.
+
+    :param states: list of TableState ordered by month
+    """
+    groups = {}
+    for state in states:
+        groups.setdefault((state.parent, state.service), []).append(state)
+    templates = {}
+    for group_key, group in groups.items():
+        indexes, constraints, counts = {}, {}, {}
+        for state in group:
+            keys = set()
+            for name, indexdef, _ in state.indexes:
+                key = ('i', ) + _index_key(indexdef)
+                indexes[key[1:]] = (state.table, name, indexdef)
+                keys.add(key)
+            for name, contype, definition, _ in state.constraints:
+                key = ('c', ) + _constraint_key(contype, definition)
+                constraints[key[1:]] = (state.table, name, contype, definition)
+                keys.add(key)
+            for key in keys:
+                counts[key] = counts.get(key, 0) + 1
+        templates[group_key] = Template(
+            {key: value for key, value in indexes.items() if 2 * counts[('i', ) + key] >= len(group)},
+            {key: value for key, value in constraints.items() if 2 * counts[('c', ) + key] >= len(group)})
+    return templates
+
+
+def _index_repair(indexdef, name, table):
+    """Return steps building the index on the table concurrently or empty tuple if definition is not supported."""
+    match = INDEX_DEF_RE.match(indexdef)
+    if match is None:
+        return ()
+    return ((sql.SQL("CREATE {}INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}").format(
+        sql.SQL(match.group(1) or ''), sql.Identifier(name), sql.Identifier(table), sql.SQL(match.group(3))), True), )
+
+
+def _constraint_repair(table, name, contype, definition):
+    """Return steps adding the constraint without blocking writes or empty tuple if it is not supported.
+
+    CHECK and foreign key constraints are added as `NOT VALID` and validated afterwards, primary keys and unique
+    constraints are added using a unique index built concurrently.
+    """
+    table_id, name_id = sql.Identifier(table), sql.Identifier(name)
+    if contype in ('c', 'f'):
+        return (
+            (sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID").format(table_id, name_id, sql.SQL(definition)),
+             False),
+            (sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(table_id, name_id), False),
+        )
+    match = KEY_RE.match(definition) if contype in ('p', 'u') else None
+    if match is None:
+        return ()
+    return (
+        (sql.SQL("CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}").format(
+            name_id, table_id, sql.SQL(match.group(2))), True),
+        (sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} USING INDEX {}").format(
+            table_id, name_id, sql.SQL(match.group(1)), name_id), False),
+    )
+
+
+def audit_table(state, template, owner, tablespaces, granularity=None):
+    """Return list of deviations of the partition from the template.
+
+    :param TableState state: state of the partition
+    :param Template template: template of partitions of its parent and service
+    :param str owner: expected owner
+    :param tablespaces: expected tablespaces (None for the default tablespace)
+    :param dict granularity: granularity of services as returned by `common.parse_granularity`
+    """
+    table = state.table
+    deviations = []
+
+    index_keys = {_index_key(indexdef) for _, indexdef, _ in state.indexes}
+    for key, (template_table, name, indexdef) in sorted(template.indexes.items()):
+        if key not in index_keys:
+            new_name = _rename(name, template_table, table)
+            deviations.append(Deviation(table, INDEX, "{} {}{}".format(new_name, *key),
+                                        _index_repair(indexdef, new_name, table)))
+    for name, indexdef, valid in state.indexes:
+        if not valid:
+            deviations.append(Deviation(
+                table, INVALID_INDEX, name,
+                ((sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)), True), )
+                + _index_repair(indexdef, name, table)))
+
+    column = TIME_COLUMNS.get(state.parent)
+    period = get_period(table, state.service, granularity) if column is not None else None
+    constraint_keys = {_constraint_key(contype, definition) for _, contype, definition, _ in state.constraints}
+    time_check = False
+    for key, (template_table, name, contype, definition) in sorted(template.constraints.items()):
+        if contype == 'c' and column is not None and get_time_bounds(definition, column) is not None:
+            time_check = True
+            definition = with_time_bounds(definition, column, *period)
+        if key not in constraint_keys:
+            new_name = _rename(name, template_table, table)
+            deviations.append(Deviation(table, CONSTRAINT, "{} {}".format(new_name, definition),
+                                        _constraint_repair(table, new_name, contype, definition)))
+    for name, _, _, validated in state.constraints:
+        if not validated:
+            deviations.append(Deviation(
+                table, NOT_VALIDATED, name,
+                ((sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(
+                    sql.Identifier(table), sql.Identifier(name)), False), )))
+
+    if column is not None:
+        expected = tuple(day.isoformat() for day in period)
+        bounds = [(name, get_time_bounds(definition, column))
+                  for name, contype, definition, _ in state.constraints if contype == 'c']
+        bounds = [(name, bound) for name, bound in bounds if bound is not None]
+        if not bounds and not time_check:
+            name = table + '_time_check'
+            definition = "CHECK ({0} >= '{1}' AND {0} < '{2}')".format(column, *expected)
+            deviations.append(Deviation(table, TIME_RANGE, "missing {} {}".format(name, definition),
+                                        _constraint_repair(table, name, 'c', definition)))
+        elif bounds and all(bound != expected for _, bound in bounds):
+            deviations.append(Deviation(table, TIME_RANGE, "{} covers {}..{} instead of {}..{}".format(
+                bounds[0][0], bounds[0][1][0], bounds[0][1][1], *expected), ()))
+
+    if state.owner != owner:
+        deviations.append(Deviation(
+            table, OWNER, "{} instead of {}".format(state.owner, owner),
+            ((sql.SQL("ALTER TABLE {} OWNER TO {}").format(sql.Identifier(table), sql.Identifier(owner)), False), )))
+    if state.tablespace not in tablespaces:
+        deviations.append(Deviation(table, TABLESPACE, "{} instead of {}".format(
+            state.tablespace or "default", " or ".join(tablespace or "default" for tablespace in tablespaces)), ()))
+    return deviations
+
+
+def get_parents(conn, parents):
+    """Return dictionary mapping the parents to tuples (owner, tablespace)."""
+    with conn.cursor() as cursor:
+        result = {parent: tuple(get_owner_tablespace(cursor, parent)) for parent in parents}
+    conn.rollback()
+    return result
+
+
+def audit_tables(states, parents, tablespace=None, granularity=None):
+    """Return list of deviations of the partitions from templates of their parents and services.
+
+    :param states: list of TableState ordered by month
+    :param dict parents: dictionary mapping parents to tuples (owner, tablespace) as returned by `get_parents`
+    :param str tablespace: tiering tablespace, which is expected besides the tablespace of the parent
+    :param dict granularity: granularity of services as returned by `common.parse_granularity`
+    """
+    templates = get_templates(states)
+    deviations = []
+    for state in states:
+        owner, parent_tablespace = parents[state.parent]
+        tablespaces = [parent_tablespace] + ([tablespace] if tablespace not in (None, parent_tablespace) else [])
+        deviations.extend(audit_table(state, templates[(state.parent, state.service)], owner, tablespaces,
+                                      granularity))
+    return deviations
+
+
+def _execute_concurrently(conn, statement, lock_timeout):
+    """Execute the statement outside a transaction block, as statements running concurrently require."""
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, false)", (str(lock_timeout), ))
+            try:
+                cursor.execute(statement)
+            finally:
+                cursor.execute("RESET lock_timeout")
+    finally:
+        conn.autocommit = False
+
+
+def repair_deviation(conn, deviation, lock_timeout=1000, retries=5, backoff=0.5):
+    """Execute steps repairing the deviation.
+
+    Steps which are not concurrent are executed in short transactions retried after lock timeout, see
+    `common.execute_short_transaction`.
+    """
+    for statement, concurrently in deviation.repair:
+        if concurrently:
+            _execute_concurrently(conn, statement, lock_timeout)
+        else:
+            execute_short_transaction(conn, statement, lock_timeout, retries, backoff)
+
+
+def repair_tables(pool, deviations, **kwargs):
+    """Repair deviations concurrently, deviations of each table in order using its own connection from the pool.
+
+    Deviations without repair steps are skipped. Keyword arguments are passed to `repair_deviation`.
+
+    :return: ordered dictionary mapping tables to FatalScriptError or None
+    """
+    tables = {}
+    for deviation in deviations:
+        if deviation.repair:
+            tables.setdefault(deviation.table, []).append(deviation)
+
+    def work(conn, table):
+        for deviation in tables[table]:
+            start = time.monotonic()
+            try:
+                repair_deviation(conn, deviation, **kwargs)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+            logging.info("Repaired %s of %s (%s) in %.3f s", deviation.kind, table, deviation.detail,
+                         time.monotonic() - start)
+
+    return run_on_pool(pool, work, sorted(tables))
@@ -0,0 +1,232 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for reading inventory of logger partitions from the database catalog.
+
+All partitions are read by a single catalog query. The result may be cached in a local snapshot file.
+"""
+import json
+import logging
+import os
+import re
+import time
+from collections import namedtuple
+from datetime import date
+
+from psycopg2 import sql
+
+from logger_maintenance.common import DAY, MONTH, WEEK, add_months, add_periods, get_granularity
+
+# Monthly partitions are suffixed by `_YY_MM`, weekly and daily partitions by `_YY_MM_DD` of their first day,
+# partitions merging several months (see `merge`) by `_YY_MM_m<months>` of their first month
+PARTITION_MONTH_RE = re.compile(r'_(\d{2})_(\d{2})(?:_(\d{2})|_m(\d{1,2}))?$')
+
+PARTITIONS_SQL = r"""
+    SELECT c.relname, p.relname,
+           pg_relation_size(c.oid), pg_indexes_size(c.oid), c.reltuples::bigint,
+           greatest(s.last_vacuum, s.last_autovacuum), greatest(s.last_analyze, s.last_autoanalyze)
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      JOIN pg_class p ON p.oid = i.inhparent
+      LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+     WHERE c.relname ~ '_\d{2}_\d{2}(_m\d{1,2})?$'
+     ORDER BY p.relname, c.relname
+"""
+
+# Indexes which do not back any constraint, these may be dropped and created later
+DEFERRABLE_INDEXES_SQL = """
+    SELECT pg_get_indexdef(i.indexrelid), n.nspname, c.relname
+      FROM pg_index i
+      JOIN pg_class c ON c.oid = i.indexrelid
+      JOIN pg_namespace n ON n.oid = c.relnamespace
+     WHERE i.indrelid = %s::regclass
+       AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid)
+     ORDER BY i.indexrelid
+"""
+MONTH_PARTITIONS_SQL = """
+    SELECT c.relname
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+     WHERE c.relname ~ %s
+     ORDER BY c.relname
+"""
+
+SERVICES_SQL = "SELECT trim(trailing '_' from partition_postfix) FROM service ORDER BY id"
+
+Partition = namedtuple(
+    'Partition', ['table', 'parent', 'service', 'month', 'size', 'index_size', 'rows', 'last_vacuum', 'last_analyze'])
+Partition.__doc__ = """Logger partition.
+
+Service is empty for partitions common for all services. Times of the last vacuum and analyze are ISO formatted
+strings or None.
+"""
+
+
+def get_table_month(table):
+    """Return the first day of the partition period (month, week or day) or None if table is not a partition."""
+    match = PARTITION_MONTH_RE.search(table)
+    if match is None:
+        return None
+    return date(2000 + int(match.group(1)), int(match.group(2)), int(match.group(3) or 1))
+
+
+def get_table_span(table):
+    """Return number of months covered by the partition, 1 for monthly, weekly and daily partitions."""
+    match = PARTITION_MONTH_RE.search(table)
+    return int(match.group(4)) if match is not None and match.group(4) is not None else 1
+
+
+def get_table_suffix(month, granularity=MONTH):
+    """Return suffix of partitions for the period starting by the date."""
+    return month.strftime("_%y_%m" if granularity == MONTH else "_%y_%m_%d")
+
+
+def get_table_service(table, parent):
+    """Return service of the partition, i.e. the part of its name between parent name and month."""
+    return table[len(parent) + 1:PARTITION_MONTH_RE.search(table).start()]
+
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+
+def get_partitions(conn):
+    """Return list of all logger partitions."""
+    with conn.cursor() as cursor:
+        cursor.execute(PARTITIONS_SQL)
+        rows = cursor.fetchall()
+    conn.rollback()
+    return [
+        Partition(table, parent, get_table_service(table, parent), get_table_month(table), size, index_size,
+                  max(rows, 0), _isoformat(last_vacuum), _isoformat(last_analyze))
+        for table, parent, size, index_size, rows, last_vacuum, last_analyze in rows
+    ]
+
+
+def get_month_partitions(cursor, month):
+    """Return names of all partitions for the month including weekly and daily partitions starting in it."""
+    cursor.execute(MONTH_PARTITIONS_SQL, (get_table_suffix(month) + r'(_\d{2})?$', ))
+    return [table for (table, ) in cursor.fetchall()]
+
+
+def get_services(cursor):
+    """Return names of all services."""
+    cursor.execute(SERVICES_SQL)
+    return [service for (service, ) in cursor.fetchall()]
+
+
+def defer_indexes(cursor, table):
+    """Drop indexes of the table which do not back a constraint.
+
+    :return: list of statements creating the dropped indexes
+    """
+    cursor.execute(DEFERRABLE_INDEXES_SQL, (table, ))
+    indexes = cursor.fetchall()
+    for _, schema, index in indexes:
+        cursor.execute(sql.SQL("DROP INDEX {}.{}").format(sql.Identifier(schema), sql.Identifier(index)))
+    return [indexdef for indexdef, _, _ in indexes]
+
+
+def find_missing(partitions, granularity=None):
+    """Return list of (parent, service, month) of partitions missing between the first and the last period.
+
+    Monthly and sub-monthly partitions of a service are checked separately, so a service may switch granularity.
+
+    :param partitions: list of partitions
+    :param dict granularity: granularity of services as returned by `common.parse_granularity`, sub-monthly
+                             partitions of services not configured as weekly are daily
+    """
+    months = {}
+    for part in partitions:
+        monthly = PARTITION_MONTH_RE.search(part.table).group(3) is None
+        months.setdefault((part.parent, part.service, monthly), set()).update(
+            add_months(part.month, offset) if offset else part.month for offset in range(get_table_span(part.table)))
+
+    missing = []
+    for (parent, service, monthly), present in sorted(months.items()):
+        step = MONTH
+        if not monthly:
+            # Weekly partitions are always configured, anything else is stepped by days
+            step = WEEK if get_granularity(granularity or {None: DAY}, service) == WEEK else DAY
+        month, last = min(present), max(present)
+        while month < last:
+            if month not in present:
+                missing.append((parent, service, month))
+            month = add_periods(month, 1, step)
+    return sorted(missing)
+
+
+def partition_to_dict(part):
+    """Return partition as a JSON serializable dictionary."""
+    result = part._asdict()
+    result['month'] = part.month.isoformat()
+    return result
+
+
+def save_snapshot(path, partitions):
+    """Save partitions to the snapshot file atomically."""
+    snapshot = {'created': time.time(), 'partitions': [partition_to_dict(part) for part in partitions]}
+    with open(path + '.tmp', 'w') as fsnapshot:
+        json.dump(snapshot, fsnapshot)
+    os.replace(path + '.tmp', path)
+
+
+def load_snapshot(path, max_age):
+    """Load partitions from the snapshot file.
+
+    :param str path: path to the snapshot file
+    :param float max_age: maximal age of the snapshot in seconds
+
+    :return: list of partitions or None if snapshot does not exist or is too old
+    """
+    try:
+        with open(path) as fsnapshot:
+            snapshot = json.load(fsnapshot)
+    except FileNotFoundError:
+        return None
+    except ValueError as err:
+        logging.warning("Ignoring broken snapshot %s: %s", path, err)
+        return None
+    if time.time() - snapshot['created'] > max_age:
+        return None
+
+    partitions = []
+    for item in snapshot['partitions']:
+        item['month'] = date(*map(int, item['month'].split('-')))
+        partitions.append(Partition(**item))
+    return partitions
+
+
+def get_partitions_cached(connect, path=None, max_age=0):
+    """Return list of all logger partitions, use snapshot file if it is fresh enough.
+
+    :param connect: callable returning new connection, called only if snapshot can not be used
+    :param str path: path to the snapshot file, None for no caching
+    :param float max_age: maximal age of the snapshot in seconds
+    """
+    if path is not None:
+        partitions = load_snapshot(path, max_age)
+        if partitions is not None:
+            logging.info("Using partitions snapshot %s", path)
+            return partitions
+
+    with connect() as conn:
+        partitions = get_partitions(conn)
+    if path is not None:
+        save_snapshot(path, partitions)
+    return partitions
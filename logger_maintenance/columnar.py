@@ -0,0 +1,277 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+r"""Module for column-oriented archive files.
+
+Rows in `COPY` text format are split into blocks of rows and every column of a block is compressed separately,
+so a scan decompresses only the columns it needs. The footer describes columns and blocks including minimal
+and maximal time of each block, so blocks outside of a time range are skipped without being read.
+
+Layout of the file::
+
+    MAGIC | column blocks ... | footer (JSON) | footer length (8 bytes, little endian) | MAGIC
+
+Values are kept in `COPY` text format, i.e. escaped and NULL stored as `\N`. Times in `COPY` text format of
+`timestamp` columns are ordered lexicographically, so they are compared as strings.
+"""
+import hashlib
+import ipaddress
+import json
+import mmap
+import struct
+import zlib
+from collections import namedtuple
+
+MAGIC = b'LMCOLAR1'
+FOOTER_SIZE = struct.Struct('<Q')
+# Number of rows in a block
+BLOCK_ROWS = 65536
+NULL = b'\\N'
+# Format of query times, same as `COPY` text format of `timestamp`
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+Query = namedtuple('Query', ['columns', 'time_from', 'time_to', 'networks', 'request_types', 'request_ids'])
+Query.__doc__ = """Scan of request archives.
+
+Columns are names of returned columns, None for all columns. Rows with time in [time_from, time_to), source IP
+in any of the networks, request type in request types and id in request ids are returned, None stands for
+no restriction.
+"""
+
+
+class ColumnarError(Exception):
+    """Raised when columnar archive is malformed."""
+
+    def __init__(self, message):
+        """Initialize error message."""
+        self.message = message
+
+    def __str__(self):
+        """Return error message."""
+        return self.message
+
+
+class ColumnarWriter(object):
+    """File-like object storing rows written in `COPY` text format column by column.
+
+    Counts rows and computes checksum of the written file on the fly.
+    """
+
+    def __init__(self, fileobj, columns, time_column=None, block_rows=BLOCK_ROWS):
+        """Initialize writer.
+
+        :param fileobj: binary file object to write to
+        :param list columns: names of columns of written rows
+        :param str time_column: name of the column with time of rows or None
+        :param int block_rows: number of rows in a block
+        """
+        self.fileobj = fileobj
+        self.columns = list(columns)
+        self.time_column = time_column
+        self.block_rows = block_rows
+        self.rows = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.blocks = []
+        self._time_index = self.columns.index(time_column) if time_column in self.columns else None
+        self._tail = b''
+        self._pending = []
+        self._output(MAGIC)
+
+    def write(self, data):
+        """Write data, each row has to be terminated by a newline."""
+        if isinstance(data, str):
+            data = data.encode()
+        lines = (self._tail + data).split(b'\n')
+        self._tail = lines.pop()
+        for line in lines:
+            row = line.split(b'\t')
+            if len(row) != len(self.columns):
+                raise ColumnarError("Row has {} columns, expected {}".format(len(row), len(self.columns)))
+            self._pending.append(row)
+            if len(self._pending) >= self.block_rows:
+                self._flush()
+        self.rows += len(lines)
+
+    def close(self):
+        """Write remaining rows and the footer."""
+        if self._tail:
+            raise ColumnarError("Last row is not terminated by a newline")
+        self._flush()
+        footer = json.dumps({
+            'columns': self.columns,
+            'time_column': self.time_column,
+            'rows': self.rows,
+            'blocks': self.blocks,
+        }, sort_keys=True).encode()
+        self._output(footer + FOOTER_SIZE.pack(len(footer)) + MAGIC)
+
+    def _flush(self):
+        if not self._pending:
+            return
+        values = list(zip(*self._pending))
+        block = {'rows': len(self._pending), 'columns': [], 'time_min': None, 'time_max': None}
+        for column in values:
+            data = zlib.compress(b'\n'.join(column))
+            block['columns'].append([self.size, len(data)])
+            self._output(data)
+        if self._time_index is not None:
+            times = [value for value in values[self._time_index] if value != NULL]
+            if times:
+                block['time_min'], block['time_max'] = min(times).decode(), max(times).decode()
+        self.blocks.append(block)
+        self._pending = []
+
+    def _output(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+
+class ColumnarFile(object):
+    """Memory-mapped columnar archive file."""
+
+    def __init__(self, path):
+        """Map the file and read its footer.
+
+        :raises ColumnarError: if the file is not a complete columnar archive
+        """
+        self.path = path
+        with open(path, 'rb') as farchive:
+            try:
+                self._map = mmap.mmap(farchive.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ColumnarError("Archive {} is empty".format(path))
+        trailer = len(MAGIC) + FOOTER_SIZE.size
+        if len(self._map) < len(MAGIC) + trailer or self._map[:len(MAGIC)] != MAGIC \
+                or self._map[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ColumnarError("Archive {} is truncated".format(path))
+        (footer_size, ) = FOOTER_SIZE.unpack(self._map[-trailer:-len(MAGIC)])
+        try:
+            footer = json.loads(self._map[-trailer - footer_size:-trailer].decode())
+        except ValueError:
+            self.close()
+            raise ColumnarError("Archive {} has a broken footer".format(path))
+        self.columns = footer['columns']
+        self.time_column = footer['time_column']
+        self.rows = footer['rows']
+        self.blocks = footer['blocks']
+
+    def close(self):
+        """Unmap the file."""
+        self._map.close()
+
+    def __enter__(self):
+        """Return the file."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Unmap the file."""
+        self.close()
+
+    def read_column(self, block, column):
+        """Return list of values of the column in the block."""
+        offset, size = block['columns'][self.columns.index(column)]
+        return zlib.decompress(self._map[offset:offset + size]).split(b'\n')
+
+    def iter_blocks(self, columns=None, time_from=None, time_to=None):
+        """Yield lists of rows of blocks which may contain rows of the time range, only the given columns.
+
+        :param list columns: names of columns or None for all columns
+        :param str time_from: skip blocks with all rows before the time
+        :param str time_to: skip blocks with all rows at or after the time
+        """
+        columns = self.columns if columns is None else columns
+        for block in self.blocks:
+            if time_from is not None and block['time_max'] is not None and block['time_max'] < time_from:
+                continue
+            if time_to is not None and block['time_min'] is not None and block['time_min'] >= time_to:
+                continue
+            yield list(zip(*[self.read_column(block, column) for column in columns]))
+
+
+class ColumnarReader(object):
+    """File-like object returning rows of a columnar archive in `COPY` text format for `copy_expert`."""
+
+    def __init__(self, archive):
+        """Initialize reader of the ColumnarFile."""
+        self._blocks = archive.iter_blocks()
+        self.rows = 0
+
+    def read(self, size=-1):
+        """Return rows of the next block, empty bytes at the end."""
+        for rows in self._blocks:
+            self.rows += len(rows)
+            return b''.join(b'\t'.join(row) + b'\n' for row in rows)
+        return b''
+
+
+def _match_network(value, networks):
+    if value == NULL:
+        return False
+    address = ipaddress.ip_interface(value.decode()).ip
+    return any(address in network for network in networks)
+
+
+def scan_archive(path, query):
+    """Return rows of the request archive matching the query.
+
+    Only columns needed by the query are decompressed and blocks outside of the time range are skipped.
+
+    :return: list of tuples of values of query columns (strings escaped as in `COPY` text format, None for NULL)
+    """
+    networks = None if query.networks is None else [ipaddress.ip_network(network) for network in query.networks]
+    request_types = None if query.request_types is None else {str(value).encode() for value in query.request_types}
+    request_ids = None if query.request_ids is None else {str(value).encode() for value in query.request_ids}
+    time_from = query.time_from.strftime(TIME_FORMAT) if query.time_from is not None else None
+    time_to = query.time_to.strftime(TIME_FORMAT) if query.time_to is not None else None
+
+    result = []
+    with ColumnarFile(path) as archive:
+        output = archive.columns if query.columns is None else list(query.columns)
+        filters = []
+        if time_from is not None or time_to is not None:
+            filters.append(archive.time_column)
+        if networks is not None:
+            filters.append('source_ip')
+        if request_types is not None:
+            filters.append('request_type_id')
+        if request_ids is not None:
+            filters.append('id')
+        needed = output + [column for column in filters if column not in output]
+        for column in needed:
+            if column not in archive.columns:
+                raise ColumnarError("Archive {} has no column {}".format(path, column))
+        index = {column: position for position, column in enumerate(needed)}
+
+        for rows in archive.iter_blocks(needed, time_from, time_to):
+            for row in rows:
+                if time_from is not None or time_to is not None:
+                    value = row[index[archive.time_column]]
+                    if value == NULL or (time_from is not None and value.decode() < time_from) \
+                            or (time_to is not None and value.decode() >= time_to):
+                        continue
+                if networks is not None and not _match_network(row[index['source_ip']], networks):
+                    continue
+                if request_types is not None and row[index['request_type_id']] not in request_types:
+                    continue
+                if request_ids is not None and row[index['id']] not in request_ids:
+                    continue
+                result.append(tuple(None if value == NULL else value.decode() for value in row[:len(output)]))
+    return result
@@ -20,11 +20,88 @@
 import argparse
 import json
 import logging
-from datetime import date
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from functools import wraps
 from json.decoder import JSONDecodeError
 
 import psycopg2
-from psycopg2 import InterfaceError, OperationalError
+from psycopg2 import DatabaseError, InterfaceError, OperationalError, extensions, sql
+from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
+
+from logger_maintenance.journal import Journal, JournalError
+from logger_maintenance.watchdog import Watchdog, canceled_by_watchdog
+
+# Upper bound of a single backoff delay (in seconds)
+BACKOFF_CAP = 60
+# Interval of sampling lock waits (in seconds)
+LOCK_SAMPLE_INTERVAL = 0.1
+METRICS_PREFIX = 'logger_maintenance_'
+
+# Statements which may create or free space, relation sizes are compared before and after them
+MEASURED_SQL_RE = re.compile(
+    r'\s*(SELECT\s+(create_parts|drop_parts)\b|CREATE|DROP|ALTER|TRUNCATE|VACUUM|CLUSTER|REINDEX|COPY\s+\S+\s+FROM)',
+    re.IGNORECASE)
+# Sizes of the logger partitions including indexes and TOAST. Sizes are computed from `relpages` (as of the last
+# VACUUM, ANALYZE or CREATE INDEX), because `pg_relation_size` would wait for locks held by the measured transaction.
+RELATION_SIZES_SQL = r"""
+    SELECT c.oid, c.relname,
+           (c.relpages + coalesce(t.relpages, 0) + coalesce(sum(i.relpages), 0))::bigint
+           * current_setting('block_size')::bigint
+      FROM pg_class c
+      LEFT JOIN pg_class t ON t.oid = c.reltoastrelid
+      LEFT JOIN pg_index x ON x.indrelid = c.oid
+      LEFT JOIN pg_class i ON i.oid = x.indexrelid
+     WHERE c.oid = ANY(%s::oid[]) AND c.relkind = 'r' AND c.relname ~ '_\d{2}_\d{2}(_\d{2}|_m\d{1,2})?$'
+     GROUP BY c.oid, c.relname, c.relpages, t.relpages
+"""
+# Relations locked by the transaction of the backend, including those it dropped
+OWN_LOCKS_SQL = """
+    SELECT DISTINCT relation::bigint
+      FROM pg_locks
+     WHERE pid = pg_backend_pid() AND locktype = 'relation' AND relation IS NOT NULL
+"""
+LOCK_WAITING_SQL = "SELECT pid FROM pg_stat_activity WHERE wait_event_type = 'Lock' AND pid = ANY(%s)"
+
+RetentionPolicy = namedtuple('RetentionPolicy', ['keep_months', 'create_months'])
+RetentionPolicy.__doc__ = """Retention policy of a service.
+
+Partitions are kept for `keep_months` months including the current one and created `create_months` months ahead.
+"""
+# Same as defaults of drop_parts.py and create_parts.py
+DEFAULT_RETENTION = RetentionPolicy(keep_months=6, create_months=1)
+
+# Granularity of partitions, sub-monthly partitions are suffixed by `_YY_MM_DD` of their first day
+MONTH = 'month'
+WEEK = 'week'
+DAY = 'day'
+GRANULARITIES = (MONTH, WEEK, DAY)
+# Overloads of database functions called only if some service has weekly or daily partitions
+GRANULARITY_FUNCTIONS = (
+    'create_parts(timestamp without time zone, timestamp without time zone, text[])',
+    'create_parts(timestamp without time zone, timestamp without time zone, text, text)',
+    'drop_parts(timestamp without time zone, timestamp without time zone, text, boolean, text)',
+)
+GRANULARITY_FUNCTIONS_SQL = """
+    SELECT proname || '(' || oidvectortypes(proargtypes) || ')'
+      FROM pg_proc
+     WHERE proname IN ('create_parts', 'drop_parts')
+"""
+
+StatementMetrics = namedtuple(
+    'StatementMetrics', ['sql', 'seconds', 'lock_wait', 'relations', 'bytes_created', 'bytes_freed', 'error'])
+StatementMetrics.__doc__ = """Metrics of an executed statement.
+
+Relations are partitions whose size changed or which were created or dropped by the statement.
+"""
 
 
 class ConfigError(Exception):
@@ -45,7 +122,7 @@ class FatalScriptError(Exception):
 
 
 class DateAction(argparse.Action):
-    """Action class to convert YYYY-MM string to date object."""
+    """Action class to convert YYYY-MM or YYYY-MM-DD string to date object, month is converted to its first day."""
 
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
         """Initialize convert action."""
@@ -54,10 +131,13 @@ class DateAction(argparse.Action):
         super(DateAction, self).__init__(option_strings, dest, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string=None):
-        """Convert YYYY-MM string to date object."""
+        """Convert YYYY-MM or YYYY-MM-DD string to date object."""
         try:
-            (year, month) = values.split('-')
-            setattr(namespace, self.dest, date(int(year), int(month), 1))
+            parts = [int(item) for item in values.split('-')]
+            if len(parts) == 2:
+                parts.append(1)
+            (year, month, day) = parts
+            setattr(namespace, self.dest, date(year, month, day))
         except ValueError:
             logging.error("Wrong date format")
             raise FatalScriptError(ValueError)
@@ -69,6 +149,15 @@ class LoggerMaintenanceScript(object):
     # Items that has to be present in configuration file
     MANDATORY_CONF = {"host", "user", "database"}
 
+    # Metrics of the current run, None if not collected
+    metrics = None
+    # Watchdog of blocked sessions, None if not running
+    watchdog = None
+    # Journal of steps of the current run, None if not kept
+    journal = None
+    # Values of date arguments as passed to the script, if the script resolved them from the current date
+    passed_dates = None
+
     def __init__(self, args):
         """Process command line arguments and read given configuration file.
 
@@ -102,6 +191,8 @@ class LoggerMaintenanceScript(object):
             if self.MANDATORY_CONF - set(db_config.keys()) != set():
                 raise ConfigError("Incorrect config file - mandatory configuration missing")
 
+            self.retention = parse_retention(self.config.get("retention", {}))
+            self.granularity = parse_granularity(self.config.get("granularity", {}))
             return self.config
         except (FileNotFoundError, PermissionError, JSONDecodeError, KeyError, ConfigError) as err:
             logging.error(err)
@@ -110,6 +201,72 @@ class LoggerMaintenanceScript(object):
     def connect_db(self):
         """Connect to the database using credentials from configuration.
 
+        Settings from the `session` section of configuration are applied to the new session.
+
+        :return: connection object
+        """
+        try:
+            if self.metrics is not None or self.watchdog is not None:
+                conn = psycopg2.connect(connection_factory=InstrumentedConnection, **self.config["database"])
+            else:
+                conn = psycopg2.connect(**self.config["database"])
+            try:
+                self._set_up_session(conn)
+            except BaseException:
+                # The connection is not returned, do not leak its backend
+                conn.close()
+                raise
+            return conn
+        except (OperationalError, InterfaceError) as err:
+            logging.error("DB connection failed: " + str(err))
+            raise FatalScriptError(err)
+        except DatabaseError as err:
+            logging.error("Session settings failed: " + str(err))
+            raise FatalScriptError(err)
+
+    def _set_up_session(self, conn):
+        """Apply session settings to the new connection, register it to metrics and watchdog."""
+        settings = self.config.get("session", {})
+        if settings:
+            with conn.cursor() as cursor:
+                for name, value in sorted(settings.items()):
+                    cursor.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+            conn.commit()
+        if self.metrics is not None:
+            conn.metrics = self.metrics
+            if self.metrics.sampler is not None:
+                self.metrics.sampler.add_backend(conn.get_backend_pid())
+        if self.watchdog is not None:
+            conn.watchdog = self.watchdog
+            self.watchdog.add_backend(conn.get_backend_pid())
+
+    def check_granularity(self):
+        """Check the database supports configured granularity, monthly configuration is not checked at all.
+
+        :raises FatalScriptError: if overloads of `create_parts` and `drop_parts` taking granularity are missing
+        """
+        if is_monthly(self.granularity):
+            return
+        try:
+            with self.connect_db() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(GRANULARITY_FUNCTIONS_SQL)
+                    rows = cursor.fetchall()
+                conn.rollback()
+            check_granularity_functions(rows, self.granularity)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except ConfigError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+    def connect_monitor(self):
+        """Connect to the database for monitoring of the script.
+
+        The connection is neither instrumented nor watched and gets no session settings, so its own queries never
+        appear in metrics.
+
         :return: connection object
         """
         try:
@@ -118,6 +275,404 @@ class LoggerMaintenanceScript(object):
             logging.error("DB connection failed: " + str(err))
             raise FatalScriptError(err)
 
+    def start_metrics(self, script):
+        """Start collecting metrics if requested by `--metrics-file` or `--report-file`."""
+        if getattr(self.args, 'metrics_file', None) is None and getattr(self.args, 'report_file', None) is None:
+            return
+        sampler = LockWaitSampler(self.connect_monitor())
+        sampler.start()
+        # The sampler connection is autocommit and safe to share between threads
+        self.metrics = Metrics(script, sampler, sampler.conn)
+
+    def finish_metrics(self, success):
+        """Stop collecting metrics and write them to the requested files."""
+        if self.metrics is None:
+            return
+        metrics, self.metrics = self.metrics, None
+        metrics.finish(success)
+        totals = metrics.totals()
+        logging.info("%d statements in %.3f s, lock wait %.3f s, %d bytes created, %d bytes freed",
+                     totals['statements'], totals['statement_seconds'], totals['lock_wait_seconds'],
+                     totals['bytes_created'], totals['bytes_freed'])
+        try:
+            if self.args.metrics_file is not None:
+                _write_atomic(self.args.metrics_file, metrics.to_textfile())
+            if self.args.report_file is not None:
+                _write_atomic(self.args.report_file, json.dumps(metrics.to_dict(), indent=4) + '\n')
+        except OSError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+    def start_watchdog(self):
+        """Start watchdog of sessions blocked by the script if requested by `--watchdog`."""
+        if not getattr(self.args, 'watchdog', False):
+            return
+        self.watchdog = Watchdog(self.connect_monitor(), self.args.max_blocked, self.args.max_block_wait)
+        self.watchdog.start()
+
+    def finish_watchdog(self):
+        """Stop watchdog and report blocking caused by the script."""
+        if self.watchdog is None:
+            return
+        watchdog, self.watchdog = self.watchdog, None
+        watchdog.finish()
+        report = watchdog.report()
+        logging.info("Blocked sessions: %.1f session-seconds, at most %d sessions, at most %.1f s, %d cancels",
+                     report['blocked_session_seconds'], report['max_blocked_sessions'],
+                     report['max_block_wait_seconds'], report['watchdog_cancels'])
+        if self.metrics is not None:
+            self.metrics.blocking = report
+
+    def open_journal(self, script):
+        """Open journal of steps if requested by `--journal`, steps of an interrupted run are loaded from it."""
+        if getattr(self.args, 'journal_file', None) is None or getattr(self.args, 'dry_run', False):
+            return
+        try:
+            self.journal = Journal(self.args.journal_file, script, self.args, self.passed_dates)
+            # The interrupted run is resumed with its dates even if the current date differs
+            resolved = {name: datetime.strptime(value, "%Y-%m-%d").date()
+                        for name, value in self.journal.resolved.items()}
+        except (OSError, ValueError, JournalError) as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        for name, value in sorted(resolved.items()):
+            setattr(self.args, name, value)
+        if self.journal.steps:
+            logging.info("Resuming interrupted run from journal %s", self.args.journal_file)
+
+    def close_journal(self, success):
+        """Close journal, remove its file if the run finished successfully."""
+        if self.journal is None:
+            return
+        journal, self.journal = self.journal, None
+        if success:
+            try:
+                journal.remove()
+            except OSError as err:
+                logging.error(err)
+                raise FatalScriptError(err)
+
+    def step_state(self, step):
+        """Return state of the step in the journal, None if it was not started or journal is not kept."""
+        return self.journal.state(step) if self.journal is not None else None
+
+    def start_step(self, step, **data):
+        """Record the step as started with the data in the journal if kept."""
+        self._write_journal(lambda: self.journal.start(step, **data))
+
+    def finish_step(self, step, **data):
+        """Record the step as done with the data in the journal if kept."""
+        self._write_journal(lambda: self.journal.done(step, **data))
+
+    def _write_journal(self, func):
+        if self.journal is None:
+            return
+        try:
+            func()
+        except OSError as err:
+            logging.error("Journal write failed: %s", err)
+            raise FatalScriptError(err)
+
+    def run_step(self, step, func):
+        """Execute the step unless it was done by an interrupted run, record it in the journal if kept.
+
+        :return: result of `func` or None if the step was skipped
+        """
+        if self.journal is None:
+            return func()
+        try:
+            return self.journal.run(step, func)
+        except OSError as err:
+            logging.error("Journal write failed: %s", err)
+            raise FatalScriptError(err)
+
+
+class ConnectionPool(object):
+    """Bounded thread-safe pool of database connections.
+
+    Connections are created lazily by the given factory (usually `LoggerMaintenanceScript.connect_db`).
+    """
+
+    def __init__(self, connect, size):
+        """Initialize empty pool.
+
+        :param connect: callable returning new connection
+        :param int size: maximal number of connections
+        """
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._count = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow connection from the pool, wait for one if all of them are in use."""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _acquire(self):
+        with self._lock:
+            # `None` in the queue stands for a free slot for a new connection
+            if self._idle.empty() and self._count < self.size:
+                self._count += 1
+                self._idle.put(None)
+        conn = self._idle.get()
+        if conn is None:
+            try:
+                conn = self.connect()
+            except BaseException:
+                self._idle.put(None)
+                raise
+        return conn
+
+    def _release(self, conn):
+        broken = False
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except (OperationalError, InterfaceError):
+                broken = True
+        if broken or conn.closed:
+            conn.close()
+            self._idle.put(None)
+        else:
+            self._idle.put(conn)
+
+    def closeall(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                conn.close()
+
+
+def run_on_pool(pool, func, items):
+    """Call `func(conn, item)` for each item concurrently, each call with its own pooled connection.
+
+    :param ConnectionPool pool: connection pool, its size limits the number of concurrent calls
+    :param func: function to be called
+    :param items: iterable of items
+
+    :return: ordered dictionary mapping items to FatalScriptError raised by the call or None, other exceptions of
+        the call are logged and wrapped in FatalScriptError, so the remaining items are processed
+    """
+    def work(item):
+        with pool.connection() as conn:
+            func(conn, item)
+
+    results = OrderedDict()
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = [(item, executor.submit(work, item)) for item in items]
+        for item, future in futures:
+            try:
+                future.result()
+            except FatalScriptError as err:
+                results[item] = err
+            except Exception as err:
+                logging.exception("Unexpected error processing %s", item)
+                results[item] = FatalScriptError(err, "{}: {}".format(type(err).__name__, err))
+            else:
+                results[item] = None
+    return results
+
+
+def _parse_policy(config, default):
+    """Return retention policy from the config, missing items are taken from default policy."""
+    values = []
+    for name in RetentionPolicy._fields:
+        value = config.get(name, getattr(default, name))
+        # At least the current month has to be kept
+        minimum = 1 if name == 'keep_months' else 0
+        if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+            raise ConfigError("Incorrect config file - retention `{}` has to be an integer >= {}".format(name, minimum))
+        values.append(value)
+    return RetentionPolicy(*values)
+
+
+def parse_retention(config):
+    """Parse retention section of the configuration.
+
+    Example of the retention section::
+
+        {
+            "default": {"keep_months": 6, "create_months": 1},
+            "services": {
+                "mojeid": {"keep_months": 3},
+                "epp": {"keep_months": 24, "create_months": 3}
+            }
+        }
+
+    :return: dictionary mapping services to their policies, policy for other services is stored under None
+    """
+    try:
+        default = _parse_policy(config.get("default", {}), DEFAULT_RETENTION)
+        retention = {None: default}
+        for service, policy in config.get("services", {}).items():
+            retention[service] = _parse_policy(policy, default)
+    except AttributeError:
+        raise ConfigError("Incorrect config file - retention items have to be objects")
+    return retention
+
+
+def parse_granularity(config):
+    """Parse granularity section of the configuration.
+
+    Example of the granularity section::
+
+        {
+            "default": "month",
+            "services": {"epp": "day", "mojeid": "week"}
+        }
+
+    :return: dictionary mapping services to their granularity, granularity of other services is stored under None
+    """
+    if not isinstance(config, dict) or not isinstance(config.get("services", {}), dict):
+        raise ConfigError("Incorrect config file - granularity and its `services` have to be objects")
+    granularity = {None: config.get("default", MONTH)}
+    granularity.update(config.get("services", {}))
+    for value in granularity.values():
+        if value not in GRANULARITIES:
+            raise ConfigError("Incorrect config file - granularity has to be one of " + ", ".join(GRANULARITIES))
+    return granularity
+
+
+def get_granularity(granularity, service):
+    """Return granularity of partitions of the service, partitions common for all services are monthly."""
+    if not service:
+        return MONTH
+    return granularity.get(service, granularity[None])
+
+
+def is_monthly(granularity):
+    """Return whether partitions of all services are monthly."""
+    return all(value == MONTH for value in granularity.values())
+
+
+def check_granularity_functions(rows, granularity):
+    """Check the database functions taking granularity exist if some service has weekly or daily partitions.
+
+    :param rows: rows of `GRANULARITY_FUNCTIONS_SQL`
+    :raises ConfigError: if any of `GRANULARITY_FUNCTIONS` is missing
+    """
+    if is_monthly(granularity):
+        return
+    present = set(signature for (signature, ) in rows)
+    missing = [function for function in GRANULARITY_FUNCTIONS if function not in present]
+    if missing:
+        raise ConfigError("Weekly and daily partitions need database functions missing in the database: "
+                          + "; ".join(missing))
+
+
+def get_submonthly_services(granularity, services):
+    """Return services of the list which have weekly or daily partitions."""
+    return [service for service in services if get_granularity(granularity, service) != MONTH]
+
+
+def period_start(cur_date, granularity):
+    """Return the first day of the partition period containing the date, weeks start on Monday."""
+    if granularity == DAY:
+        return cur_date
+    if granularity == WEEK:
+        return cur_date - timedelta(days=cur_date.weekday())
+    return add_months(cur_date, 0)
+
+
+def add_periods(cur_date, periods, granularity):
+    """Add given number of partition periods to the date, result is the first day of the period."""
+    if granularity == MONTH:
+        return add_months(cur_date, periods)
+    days = 7 if granularity == WEEK else 1
+    return period_start(cur_date, granularity) + timedelta(days=days * periods)
+
+
+def range_end(date_to, granularity):
+    """Return the last day covered by `--to-date` for the granularity.
+
+    Monthly partitions are given by their first day. For weekly and daily partitions the first day of a month
+    stands for the whole month, other days for themselves.
+    """
+    if granularity == MONTH or date_to.day != 1:
+        return date_to
+    return add_months(date_to, 1) - timedelta(days=1)
+
+
+def create_parts_sql(cursor, date_from, date_to, service=None, granularity=MONTH, skip=()):
+    """Return `create_parts` call creating partitions for the given dates.
+
+    Monthly partitions are created for all services except `skip`, which have their partitions created
+    by calls for the single service with its granularity.
+    """
+    if service is not None:
+        return cursor.mogrify(
+            "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(granularity)s)",
+            {
+                'from': period_start(date_from, granularity).isoformat(),
+                'to': period_start(range_end(date_to, granularity), granularity).isoformat(),
+                'service': service,
+                'granularity': granularity,
+            }
+        )
+    if skip:
+        return cursor.mogrify(
+            "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp, %(skip)s::text[])",
+            {
+                'from': date_from.strftime("%Y-%m-01"),
+                'to': date_to.strftime("%Y-%m-01"),
+                'skip': list(skip),
+            }
+        )
+    return cursor.mogrify(
+        "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp)",
+        {
+            'from': date_from.strftime("%Y-%m-01"),
+            'to': date_to.strftime("%Y-%m-01"),
+        }
+    )
+
+
+def create_parts_statements(cursor, date_from, date_to, granularity, services):
+    """Return `create_parts` calls creating partitions of all services with their granularity for the given dates.
+
+    :param list services: names of all services, needed only if some of them are not monthly
+    """
+    submonthly = get_submonthly_services(granularity, services)
+    statements = [create_parts_sql(cursor, date_from, date_to, skip=submonthly)]
+    for service in submonthly:
+        statements.append(
+            create_parts_sql(cursor, date_from, date_to, service, get_granularity(granularity, service)))
+    return statements
+
+
+def drop_parts_sql(cursor, date_from, date_to, service, dry_run, granularity=MONTH):
+    """Return `drop_parts` call dropping partitions of the service for the given dates."""
+    if granularity != MONTH:
+        return cursor.mogrify(
+            "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s, %(granularity)s)",
+            {
+                'from': period_start(date_from, granularity).isoformat(),
+                'to': period_start(range_end(date_to, granularity), granularity).isoformat(),
+                'service': service,
+                'dry_run': dry_run,
+                'granularity': granularity,
+            }
+        )
+    return cursor.mogrify(
+        "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s)",
+        {
+            'from': date_from.strftime("%Y-%m-01"),
+            'to': date_to.strftime("%Y-%m-01"),
+            'service': service,
+            'dry_run': dry_run
+        }
+    )
+
 
 def add_months(cur_date, months):
     """Add given number of months to the current date.
@@ -137,3 +692,461 @@ def add_months(cur_date, months):
     month = (month-1) % 12 + 1
 
     return date(year, month, 1)
+
+
+def execute_statement(conn, statement):
+    """Execute the statement in its own transaction.
+
+    :raises FatalScriptError: if the statement fails
+    """
+    with conn.cursor() as cursor:
+        try:
+            logging.info(statement)
+            start = time.monotonic()
+            cursor.execute(statement)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            conn.rollback()
+            raise FatalScriptError(err)
+        else:
+            conn.commit()
+            logging.info("Done in %.3f s: %s", time.monotonic() - start, statement)
+
+
+def execute_statements(pool, statements):
+    """Execute statements concurrently, each statement in its own transaction using a pooled connection.
+
+    :return: ordered dictionary mapping statements to FatalScriptError or None
+    """
+    return run_on_pool(pool, execute_statement, statements)
+
+
+def backoff_delay(attempt, base, cap=BACKOFF_CAP):
+    """Compute jittered exponential backoff delay.
+
+    :param int attempt: number of the failed attempt (starting from 0)
+    :param float base: base delay in seconds
+    :param float cap: maximal delay in seconds
+
+    :return: delay in seconds chosen uniformly from <0, min(cap, base * 2^attempt)>
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _execute_autocommit(conn, sql, lock_timeout):
+    """Execute the statement outside of a transaction block with lock timeout set for the session meanwhile."""
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, false)", (str(lock_timeout), ))
+            try:
+                cursor.execute(sql)
+            finally:
+                cursor.execute("RESET lock_timeout")
+    finally:
+        conn.autocommit = False
+
+
+def execute_short_transaction(conn, sql, lock_timeout, retries, backoff, autocommit=False):
+    """Execute the statement in its own transaction, retry it when a lock is not obtained in time.
+
+    :param conn: database connection
+    :param str sql: statement to be executed
+    :param int lock_timeout: lock timeout in milliseconds
+    :param int retries: how many times the statement may be retried after lock timeout
+    :param float backoff: base delay of jittered exponential backoff in seconds
+    :param bool autocommit: execute the statement outside of a transaction block, e.g. statements
+                            `... CONCURRENTLY` which commit by themselves
+
+    :return: tuple (lock wait, hold time) in seconds; lock wait is the time spent in attempts
+             which timed out, hold time is the duration of the successful transaction
+    """
+    wait = 0.0
+    for attempt in range(retries + 1):
+        start = time.monotonic()
+        try:
+            if autocommit:
+                _execute_autocommit(conn, sql, lock_timeout)
+            else:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT set_config('lock_timeout', %s, true)", (str(lock_timeout), ))
+                    cursor.execute(sql)
+                conn.commit()
+        except DatabaseError as err:
+            conn.rollback()
+            if err.pgcode == LOCK_NOT_AVAILABLE:
+                reason = "Lock not available"
+            elif canceled_by_watchdog(conn, err):
+                reason = "Canceled by watchdog"
+            else:
+                raise
+            if attempt == retries:
+                raise
+            wait += time.monotonic() - start
+            delay = backoff_delay(attempt, backoff)
+            logging.warning("%s, retrying in %.2f s (attempt %d of %d)", reason, delay, attempt + 1, retries)
+            time.sleep(delay)
+        else:
+            return wait, time.monotonic() - start
+
+
+def retry_canceled(conn, func, retries, backoff):
+    """Call `func()`, retry it when it fails because the watchdog canceled a statement of the connection.
+
+    :param conn: database connection used by `func`
+    :param func: function raising FatalScriptError, it has to roll back the failed transaction
+    :param int retries: how many times the call may be retried
+    :param float backoff: base delay of jittered exponential backoff in seconds
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except FatalScriptError as err:
+            if attempt == retries or not canceled_by_watchdog(conn, err.error):
+                raise
+            delay = backoff_delay(attempt, backoff)
+            logging.warning("Canceled by watchdog, retrying in %.2f s (attempt %d of %d)", delay, attempt + 1, retries)
+            time.sleep(delay)
+
+
+class LockWaitSampler(threading.Thread):
+    """Thread sampling `pg_stat_activity` for registered backends waiting for a lock.
+
+    Each sample in which a backend waits for a lock accounts one sampling interval to its lock wait.
+    """
+
+    def __init__(self, conn, interval=LOCK_SAMPLE_INTERVAL):
+        """Initialize sampler using its own autocommit connection."""
+        super(LockWaitSampler, self).__init__(name='lock-wait-sampler', daemon=True)
+        self.conn = conn
+        self.conn.autocommit = True
+        self.interval = interval
+        self._waits = {}
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def add_backend(self, pid):
+        """Start sampling the backend."""
+        with self._lock:
+            self._waits.setdefault(pid, 0.0)
+
+    def lock_wait(self, pid):
+        """Return lock wait of the backend accumulated so far."""
+        with self._lock:
+            return self._waits.get(pid, 0.0)
+
+    def finish(self):
+        """Stop sampling and close the connection."""
+        self._finished.set()
+        self.join()
+        self.conn.close()
+
+    def run(self):
+        """Sample lock waits until finished."""
+        while not self._finished.wait(self.interval):
+            with self._lock:
+                pids = list(self._waits)
+            if not pids:
+                continue
+            try:
+                with self.conn.cursor() as cursor:
+                    cursor.execute(LOCK_WAITING_SQL, (pids, ))
+                    waiting = [pid for (pid, ) in cursor.fetchall()]
+            except DatabaseError as err:
+                logging.warning("Lock wait sampling stopped: %s", err)
+                return
+            with self._lock:
+                for pid in waiting:
+                    self._waits[pid] += self.interval
+
+
+class Metrics(object):
+    """Metrics of statements executed during a script run."""
+
+    def __init__(self, script, sampler=None, monitor=None):
+        """Initialize empty metrics of the script.
+
+        :param str script: name of the script, used as a label of exported metrics
+        :param LockWaitSampler sampler: sampler of lock waits, lock waits are not measured if None
+        :param monitor: autocommit connection reading sizes of relations, sizes are not measured if None
+        """
+        self.script = script
+        self.sampler = sampler
+        self.monitor = monitor
+        self._monitor_lock = threading.Lock()
+        self.started = time.time()
+        self.seconds = None
+        self.success = None
+        self.blocking = None
+        self.statements = []
+        self._lock = threading.Lock()
+
+    def lock_wait(self, pid):
+        """Return lock wait of the backend accumulated so far."""
+        return self.sampler.lock_wait(pid) if self.sampler is not None else 0.0
+
+    def relation_sizes(self, oids):
+        """Return dictionary mapping oids of the partitions to tuples (name, size) as committed.
+
+        Missing partitions are left out, no sizes are returned if they are not measured.
+        """
+        if self.monitor is None or not oids:
+            return {}
+        with self._monitor_lock:
+            try:
+                with self.monitor.cursor() as cursor:
+                    cursor.execute(RELATION_SIZES_SQL, (sorted(oids), ))
+                    return {oid: (name, size) for oid, name, size in cursor.fetchall()}
+            except DatabaseError as err:
+                logging.warning("Sizes of relations not measured: %s", err)
+                return {}
+
+    def record(self, statement):
+        """Record metrics of an executed statement."""
+        with self._lock:
+            self.statements.append(statement)
+
+    def finish(self, success):
+        """Stop measuring the run."""
+        if self.sampler is not None:
+            self.sampler.finish()
+        self.seconds = time.time() - self.started
+        self.success = success
+
+    def totals(self):
+        """Return dictionary of aggregated metrics."""
+        relations = set()
+        for statement in self.statements:
+            relations.update(statement.relations)
+        return OrderedDict([
+            ('statements', len(self.statements)),
+            ('failed_statements', sum(1 for statement in self.statements if statement.error)),
+            ('statement_seconds', sum(statement.seconds for statement in self.statements)),
+            ('lock_wait_seconds', sum(statement.lock_wait for statement in self.statements)),
+            ('relations_touched', len(relations)),
+            ('bytes_created', sum(statement.bytes_created for statement in self.statements)),
+            ('bytes_freed', sum(statement.bytes_freed for statement in self.statements)),
+        ] + list((self.blocking or {}).items()))
+
+    def to_dict(self):
+        """Return JSON serializable report."""
+        return OrderedDict([
+            ('script', self.script),
+            ('started', self.started),
+            ('seconds', self.seconds),
+            ('success', self.success),
+            ('totals', self.totals()),
+            ('statements', [statement._asdict() for statement in self.statements]),
+        ])
+
+    def to_textfile(self):
+        """Return metrics in Prometheus text exposition format."""
+        label = '{{script="{}"}}'.format(self.script)
+        values = [
+            ('run_seconds', 'gauge', 'Duration of the last run.', self.seconds or 0),
+            ('last_run_timestamp_seconds', 'gauge', 'Start time of the last run.', self.started),
+            ('last_run_success', 'gauge', 'Whether the last run succeeded.', int(bool(self.success))),
+        ]
+        for name, value in self.totals().items():
+            values.append((name, 'gauge', 'Total {} in the last run.'.format(name.replace('_', ' ')), value))
+
+        lines = []
+        for name, kind, description, value in values:
+            name = METRICS_PREFIX + name
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{}{} {}'.format(name, label, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path, content):
+    """Write file atomically, readers never see a partial file."""
+    with open(path + '.tmp', 'w') as ffile:
+        ffile.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def _query_text(cursor, query):
+    if isinstance(query, sql.Composable):
+        return query.as_string(cursor)
+    if isinstance(query, bytes):
+        return query.decode()
+    return query
+
+
+def _own_locks(conn):
+    # Use a plain cursor, so the query is not measured itself
+    with conn.cursor(cursor_factory=extensions.cursor) as locks_cursor:
+        locks_cursor.execute(OWN_LOCKS_SQL)
+        return set(oid for (oid, ) in locks_cursor.fetchall())
+
+
+def _finish_transaction(conn, end, committed):
+    """End the transaction of the instrumented connection, record metrics of its measured statements.
+
+    Relations touched by a statement are those locked by the transaction after it and not before it. Their sizes
+    are read by the monitoring connection of the metrics as committed before and after the transaction ends, so
+    neither the catalog is scanned nor partitions are measured while the transaction holds its locks.
+
+    :param end: function committing or rolling back the transaction
+    :param bool committed: whether `end` commits, statements of rolled back transactions changed nothing
+    """
+    pending, conn.pending = conn.pending, []
+    if not pending:
+        return end()
+    oids = set().union(*(locks for _, locks in pending)) if committed else set()
+    before = conn.metrics.relation_sizes(oids)
+    try:
+        result = end()
+    except BaseException:
+        for statement, _ in pending:
+            conn.metrics.record(statement)
+        raise
+    after = conn.metrics.relation_sizes(oids)
+    seen = set()
+    for statement, locks in pending:
+        relations, created, freed = [], 0, 0
+        for oid in sorted(locks - seen, key=lambda oid: (before.get(oid) or after.get(oid) or ('', 0))[0]):
+            if oid not in before and oid not in after:
+                continue
+            name, size_before = before.get(oid, (None, 0))
+            name, size_after = after.get(oid, (name, 0))
+            delta = size_after - size_before
+            if delta or (oid in before) != (oid in after):
+                relations.append(name)
+                created += max(delta, 0)
+                freed += max(-delta, 0)
+        seen |= locks
+        conn.metrics.record(statement._replace(relations=relations, bytes_created=created, bytes_freed=freed))
+    return result
+
+
+class InstrumentedCursor(extensions.cursor):
+    """Cursor recording metrics of executed statements to the `metrics` of its connection."""
+
+    def _measured(self, query, func, *args):
+        metrics = self.connection.metrics
+        if metrics is None:
+            return func(*args)
+
+        text = _query_text(self, query)
+        pid = self.connection.get_backend_pid()
+        wait = metrics.lock_wait(pid)
+        start = time.monotonic()
+        error = True
+        try:
+            result = func(*args)
+            error = False
+            return result
+        finally:
+            statement = StatementMetrics(
+                text, time.monotonic() - start, metrics.lock_wait(pid) - wait, [], 0, 0, error)
+            if MEASURED_SQL_RE.match(text) and not error and not self.connection.autocommit:
+                # Sizes are measured when the transaction ends
+                self.connection.pending.append((statement, _own_locks(self.connection)))
+            else:
+                metrics.record(statement)
+
+    def execute(self, query, vars=None):
+        """Execute the statement and record its metrics."""
+        return self._measured(query, super(InstrumentedCursor, self).execute, query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        """Execute COPY and record its metrics."""
+        return self._measured(sql, super(InstrumentedCursor, self).copy_expert, sql, file, size)
+
+
+class InstrumentedConnection(extensions.connection):
+    """Connection creating cursors which record metrics of executed statements, watched by the watchdog."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize connection without metrics and watchdog."""
+        super(InstrumentedConnection, self).__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+        self.metrics = None
+        self.watchdog = None
+        # Measured statements of the current transaction with relations locked after them
+        self.pending = []
+
+    def commit(self):
+        """Commit the transaction, record metrics of its statements."""
+        return _finish_transaction(self, super(InstrumentedConnection, self).commit, True)
+
+    def rollback(self):
+        """Roll back the transaction, record metrics of its statements."""
+        return _finish_transaction(self, super(InstrumentedConnection, self).rollback, False)
+
+
+def instrumented(script):
+    """Decorate `execute` method of the script to collect metrics, watch blocked sessions and keep journal.
+
+    Metrics are collected only if the script has `metrics_file` or `report_file` argument set, the watchdog runs
+    only if the script has `watchdog` argument set and the journal is kept only if the script has `journal_file`
+    argument set.
+
+    :param str script: name of the script used in metrics
+    """
+    def decorator(execute):
+        @wraps(execute)
+        def wrapper(self):
+            self.start_metrics(script)
+            success = False
+            try:
+                self.open_journal(script)
+                self.start_watchdog()
+                try:
+                    result = execute(self)
+                finally:
+                    self.finish_watchdog()
+                success = True
+                return result
+            finally:
+                self.close_journal(success)
+                self.finish_metrics(success)
+        return wrapper
+    return decorator
+
+
+def add_metrics_arguments(parser):
+    """Add arguments of metrics export to the argument parser."""
+    parser.add_argument(
+        "--metrics-file", dest="metrics_file",
+        help="write metrics to the file in Prometheus textfile format (i.e. for node exporter)"
+    )
+    parser.add_argument(
+        "--report-file", dest="report_file",
+        help="write JSON report with metrics of each statement to the file"
+    )
+
+
+def add_journal_arguments(parser):
+    """Add arguments of the journal of steps to the argument parser."""
+    parser.add_argument(
+        "--journal", dest="journal_file",
+        help="keep started and done steps in the file, a rerun with the same arguments after an interrupted run "
+             "skips done steps"
+    )
+
+
+def add_watchdog_arguments(parser):
+    """Add arguments of the watchdog of blocked sessions to the argument parser."""
+    parser.add_argument(
+        "--watchdog", action='store_true',
+        help="cancel our statement if it blocks too many sessions or for too long, retry it later"
+    )
+    parser.add_argument(
+        "--max-blocked", dest="max_blocked", type=int, default=5,
+        help="maximal number of sessions blocked by our statement (--watchdog only, default 5)"
+    )
+    parser.add_argument(
+        "--max-block-wait", dest="max_block_wait", type=float, default=10.0,
+        help="maximal time in seconds a session may be blocked by our statement (--watchdog only, default 10)"
+    )
+    parser.add_argument(
+        "--cancel-retries", dest="cancel_retries", type=int, default=3,
+        help="how many times a transaction canceled by the watchdog is retried (--watchdog only, default 3)"
+    )
+    parser.add_argument(
+        "--cancel-backoff", dest="cancel_backoff", type=float, default=10.0,
+        help="base delay in seconds of backoff before retrying canceled transaction (--watchdog only, default 10)"
+    )
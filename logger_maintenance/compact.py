@@ -0,0 +1,354 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for rewriting closed logger partitions ordered by time.
+
+A partition is copied into a new table ordered by its time column while it is locked in SHARE mode, so it can be
+read but not written. Indexes and constraints are built on the new table afterwards. Only the final swap of the
+tables takes an exclusive lock; it is done under a savepoint with lock timeout and retried, so the copy is not lost
+when the lock is not obtained in time. Rewritten tables are marked by a comment.
+"""
+import logging
+import re
+import threading
+import time
+from collections import namedtuple
+
+from psycopg2 import DatabaseError, sql
+from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
+
+from logger_maintenance.common import FatalScriptError, add_months, backoff_delay, run_on_pool
+
+COMPACTED_COMMENT = 'logger-maintenance: compacted'
+# Partitions of these parents are ordered by the column
+TIME_COLUMNS = {
+    'request': 'time_begin',
+    'request_data': 'request_time_begin',
+    'request_property_value': 'request_time_begin',
+    'session': 'login_date',
+}
+COMPACT_SUFFIX = '_compact'
+
+COMPACTED_TABLES_SQL = """
+    SELECT c.relname
+      FROM pg_class c
+      JOIN pg_description d ON d.objoid = c.oid AND d.classoid = 'pg_class'::regclass AND d.objsubid = 0
+     WHERE c.relkind = 'r'
+       AND d.description = %s
+"""
+TABLE_INFO_SQL = """
+    SELECT pg_get_userbyid(c.relowner),
+           EXISTS (SELECT 1 FROM pg_trigger t WHERE t.tgrelid = c.oid AND NOT t.tgisinternal),
+           EXISTS (SELECT 1 FROM pg_constraint r WHERE r.confrelid = c.oid)
+      FROM pg_class c
+     WHERE c.oid = %s::regclass
+"""
+# Partitions are not declarative before PostgreSQL 10
+PARTITION_BOUND_SQL = "SELECT CASE WHEN relispartition THEN pg_get_expr(relpartbound, oid) END FROM pg_class " \
+                      "WHERE oid = %s::regclass"
+GRANTS_SQL = """
+    SELECT a.grantee = 0, pg_get_userbyid(a.grantee), a.privilege_type
+      FROM pg_class c, aclexplode(c.relacl) a
+     WHERE c.oid = %s::regclass AND a.grantee <> c.relowner
+     ORDER BY 2, 3
+"""
+# Constraints backed by an index are created with temporary names, foreign keys with their own
+CONSTRAINTS_SQL = """
+    SELECT conname, contype IN ('p', 'u', 'x'), pg_get_constraintdef(oid)
+      FROM pg_constraint
+     WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'x', 'f')
+     ORDER BY conname
+"""
+INDEXES_SQL = """
+    SELECT c.relname, pg_get_indexdef(i.indexrelid)
+      FROM pg_index i
+      JOIN pg_class c ON c.oid = i.indexrelid
+     WHERE i.indrelid = %s::regclass
+       AND NOT EXISTS (SELECT 1 FROM pg_constraint n WHERE n.conindid = i.indexrelid)
+     ORDER BY c.relname
+"""
+INDEX_DEF_RE = re.compile(r'^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+ (USING .*)$')
+
+CompactResult = namedtuple('CompactResult', ['table', 'size_before', 'size_after', 'rows', 'lock_wait', 'hold'])
+CompactResult.__doc__ = """Result of a rewritten partition.
+
+Sizes include indexes and TOAST, lock wait and hold are times in seconds of the final swap.
+"""
+
+
+class CompactError(Exception):
+    """Raised when the partition can not be rewritten safely."""
+
+    def __init__(self, message):
+        """Initialize error message."""
+        self.message = message
+
+    def __str__(self):
+        """Return error message."""
+        return self.message
+
+
+def get_compacted_tables(conn):
+    """Return set of names of tables rewritten by previous runs."""
+    with conn.cursor() as cursor:
+        cursor.execute(COMPACTED_TABLES_SQL, (COMPACTED_COMMENT, ))
+        tables = {table for (table, ) in cursor.fetchall()}
+    conn.rollback()
+    return tables
+
+
+def plan_compact(partitions, today, compacted=(), services=None, date_from=None, date_to=None):
+    """Return partitions of closed months to be rewritten, the oldest first.
+
+    :param partitions: list of `catalog.Partition`
+    :param date today: current date, partitions of the current and later months are never rewritten
+    :param compacted: names of tables rewritten by previous runs, these are skipped
+    :param services: list of services or None for all services
+    :param date date_from: first month or None for no limit
+    :param date date_to: last month or None for no limit
+    """
+    current = add_months(today, 0)
+    selected = []
+    for part in partitions:
+        if part.parent not in TIME_COLUMNS or part.month >= current or part.table in compacted:
+            continue
+        if services is not None and part.service not in services:
+            continue
+        if (date_from is not None and part.month < date_from) or (date_to is not None and part.month > date_to):
+            continue
+        selected.append(part)
+    return sorted(selected, key=lambda part: (part.month, part.table))
+
+
+class IOBudget(object):
+    """Thread-safe limit of the average rate of rewritten bytes."""
+
+    def __init__(self, rate):
+        """Initialize budget with rate in bytes per second, None for unlimited."""
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """Wait until rewrite of `size` bytes fits into the budget."""
+        if not self.rate:
+            return
+        with self._lock:
+            start = max(self._next, time.monotonic())
+            self._next = start + size / self.rate
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _with_tablespace(definition, clause):
+    """Return index or constraint definition with the tablespace clause, which has to precede the predicate."""
+    if clause is None:
+        return sql.SQL(definition)
+    head, where, predicate = definition.partition(' WHERE ')
+    return sql.SQL("{} {}{}").format(sql.SQL(head), clause, sql.SQL(where + predicate))
+
+
+def _index_sql(indexdef, name, table, tablespace=None):
+    """Return definition of the index on another table with another name."""
+    match = INDEX_DEF_RE.match(indexdef)
+    if match is None:
+        raise CompactError("Unsupported index definition: " + indexdef)
+    clause = sql.SQL("TABLESPACE {}").format(sql.Identifier(tablespace)) if tablespace is not None else None
+    return sql.SQL("CREATE {}INDEX {} ON {} {}").format(
+        sql.SQL(match.group(1) or ''), sql.Identifier(name), sql.Identifier(table),
+        _with_tablespace(match.group(3), clause))
+
+
+def _rebuild(cursor, table, new_table, time_column, fillfactor, tablespace):
+    """Copy the table into a new one ordered by time, build its indexes and constraints.
+
+    :return: tuple (number of rows, list of (temporary name, name) of indexes to be renamed)
+    """
+    table_id, new_id = sql.Identifier(table), sql.Identifier(new_table)
+    cursor.execute(
+        sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE){}{}").format(
+            new_id, table_id,
+            sql.SQL(" WITH (fillfactor = {})").format(sql.Literal(fillfactor)) if fillfactor else sql.SQL(''),
+            sql.SQL(" TABLESPACE {}").format(sql.Identifier(tablespace)) if tablespace is not None else sql.SQL('')))
+    cursor.execute(sql.SQL("INSERT INTO {} SELECT * FROM {}{}").format(
+        new_id, table_id,
+        sql.SQL(" ORDER BY {}").format(sql.Identifier(time_column)) if time_column is not None else sql.SQL('')))
+    rows = cursor.rowcount
+
+    renames = []
+    cursor.execute(CONSTRAINTS_SQL, (table, ))
+    for number, (name, indexed, definition) in enumerate(cursor.fetchall()):
+        clause = None
+        if indexed:
+            temporary = "{}_{}".format(new_table, number)
+            renames.append((temporary, name))
+            if tablespace is not None:
+                clause = sql.SQL("USING INDEX TABLESPACE {}").format(sql.Identifier(tablespace))
+        else:
+            temporary = name
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            new_id, sql.Identifier(temporary), _with_tablespace(definition, clause)))
+    cursor.execute(INDEXES_SQL, (table, ))
+    for number, (name, indexdef) in enumerate(cursor.fetchall()):
+        temporary = "{}_i{}".format(new_table, number)
+        renames.append((temporary, name))
+        cursor.execute(_index_sql(indexdef, temporary, new_table, tablespace))
+    cursor.execute(sql.SQL("ANALYZE {}").format(new_id))
+    return rows, renames
+
+
+def _copy_privileges(cursor, table, new_table, owner):
+    new_id = sql.Identifier(new_table)
+    cursor.execute(GRANTS_SQL, (table, ))
+    for public, grantee, privilege in cursor.fetchall():
+        cursor.execute(sql.SQL("GRANT {} ON {} TO {}").format(
+            sql.SQL(privilege), new_id, sql.SQL('PUBLIC') if public else sql.Identifier(grantee)))
+    cursor.execute(sql.SQL("ALTER TABLE {} OWNER TO {}").format(new_id, sql.Identifier(owner)))
+
+
+def _swap_sql(table, new_table, parent, bound, renames):
+    """Return statement replacing the table by the new one."""
+    table_id, new_id, parent_id = sql.Identifier(table), sql.Identifier(new_table), sql.Identifier(parent)
+    if bound is None:
+        statements = [
+            sql.SQL("ALTER TABLE {} NO INHERIT {}").format(table_id, parent_id),
+            sql.SQL("ALTER TABLE {} INHERIT {}").format(new_id, parent_id),
+        ]
+    else:
+        statements = [
+            sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(parent_id, table_id),
+            sql.SQL("ALTER TABLE {} ATTACH PARTITION {} {}").format(parent_id, new_id, sql.SQL(bound)),
+        ]
+    statements.append(sql.SQL("DROP TABLE {}").format(table_id))
+    statements.append(sql.SQL("ALTER TABLE {} RENAME TO {}").format(new_id, table_id))
+    for temporary, name in renames:
+        statements.append(
+            sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(temporary), sql.Identifier(name)))
+    statements.append(sql.SQL("COMMENT ON TABLE {} IS {}").format(table_id, sql.Literal(COMPACTED_COMMENT)))
+    return sql.SQL("; ").join(statements)
+
+
+def _swap(conn, cursor, swap, lock_timeout, retries, backoff):
+    """Execute the swap under a savepoint, retry it when a lock is not obtained in time.
+
+    :return: tuple (lock wait, hold time) in seconds
+    """
+    wait = 0.0
+    for attempt in range(retries + 1):
+        start = time.monotonic()
+        cursor.execute("SAVEPOINT swap")
+        try:
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (str(lock_timeout), ))
+            cursor.execute(swap)
+            cursor.execute("SELECT set_config('lock_timeout', '0', true)")
+        except DatabaseError as err:
+            if err.pgcode != LOCK_NOT_AVAILABLE or attempt == retries:
+                raise
+            cursor.execute("ROLLBACK TO SAVEPOINT swap")
+            wait += time.monotonic() - start
+            delay = backoff_delay(attempt, backoff)
+            logging.warning("Lock not available, retrying in %.2f s (attempt %d of %d)", delay, attempt + 1, retries)
+            time.sleep(delay)
+        else:
+            conn.commit()
+            return wait, time.monotonic() - start
+
+
+def compact_table(conn, table, parent, fillfactor=None, tablespace=None, lock_timeout=1000, retries=5, backoff=0.5):
+    """Rewrite the partition ordered by time and replace it in a single transaction.
+
+    :param conn: database connection
+    :param str table: name of the partition
+    :param str parent: name of its parent, partitions of parents missing in `TIME_COLUMNS` are not ordered
+    :param int fillfactor: fillfactor of the new table or None to keep the default
+    :param str tablespace: tablespace of the new table and its indexes or None for the default tablespace
+    :param int lock_timeout: lock timeout in milliseconds of locking the partition and of the swap
+    :param int retries: how many times the swap is retried after lock timeout
+    :param float backoff: base delay of jittered exponential backoff in seconds
+
+    :return: CompactResult
+    :raises CompactError: if the partition has triggers or is referenced by a foreign key
+    """
+    new_table = table + COMPACT_SUFFIX
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(TABLE_INFO_SQL, (table, ))
+            owner, has_triggers, referenced = cursor.fetchone()
+            if has_triggers or referenced:
+                raise CompactError("Table {} has triggers or is referenced by a foreign key".format(table))
+            bound = None
+            if conn.server_version >= 100000:
+                cursor.execute(PARTITION_BOUND_SQL, (table, ))
+                bound = cursor.fetchone()[0]
+
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (str(lock_timeout), ))
+            cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(sql.Identifier(table)))
+            cursor.execute("SELECT set_config('lock_timeout', '0', true)")
+            cursor.execute("SELECT pg_total_relation_size(%s::regclass)", (table, ))
+            size_before = cursor.fetchone()[0]
+
+            rows, renames = _rebuild(cursor, table, new_table, TIME_COLUMNS.get(parent), fillfactor, tablespace)
+            _copy_privileges(cursor, table, new_table, owner)
+            cursor.execute("SELECT pg_total_relation_size(%s::regclass)", (new_table, ))
+            size_after = cursor.fetchone()[0]
+
+            wait, hold = _swap(
+                conn, cursor, _swap_sql(table, new_table, parent, bound, renames), lock_timeout, retries, backoff)
+    except BaseException:
+        conn.rollback()
+        raise
+    return CompactResult(table, size_before, size_after, rows, wait, hold)
+
+
+def compact_tables(pool, partitions, budget, may_start=None, **kwargs):
+    """Rewrite partitions concurrently, each partition using its own connection from the pool.
+
+    :param ConnectionPool pool: connection pool
+    :param partitions: list of `catalog.Partition`
+    :param IOBudget budget: limit of rewritten bytes, size of a partition including indexes is reserved before
+                            it is rewritten
+    :param may_start: callable returning whether a partition may be started now, None to start all of them
+    :param kwargs: arguments of `compact_table`
+
+    :return: tuple (ordered dictionary mapping partitions to FatalScriptError or None, list of CompactResult,
+             list of partitions which were not started)
+    """
+    done = []
+    skipped = []
+
+    def work(conn, part):
+        budget.reserve(part.size + part.index_size)
+        if may_start is not None and not may_start():
+            skipped.append(part)
+            return
+        start = time.monotonic()
+        try:
+            result = compact_table(conn, part.table, part.parent, **kwargs)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except CompactError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        done.append(result)
+        logging.info("Rewrote %s (%d rows, %d -> %d bytes, lock wait %.3f s, hold %.3f s) in %.3f s",
+                     result.table, result.rows, result.size_before, result.size_after, result.lock_wait,
+                     result.hold, time.monotonic() - start)
+
+    return run_on_pool(pool, work, partitions), done, skipped
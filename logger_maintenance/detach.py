@@ -0,0 +1,230 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for two-phase removal of logger partitions.
+
+In the first phase partitions are detached from their parents in short transactions. Detached tables are marked
+by a comment, so tables which were detached but not dropped may be found by later runs. In the second phase
+detached tables are dropped by a background thread, no lock on parent tables is needed.
+"""
+import logging
+import queue
+import threading
+import time
+
+from psycopg2 import DatabaseError, InterfaceError, sql
+
+from logger_maintenance.common import FatalScriptError, execute_short_transaction
+
+DETACHED_COMMENT = 'logger-maintenance: detached'
+# Server version supporting DETACH PARTITION CONCURRENTLY
+DETACH_CONCURRENTLY_VERSION = 140000
+
+PARENTS_SQL = """
+    SELECT p.relname, c.relispartition, i.inhdetachpending
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      JOIN pg_class p ON p.oid = i.inhparent
+     WHERE i.inhrelid = %s::regclass
+"""
+# Partitions can not be detached concurrently before PostgreSQL 14
+PARENTS_SQL_NO_CONCURRENT = """
+    SELECT p.relname, c.relispartition, false
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      JOIN pg_class p ON p.oid = i.inhparent
+     WHERE i.inhrelid = %s::regclass
+"""
+# Partitions are not declarative before PostgreSQL 10
+PARENTS_SQL_LEGACY = """
+    SELECT p.relname, false, false
+      FROM pg_inherits i
+      JOIN pg_class p ON p.oid = i.inhparent
+     WHERE i.inhrelid = %s::regclass
+"""
+DETACH_PENDING_SQL = """
+    SELECT inhdetachpending
+      FROM pg_inherits
+     WHERE inhrelid = %s::regclass AND inhparent = %s::regclass
+"""
+DETACHED_TABLES_SQL = """
+    SELECT c.relname
+      FROM pg_class c
+      JOIN pg_description d ON d.objoid = c.oid AND d.classoid = 'pg_class'::regclass AND d.objsubid = 0
+     WHERE c.relkind IN ('r', 'p')
+       AND d.description = %s
+     ORDER BY c.relname
+"""
+
+
+def get_detached_tables(conn):
+    """Return names of tables detached but not dropped yet."""
+    with conn.cursor() as cursor:
+        cursor.execute(DETACHED_TABLES_SQL, (DETACHED_COMMENT, ))
+        tables = [table for (table, ) in cursor.fetchall()]
+    conn.rollback()
+    return tables
+
+
+def detach_table(conn, table, lock_timeout, retries, backoff):
+    """Detach the table from all its parents and mark it as detached.
+
+    Declarative partitions are detached concurrently where server supports it, inherited tables are detached
+    by `NO INHERIT` in a short transaction. Lock timeouts are retried, see `execute_short_transaction`.
+    Concurrent detach commits by itself, so the table is marked before it; a detach left pending by an
+    interrupted run or a failed attempt is finalized.
+
+    :return: tuple (lock wait, hold time) in seconds summed over all parents
+    """
+    concurrently = conn.server_version >= DETACH_CONCURRENTLY_VERSION
+    with conn.cursor() as cursor:
+        if concurrently:
+            cursor.execute(PARENTS_SQL, (table, ))
+        elif conn.server_version >= 100000:
+            cursor.execute(PARENTS_SQL_NO_CONCURRENT, (table, ))
+        else:
+            cursor.execute(PARENTS_SQL_LEGACY, (table, ))
+        parents = cursor.fetchall()
+    conn.rollback()
+
+    table_id = sql.Identifier(table)
+    mark = sql.SQL("COMMENT ON TABLE {} IS {}").format(table_id, sql.Literal(DETACHED_COMMENT))
+    total_wait, total_hold = 0.0, 0.0
+    marked = False
+    if any(detach_pending or (is_partition and concurrently) for _, is_partition, detach_pending in parents):
+        # Table detached by a statement which commits by itself can not get lost
+        total_wait, total_hold = execute_short_transaction(conn, mark, lock_timeout, retries, backoff)
+        marked = True
+    for parent, is_partition, detach_pending in parents:
+        parent_id = sql.Identifier(parent)
+        finalize = sql.SQL("ALTER TABLE {} DETACH PARTITION {} FINALIZE").format(parent_id, table_id)
+        if detach_pending:
+            # Finish detach interrupted by a previous run
+            wait, hold = execute_short_transaction(conn, finalize, lock_timeout, retries, backoff)
+        elif is_partition and concurrently:
+            try:
+                wait, hold = execute_short_transaction(
+                    conn, sql.SQL("ALTER TABLE {} DETACH PARTITION {} CONCURRENTLY").format(parent_id, table_id),
+                    lock_timeout, retries, backoff, autocommit=True)
+            except DatabaseError as err:
+                if not _is_detach_pending(conn, table, parent):
+                    raise
+                logging.warning("Detach of %s from %s interrupted (%s), finalizing", table, parent, str(err).strip())
+                wait, hold = execute_short_transaction(conn, finalize, lock_timeout, retries, backoff)
+        else:
+            if is_partition:
+                detach = sql.SQL("ALTER TABLE {} DETACH PARTITION {}; ").format(parent_id, table_id)
+            else:
+                detach = sql.SQL("ALTER TABLE {} NO INHERIT {}; ").format(table_id, parent_id)
+            # Table is marked in the same transaction, so it can not get lost
+            wait, hold = execute_short_transaction(conn, detach + mark, lock_timeout, retries, backoff)
+            marked = True
+        total_wait += wait
+        total_hold += hold
+
+    if not marked:
+        execute_short_transaction(conn, mark, lock_timeout, retries, backoff)
+    return total_wait, total_hold
+
+
+def _is_detach_pending(conn, table, parent):
+    """Return whether detach of the table from the parent is pending, i.e. it has to be finalized."""
+    with conn.cursor() as cursor:
+        cursor.execute(DETACH_PENDING_SQL, (table, parent))
+        row = cursor.fetchone()
+    conn.rollback()
+    return bool(row and row[0])
+
+
+def drop_detached_table(conn, table):
+    """Drop the detached table, refuse to drop tables which are still attached or not marked as detached.
+
+    :return: True if table was dropped
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT obj_description(%(table)s::regclass, 'pg_class') = %(comment)s "
+            "   AND NOT EXISTS (SELECT 1 FROM pg_inherits WHERE inhrelid = %(table)s::regclass)",
+            {'table': table, 'comment': DETACHED_COMMENT})
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            logging.warning("Table %s is not detached, not dropped", table)
+            return False
+        cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(table)))
+    conn.commit()
+    return True
+
+
+class DetachedTablesDropper(threading.Thread):
+    """Background thread dropping detached tables one by one with delay between drops."""
+
+    def __init__(self, connect, delay):
+        """Initialize dropper.
+
+        :param connect: callable returning new connection
+        :param float delay: delay in seconds after each dropped table
+        """
+        super(DetachedTablesDropper, self).__init__(name="dropper", daemon=True)
+        self.connect = connect
+        self.delay = delay
+        self.dropped = []
+        self.failed = []
+        self._queue = queue.Queue()
+
+    def add(self, table):
+        """Schedule drop of the detached table."""
+        self._queue.put(table)
+
+    def finish(self):
+        """Wait until all scheduled tables are dropped."""
+        self._queue.put(None)
+        self.join()
+
+    @staticmethod
+    def _reset(conn):
+        """Roll back the failed transaction, return None if the connection is broken, so a new one is opened."""
+        try:
+            conn.rollback()
+            return conn
+        except (DatabaseError, InterfaceError) as err:
+            logging.error("Connection of dropper lost: %s", str(err).strip())
+            conn.close()
+            return None
+
+    def run(self):
+        """Drop scheduled tables until finished."""
+        conn = None
+        try:
+            for table in iter(self._queue.get, None):
+                try:
+                    if conn is None:
+                        conn = self.connect()
+                    start = time.monotonic()
+                    if drop_detached_table(conn, table):
+                        self.dropped.append(table)
+                        logging.info("Dropped detached table %s (%.3f s)", table, time.monotonic() - start)
+                except (DatabaseError, InterfaceError) as err:
+                    logging.error("Dropping detached table %s failed: %s", table, str(err).strip())
+                    self.failed.append(table)
+                    conn = self._reset(conn)
+                except FatalScriptError:
+                    self.failed.append(table)
+                time.sleep(self.delay)
+        finally:
+            if conn is not None:
+                conn.close()
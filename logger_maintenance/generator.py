@@ -0,0 +1,315 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for generating synthetic logger data.
+
+Data are split into units, i.e. chunks of requests of a single service and month. Every request row, its request
+and response data, its properties and its session are derived from the index of the request within the month, so rows
+of all tables of a unit are generated independently by separate `COPY ... FROM STDIN` without keeping them in memory.
+Rows are encoded in batches directly in COPY text format.
+"""
+import calendar
+import time
+from collections import namedtuple
+
+from psycopg2 import sql
+
+# Number of requests encoded in a single batch
+BATCH_SIZE = 1000
+# Number of payload variants of different sizes
+PAYLOAD_VARIANTS = 16
+
+REQUEST_COLUMNS = ('id', 'time_begin', 'time_end', 'source_ip', 'service_id', 'request_type_id', 'user_name',
+                   'session_id', 'is_monitoring')
+REQUEST_DATA_COLUMNS = ('request_time_begin', 'request_service_id', 'request_monitoring', 'request_id', 'content',
+                        'is_response')
+REQUEST_PROPERTY_VALUE_COLUMNS = ('request_time_begin', 'request_service_id', 'request_monitoring', 'id',
+                                  'request_id', 'property_name_id', 'value', 'output')
+SESSION_COLUMNS = ('id', 'user_name', 'login_date', 'logout_date')
+
+Unit = namedtuple('Unit', ['service_id', 'postfix', 'month', 'month_count', 'start', 'count', 'first_id',
+                           'first_property_id', 'first_session_id'])
+Unit.__doc__ = """Chunk of generated requests of a single service and month.
+
+Requests with indexes `start` to `start + count - 1` of `month_count` requests of the month are generated,
+request ids start by `first_id`, property ids by `first_property_id`. Request with index `i` belongs to the session
+with id `first_session_id + i // session_size` of the service and month, the session is generated by the unit
+of its first request.
+"""
+
+Options = namedtuple('Options', ['payload_size', 'properties', 'request_types', 'property_names', 'rate',
+                                 'session_size'])
+Options.__doc__ = """Generator options.
+
+Payload size is the mean size of request data in bytes, `properties` is the number of properties of each request,
+`request_types` maps service ids to lists of request type ids, `property_names` is a list of property name ids,
+`rate` is the maximal number of rows of all tables per second of a single worker (None for unlimited),
+`session_size` is the number of consecutive requests sharing a session (0 for requests without sessions).
+"""
+
+
+def split_counts(total, weights):
+    """Split total count according to weights, sum of the result is equal to total.
+
+    :param int total: total count
+    :param weights: list of (key, weight)
+    :return: list of (key, count)
+    """
+    weight_sum = float(sum(weight for _, weight in weights))
+    result = []
+    assigned = 0
+    cumulative = 0.0
+    for key, weight in weights:
+        cumulative += weight
+        count = int(round(total * cumulative / weight_sum)) - assigned
+        assigned += count
+        result.append((key, count))
+    return result
+
+
+def count_sessions(start, count, session_size):
+    """Return number of sessions starting by requests with indexes `start` to `start + count - 1`."""
+    if not session_size:
+        return 0
+    return (start + count - 1) // session_size - (start - 1) // session_size
+
+
+def plan_units(counts, first_id, first_property_id, properties, chunk_size, first_session_id=0, session_size=0):
+    """Split counts of requests into units.
+
+    :param counts: list of ((service_id, postfix, month), count)
+    :param int first_id: the first request id
+    :param int first_property_id: the first property id
+    :param int properties: number of properties per request
+    :param int chunk_size: maximal number of requests in a unit
+    :param int first_session_id: the first session id
+    :param int session_size: number of requests per session, 0 for no sessions
+    :return: list of units
+    """
+    units = []
+    for (service_id, postfix, month), count in counts:
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            units.append(Unit(service_id, postfix, month, count, start, size, first_id, first_property_id,
+                              first_session_id))
+            first_id += size
+            first_property_id += size * properties
+        first_session_id += count_sessions(0, count, session_size)
+    return units
+
+
+def make_payloads(size):
+    """Return payloads of sizes spread around given mean size."""
+    base = b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789<>/="'
+    payloads = []
+    for variant in range(PAYLOAD_VARIANTS):
+        length = max(1, size // 2 + size * variant // (PAYLOAD_VARIANTS - 1))
+        payloads.append((base * (length // len(base) + 1))[:length])
+    return payloads
+
+
+class UnitEncoder(object):
+    """Encoder of rows of a single unit in COPY text format."""
+
+    def __init__(self, unit, options):
+        """Initialize encoder and precompute values shared by all rows."""
+        self.unit = unit
+        self.options = options
+        days = calendar.monthrange(unit.month.year, unit.month.month)[1]
+        self.span = days * 86400
+        self.prefix = unit.month.strftime("%Y-%m-").encode()
+        self.payloads = make_payloads(options.payload_size)
+        self.service = str(unit.service_id).encode()
+        self.request_types = [str(type_id).encode() for type_id in options.request_types.get(unit.service_id, [])]
+        self.property_names = [str(name_id).encode() for name_id in options.property_names]
+
+    def _user(self, index):
+        """Return user name of the request with given index, requests of a session share the user."""
+        if self.options.session_size:
+            index -= index % self.options.session_size
+        return b'user%d' % (index % 1000)
+
+    def _time(self, index):
+        """Return time of the request with given index within the month."""
+        offset = index * self.span // self.unit.month_count
+        day, offset = divmod(offset, 86400)
+        hour, offset = divmod(offset, 3600)
+        return b'%s%02d %02d:%02d:%02d' % (self.prefix, day + 1, hour, offset // 60, offset % 60)
+
+    def batches(self, encode_row):
+        """Yield encoded batches of rows, rows of each request are encoded by `encode_row`."""
+        unit = self.unit
+        for batch_start in range(unit.start, unit.start + unit.count, BATCH_SIZE):
+            rows = []
+            for index in range(batch_start, min(batch_start + BATCH_SIZE, unit.start + unit.count)):
+                encode_row(rows, index, unit.first_id + index - unit.start, self._time(index))
+            yield b''.join(rows)
+
+    def encode_request(self, rows, index, request_id, time_begin):
+        """Encode request row."""
+        request_type = self.request_types[index % len(self.request_types)] if self.request_types else b'\\N'
+        session_size = self.options.session_size
+        session = b'%d' % (self.unit.first_session_id + index // session_size) if session_size else b'\\N'
+        rows.append(b'%d\t%s\t%s.5\t10.%d.%d.%d\t%s\t%s\t%s\t%s\tf\n' % (
+            request_id, time_begin, time_begin, index >> 16 & 255, index >> 8 & 255, index & 255, self.service,
+            request_type, self._user(index), session))
+
+    def encode_session(self, rows, index, request_id, time_begin):
+        """Encode session row if the request is the first one of its session."""
+        session_size = self.options.session_size
+        if index % session_size:
+            return
+        last = min(index + session_size, self.unit.month_count) - 1
+        rows.append(b'%d\t%s\t%s\t%s.5\n' % (
+            self.unit.first_session_id + index // session_size, self._user(index), time_begin, self._time(last)))
+
+    def encode_request_data(self, rows, index, request_id, time_begin):
+        """Encode request and response data rows."""
+        payloads = self.payloads
+        rows.append(b'%s\t%s\tf\t%d\t%s\tf\n' % (
+            time_begin, self.service, request_id, payloads[index % PAYLOAD_VARIANTS]))
+        rows.append(b'%s\t%s\tf\t%d\t%s\tt\n' % (
+            time_begin, self.service, request_id, payloads[(index * 7 + 3) % PAYLOAD_VARIANTS]))
+
+    def encode_request_property_value(self, rows, index, request_id, time_begin):
+        """Encode property rows."""
+        count = self.options.properties
+        first = self.unit.first_property_id + (request_id - self.unit.first_id) * count
+        names = self.property_names
+        for number in range(count):
+            rows.append(b'%s\t%s\tf\t%d\t%d\t%s\tvalue-%d-%d\t%s\n' % (
+                time_begin, self.service, first + number, request_id, names[(index + number) % len(names)],
+                index, number, b't' if number % 2 else b'f'))
+
+
+class Throttle(object):
+    """Limit rate of processed rows."""
+
+    def __init__(self, rate):
+        """Initialize throttle with rate in rows per second, None for unlimited."""
+        self.rate = rate
+        self.done = 0
+        self.start = time.monotonic()
+
+    def wait(self, count):
+        """Account processed rows, sleep to keep the rate."""
+        self.done += count
+        if self.rate:
+            delay = self.done / self.rate - (time.monotonic() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+
+
+class BatchReader(object):
+    """File-like object returning batches for `copy_expert`."""
+
+    def __init__(self, batches, on_batch=None):
+        """Initialize reader from iterator of batches and optional callback called with each returned batch."""
+        self._batches = batches
+        self._on_batch = on_batch
+        self.size = 0
+
+    def read(self, size=-1):
+        """Return next batch, empty bytes at the end."""
+        for batch in self._batches:
+            if not batch:
+                # Empty bytes would end COPY, i.e. batch of requests none of which starts a session
+                continue
+            if self._on_batch is not None:
+                self._on_batch(batch)
+            self.size += len(batch)
+            return batch
+        return b''
+
+
+def _copy(cursor, table, columns, reader):
+    cursor.copy_expert(
+        sql.SQL("COPY {} ({}) FROM STDIN").format(
+            sql.Identifier(table), sql.SQL(', ').join(sql.Identifier(column) for column in columns)),
+        reader)
+
+
+def generate_unit(conn, unit, options, throttle=None):
+    """Generate all rows of the unit and commit them.
+
+    :return: dictionary mapping tables to number of rows
+    """
+    encoder = UnitEncoder(unit, options)
+    suffix = unit.postfix + unit.month.strftime("%y_%m")
+    session_table = 'session_' + unit.month.strftime("%y_%m")
+    sessions = count_sessions(unit.start, unit.count, options.session_size)
+
+    def on_batch(batch):
+        # Every encoded row ends by a newline, payloads contain none
+        if throttle is not None:
+            throttle.wait(batch.count(b'\n'))
+
+    with conn.cursor() as cursor:
+        _copy(cursor, 'request_' + suffix, REQUEST_COLUMNS,
+              BatchReader(encoder.batches(encoder.encode_request), on_batch))
+        _copy(cursor, 'request_data_' + suffix, REQUEST_DATA_COLUMNS,
+              BatchReader(encoder.batches(encoder.encode_request_data), on_batch))
+        if options.properties and options.property_names:
+            _copy(cursor, 'request_property_value_' + suffix, REQUEST_PROPERTY_VALUE_COLUMNS,
+                  BatchReader(encoder.batches(encoder.encode_request_property_value), on_batch))
+        if sessions:
+            _copy(cursor, session_table, SESSION_COLUMNS,
+                  BatchReader(encoder.batches(encoder.encode_session), on_batch))
+    conn.commit()
+    counts = {
+        'request_' + suffix: unit.count,
+        'request_data_' + suffix: 2 * unit.count,
+        'request_property_value_' + suffix: unit.count * options.properties if options.property_names else 0,
+    }
+    if sessions:
+        counts[session_table] = sessions
+    return counts
+
+
+def reserve_ids(cursor, table, count):
+    """Reserve block of ids from the serial sequence of the table.
+
+    The database should not be written concurrently, the block is not reserved atomically.
+
+    :return: the first reserved id
+    """
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table, ))
+    sequence = cursor.fetchone()[0]
+    cursor.execute("SELECT nextval(%s)", (sequence, ))
+    first = cursor.fetchone()[0]
+    if count > 1:
+        cursor.execute("SELECT setval(%s, %s)", (sequence, first + count - 1))
+    return first
+
+
+def generate_units(connect, units, options):
+    """Generate units over a single connection, used as a worker process.
+
+    :param connect: callable returning new connection
+    :return: dictionary mapping tables to number of rows
+    """
+    throttle = Throttle(options.rate)
+    counts = {}
+    conn = connect()
+    try:
+        for unit in units:
+            for table, rows in generate_unit(conn, unit, options, throttle).items():
+                counts[table] = counts.get(table, 0) + rows
+    finally:
+        conn.close()
+    return counts
@@ -0,0 +1,160 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for the journal of steps of maintenance runs.
+
+A step is recorded as started before it is executed and as done once it is finished. The journal is written
+atomically and synced to disk before the step continues, so a run killed at any moment leaves a journal
+telling which steps were done and which were interrupted. A rerun with the same arguments skips done steps
+and executes interrupted ones again, steps are expected to be idempotent or to finish interrupted work.
+
+Arguments resolved by the script at run time (i.e. dates computed from the current date) bind the journal as they
+were passed, their resolved values are kept in the journal and a resumed run reuses them.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+
+STARTED = 'started'
+DONE = 'done'
+# Arguments which do not change the work done by the run
+IGNORED_ARGS = ('journal_file', 'metrics_file', 'report_file')
+
+
+class JournalError(Exception):
+    """Raised when journal belongs to another run."""
+
+    def __init__(self, message):
+        """Initialize error message."""
+        self.message = message
+
+    def __str__(self):
+        """Return error message."""
+        return self.message
+
+
+def args_to_dict(args, passed=None):
+    """Return JSON serializable dictionary of arguments identifying the run.
+
+    :param passed: dictionary of values of the resolved arguments as passed to the script, they replace the resolved
+        values
+    """
+    values = {name: value for name, value in vars(args).items() if name not in IGNORED_ARGS}
+    values.update(passed or {})
+    return json.loads(json.dumps(values, sort_keys=True, default=str))
+
+
+class Journal(object):
+    """Steps of a run kept in a file, bound to the script and its arguments.
+
+    For every step its state (`STARTED` or `DONE`) and data recorded by the step are kept. Journal may be
+    shared by threads. `resolved` maps names of the resolved arguments to their values (serialized as strings) used
+    by the run, i.e. those of the interrupted run if it is resumed.
+    """
+
+    def __init__(self, path, script, args, passed=None):
+        """Load steps of an interrupted run from the file, path may be None for steps kept only in memory.
+
+        :param str path: path to the journal file or None
+        :param str script: name of the script
+        :param args: parsed arguments of the script
+        :param passed: dictionary of values of arguments resolved by the script as they were passed to it
+
+        :raises JournalError: if the file contains steps of a run of another script or with other arguments
+        """
+        self.path = path
+        self.script = script
+        self.args = args_to_dict(args, passed)
+        self.resolved = args_to_dict(argparse.Namespace(**{name: getattr(args, name) for name in passed or {}}))
+        self.steps = {}
+        self._lock = threading.Lock()
+        if path is None:
+            return
+        try:
+            with open(path) as fjournal:
+                data = json.load(fjournal)
+        except FileNotFoundError:
+            return
+        if data.get('script') != script or data.get('args') != self.args:
+            raise JournalError(
+                "Journal {} belongs to a run of {} with other arguments".format(path, data.get('script')))
+        self.resolved = data.get('resolved', self.resolved)
+        self.steps = data.get('steps', {})
+
+    def state(self, step):
+        """Return state of the step or None if it was not started."""
+        with self._lock:
+            return self.steps.get(step, {}).get('state')
+
+    def is_done(self, step):
+        """Return whether the step is done."""
+        return self.state(step) == DONE
+
+    def data(self, step):
+        """Return dictionary of data recorded by the step."""
+        with self._lock:
+            return dict(self.steps.get(step, {}).get('data', {}))
+
+    def start(self, step, **data):
+        """Record the step as started with the data and save the journal before the step is executed."""
+        self._update(step, STARTED, data)
+
+    def done(self, step, **data):
+        """Record the step as done with the data and save the journal."""
+        self._update(step, DONE, data)
+
+    def run(self, step, func):
+        """Execute the step unless it is done, record it in the journal.
+
+        :return: result of `func` or None if the step was done by a previous run
+        """
+        state = self.state(step)
+        if state == DONE:
+            logging.info("Step %s done by a previous run, skipped", step)
+            return None
+        if state == STARTED:
+            logging.info("Step %s interrupted by a previous run, executed again", step)
+        self.start(step)
+        result = func()
+        self.done(step)
+        return result
+
+    def remove(self):
+        """Remove the journal file once the run finished."""
+        if self.path is None:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _update(self, step, state, data):
+        with self._lock:
+            entry = self.steps.setdefault(step, {})
+            entry['state'] = state
+            entry.setdefault('data', {}).update(data)
+            if self.path is None:
+                return
+            with open(self.path + '.tmp', 'w') as fjournal:
+                json.dump({'script': self.script, 'args': self.args, 'resolved': self.resolved, 'steps': self.steps},
+                          fjournal, indent=4, sort_keys=True)
+                fjournal.flush()
+                os.fsync(fjournal.fileno())
+            os.replace(self.path + '.tmp', self.path)
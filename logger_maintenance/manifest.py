@@ -0,0 +1,144 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for the manifest of an archive directory.
+
+The manifest `manifest.json` describes every archived partition: its service, month, time range, row count,
+checksum and a bloom filter of request ids, so lookups open only archives which may contain the searched rows.
+Entries are added one by one as partitions are archived. Every update rewrites the manifest atomically under
+an exclusive lock, so concurrent archivers do not lose entries of each other.
+"""
+import base64
+import fcntl
+import hashlib
+import json
+import math
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+
+MANIFEST_NAME = 'manifest.json'
+# Default false positive rate of bloom filters
+FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter(object):
+    """Bloom filter of integers with double hashing."""
+
+    def __init__(self, bits, hashes, data=None):
+        """Initialize empty filter or filter with the given bit array."""
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, count, rate=FALSE_POSITIVE_RATE):
+        """Return empty filter sized for `count` items with the false positive rate."""
+        count = max(1, count)
+        bits = max(8, int(math.ceil(-count * math.log(rate) / math.log(2) ** 2)))
+        return cls(bits, max(1, int(round(bits / count * math.log(2)))))
+
+    def _positions(self, value):
+        first, second = struct.unpack('<QQ', hashlib.sha256(str(value).encode()).digest()[:16])
+        return ((first + i * second) % self.bits for i in range(self.hashes))
+
+    def add(self, value):
+        """Add the value to the filter."""
+        for position in self._positions(value):
+            self.data[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        """Return False if the value is certainly not in the filter."""
+        return all(self.data[position // 8] & (1 << (position % 8)) for position in self._positions(value))
+
+    def to_dict(self):
+        """Return JSON serializable filter."""
+        return {
+            'bits': self.bits,
+            'hashes': self.hashes,
+            'data': base64.b64encode(zlib.compress(bytes(self.data))).decode(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return filter loaded from dictionary."""
+        return cls(data['bits'], data['hashes'], zlib.decompress(base64.b64decode(data['data'])))
+
+
+def get_manifest_path(directory):
+    """Return path of the manifest of the archive directory."""
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def load_manifest(directory):
+    """Return dictionary mapping archived tables to their manifest entries, empty if there is no manifest."""
+    try:
+        with open(get_manifest_path(directory)) as fmanifest:
+            return json.load(fmanifest)['tables']
+    except FileNotFoundError:
+        return {}
+
+
+@contextmanager
+def _locked(directory):
+    with open(get_manifest_path(directory) + '.lock', 'w') as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+def update_manifest(directory, entries=(), removed=()):
+    """Add entries to the manifest and remove entries of the tables, atomically.
+
+    :param entries: manifest entries (dictionaries with `table` key)
+    :param removed: names of tables to be removed from the manifest
+    """
+    path = get_manifest_path(directory)
+    with _locked(directory):
+        tables = load_manifest(directory)
+        for table in removed:
+            tables.pop(table, None)
+        for entry in entries:
+            tables[entry['table']] = entry
+        with open(path + '.tmp', 'w') as fmanifest:
+            json.dump({'tables': tables}, fmanifest, indent=4, sort_keys=True)
+            fmanifest.flush()
+            os.fsync(fmanifest.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def may_contain(entry, time_from=None, time_to=None, request_id=None):
+    """Return whether the archive of the manifest entry may contain rows of the time range and the request id.
+
+    :param dict entry: manifest entry
+    :param str time_from: time in `COPY` text format or None
+    :param str time_to: time in `COPY` text format (exclusive) or None
+    :param int request_id: request id or None
+    """
+    if entry.get('rows') == 0:
+        return False
+    if time_from is not None and entry.get('time_max') is not None and entry['time_max'] < time_from:
+        return False
+    if time_to is not None and entry.get('time_min') is not None and entry['time_min'] >= time_to:
+        return False
+    if request_id is not None and entry.get('bloom') is not None:
+        return request_id in BloomFilter.from_dict(entry['bloom'])
+    return True
@@ -0,0 +1,390 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for merging small closed monthly partitions into quarterly or yearly tables.
+
+Monthly partitions of a period are copied into a new table `<first partition>_m<months>` ordered by time while
+they are locked in SHARE mode. The new table gets the CHECK constraints of the first partition with their time
+range extended to the whole period, and its indexes and constraints. Only the final swap, which replaces
+the monthly partitions by the new table, takes exclusive locks (see `compact`). Merged tables are named by their
+first month, so catalog and retention see them as partitions covering all months of the period.
+"""
+import logging
+import re
+import time
+from collections import namedtuple
+
+from psycopg2 import DatabaseError, sql
+
+from logger_maintenance.catalog import PARTITION_MONTH_RE, get_table_month, get_table_service, get_table_span
+from logger_maintenance.common import MONTH, ConfigError, FatalScriptError, add_months, add_periods, period_start, \
+    range_end, run_on_pool
+from logger_maintenance.compact import COMPACTED_COMMENT, CONSTRAINTS_SQL, INDEXES_SQL, PARTITION_BOUND_SQL, \
+    TABLE_INFO_SQL, TIME_COLUMNS, CompactError, CompactResult, _copy_privileges, _index_sql, _swap, _with_tablespace
+
+# Number of months of merged periods
+PERIODS = {'quarter': 3, 'year': 12}
+# Partitions of a request, its data and property values are merged together or not at all, so their names match
+REQUEST_TABLES = ('request', 'request_data', 'request_property_value')
+MERGED_SUFFIX = '_m{}'
+
+CHECKS_SQL = """
+    SELECT conname, pg_get_constraintdef(oid)
+      FROM pg_constraint
+     WHERE conrelid = %s::regclass AND contype = 'c'
+"""
+TABLESPACE_SQL = """
+    SELECT t.spcname
+      FROM pg_class c
+      LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+     WHERE c.oid = %s::regclass
+"""
+MERGED_TABLES_SQL = r"""
+    SELECT c.relname
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      JOIN pg_class p ON p.oid = i.inhparent
+     WHERE p.relname = ANY(%s) AND c.relname ~ %s
+     ORDER BY c.relname
+"""
+TOTAL_SIZE_SQL = "SELECT sum(pg_total_relation_size(oid))::bigint FROM pg_class WHERE oid = ANY(%s::regclass[])"
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+UPPER_BOUND_RE = re.compile(r'<=?\s*\(?$')
+RANGE_BOUND_RE = re.compile(r'^FOR VALUES FROM \((.*)\) TO \((.*)\)$')
+
+MergePolicy = namedtuple('MergePolicy', ['period', 'max_size'])
+MergePolicy.__doc__ = """Merge policy of a service.
+
+Closed monthly partitions are merged into tables of the `period` (`quarter` or `year`) if each of them including
+indexes is smaller than `max_size` bytes.
+"""
+DEFAULT_MERGE_POLICY = MergePolicy(period='quarter', max_size=16 * 1024 * 1024)
+
+Merge = namedtuple('Merge', ['table', 'parent', 'service', 'month', 'months', 'tables', 'size', 'index_size'])
+Merge.__doc__ = """Planned merge of monthly partitions.
+
+Table is the name of the merged table covering `months` months from `month`, tables are a tuple of names of
+the merged monthly partitions ordered by month. Sizes are sums of sizes of the monthly partitions.
+"""
+
+
+class MergeError(CompactError):
+    """Raised when partitions can not be merged safely."""
+
+
+def _parse_policy(config, default):
+    if not isinstance(config, dict):
+        raise ConfigError("Incorrect config file - merge policies have to be objects")
+    period = config.get("period", default.period)
+    if period not in PERIODS:
+        raise ConfigError("Incorrect config file - merge `period` has to be one of: " + ", ".join(sorted(PERIODS)))
+    if "max_size_mb" in config:
+        value = config["max_size_mb"]
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+            raise ConfigError("Incorrect config file - merge `max_size_mb` has to be a positive number")
+        max_size = int(value * 1024 * 1024)
+    else:
+        max_size = default.max_size
+    return MergePolicy(period, max_size)
+
+
+def parse_merge(config):
+    """Parse merge section of the configuration.
+
+    Example of the merge section::
+
+        {
+            "default": {"period": "quarter", "max_size_mb": 16},
+            "services": {"mojeid": {"period": "year"}}
+        }
+
+    :return: dictionary mapping services to their policies, policy for other services is stored under None
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("Incorrect config file - merge has to be an object")
+    default = _parse_policy(config.get("default", {}), DEFAULT_MERGE_POLICY)
+    policies = {None: default}
+    services = config.get("services", {})
+    if not isinstance(services, dict):
+        raise ConfigError("Incorrect config file - merge `services` has to be an object")
+    for service, policy in services.items():
+        policies[service] = _parse_policy(policy, default)
+    return policies
+
+
+def get_merged_table(table, months):
+    """Return name of the table merging `months` months from the monthly partition."""
+    return table + MERGED_SUFFIX.format(months)
+
+
+def plan_merge(partitions, policies, today, services=None):
+    """Return merges of closed periods whose monthly partitions are all small, the oldest first.
+
+    Only periods with a monthly partition for each of their months are merged, so merged tables never overlap
+    and each of them covers its whole period. Partitions of `REQUEST_TABLES` of a period are merged only if all
+    of them can be merged.
+
+    :param partitions: list of `catalog.Partition`
+    :param dict policies: merge policies as returned by `parse_merge`
+    :param date today: current date, periods ending after the last closed month are never merged
+    :param services: list of services or None for all services
+    """
+    current = add_months(today, 0)
+    groups = {}
+    for part in partitions:
+        if part.parent not in TIME_COLUMNS or (services is not None and part.service not in services):
+            continue
+        match = PARTITION_MONTH_RE.search(part.table)
+        # Only plain monthly partitions are merged
+        if match.group(3) is not None or get_table_span(part.table) != 1:
+            continue
+        policy = policies.get(part.service or None, policies[None])
+        months = PERIODS[policy.period]
+        start = add_months(part.month, -((part.month.month - 1) % months))
+        if add_months(start, months) > current:
+            continue
+        groups.setdefault((part.parent, part.service, start, months), []).append((part, policy))
+
+    merges = []
+    for (parent, service, start, months), members in groups.items():
+        if len(members) != months or any(part.size + part.index_size > policy.max_size for part, policy in members):
+            continue
+        parts = sorted((part for part, _ in members), key=lambda part: part.month)
+        merges.append(Merge(get_merged_table(parts[0].table, months), parent, service, start, months,
+                            tuple(part.table for part in parts), sum(part.size for part in parts),
+                            sum(part.index_size for part in parts)))
+
+    planned = {(merge.parent, merge.service, merge.month, merge.months) for merge in merges}
+    merges = [merge for merge in merges if merge.parent not in REQUEST_TABLES or all(
+        (parent, merge.service, merge.month, merge.months) in planned for parent in REQUEST_TABLES)]
+    return sorted(merges, key=lambda merge: (merge.month, merge.table))
+
+
+def merged_tables_query(service):
+    """Return query and its parameters listing merged partitions of the service, rows contain table names."""
+    return MERGED_TABLES_SQL, (list(REQUEST_TABLES), r'_{}_\d{{2}}_\d{{2}}_m\d{{1,2}}$'.format(service))
+
+
+def get_merged_drops(rows, service, date_from, date_to, granularity=MONTH):
+    """Return statements dropping merged partitions whose all months are within the dropped dates.
+
+    Database function `drop_parts` drops only monthly, weekly and daily partitions, so merged tables are dropped
+    by its callers once their whole period is dropped. Statements are ordered as those of `drop_parts`, i.e.
+    by month with property values and data of requests first.
+
+    :param rows: rows of the query returned by `merged_tables_query`
+    :param date date_from: first dropped day as passed to `drop_parts_sql`
+    :param date date_to: last dropped day as passed to `drop_parts_sql`
+    """
+    start = period_start(date_from, granularity)
+    end = add_periods(range_end(date_to, granularity), 1, granularity)
+    order = {parent: index for index, parent in enumerate(reversed(REQUEST_TABLES))}
+    expired = []
+    for (table, ) in rows:
+        months = get_table_span(table)
+        if months == 1:
+            continue
+        parents = [parent for parent in REQUEST_TABLES
+                   if table.startswith(parent + '_') and get_table_service(table, parent) == service]
+        month = get_table_month(table)
+        if parents and start <= month and add_months(month, months) <= end:
+            expired.append((month, order[parents[0]], table))
+    return ["DROP TABLE {}".format(table) for _, _, table in sorted(expired)]
+
+
+def _rename(name, table, new_table):
+    """Return name of an index or constraint of the table for the new table."""
+    if name.startswith(table):
+        return new_table + name[len(table):]
+    return "{}_{}".format(new_table, name)
+
+
+def merge_checks(first, last):
+    """Return definition of a CHECK constraint covering time ranges of both constraints.
+
+    Definitions may differ only in quoted literals; upper bounds (following `<` or `<=`) are taken from the last
+    definition, other literals from the first one.
+
+    :raises MergeError: if the definitions differ in anything else
+    """
+    first_literals, last_literals = LITERAL_RE.findall(first), LITERAL_RE.findall(last)
+    first_parts, last_parts = LITERAL_RE.split(first), LITERAL_RE.split(last)
+    if first_parts != last_parts:
+        raise MergeError("CHECK constraints {} and {} differ".format(first, last))
+    result = [first_parts[0]]
+    for part, first_literal, last_literal in zip(first_parts[1:], first_literals, last_literals):
+        result.append(last_literal if UPPER_BOUND_RE.search(result[-1]) else first_literal)
+        result.append(part)
+    return ''.join(result)
+
+
+def _get_checks(cursor, table):
+    """Return dictionary mapping names of CHECK constraints without the table name to their definitions."""
+    cursor.execute(CHECKS_SQL, (table, ))
+    return {name[len(table):] if name.startswith(table) else name: definition
+            for name, definition in cursor.fetchall()}
+
+
+def _merged_bound(bounds):
+    """Return partition bound covering bounds of all partitions or None for inherited tables."""
+    if all(bound is None for bound in bounds):
+        return None
+    matches = [RANGE_BOUND_RE.match(bound or '') for bound in bounds]
+    if not all(matches):
+        raise MergeError("Unsupported partition bounds: " + "; ".join(str(bound) for bound in bounds))
+    return "FOR VALUES FROM ({}) TO ({})".format(matches[0].group(1), matches[-1].group(2))
+
+
+def _build(cursor, merge, tablespace):
+    """Copy the monthly partitions into the merged table ordered by time, build its constraints and indexes.
+
+    :return: number of rows
+    """
+    first, last = merge.tables[0], merge.tables[-1]
+    new_id = sql.Identifier(merge.table)
+    cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING STORAGE){}").format(
+        new_id, sql.Identifier(first),
+        sql.SQL(" TABLESPACE {}").format(sql.Identifier(tablespace)) if tablespace is not None else sql.SQL('')))
+    rows = 0
+    time_column = sql.Identifier(TIME_COLUMNS[merge.parent])
+    for table in merge.tables:
+        cursor.execute(sql.SQL("INSERT INTO {} SELECT * FROM {} ORDER BY {}").format(
+            new_id, sql.Identifier(table), time_column))
+        rows += cursor.rowcount
+
+    first_checks, last_checks = _get_checks(cursor, first), _get_checks(cursor, last)
+    if set(first_checks) != set(last_checks):
+        raise MergeError("Tables {} and {} have different CHECK constraints".format(first, last))
+    for name, definition in sorted(first_checks.items()):
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            new_id, sql.Identifier(_rename(first + name, first, merge.table)),
+            sql.SQL(merge_checks(definition, last_checks[name]))))
+
+    cursor.execute(CONSTRAINTS_SQL, (first, ))
+    for name, indexed, definition in cursor.fetchall():
+        clause = None
+        if indexed and tablespace is not None:
+            clause = sql.SQL("USING INDEX TABLESPACE {}").format(sql.Identifier(tablespace))
+        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            new_id, sql.Identifier(_rename(name, first, merge.table)), _with_tablespace(definition, clause)))
+    cursor.execute(INDEXES_SQL, (first, ))
+    for name, indexdef in cursor.fetchall():
+        cursor.execute(_index_sql(indexdef, _rename(name, first, merge.table), merge.table, tablespace))
+    cursor.execute(sql.SQL("ANALYZE {}").format(new_id))
+    return rows
+
+
+def _swap_sql(merge, bound):
+    """Return statement replacing the monthly partitions by the merged table."""
+    new_id, parent_id = sql.Identifier(merge.table), sql.Identifier(merge.parent)
+    statements = []
+    for table in merge.tables:
+        if bound is None:
+            statements.append(sql.SQL("ALTER TABLE {} NO INHERIT {}").format(sql.Identifier(table), parent_id))
+        else:
+            statements.append(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(parent_id, sql.Identifier(table)))
+    if bound is None:
+        statements.append(sql.SQL("ALTER TABLE {} INHERIT {}").format(new_id, parent_id))
+    else:
+        statements.append(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} {}").format(parent_id, new_id, sql.SQL(bound)))
+    for table in merge.tables:
+        statements.append(sql.SQL("DROP TABLE {}").format(sql.Identifier(table)))
+    statements.append(sql.SQL("COMMENT ON TABLE {} IS {}").format(new_id, sql.Literal(COMPACTED_COMMENT)))
+    return sql.SQL("; ").join(statements)
+
+
+def merge_table(conn, merge, lock_timeout=1000, retries=5, backoff=0.5):
+    """Merge the monthly partitions into a new table and replace them in a single transaction.
+
+    The merged table is placed into the tablespace of the first partition, owned by its owner and gets its grants.
+
+    :param conn: database connection
+    :param Merge merge: planned merge
+    :param int lock_timeout: lock timeout in milliseconds of locking the partitions and of the swap
+    :param int retries: how many times the swap is retried after lock timeout
+    :param float backoff: base delay of jittered exponential backoff in seconds
+
+    :return: CompactResult of the merged table
+    :raises MergeError: if any partition has triggers, is referenced by a foreign key or the partitions differ
+    """
+    try:
+        with conn.cursor() as cursor:
+            bounds = []
+            owners = []
+            for table in merge.tables:
+                cursor.execute(TABLE_INFO_SQL, (table, ))
+                owner, has_triggers, referenced = cursor.fetchone()
+                owners.append(owner)
+                if has_triggers or referenced:
+                    raise MergeError("Table {} has triggers or is referenced by a foreign key".format(table))
+                if conn.server_version >= 100000:
+                    cursor.execute(PARTITION_BOUND_SQL, (table, ))
+                    bounds.append(cursor.fetchone()[0])
+                else:
+                    bounds.append(None)
+            bound = _merged_bound(bounds)
+            cursor.execute(TABLESPACE_SQL, (merge.tables[0], ))
+            tablespace = cursor.fetchone()[0]
+
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (str(lock_timeout), ))
+            cursor.execute(sql.SQL("LOCK TABLE {} IN SHARE MODE").format(
+                sql.SQL(', ').join(sql.Identifier(table) for table in merge.tables)))
+            cursor.execute("SELECT set_config('lock_timeout', '0', true)")
+            cursor.execute(TOTAL_SIZE_SQL, (list(merge.tables), ))
+            size_before = cursor.fetchone()[0]
+
+            rows = _build(cursor, merge, tablespace)
+            _copy_privileges(cursor, merge.tables[0], merge.table, owners[0])
+            cursor.execute("SELECT pg_total_relation_size(%s::regclass)", (merge.table, ))
+            size_after = cursor.fetchone()[0]
+
+            wait, hold = _swap(conn, cursor, _swap_sql(merge, bound), lock_timeout, retries, backoff)
+    except BaseException:
+        conn.rollback()
+        raise
+    return CompactResult(merge.table, size_before, size_after, rows, wait, hold)
+
+
+def merge_tables(pool, merges, budget, may_start=None, **kwargs):
+    """Merge partitions concurrently, each merge using its own connection from the pool.
+
+    Arguments and result are the same as of `compact.compact_tables`, merges take place of partitions.
+    """
+    done = []
+    skipped = []
+
+    def work(conn, merge):
+        budget.reserve(merge.size + merge.index_size)
+        if may_start is not None and not may_start():
+            skipped.append(merge)
+            return
+        start = time.monotonic()
+        try:
+            result = merge_table(conn, merge, **kwargs)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except CompactError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        done.append(result)
+        logging.info("Merged %s into %s (%d rows, %d -> %d bytes, lock wait %.3f s, hold %.3f s) in %.3f s",
+                     ", ".join(merge.tables), result.table, result.rows, result.size_before, result.size_after,
+                     result.lock_wait, result.hold, time.monotonic() - start)
+
+    return run_on_pool(pool, work, merges), done, skipped
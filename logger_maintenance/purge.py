@@ -0,0 +1,291 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for purging requests matching a time window and source addresses inside logger partitions.
+
+Requests are deleted together with their data and property values in batches of request id ranges, each batch
+in its own transaction, so no batch holds row locks or creates dead tuples for long. Progress is checkpointed after
+every batch, so a purge may be stopped and resumed.
+"""
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from psycopg2 import sql
+
+from logger_maintenance.catalog import get_table_span
+from logger_maintenance.common import add_months
+
+# Format of times in criteria
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+REPLICATION_LAG_SQL = "SELECT coalesce(max(extract(epoch FROM replay_lag)), 0) FROM pg_stat_replication"
+# Standbys and those of them whose state is hidden from roles without `pg_monitor`
+REPLICAS_SQL = "SELECT count(*), count(*) FILTER (WHERE state IS NULL) FROM pg_stat_replication"
+
+# Tables of request partitions, purged in this order
+PURGE_TABLES = ('request_property_value', 'request_data', 'request')
+
+Criteria = namedtuple('Criteria', ['time_from', 'time_to', 'networks'])
+Criteria.__doc__ = """Requests to be purged.
+
+Requests with `time_begin` in [time_from, time_to) and `source_ip` in any of the networks (list of addresses
+or CIDR strings, empty for any address) are purged with their data and property values.
+"""
+
+
+class PurgeError(Exception):
+    """Raised when the purge can not continue safely."""
+
+    def __init__(self, message):
+        """Initialize error message."""
+        self.message = message
+
+    def __str__(self):
+        """Return error message."""
+        return self.message
+
+
+def criteria_to_dict(criteria):
+    """Return JSON serializable criteria."""
+    return {
+        'time_from': criteria.time_from.strftime(TIME_FORMAT),
+        'time_to': criteria.time_to.strftime(TIME_FORMAT),
+        'networks': sorted(criteria.networks),
+    }
+
+
+def plan_purge(partitions, criteria, services=None):
+    """Return request partitions which may contain requests matching the criteria, the oldest first.
+
+    :param partitions: list of `catalog.Partition`
+    :param Criteria criteria: purged requests
+    :param services: list of services or None for all services
+    """
+    selected = []
+    for part in partitions:
+        if part.parent != 'request' or (services is not None and part.service not in services):
+            continue
+        begin = datetime.combine(part.month, datetime.min.time())
+        end = datetime.combine(add_months(part.month, get_table_span(part.table)), datetime.min.time())
+        if begin < criteria.time_to and end > criteria.time_from:
+            selected.append(part)
+    return sorted(selected, key=lambda part: (part.month, part.table))
+
+
+class Checkpoint(object):
+    """Progress of a purge kept in a file, bound to the purge criteria.
+
+    For every partition, the first request id not purged yet and whether the partition was vacuumed is kept.
+    """
+
+    def __init__(self, path, criteria):
+        """Load progress from the file, path may be None for progress kept only in memory.
+
+        :raises PurgeError: if the file contains progress of a purge with other criteria
+        """
+        self.path = path
+        self.criteria = criteria_to_dict(criteria)
+        self.tables = {}
+        if path is None:
+            return
+        try:
+            with open(path) as fcheckpoint:
+                data = json.load(fcheckpoint)
+        except FileNotFoundError:
+            return
+        if data.get('criteria') != self.criteria:
+            raise PurgeError("Checkpoint {} belongs to a purge with other criteria".format(path))
+        self.tables = data.get('tables', {})
+
+    def next_id(self, table):
+        """Return the first request id not purged yet or None if purge of the table did not start."""
+        return self.tables.get(table, {}).get('next_id')
+
+    def is_vacuumed(self, table):
+        """Return whether the table was vacuumed after the purge."""
+        return self.tables.get(table, {}).get('vacuumed', False)
+
+    def update(self, table, **kwargs):
+        """Update progress of the table, i.e. `next_id` or `vacuumed`, and save it."""
+        self.tables.setdefault(table, {}).update(kwargs)
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as fcheckpoint:
+            json.dump({'criteria': self.criteria, 'tables': self.tables}, fcheckpoint, indent=4, sort_keys=True)
+            fcheckpoint.flush()
+            os.fsync(fcheckpoint.fileno())
+        os.replace(self.path + '.tmp', self.path)
+
+
+def _overlaps(part, month, months):
+    """Return whether the partition has a month in the range of `months` months from `month`."""
+    return part.month < add_months(month, months) and add_months(part.month, get_table_span(part.table)) > month
+
+
+def get_partition_tables(table, partitions=None):
+    """Return names of the partitions of `PURGE_TABLES` belonging to the request partition, the request one last.
+
+    Partitions of `request_data` and `request_property_value` are found by the suffix of the request partition.
+    If `partitions` are given and a partition with the suffix does not exist, because the tables of a period were
+    not merged the same way (see `merge`), all partitions of the service overlapping months of the request
+    partition are returned instead.
+
+    :param partitions: list of `catalog.Partition` or None
+    """
+    suffix = table[len('request'):]
+    if partitions is None:
+        return [parent + suffix for parent in PURGE_TABLES]
+    tables = {part.table: part for part in partitions}
+    request = tables[table]
+    result = []
+    for parent in PURGE_TABLES[:-1]:
+        if parent + suffix in tables:
+            result.append(parent + suffix)
+            continue
+        result.extend(sorted(
+            part.table for part in partitions
+            if part.parent == parent and part.service == request.service
+            and _overlaps(part, add_months(request.month, 0), get_table_span(table))))
+    return result + [table]
+
+
+def _criteria_condition(criteria):
+    """Return condition of requests matching the criteria with parameters `from`, `to` and `networks`."""
+    condition = "time_begin >= %(from)s AND time_begin < %(to)s"
+    if criteria.networks:
+        condition += " AND source_ip <<= ANY(%(networks)s::inet[])"
+    return condition
+
+
+def purge_batch_sql(tables, criteria):
+    """Return statement purging requests of the partition in the id range `[%(low)s, %(high)s)`.
+
+    The statement returns the number of deleted requests and the number of deleted data and property values.
+
+    :param tables: names of partitions as returned by `get_partition_tables`, the request partition last
+    """
+    requests = sql.Identifier(tables[-1])
+    others = [sql.Identifier(name) for name in tables[:-1]]
+    condition = _criteria_condition(criteria)
+    deletes = [
+        sql.SQL("deleted_{} AS (DELETE FROM {} WHERE request_id IN (SELECT id FROM ids) RETURNING 1), ").format(
+            sql.SQL(str(number)), name) for number, name in enumerate(others)]
+    counts = [sql.SQL("(SELECT count(*) FROM deleted_{})").format(sql.SQL(str(number)))
+              for number in range(len(others))]
+    return sql.SQL(
+        "WITH ids AS (SELECT id FROM {requests} WHERE id >= %(low)s AND id < %(high)s AND {condition}), "
+        "{deletes}"
+        "deleted_requests AS (DELETE FROM {requests} WHERE id IN (SELECT id FROM ids) RETURNING 1) "
+        "SELECT (SELECT count(*) FROM deleted_requests), {counts}"
+    ).format(requests=requests, condition=sql.SQL(condition), deletes=sql.SQL('').join(deletes),
+             counts=sql.SQL(' + ').join(counts) if counts else sql.SQL('0'))
+
+
+def get_replication_lag(conn):
+    """Return the maximal replay lag of standbys in seconds."""
+    with conn.cursor() as cursor:
+        cursor.execute(REPLICATION_LAG_SQL)
+        (lag, ) = cursor.fetchone()
+    conn.commit()
+    return float(lag)
+
+
+def check_replicas(conn):
+    """Check replication lag of all standbys is visible, so it can be waited for.
+
+    :raises PurgeError: if state of any standby is hidden, i.e. the role is not a member of `pg_monitor`
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(REPLICAS_SQL)
+        (replicas, hidden) = cursor.fetchone()
+    conn.commit()
+    if hidden:
+        raise PurgeError("Replication lag of {} of {} standbys is not visible, grant pg_monitor to the role "
+                         "or purge without lag limit".format(hidden, replicas))
+    if not replicas:
+        logging.warning("No standbys found, replication lag is not limited")
+
+
+def wait_for_replicas(conn, max_lag, interval=1.0):
+    """Wait until the replication lag drops under `max_lag` seconds, None for no limit."""
+    if max_lag is None:
+        return
+    lag = get_replication_lag(conn)
+    while lag > max_lag:
+        logging.info("Replication lag %.1f s exceeds %.1f s, waiting", lag, max_lag)
+        time.sleep(interval)
+        lag = get_replication_lag(conn)
+
+
+def purge_table(conn, table, criteria, checkpoint, throttle, batch_size=10000, max_lag=None, partitions=None):
+    """Purge requests of the request partition matching the criteria batch by batch.
+
+    Every batch is committed separately and recorded in the checkpoint. The throttle is given the number of all
+    deleted rows after each batch. Partitions are used to find data and property values of the requests, see
+    `get_partition_tables`.
+
+    :return: tuple (number of deleted requests, number of deleted data and property values)
+    """
+    params = {
+        'from': criteria.time_from.strftime(TIME_FORMAT),
+        'to': criteria.time_to.strftime(TIME_FORMAT),
+        'networks': list(criteria.networks),
+    }
+    with conn.cursor() as cursor:
+        # Batches cover only ids of the requests matching the criteria
+        cursor.execute(sql.SQL("SELECT min(id), max(id) FROM {} WHERE {}").format(
+            sql.Identifier(table), sql.SQL(_criteria_condition(criteria))), params)
+        (low, high) = cursor.fetchone()
+    conn.commit()
+    if checkpoint.next_id(table) is not None:
+        low = checkpoint.next_id(table)
+    if high is None:
+        return 0, 0
+
+    statement = purge_batch_sql(get_partition_tables(table, partitions), criteria)
+    requests = others = 0
+    while low <= high:
+        wait_for_replicas(conn, max_lag)
+        params.update(low=low, high=low + batch_size)
+        with conn.cursor() as cursor:
+            cursor.execute(statement, params)
+            (deleted_requests, deleted_others) = cursor.fetchone()
+        conn.commit()
+        low += batch_size
+        checkpoint.update(table, next_id=low)
+        requests += deleted_requests
+        others += deleted_others
+        throttle.wait(deleted_requests + deleted_others)
+    logging.info("Purged %d requests and %d data and property values from %s", requests, others, table)
+    return requests, others
+
+
+def vacuum_purged(conn, table, partitions=None):
+    """Vacuum all partitions of the purged request partition in autocommit mode."""
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            for name in get_partition_tables(table, partitions):
+                logging.info("Vacuuming %s", name)
+                cursor.execute(sql.SQL("VACUUM (ANALYZE) {}").format(sql.Identifier(name)))
+    finally:
+        conn.autocommit = False
@@ -0,0 +1,102 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for planning partition maintenance according to retention policies."""
+from collections import namedtuple
+
+from logger_maintenance.catalog import get_table_span
+from logger_maintenance.common import DAY, MONTH, add_months, add_periods, get_granularity, period_start, range_end
+
+Action = namedtuple('Action', ['kind', 'service', 'date_from', 'date_to'])
+Action.__doc__ = """Planned maintenance action.
+
+Kind is either `create` or `drop`. Service is None for `create` of monthly partitions, since `create_parts`
+creates partitions of all services. Services with weekly or daily partitions have their own `create` actions.
+Actions of weekly and daily partitions end by the last day of a month.
+"""
+CREATE = 'create'
+DROP = 'drop'
+
+
+def get_policy(retention, service):
+    """Return retention policy of the service."""
+    return retention.get(service, retention[None])
+
+
+def plan_retention(partitions, retention, today, granularity=None):
+    """Compute create and drop actions for all services.
+
+    Partitions are created for months up to `create_months` ahead, if any of the active partitioned tables
+    (i.e. those having a partition for current or later month) of a service is missing the partition.
+    Weekly and daily partitions are created from the current period up to the end of the same month.
+    Partitions older than `keep_months` months (current month included) are dropped. Merged partitions cover all
+    their months, so they are dropped once the last of them expires.
+
+    :param partitions: list of `catalog.Partition`
+    :param dict retention: retention policies as returned by `common.parse_retention`
+    :param date today: current date
+    :param dict granularity: granularity of services as returned by `common.parse_granularity`, None for monthly
+
+    :return: list of actions, create action first
+    """
+    granularity = granularity or {None: MONTH}
+    current = add_months(today, 0)
+    months = {}
+    for part in partitions:
+        months.setdefault((part.parent, part.service), set()).update(
+            add_months(part.month, offset) if offset else part.month for offset in range(get_table_span(part.table)))
+
+    to_create = set()
+    to_create_periods = {}
+    for (parent, service), present in months.items():
+        if max(present) < current:
+            continue
+        policy = get_policy(retention, service or None)
+        service_granularity = get_granularity(granularity, service)
+        if service_granularity == MONTH:
+            for offset in range(1, policy.create_months + 1):
+                month = add_months(current, offset)
+                if month not in present:
+                    to_create.add(month)
+            continue
+        period = period_start(today, service_granularity)
+        while period < add_months(current, policy.create_months + 1):
+            if period not in present:
+                to_create_periods.setdefault(service, set()).add(period)
+            period = add_periods(period, 1, service_granularity)
+
+    actions = []
+    if to_create:
+        actions.append(Action(CREATE, None, min(to_create), max(to_create)))
+    for service, periods in sorted(to_create_periods.items()):
+        actions.append(Action(CREATE, service, min(periods), range_end(add_months(max(periods), 0), DAY)))
+
+    services = sorted(set(service for (_, service) in months if service))
+    for service in services:
+        policy = get_policy(retention, service)
+        cutoff = add_months(current, -policy.keep_months)
+        expired = [
+            month for (_, part_service), present in months.items() if part_service == service
+            for month in present if add_months(month, 0) <= cutoff
+        ]
+        if expired:
+            date_to = max(expired)
+            if get_granularity(granularity, service) != MONTH:
+                date_to = range_end(add_months(date_to, 0), DAY)
+            actions.append(Action(DROP, service, min(expired), date_to))
+    return actions
@@ -0,0 +1,154 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for rolling up statistics of logger partitions before they are dropped.
+
+All configured aggregates of a partition are computed by a single `GROUP BY` scan and stored in a summary table.
+Rows of the partition are replaced in the same transaction, so the rollup may be repeated safely.
+"""
+import logging
+import time
+from collections import namedtuple
+
+from psycopg2 import DatabaseError, sql
+
+from logger_maintenance.catalog import get_table_month, get_table_service
+from logger_maintenance.common import ConfigError, FatalScriptError, run_on_pool
+
+Rollup = namedtuple('Rollup', ['table', 'source', 'dimensions', 'aggregates'])
+Rollup.__doc__ = """Configuration of the rollup.
+
+Partitions of the `source` table are aggregated into the summary `table` grouped by `dimensions` (column names).
+Aggregates is a list of (name, SQL expression) sorted by name.
+"""
+DEFAULT_ROLLUP = Rollup(
+    table='request_rollup',
+    source='request',
+    dimensions=['service_id', 'request_type_id', 'result_code_id'],
+    aggregates=[('monitoring_requests', 'count(*) FILTER (WHERE is_monitoring)'), ('requests', 'count(*)')],
+)
+# Columns of the summary table identifying the partition
+RESERVED_COLUMNS = {'source', 'month'}
+
+
+def parse_rollup(config):
+    """Parse rollup section of the configuration.
+
+    Example of the rollup section::
+
+        {
+            "table": "request_rollup",
+            "dimensions": ["service_id", "request_type_id", "result_code_id"],
+            "aggregates": {
+                "requests": "count(*)",
+                "monitoring_requests": "count(*) FILTER (WHERE is_monitoring)"
+            }
+        }
+
+    Aggregates are SQL expressions evaluated over rows of a single group.
+
+    :return: Rollup
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("Incorrect config file - rollup has to be an object")
+    table = config.get("table", DEFAULT_ROLLUP.table)
+    source = config.get("source", DEFAULT_ROLLUP.source)
+    dimensions = config.get("dimensions", DEFAULT_ROLLUP.dimensions)
+    aggregates = config.get("aggregates", dict(DEFAULT_ROLLUP.aggregates))
+    if not isinstance(table, str) or not isinstance(source, str):
+        raise ConfigError("Incorrect config file - rollup `table` and `source` have to be strings")
+    if not isinstance(dimensions, list) or not all(isinstance(item, str) for item in dimensions):
+        raise ConfigError("Incorrect config file - rollup `dimensions` have to be a list of column names")
+    if not isinstance(aggregates, dict) or not aggregates \
+            or not all(isinstance(item, str) for item in aggregates.values()):
+        raise ConfigError("Incorrect config file - rollup `aggregates` have to be an object of SQL expressions")
+    columns = dimensions + list(aggregates)
+    if len(set(columns)) != len(columns) or RESERVED_COLUMNS & set(columns):
+        raise ConfigError("Incorrect config file - rollup columns have to be unique and differ from {}".format(
+            ", ".join(sorted(RESERVED_COLUMNS))))
+    return Rollup(table, source, dimensions, sorted(aggregates.items()))
+
+
+def get_rollup_tables(rollup, tables, service):
+    """Return partitions of the rollup source table of the service among given tables."""
+    result = []
+    for table in tables:
+        if (table.startswith(rollup.source + "_") and get_table_month(table) is not None
+                and get_table_service(table, rollup.source) == service):
+            result.append(table)
+    return result
+
+
+def _select_sql(rollup, table):
+    """Return query aggregating the table, its first two parameters are source and month."""
+    dimensions = sql.SQL(', ').join(sql.Identifier(column) for column in rollup.dimensions)
+    aggregates = sql.SQL(', ').join(
+        sql.SQL("{} AS {}").format(sql.SQL(expression), sql.Identifier(name)) for name, expression in rollup.aggregates)
+    return sql.SQL("SELECT %s::text AS source, %s::date AS month, {}{}{} FROM {}{}").format(
+        dimensions, sql.SQL(', ') if rollup.dimensions else sql.SQL(''), aggregates, sql.Identifier(table),
+        sql.SQL(" GROUP BY {}").format(dimensions) if rollup.dimensions else sql.SQL(''))
+
+
+def create_rollup_table(conn, rollup):
+    """Create the summary table if it does not exist, column types are derived from the aggregating query."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} AS {} WITH NO DATA").format(
+                sql.Identifier(rollup.table), _select_sql(rollup, rollup.source)),
+            ('', None))
+        cursor.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (source)").format(
+            sql.Identifier(rollup.table + '_source_idx'), sql.Identifier(rollup.table)))
+    conn.commit()
+
+
+def rollup_table(conn, rollup, table):
+    """Replace rows of the partition in the summary table by its aggregates.
+
+    :return: number of summary rows
+    """
+    month = get_table_month(table)
+    columns = sql.SQL(', ').join(
+        sql.Identifier(column) for column in ['source', 'month'] + rollup.dimensions + [
+            name for name, _ in rollup.aggregates])
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("DELETE FROM {} WHERE source = %s").format(sql.Identifier(rollup.table)), (table, ))
+        cursor.execute(
+            sql.SQL("INSERT INTO {} ({}) {}").format(sql.Identifier(rollup.table), columns,
+                                                     _select_sql(rollup, table)),
+            (table, month.isoformat()))
+        rows = cursor.rowcount
+    conn.commit()
+    return rows
+
+
+def rollup_tables(pool, rollup, tables):
+    """Roll up tables concurrently, each table using its own connection from the pool.
+
+    :return: ordered dictionary mapping tables to FatalScriptError or None
+    """
+    def work(conn, table):
+        start = time.monotonic()
+        try:
+            rows = rollup_table(conn, rollup, table)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            conn.rollback()
+            raise FatalScriptError(err)
+        logging.info("Rolled up %s into %s (%d rows) in %.3f s", table, rollup.table, rows, time.monotonic() - start)
+
+    return run_on_pool(pool, work, tables)
@@ -0,0 +1,411 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for scheduling maintenance jobs in a long running daemon.
+
+Jobs are scheduled by calendar rules similar to cron. A job becomes pending when its calendar matches, pending jobs
+are run only inside quiet hours. Failed jobs are retried with backoff until they succeed or run out of retries.
+State of all jobs is persisted in a JSON file, so jobs missed while the daemon was not running are caught up.
+"""
+import json
+import logging
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from psycopg2 import InterfaceError, OperationalError
+
+from logger_maintenance.common import BACKOFF_CAP, ConfigError, FatalScriptError, backoff_delay
+from logger_maintenance.retention import CREATE, DROP
+
+# Fields of calendar rules with their ranges
+CALENDAR_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 6))
+# Maximal period in which missed calendar matches are looked up (in minutes)
+MAX_LOOKBACK = 35 * 24 * 60
+# Format of times in the state file
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+Job = namedtuple('Job', ['name', 'action', 'calendar', 'services'])
+Job.__doc__ = """Scheduled job.
+
+Action is `create` or `drop`, i.e. which actions of the retention plan are run. Services limit drop actions,
+None for all services.
+"""
+
+Schedule = namedtuple('Schedule', ['jobs', 'quiet_hours', 'retries', 'backoff', 'health_interval'])
+Schedule.__doc__ = """Schedule of the daemon.
+
+Quiet hours are list of (start, end) tuples of minutes since midnight, empty for no restriction. Failed jobs are
+retried up to `retries` times with exponential backoff with base `backoff` seconds. Connection is checked if it
+was not used for `health_interval` seconds.
+"""
+
+
+class Calendar(object):
+    """Calendar rule matching times by minute, hour, day, month and weekday (0 is Monday)."""
+
+    def __init__(self, **fields):
+        """Initialize rule, each field is a set of allowed values or None for any value."""
+        self.fields = fields
+
+    def matches(self, moment):
+        """Return whether the rule matches the minute of the datetime."""
+        values = {'minute': moment.minute, 'hour': moment.hour, 'day': moment.day, 'month': moment.month,
+                  'weekday': moment.weekday()}
+        return all(allowed is None or values[name] in allowed for name, allowed in self.fields.items())
+
+    def last_match(self, since, until):
+        """Return the last matching minute in the interval (since, until> or None."""
+        moment = until.replace(second=0, microsecond=0)
+        since = max(since, until - timedelta(minutes=MAX_LOOKBACK))
+        while moment > since:
+            if self.matches(moment):
+                return moment
+            moment -= timedelta(minutes=1)
+        return None
+
+
+def _parse_calendar(name, config):
+    if not isinstance(config, dict) or set(config) - {field for field, _, _ in CALENDAR_FIELDS}:
+        raise ConfigError("Incorrect config file - calendar of job `{}` has to be an object with items {}".format(
+            name, ", ".join(field for field, _, _ in CALENDAR_FIELDS)))
+    fields = {}
+    for field, low, high in CALENDAR_FIELDS:
+        # Minute and hour default to midnight, other fields to any value
+        value = config.get(field, 0 if field in ('minute', 'hour') else '*')
+        if value == '*':
+            continue
+        values = value if isinstance(value, list) else [value]
+        if not values or any(not isinstance(item, int) or isinstance(item, bool) or not low <= item <= high
+                             for item in values):
+            raise ConfigError("Incorrect config file - `{}` of job `{}` has to be `*` or integers {}-{}".format(
+                field, name, low, high))
+        fields[field] = set(values)
+    return Calendar(**fields)
+
+
+def _parse_window(value):
+    try:
+        start, end = value.split('-')
+        minutes = []
+        for item in (start, end):
+            hour, minute = item.split(':')
+            if not (0 <= int(hour) <= 24 and 0 <= int(minute) <= 59):
+                raise ValueError(value)
+            minutes.append(int(hour) * 60 + int(minute))
+    except (AttributeError, ValueError):
+        raise ConfigError("Incorrect config file - quiet hours `{}` have to be in format HH:MM-HH:MM".format(value))
+    return tuple(minutes)
+
+
+def parse_quiet_hours(values):
+    """Parse list of `HH:MM-HH:MM` windows.
+
+    :return: list of (start, end) tuples of minutes since midnight
+    """
+    if not isinstance(values, list):
+        raise ConfigError("Incorrect config file - quiet hours have to be a list")
+    return [_parse_window(value) for value in values]
+
+
+def _non_negative_number(config, name, default):
+    value = config.get(name, default)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        raise ConfigError("Incorrect config file - schedule `{}` has to be a non-negative number".format(name))
+    return value
+
+
+def parse_schedule(config):
+    """Parse schedule section of the configuration.
+
+    Example of the schedule section::
+
+        {
+            "quiet_hours": ["01:00-05:00", "23:30-00:30"],
+            "retries": 5,
+            "backoff": 300,
+            "jobs": [
+                {"name": "create", "action": "create", "calendar": {"day": 20, "hour": 2}},
+                {"name": "drop-mojeid", "action": "drop", "services": ["mojeid"],
+                 "calendar": {"weekday": 6, "hour": 3, "minute": 30}}
+            ]
+        }
+
+    :return: Schedule
+    """
+    if not isinstance(config, dict):
+        raise ConfigError("Incorrect config file - schedule has to be an object")
+    jobs = []
+    for item in config.get("jobs", []):
+        if not isinstance(item, dict) or "name" not in item or item.get("action") not in (CREATE, DROP):
+            raise ConfigError("Incorrect config file - each job needs `name` and `action` (create or drop)")
+        services = item.get("services")
+        if services is not None and (not isinstance(services, list) or item["action"] != DROP):
+            raise ConfigError("Incorrect config file - `services` of job `{}` has to be a list, drop only".format(
+                item["name"]))
+        jobs.append(Job(item["name"], item["action"], _parse_calendar(item["name"], item.get("calendar", {})),
+                        services))
+    if not jobs:
+        raise ConfigError("Incorrect config file - schedule has no jobs")
+    if len({job.name for job in jobs}) != len(jobs):
+        raise ConfigError("Incorrect config file - job names have to be unique")
+
+    retries = config.get("retries", 5)
+    if not isinstance(retries, int) or isinstance(retries, bool) or retries < 0:
+        raise ConfigError("Incorrect config file - schedule `retries` has to be an integer >= 0")
+    return Schedule(jobs, parse_quiet_hours(config.get("quiet_hours", [])), retries,
+                    _non_negative_number(config, "backoff", 300), _non_negative_number(config, "health_interval", 60))
+
+
+def in_quiet_hours(quiet_hours, moment):
+    """Return whether the datetime is inside any of the quiet hours windows."""
+    if not quiet_hours:
+        return True
+    minute = moment.hour * 60 + moment.minute
+    for start, end in quiet_hours:
+        if start <= end and start <= minute < end:
+            return True
+        # Window over midnight
+        if start > end and (minute >= start or minute < end):
+            return True
+    return False
+
+
+def _format_time(moment):
+    return moment.strftime(TIME_FORMAT) if moment is not None else None
+
+
+def _parse_time(value):
+    return datetime.strptime(value, TIME_FORMAT) if value is not None else None
+
+
+class JobState(object):
+    """Run state of a job."""
+
+    FIELDS = ('pending_since', 'next_attempt', 'attempts', 'last_attempt', 'last_success', 'last_error')
+
+    def __init__(self, pending_since=None, next_attempt=None, attempts=0, last_attempt=None, last_success=None,
+                 last_error=None):
+        """Initialize state, times are datetimes or None."""
+        self.pending_since = pending_since
+        self.next_attempt = next_attempt
+        self.attempts = attempts
+        self.last_attempt = last_attempt
+        self.last_success = last_success
+        self.last_error = last_error
+
+    def to_dict(self):
+        """Return JSON serializable state."""
+        return {name: _format_time(value) if isinstance(value, datetime) else value
+                for name, value in ((name, getattr(self, name)) for name in self.FIELDS)}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return state loaded from dictionary."""
+        return cls(_parse_time(data.get('pending_since')), _parse_time(data.get('next_attempt')),
+                   data.get('attempts', 0), _parse_time(data.get('last_attempt')),
+                   _parse_time(data.get('last_success')), data.get('last_error'))
+
+
+def load_state(path):
+    """Load daemon state from the file.
+
+    :return: tuple (time of the last check or None, dictionary mapping job names to JobState)
+    """
+    try:
+        with open(path) as fstate:
+            data = json.load(fstate)
+    except FileNotFoundError:
+        return None, {}
+    except ValueError as err:
+        logging.warning("Ignoring broken state file %s: %s", path, err)
+        return None, {}
+    return _parse_time(data.get('last_check')), {
+        name: JobState.from_dict(job) for name, job in data.get('jobs', {}).items()}
+
+
+def save_state(path, last_check, states, connected):
+    """Save daemon state to the file atomically."""
+    data = {
+        'last_check': _format_time(last_check),
+        'connected': connected,
+        'jobs': {name: state.to_dict() for name, state in sorted(states.items())},
+    }
+    with open(path + '.tmp', 'w') as fstate:
+        json.dump(data, fstate, indent=4)
+    os.replace(path + '.tmp', path)
+
+
+class PersistentConnection(object):
+    """Database connection kept open by the daemon, checked before use and reopened with backoff."""
+
+    def __init__(self, connect, health_interval, backoff=1.0, cap=BACKOFF_CAP):
+        """Initialize closed connection.
+
+        :param connect: callable returning new connection, raising FatalScriptError on failure
+        :param float health_interval: connection unused for longer is checked by `SELECT 1` before use
+        """
+        self.connect = connect
+        self.health_interval = health_interval
+        self.backoff = backoff
+        self.cap = cap
+        self.conn = None
+        self.failures = 0
+        self.retry_at = 0.0
+        self.last_used = 0.0
+
+    @property
+    def connected(self):
+        """Return whether the connection is open."""
+        return self.conn is not None and not self.conn.closed
+
+    def close(self):
+        """Close the connection."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _healthy(self):
+        if time.monotonic() - self.last_used < self.health_interval:
+            return True
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            self.conn.rollback()
+            return True
+        except (OperationalError, InterfaceError) as err:
+            logging.warning("Connection lost: %s", err)
+            return False
+
+    def get(self):
+        """Return healthy connection or None if it can not be opened now (reconnect is backed off)."""
+        if self.connected and self._healthy():
+            self.last_used = time.monotonic()
+            return self.conn
+        self.close()
+        if time.monotonic() < self.retry_at:
+            return None
+        try:
+            self.conn = self.connect()
+        except FatalScriptError:
+            delay = backoff_delay(self.failures, self.backoff, self.cap)
+            self.failures += 1
+            self.retry_at = time.monotonic() + delay
+            logging.warning("Reconnecting in %.1f s", delay)
+            return None
+        self.failures = 0
+        self.last_used = time.monotonic()
+        return self.conn
+
+    def invalidate(self):
+        """Force health check before the next use, i.e. after an error."""
+        self.last_used = 0.0
+
+
+class Scheduler(object):
+    """Scheduler running pending jobs inside quiet hours."""
+
+    def __init__(self, schedule, run_job, connection, state_path=None):
+        """Initialize scheduler.
+
+        :param Schedule schedule: parsed schedule
+        :param run_job: callable `run_job(conn, job)` raising FatalScriptError on failure
+        :param PersistentConnection connection: connection used by jobs
+        :param str state_path: path to the state file, None for no persistence
+        """
+        self.schedule = schedule
+        self.run_job = run_job
+        self.connection = connection
+        self.state_path = state_path
+        self.last_check, self.states = load_state(state_path) if state_path is not None else (None, {})
+        for job in schedule.jobs:
+            self.states.setdefault(job.name, JobState())
+
+    def check(self, now):
+        """Mark jobs whose calendar matched since the last check pending, run pending jobs if allowed."""
+        since = self.last_check if self.last_check is not None else now - timedelta(minutes=1)
+        for job in self.schedule.jobs:
+            state = self.states[job.name]
+            match = job.calendar.last_match(since, now)
+            if match is not None and state.pending_since is None:
+                logging.info("Job %s scheduled at %s is pending", job.name, _format_time(match))
+                state.pending_since = match
+                state.attempts = 0
+                state.next_attempt = None
+        self.last_check = now
+
+        if in_quiet_hours(self.schedule.quiet_hours, now):
+            for job in self.schedule.jobs:
+                state = self.states[job.name]
+                if state.pending_since is not None and (state.next_attempt is None or state.next_attempt <= now):
+                    if not self.attempt(job, state, now):
+                        break
+        self.save()
+
+    def attempt(self, job, state, now):
+        """Run the job once, update its state.
+
+        :return: False if the connection is not available
+        """
+        conn = self.connection.get()
+        if conn is None:
+            return False
+        logging.info("Running job %s", job.name)
+        state.last_attempt = now
+        try:
+            self.run_job(conn, job)
+        except (FatalScriptError, OperationalError, InterfaceError) as err:
+            # Lost connection, i.e. failed commit, is retried over a new connection as any other failure
+            self.connection.invalidate()
+            state.attempts += 1
+            state.last_error = str(err.message or err.error) if isinstance(err, FatalScriptError) else str(err)
+            if state.attempts > self.schedule.retries:
+                logging.error("Job %s failed, giving up after %d attempts", job.name, state.attempts)
+                state.pending_since = None
+                state.next_attempt = None
+            else:
+                delay = backoff_delay(state.attempts - 1, self.schedule.backoff, cap=24 * 3600)
+                state.next_attempt = now + timedelta(seconds=delay)
+                logging.warning("Job %s failed, retrying at %s", job.name, _format_time(state.next_attempt))
+        else:
+            logging.info("Job %s done", job.name)
+            state.pending_since = None
+            state.next_attempt = None
+            state.attempts = 0
+            state.last_success = now
+            state.last_error = None
+        return True
+
+    def save(self):
+        """Save state, if persistent."""
+        if self.state_path is None:
+            return
+        try:
+            save_state(self.state_path, self.last_check, self.states, self.connection.connected)
+        except OSError as err:
+            logging.error("Saving state failed: %s", err)
+
+    def run(self, should_stop, tick=30.0):
+        """Check jobs every `tick` seconds until `should_stop()` returns True."""
+        while not should_stop():
+            self.check(datetime.now().replace(microsecond=0))
+            deadline = time.monotonic() + tick
+            while not should_stop() and time.monotonic() < deadline:
+                time.sleep(min(1.0, tick))
+        self.connection.close()
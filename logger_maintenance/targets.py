@@ -0,0 +1,222 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for running maintenance on several logger databases concurrently.
+
+Operations use asynchronous psycopg2 connections driven by an asyncio event loop, so all targets are processed
+concurrently from a single thread. Each statement runs in autocommit mode, `create_parts` and `drop_parts` are
+atomic on their own.
+"""
+import asyncio
+import logging
+import time
+from collections import namedtuple
+
+import psycopg2
+from psycopg2.extensions import POLL_OK, POLL_READ, POLL_WRITE
+
+from logger_maintenance.common import ConfigError, LoggerMaintenanceScript
+
+# Default number of concurrent statements on a single target
+DEFAULT_CONCURRENCY = 2
+
+OK = 'OK'
+FAILED = 'FAILED'
+TIMEOUT = 'TIMEOUT'
+
+Target = namedtuple('Target', ['name', 'database', 'session', 'concurrency', 'timeout'])
+Target.__doc__ = """Logger database processed by the multi-target driver.
+
+`database` contains connection parameters, `session` settings applied to each session, `concurrency` limits
+the number of concurrent statements and `timeout` the duration of the whole run on the target (None for no limit).
+"""
+
+TargetResult = namedtuple('TargetResult', ['target', 'status', 'seconds', 'rows', 'error'])
+TargetResult.__doc__ = """Result of an operation on a single target.
+
+Rows are results of all executed statements, error is a message or None.
+"""
+
+
+def _parse_target(name, config, default_session):
+    if not isinstance(config, dict):
+        raise ConfigError("Incorrect config file - target `{}` has to be an object".format(name))
+    database = config.get("database")
+    if not isinstance(database, dict) or LoggerMaintenanceScript.MANDATORY_CONF - set(database.keys()):
+        raise ConfigError("Incorrect config file - mandatory configuration of target `{}` missing".format(name))
+    concurrency = config.get("concurrency", DEFAULT_CONCURRENCY)
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+        raise ConfigError("Incorrect config file - `concurrency` of target `{}` has to be an integer >= 1".format(
+            name))
+    timeout = config.get("timeout")
+    if timeout is not None and (not isinstance(timeout, (int, float)) or isinstance(timeout, bool) or timeout <= 0):
+        raise ConfigError("Incorrect config file - `timeout` of target `{}` has to be a positive number".format(name))
+    session = dict(default_session)
+    session.update(config.get("session", {}))
+    return Target(name, database, session, concurrency, timeout)
+
+
+def parse_targets(config):
+    """Parse database targets of the configuration.
+
+    Example of the targets section::
+
+        {
+            "targets": [
+                {"name": "production", "database": {"host": "db1", "user": "logger", "database": "logger"},
+                 "concurrency": 4, "timeout": 3600},
+                {"name": "mojeid", "database": {"host": "db2", "user": "logger", "database": "logger"}}
+            ]
+        }
+
+    Configuration with a single `database` section is a single target named `default`. Session settings from
+    the top level `session` section are used for targets without their own settings.
+
+    :return: list of targets
+    """
+    default_session = config.get("session", {})
+    if "targets" not in config:
+        return [_parse_target("default", {"database": config.get("database")}, default_session)]
+
+    targets = []
+    if not isinstance(config["targets"], list) or not config["targets"]:
+        raise ConfigError("Incorrect config file - `targets` has to be a non-empty list")
+    for number, item in enumerate(config["targets"]):
+        name = item.get("name", str(number)) if isinstance(item, dict) else str(number)
+        targets.append(_parse_target(name, item, default_session))
+    if len({target.name for target in targets}) != len(targets):
+        raise ConfigError("Incorrect config file - target names have to be unique")
+    return targets
+
+
+def _ready(loop, fileno, add, remove):
+    """Return future resolved when the file descriptor is ready."""
+    future = asyncio.Future(loop=loop)
+
+    def callback():
+        if not future.done():
+            future.set_result(None)
+
+    add(fileno, callback)
+    future.add_done_callback(lambda _: remove(fileno))
+    return future
+
+
+async def wait_conn(conn, loop):
+    """Wait until the pending operation of the asynchronous connection is finished."""
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+        elif state == POLL_READ:
+            await _ready(loop, conn.fileno(), loop.add_reader, loop.remove_reader)
+        elif state == POLL_WRITE:
+            await _ready(loop, conn.fileno(), loop.add_writer, loop.remove_writer)
+        else:
+            raise psycopg2.OperationalError("poll() returned {}".format(state))
+
+
+class AsyncTargetConnection(object):
+    """Asynchronous connection to a target, its running statement is canceled if the task is canceled."""
+
+    def __init__(self, target, loop):
+        """Initialize unconnected connection."""
+        self.target = target
+        self.loop = loop
+        self.conn = None
+
+    async def __aenter__(self):
+        """Connect and apply session settings."""
+        self.conn = psycopg2.connect(async_=True, **self.target.database)
+        await wait_conn(self.conn, self.loop)
+        for name, value in sorted(self.target.session.items()):
+            await self.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        """Cancel running statement, if any, and close the connection."""
+        if self.conn is not None:
+            if self.conn.isexecuting():
+                self.conn.cancel()
+            self.conn.close()
+
+    async def execute(self, query, params=None):
+        """Execute the statement and return its rows."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(query, params)
+            await wait_conn(self.conn, self.loop)
+            return cursor.fetchall() if cursor.description is not None else []
+
+    def mogrify(self, query, params):
+        """Return query with bound parameters, same as `cursor.mogrify`."""
+        with self.conn.cursor() as cursor:
+            return cursor.mogrify(query, params)
+
+
+async def run_target(target, operation, loop):
+    """Run operation on the target, limit its concurrency and duration.
+
+    :param operation: coroutine function `operation(connect, target)` returning list of rows, `connect()` returns
+                      new `AsyncTargetConnection`; at most `target.concurrency` connections are open at once
+    :return: TargetResult, errors are not propagated
+    """
+    semaphore = asyncio.Semaphore(target.concurrency)
+
+    class LimitedConnection(AsyncTargetConnection):
+        async def __aenter__(self):
+            await semaphore.acquire()
+            try:
+                return await super(LimitedConnection, self).__aenter__()
+            except BaseException:
+                semaphore.release()
+                raise
+
+        async def __aexit__(self, exc_type, exc, traceback):
+            try:
+                await super(LimitedConnection, self).__aexit__(exc_type, exc, traceback)
+            finally:
+                semaphore.release()
+
+    start = time.monotonic()
+    try:
+        rows = await asyncio.wait_for(operation(lambda: LimitedConnection(target, loop), target), target.timeout)
+    except asyncio.TimeoutError:
+        return TargetResult(target.name, TIMEOUT, time.monotonic() - start, [],
+                            "Timed out after {} s".format(target.timeout))
+    except (psycopg2.Error, OSError, ConfigError) as err:
+        return TargetResult(target.name, FAILED, time.monotonic() - start, [], str(err).strip())
+    except Exception as err:
+        # Unexpected errors of a target must not abort the other targets
+        logging.exception("Operation failed on target %s", target.name)
+        return TargetResult(target.name, FAILED, time.monotonic() - start, [],
+                            "{}: {}".format(type(err).__name__, err))
+    return TargetResult(target.name, OK, time.monotonic() - start, rows, None)
+
+
+def run_targets(targets, operation):
+    """Run operation on all targets concurrently in a new event loop.
+
+    :return: list of TargetResult in order of targets
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(asyncio.gather(*[run_target(target, operation, loop) for target in targets]))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,121 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for planning moves of aged logger partitions to an archive tablespace.
+
+Partitions are moved by copy-and-swap (see `compact`), each of them in a single transaction. Progress is kept by
+the database catalog itself: a partition is pending while the table or any of its indexes is outside the archive
+tablespace, so an interrupted run is resumed by the next one.
+"""
+from collections import namedtuple
+
+from logger_maintenance.common import ConfigError, add_months
+from logger_maintenance.scheduler import parse_quiet_hours
+
+PENDING_TABLES_SQL = r"""
+    SELECT c.relname
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+     WHERE c.relname ~ '_\d{2}_\d{2}(_m\d{1,2})?$' AND c.relkind = 'r'
+       AND EXISTS (
+           SELECT 1
+             FROM pg_class r
+            WHERE (r.oid = c.oid OR r.oid IN (SELECT x.indexrelid FROM pg_index x WHERE x.indrelid = c.oid))
+              AND coalesce(nullif(r.reltablespace, 0),
+                           (SELECT dattablespace FROM pg_database WHERE datname = current_database()))
+                  IS DISTINCT FROM (SELECT oid FROM pg_tablespace WHERE spcname = %s))
+     ORDER BY c.relname
+"""
+
+TierPolicy = namedtuple('TierPolicy', ['keep_months'])
+TierPolicy.__doc__ = """Tiering policy of a service.
+
+Partitions are kept in their tablespace for `keep_months` months including the current one.
+"""
+DEFAULT_TIER_POLICY = TierPolicy(keep_months=3)
+
+Tiering = namedtuple('Tiering', ['tablespace', 'policies', 'quiet_hours'])
+Tiering.__doc__ = """Configuration of tiered storage.
+
+Policies map services to their policies, policy for other services is stored under None. Quiet hours are list
+of (start, end) tuples of minutes since midnight in which moves may start, empty for no restriction.
+"""
+
+
+def _parse_policy(config, default):
+    if not isinstance(config, dict):
+        raise ConfigError("Incorrect config file - tiering policies have to be objects")
+    value = config.get("keep_months", default.keep_months)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise ConfigError("Incorrect config file - tiering `keep_months` has to be an integer >= 1")
+    return TierPolicy(value)
+
+
+def parse_tiering(config):
+    """Parse tiering section of the configuration.
+
+    Example of the tiering section::
+
+        {
+            "tablespace": "archive",
+            "quiet_hours": ["01:00-05:00"],
+            "default": {"keep_months": 3},
+            "services": {"epp": {"keep_months": 12}}
+        }
+
+    :return: Tiering
+    """
+    if not isinstance(config, dict) or not isinstance(config.get("tablespace"), str):
+        raise ConfigError("Incorrect config file - tiering needs `tablespace`")
+    default = _parse_policy(config.get("default", {}), DEFAULT_TIER_POLICY)
+    policies = {None: default}
+    services = config.get("services", {})
+    if not isinstance(services, dict):
+        raise ConfigError("Incorrect config file - tiering `services` has to be an object")
+    for service, policy in services.items():
+        policies[service] = _parse_policy(policy, default)
+    return Tiering(config["tablespace"], policies, parse_quiet_hours(config.get("quiet_hours", [])))
+
+
+def get_pending_tables(conn, tablespace):
+    """Return set of partitions which are not completely in the tablespace."""
+    with conn.cursor() as cursor:
+        cursor.execute(PENDING_TABLES_SQL, (tablespace, ))
+        tables = {table for (table, ) in cursor.fetchall()}
+    conn.rollback()
+    return tables
+
+
+def plan_tier(partitions, tiering, pending, today, services=None):
+    """Return partitions to be moved to the archive tablespace, the oldest first.
+
+    :param partitions: list of `catalog.Partition`
+    :param Tiering tiering: tiering configuration
+    :param pending: names of partitions not in the archive tablespace yet
+    :param date today: current date
+    :param services: list of services or None for all services
+    """
+    current = add_months(today, 0)
+    selected = []
+    for part in partitions:
+        if part.table not in pending or (services is not None and part.service not in services):
+            continue
+        policy = tiering.policies.get(part.service or None, tiering.policies[None])
+        if part.month <= add_months(current, -policy.keep_months):
+            selected.append(part)
+    return sorted(selected, key=lambda part: (part.month, part.table))
@@ -0,0 +1,138 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for planning and running VACUUM and ANALYZE of logger partitions.
+
+Partitions of the current and later months which were never analyzed are analyzed, so the planner has statistics
+from the first day of the month. Closed months are frozen before they reach the anti-wraparound threshold, oldest
+transaction ids first, so autovacuum does not have to freeze all of them at once.
+"""
+import logging
+import time
+from collections import namedtuple
+
+from psycopg2 import DatabaseError, sql
+from psycopg2.errorcodes import QUERY_CANCELED
+
+from logger_maintenance.catalog import get_table_month, get_table_service
+from logger_maintenance.common import FatalScriptError, add_months, run_on_pool
+
+VACUUM_CANDIDATES_SQL = r"""
+    SELECT c.relname, p.relname, age(c.relfrozenxid), greatest(s.last_analyze, s.last_autoanalyze)
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+      JOIN pg_class p ON p.oid = i.inhparent
+      LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+     WHERE c.relname ~ '_\d{2}_\d{2}(_m\d{1,2})?$' AND c.relkind = 'r'
+     ORDER BY p.relname, c.relname
+"""
+# Same as default of `vacuum_freeze_min_age`, younger tables would not be frozen anyway
+DEFAULT_MIN_FREEZE_AGE = 50000000
+
+ANALYZE = 'analyze'
+FREEZE = 'freeze'
+
+VacuumCandidate = namedtuple('VacuumCandidate', ['table', 'service', 'month', 'frozen_age', 'last_analyze'])
+VacuumCandidate.__doc__ = """Partition which may be vacuumed or analyzed.
+
+Frozen age is `age(relfrozenxid)`, last analyze is None if the partition was never analyzed.
+"""
+
+VacuumTask = namedtuple('VacuumTask', ['kind', 'table', 'frozen_age'])
+VacuumTask.__doc__ = """Planned VACUUM (FREEZE) or ANALYZE of a partition, kind is either `freeze` or `analyze`."""
+
+
+def get_vacuum_candidates(conn):
+    """Return list of all logger partitions with their frozen age and last analyze."""
+    with conn.cursor() as cursor:
+        cursor.execute(VACUUM_CANDIDATES_SQL)
+        rows = cursor.fetchall()
+    conn.rollback()
+    return [
+        VacuumCandidate(table, get_table_service(table, parent), get_table_month(table), frozen_age, last_analyze)
+        for table, parent, frozen_age, last_analyze in rows
+    ]
+
+
+def plan_vacuum(candidates, today, min_freeze_age=DEFAULT_MIN_FREEZE_AGE):
+    """Compute VACUUM (FREEZE) and ANALYZE tasks.
+
+    :param candidates: list of VacuumCandidate
+    :param date today: current date
+    :param int min_freeze_age: minimal `age(relfrozenxid)` of a closed partition to be frozen
+
+    :return: list of tasks; partitions to be analyzed first, then partitions to be frozen ordered by their
+             frozen age from the oldest
+    """
+    current = add_months(today, 0)
+    analyze = sorted(
+        (part for part in candidates if part.month >= current and part.last_analyze is None),
+        key=lambda part: (part.month, part.table))
+    freeze = sorted(
+        (part for part in candidates if part.month < current and part.frozen_age >= min_freeze_age),
+        key=lambda part: (-part.frozen_age, part.table))
+    return [VacuumTask(ANALYZE, part.table, part.frozen_age) for part in analyze] + \
+        [VacuumTask(FREEZE, part.table, part.frozen_age) for part in freeze]
+
+
+def vacuum_sql(task):
+    """Return statement executing the task."""
+    if task.kind == ANALYZE:
+        return sql.SQL("ANALYZE {}").format(sql.Identifier(task.table))
+    return sql.SQL("VACUUM (FREEZE) {}").format(sql.Identifier(task.table))
+
+
+def vacuum_tables(pool, tasks, settings, deadline=None):
+    """Run tasks concurrently, each task using its own connection from the pool.
+
+    Statements run in autocommit mode. No task is started after the deadline and running statements are canceled
+    by `statement_timeout` when the deadline is reached.
+
+    :param ConnectionPool pool: connection pool
+    :param tasks: list of VacuumTask, tasks are started in the given order
+    :param dict settings: session settings, i.e. `vacuum_cost_delay` and `vacuum_cost_limit`
+    :param float deadline: `time.monotonic()` value of the deadline or None for no limit
+
+    :return: tuple (ordered dictionary mapping tasks to FatalScriptError or None, list of skipped tasks)
+    """
+    skipped = []
+
+    def work(conn, task):
+        if deadline is not None and time.monotonic() >= deadline:
+            skipped.append(task)
+            return
+        conn.autocommit = True
+        start = time.monotonic()
+        try:
+            with conn.cursor() as cursor:
+                for name, value in sorted(settings.items()):
+                    cursor.execute("SELECT set_config(%s, %s, false)", (name, str(value)))
+                timeout = 0 if deadline is None else max(1, int((deadline - start) * 1000))
+                cursor.execute("SELECT set_config('statement_timeout', %s, false)", (str(timeout), ))
+                cursor.execute(vacuum_sql(task))
+        except DatabaseError as err:
+            if err.pgcode == QUERY_CANCELED and deadline is not None and time.monotonic() >= deadline:
+                logging.warning("Time budget exhausted during %s of %s", task.kind, task.table)
+                skipped.append(task)
+                return
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        logging.info("%s of %s (frozen age %d) done in %.3f s", task.kind.capitalize(), task.table,
+                     task.frozen_age, time.monotonic() - start)
+
+    return run_on_pool(pool, work, tasks), skipped
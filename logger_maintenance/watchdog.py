@@ -0,0 +1,137 @@
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Module for watching sessions blocked by maintenance.
+
+A DDL statement waiting for a lock behind a long running query blocks all writers queued behind it. The watchdog
+polls sessions blocked by backends of the script and cancels the blocking statement when too many sessions are
+blocked or they wait too long. Canceled statements are retried by the script later.
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from psycopg2 import DatabaseError
+from psycopg2.errorcodes import QUERY_CANCELED
+
+# Interval of polling blocked sessions (in seconds)
+WATCHDOG_INTERVAL = 0.5
+
+# Sessions waiting for a lock held or requested by given backends, `pg_blocking_pids` includes backends
+# ahead in the lock queue, i.e. our DDL statement waiting for a lock itself
+BLOCKED_SQL = """
+    SELECT blocker, count(*), coalesce(max(extract(epoch FROM now() - a.query_start)), 0)
+      FROM (SELECT pid, query_start
+              FROM pg_stat_activity
+             WHERE wait_event_type = 'Lock' AND NOT pid = ANY(%(backends)s)) a
+     CROSS JOIN LATERAL unnest(pg_blocking_pids(a.pid)) AS blocker
+     WHERE blocker = ANY(%(backends)s)
+     GROUP BY blocker
+"""
+
+
+def canceled_by_watchdog(conn, error):
+    """Return whether the error was caused by the watchdog canceling the statement of the connection."""
+    watchdog = getattr(conn, 'watchdog', None)
+    if watchdog is None or getattr(error, 'pgcode', None) != QUERY_CANCELED:
+        return False
+    return watchdog.consume_cancel(conn.get_backend_pid())
+
+
+class Watchdog(threading.Thread):
+    """Thread canceling statements of registered backends which block other sessions."""
+
+    def __init__(self, conn, max_blocked, max_block_wait, interval=WATCHDOG_INTERVAL):
+        """Initialize watchdog using its own autocommit connection.
+
+        :param int max_blocked: maximal number of sessions blocked by a backend
+        :param float max_block_wait: maximal time in seconds a session may be blocked by a backend
+        :param float interval: polling interval in seconds
+        """
+        super(Watchdog, self).__init__(name='watchdog', daemon=True)
+        self.conn = conn
+        self.conn.autocommit = True
+        self.max_blocked = max_blocked
+        self.max_block_wait = max_block_wait
+        self.interval = interval
+        self.blocked_seconds = 0.0
+        self.max_seen_blocked = 0
+        self.max_seen_wait = 0.0
+        self.cancels = 0
+        self._backends = set()
+        self._canceled = set()
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+
+    def add_backend(self, pid):
+        """Start watching the backend."""
+        with self._lock:
+            self._backends.add(pid)
+
+    def consume_cancel(self, pid):
+        """Return whether the statement of the backend was canceled by the watchdog, forget the cancel."""
+        with self._lock:
+            canceled = pid in self._canceled
+            self._canceled.discard(pid)
+            return canceled
+
+    def finish(self):
+        """Stop watching and close the connection."""
+        self._finished.set()
+        self.join()
+        self.conn.close()
+
+    def report(self):
+        """Return dictionary describing blocking caused by watched backends."""
+        return OrderedDict([
+            ('blocked_session_seconds', self.blocked_seconds),
+            ('max_blocked_sessions', self.max_seen_blocked),
+            ('max_block_wait_seconds', self.max_seen_wait),
+            ('watchdog_cancels', self.cancels),
+        ])
+
+    def check(self):
+        """Poll blocked sessions once, cancel statements exceeding limits."""
+        with self._lock:
+            backends = list(self._backends)
+        if not backends:
+            return
+        with self.conn.cursor() as cursor:
+            cursor.execute(BLOCKED_SQL, {'backends': backends})
+            rows = cursor.fetchall()
+            for blocker, blocked, wait in rows:
+                self.blocked_seconds += blocked * self.interval
+                self.max_seen_blocked = max(self.max_seen_blocked, blocked)
+                self.max_seen_wait = max(self.max_seen_wait, wait)
+                if blocked <= self.max_blocked and wait <= self.max_block_wait:
+                    continue
+                logging.warning("Backend %d blocks %d sessions for %.1f s, canceling its statement",
+                                blocker, blocked, wait)
+                with self._lock:
+                    self._canceled.add(blocker)
+                cursor.execute("SELECT pg_cancel_backend(%s)", (blocker, ))
+                self.cancels += 1
+
+    def run(self):
+        """Poll blocked sessions until finished."""
+        while not self._finished.wait(self.interval):
+            try:
+                self.check()
+            except DatabaseError as err:
+                logging.warning("Watchdog stopped: %s", err)
+                return
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for applying retention policies.
+
+Creates and drops partitions of all services in logger database according to retention policies
+from the configuration file.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+from datetime import date
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.catalog import get_partitions_cached
+from logger_maintenance.common import MONTH, ConnectionPool, FatalScriptError, LoggerMaintenanceScript, \
+    create_parts_sql, drop_parts_sql, get_granularity, get_submonthly_services, run_on_pool
+from logger_maintenance.merge import get_merged_drops, merged_tables_query
+from logger_maintenance.retention import CREATE, DROP, plan_retention
+
+
+class MaintainPartsScript(LoggerMaintenanceScript):
+    """Script class for applying retention policies."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "--dry-run", dest="dry_run", action='store_true',
+            help="Just print the plan"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="maximal number of services processed concurrently (default 4)"
+        )
+        parser.add_argument(
+            "--cache", dest="cache_filename",
+            help="partitions snapshot file, catalog is not read if the snapshot is not older than --max-age"
+        )
+        parser.add_argument(
+            "--max-age", dest="max_age", type=float, default=300,
+            help="maximal age of the snapshot in seconds (default 300)"
+        )
+        self.args = parser.parse_args(args)
+
+    def get_plan(self):
+        """Return list of actions needed to apply retention policies."""
+        try:
+            partitions = get_partitions_cached(self.connect_db, self.args.cache_filename, self.args.max_age)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except OSError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        self.set_submonthly_services(partitions)
+        return plan_retention(partitions, self.retention, date.today(), self.granularity)
+
+    def set_submonthly_services(self, partitions):
+        """Store services with weekly or daily partitions, which are skipped by creating monthly partitions."""
+        services = set(part.service for part in partitions if part.service)
+        services.update(service for service in self.granularity if service is not None)
+        self.submonthly_services = get_submonthly_services(self.granularity, sorted(services))
+
+    def describe_action(self, action):
+        """Return description of the action, with days of services with weekly or daily partitions."""
+        if get_granularity(self.granularity, action.service) == MONTH:
+            dates = action.date_from.strftime("%Y-%m"), action.date_to.strftime("%Y-%m")
+        else:
+            dates = action.date_from.isoformat(), action.date_to.isoformat()
+        return "{} {} {} - {}".format(action.kind, action.service or "all services", *dates)
+
+    def execute(self):
+        """Create and drop database partitions according to retention policies."""
+        if self.args.dry_run:
+            logging.info("=== DRY-RUN ===")
+
+        actions = self.get_plan()
+        if not actions:
+            logging.info("Nothing to do")
+        for action in actions:
+            logging.info("Plan: %s", self.describe_action(action))
+        if self.args.dry_run:
+            return
+        self.check_granularity()
+
+        for action in actions:
+            if action.kind == CREATE:
+                with self.connect_db() as conn:
+                    self.run_action(conn, action)
+
+        drops = [action for action in actions if action.kind == DROP]
+        if not drops:
+            return
+        pool = ConnectionPool(self.connect_db, max(1, min(self.args.workers, len(drops))))
+        try:
+            results = run_on_pool(pool, self.run_action, drops)
+        finally:
+            pool.closeall()
+
+        failed = [action for action, error in results.items() if error is not None]
+        if failed:
+            message = "Dropping partitions failed for services: " + ", ".join(action.service for action in failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+    def run_action(self, conn, action):
+        """Execute single planned action in its own transaction."""
+        with conn.cursor() as cursor:
+            try:
+                granularity = get_granularity(self.granularity, action.service)
+                if action.kind == CREATE and action.service is None:
+                    sql = create_parts_sql(cursor, action.date_from, action.date_to, skip=self.submonthly_services)
+                elif action.kind == CREATE:
+                    sql = create_parts_sql(cursor, action.date_from, action.date_to, action.service, granularity)
+                else:
+                    # `drop_parts` leaves out merged partitions, they are dropped in the same transaction
+                    cursor.execute(*merged_tables_query(action.service))
+                    merged = get_merged_drops(cursor.fetchall(), action.service, action.date_from, action.date_to,
+                                              granularity)
+                    sql = drop_parts_sql(cursor, action.date_from, action.date_to, action.service, False, granularity)
+                logging.info(sql.decode())
+                cursor.execute(sql)
+                if action.kind == DROP:
+                    queries = [query for (query, ) in cursor.fetchall()] + merged
+                    for query in merged:
+                        cursor.execute(query)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                if not conn.closed:
+                    conn.rollback()
+                raise FatalScriptError(err)
+            else:
+                if action.kind == DROP:
+                    for query in queries:
+                        logging.info(query)
+                conn.commit()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = MaintainPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for merging small closed monthly logger partitions into quarterly or yearly tables.
+
+Merges partitions smaller than the size from `merge` section of the configuration file, so the logger schema
+has fewer partitions to plan queries over.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+from datetime import date
+
+from psycopg2 import DatabaseError
+
+from compact_parts import CompactPartsScript
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import ConfigError, FatalScriptError
+from logger_maintenance.merge import merge_tables, parse_merge, plan_merge
+
+
+class MergePartsScript(CompactPartsScript):
+    """Script class for merging small closed monthly logger partitions."""
+
+    operation = "Merging"
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        self.add_rewrite_arguments(parser)
+        self.args = parser.parse_args(args)
+
+    def read_config(self, config_filename=None):
+        """Read configuration including the merge policy."""
+        config = super(MergePartsScript, self).read_config(config_filename)
+        try:
+            self.merge = parse_merge(config.get("merge", {}))
+        except ConfigError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        return config
+
+    def get_plan(self):
+        """Return list of merges."""
+        with self.connect_db() as conn:
+            try:
+                partitions = get_partitions(conn)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+        merges = plan_merge(partitions, self.merge, date.today(), self.args.service)
+        for merge in merges:
+            logging.info("Plan: merge %s into %s", ", ".join(merge.tables), merge.table)
+        return merges
+
+    def rewrite(self, pool, merges, budget):
+        """Merge planned partitions, return result of `merge.merge_tables`."""
+        return merge_tables(pool, merges, budget, self.may_start, lock_timeout=self.args.lock_timeout,
+                            retries=self.args.retries, backoff=self.args.backoff)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = MergePartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for maintaining partitions of several logger databases at once.
+
+Creates, drops or lists partitions in all logger databases listed in `targets` section of the configuration
+file concurrently. A failure of one database does not affect the others, a summary of all of them is printed.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from datetime import date
+from json.decoder import JSONDecodeError
+
+from logger_maintenance.catalog import PARTITIONS_SQL, SERVICES_SQL
+from logger_maintenance.common import GRANULARITY_FUNCTIONS_SQL, ConfigError, DateAction, FatalScriptError, \
+    LoggerMaintenanceScript, add_months, check_granularity_functions, create_parts_statements, drop_parts_sql, \
+    get_granularity, is_monthly, parse_granularity
+from logger_maintenance.merge import get_merged_drops, merged_tables_query
+from logger_maintenance.targets import OK, parse_targets, run_targets
+
+
+class MultiPartsScript(LoggerMaintenanceScript):
+    """Script class for maintaining partitions of several logger databases."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "operation", choices=('create', 'drop', 'list'),
+            help="operation executed on all databases"
+        )
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+',
+            help="service names (i.e. `mojeid`) or `all` for all services (required for drop)"
+        )
+        parser.add_argument(
+            "-d", "--from-date", dest="date_from", action=DateAction,
+            help="YYYY-MM or YYYY-MM-DD date of the first partition "
+                 "(default next month for create, 6 months ago for drop)"
+        )
+        parser.add_argument(
+            "--to-date", dest="date_to", action=DateAction,
+            help="YYYY-MM or YYYY-MM-DD date of the last partition"
+        )
+        parser.add_argument(
+            "--dry-run", dest="dry_run", action='store_true',
+            help="Just echo the SQL commands to be executed (drop only)"
+        )
+        parser.add_argument(
+            "-f", "--format", choices=('table', 'json'), default='table',
+            help="format of the summary (default table)"
+        )
+        self.args = parser.parse_args(args)
+        self._set_default_args()
+
+    def _set_default_args(self):
+        """Set default values in case that command line arguments are not supplied."""
+        if self.args.date_from is None:
+            self.args.date_from = add_months(date.today(), 1 if self.args.operation == 'create' else -6)
+
+        if self.args.date_to is None or self.args.date_to < self.args.date_from:
+            self.args.date_to = self.args.date_from
+
+        if self.args.operation == 'drop' and not self.args.service:
+            logging.error("Services have to be set by -s/--service for drop")
+            raise FatalScriptError(ValueError)
+
+    def read_config(self, config_filename=None):
+        """Read configuration with database targets from JSON file.
+
+        :param str config_filename: path to configuration file
+        :return: config dictionary
+        """
+        if config_filename is None:
+            config_filename = self.args.config_filename
+
+        try:
+            with open(config_filename) as fconf:
+                self.config = json.load(fconf)
+            self.targets = parse_targets(self.config)
+            self.granularity = parse_granularity(self.config.get("granularity", {}))
+            return self.config
+        except (FileNotFoundError, PermissionError, JSONDecodeError, AttributeError, ConfigError) as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+    async def check_target_granularity(self, conn):
+        """Check the target supports configured granularity, monthly configuration is not checked at all."""
+        if not is_monthly(self.granularity):
+            check_granularity_functions(await conn.execute(GRANULARITY_FUNCTIONS_SQL), self.granularity)
+
+    async def run_create(self, connect, target):
+        """Create partitions on the target."""
+        async with connect() as conn:
+            await self.check_target_granularity(conn)
+            services = [] if is_monthly(self.granularity) else [
+                service for (service, ) in await conn.execute(SERVICES_SQL)]
+            queries = [query.decode() for query in create_parts_statements(
+                conn, self.args.date_from, self.args.date_to, self.granularity, services)]
+            for query in queries:
+                logging.info("%s: %s", target.name, query)
+                await conn.execute(query)
+        return [(query, ) for query in queries]
+
+    async def drop_service(self, connect, target, service):
+        """Drop partitions of the service on the target."""
+        granularity = get_granularity(self.granularity, service)
+        async with connect() as conn:
+            # `drop_parts` leaves out merged partitions
+            merged = get_merged_drops(await conn.execute(*merged_tables_query(service)), service,
+                                      self.args.date_from, self.args.date_to, granularity)
+            query = drop_parts_sql(conn, self.args.date_from, self.args.date_to, service, self.args.dry_run,
+                                   granularity).decode()
+            logging.info("%s: %s", target.name, query)
+            rows = await conn.execute(query)
+            if not self.args.dry_run:
+                for statement in merged:
+                    await conn.execute(statement)
+        rows = list(rows) + [(statement, ) for statement in merged]
+        for (statement, ) in rows:
+            logging.info("%s: %s", target.name, statement)
+        return rows
+
+    async def run_drop(self, connect, target):
+        """Drop partitions of selected services on the target, services are processed concurrently."""
+        services = self.args.service
+        async with connect() as conn:
+            await self.check_target_granularity(conn)
+            if 'all' in services:
+                rows = await conn.execute(SERVICES_SQL)
+                services = [service for (service, ) in rows]
+        # Services are dropped independently, a failing service does not abandon the others in the middle
+        results = await asyncio.gather(*[self.drop_service(connect, target, service) for service in services],
+                                       return_exceptions=True)
+        errors = []
+        for service, result in zip(services, results):
+            if isinstance(result, BaseException):
+                logging.error("%s: dropping partitions of %s failed: %s", target.name, service, result)
+                errors.append(result)
+        if errors:
+            raise errors[0]
+        return [row for rows in results for row in rows]
+
+    async def run_list(self, connect, target):
+        """List partitions on the target."""
+        async with connect() as conn:
+            return await conn.execute(PARTITIONS_SQL)
+
+    def describe(self, result):
+        """Return short description of the operation result."""
+        if self.args.operation == 'list':
+            return "{} partitions, {} bytes".format(len(result.rows), sum(row[2] or 0 for row in result.rows))
+        if self.args.operation == 'drop':
+            return "{} tables {}".format(len(result.rows), "to drop" if self.args.dry_run else "dropped")
+        return "partitions created"
+
+    def execute(self):
+        """Run the operation on all targets, print summary."""
+        if self.args.dry_run:
+            logging.info("=== DRY-RUN ===")
+
+        results = run_targets(self.targets, getattr(self, 'run_' + self.args.operation))
+
+        if self.args.format == 'json':
+            json.dump([
+                {'target': result.target, 'status': result.status, 'seconds': result.seconds,
+                 'rows': [list(row) for row in result.rows], 'error': result.error}
+                for result in results
+            ], sys.stdout, indent=4, default=str)
+            print()
+        else:
+            row_format = "{:20} {:8} {:>10}  {}"
+            print(row_format.format("target", "status", "seconds", "result"))
+            for result in results:
+                print(row_format.format(result.target, result.status, "{:.3f}".format(result.seconds),
+                                        self.describe(result) if result.status == OK else result.error))
+
+        failed = [result.target for result in results if result.status != OK]
+        if failed:
+            message = "Operation {} failed for targets: {}".format(self.args.operation, ", ".join(failed))
+            logging.error(message)
+            raise FatalScriptError(None, message)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = MultiPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
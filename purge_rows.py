@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for purging requests inside logger partitions.
+
+Deletes requests of a time window, optionally only those from given source addresses, with their data and property
+values in small batches paced by rate and replication lag, vacuums purged partitions afterwards.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import ipaddress
+import logging
+import sys
+from datetime import datetime
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import FatalScriptError, LoggerMaintenanceScript
+from logger_maintenance.generator import Throttle
+from logger_maintenance.purge import Checkpoint, Criteria, PurgeError, check_replicas, plan_purge, purge_table, \
+    vacuum_purged
+
+# Accepted formats of --from-time and --to-time
+TIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S")
+
+
+def parse_time(value):
+    """Convert YYYY-MM-DD[THH:MM[:SS]] string to datetime."""
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid time {!r}, use YYYY-MM-DD[THH:MM[:SS]]".format(value))
+
+
+def parse_network(value):
+    """Check and normalize IP address or network."""
+    try:
+        return str(ipaddress.ip_network(value, strict=False))
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err))
+
+
+class PurgeRowsScript(LoggerMaintenanceScript):
+    """Script class for purging requests inside logger partitions."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "--from-time", dest="time_from", type=parse_time, required=True,
+            help="YYYY-MM-DD[THH:MM[:SS]] time of the first purged request"
+        )
+        parser.add_argument(
+            "--to-time", dest="time_to", type=parse_time, required=True,
+            help="YYYY-MM-DD[THH:MM[:SS]] time after the last purged request (exclusive)"
+        )
+        parser.add_argument(
+            "--source-ip", dest="networks", type=parse_network, nargs='+', default=[],
+            help="purge only requests from the addresses or networks (default all addresses)"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+',
+            help="purge only requests of the services (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "--dry-run", dest="dry_run", action='store_true',
+            help="Just print the plan"
+        )
+        parser.add_argument(
+            "--batch-size", dest="batch_size", type=int, default=10000,
+            help="number of request ids examined by a single transaction (default 10000)"
+        )
+        parser.add_argument(
+            "--rows-per-second", dest="rows_per_second", type=float, default=5000,
+            help="maximal average rate of deleted rows, 0 for no limit (default 5000)"
+        )
+        parser.add_argument(
+            "--max-lag", dest="max_lag", type=float, default=10,
+            help="pause while replay lag of any standby exceeds this number of seconds, 0 for no limit (default 10)"
+        )
+        parser.add_argument(
+            "--checkpoint", dest="checkpoint_filename",
+            help="file keeping progress, an interrupted purge with the same criteria is resumed from it"
+        )
+        parser.add_argument(
+            "--no-vacuum", dest="vacuum", action='store_false',
+            help="do not vacuum purged partitions"
+        )
+        self.args = parser.parse_args(args)
+        if self.args.time_to <= self.args.time_from:
+            logging.error("--to-time has to follow --from-time")
+            raise FatalScriptError(ValueError)
+        if self.args.max_lag < 0:
+            logging.error("--max-lag can not be negative")
+            raise FatalScriptError(ValueError)
+        if not self.args.max_lag:
+            self.args.max_lag = None
+
+    def check_replicas(self, conn):
+        """Check replication lag can be limited if requested by `--max-lag`."""
+        if self.args.max_lag is None:
+            return
+        try:
+            check_replicas(conn)
+        except DatabaseError as err:
+            logging.error("DatabaseError: " + str(err))
+            raise FatalScriptError(err)
+        except PurgeError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+    def execute(self):
+        """Purge requests from database partitions."""
+        if self.args.dry_run:
+            logging.info("=== DRY-RUN ===")
+
+        criteria = Criteria(self.args.time_from, self.args.time_to, self.args.networks)
+        try:
+            checkpoint = Checkpoint(self.args.checkpoint_filename, criteria)
+        except (OSError, ValueError, PurgeError) as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+        with self.connect_db() as conn:
+            try:
+                all_partitions = get_partitions(conn)
+                partitions = plan_purge(all_partitions, criteria, self.args.service)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+            if not partitions:
+                logging.info("Nothing to do")
+            for part in partitions:
+                logging.info("Plan: purge %s", part.table)
+            if self.args.dry_run:
+                return
+
+            self.check_replicas(conn)
+            throttle = Throttle(self.args.rows_per_second)
+            for part in partitions:
+                if checkpoint.is_vacuumed(part.table):
+                    logging.info("Partition %s already purged", part.table)
+                    continue
+                try:
+                    purge_table(conn, part.table, criteria, checkpoint, throttle, self.args.batch_size,
+                                self.args.max_lag, all_partitions)
+                    if self.args.vacuum:
+                        vacuum_purged(conn, part.table, all_partitions)
+                    checkpoint.update(part.table, vacuumed=True)
+                except DatabaseError as err:
+                    logging.error("DatabaseError: " + str(err))
+                    conn.rollback()
+                    raise FatalScriptError(err)
+                except OSError as err:
+                    logging.error(err)
+                    raise FatalScriptError(err)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = PurgeRowsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
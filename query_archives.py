@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for querying columnar archives of request partitions.
+
+Scans archives written by `drop_parts.py --archive-format columnar` without loading them into a database
+and prints matching requests as tab separated values. Archives are selected by the manifest of the archive
+directory first, so only archives which may contain matching requests are opened.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+from datetime import datetime
+from functools import partial
+
+from logger_maintenance.archive import COLUMNAR_FORMAT, find_archive, list_archives, read_meta, sync_manifest
+from logger_maintenance.catalog import get_table_month, get_table_service, get_table_span
+from logger_maintenance.columnar import TIME_FORMAT, ColumnarError, Query, scan_archive
+from logger_maintenance.common import FatalScriptError, LoggerMaintenanceScript, add_months
+from logger_maintenance.manifest import load_manifest, may_contain
+from purge_rows import parse_network, parse_time
+
+# Partitions of other tables with names starting by `request_`
+OTHER_REQUEST_TABLES = ('request_data_', 'request_property_value_')
+
+
+def scan(query, path):
+    """Scan the archive, return tuple (path, rows or None, error message or None)."""
+    try:
+        return path, scan_archive(path, query), None
+    except (OSError, ColumnarError) as err:
+        return path, None, str(err)
+
+
+class QueryArchivesScript(LoggerMaintenanceScript):
+    """Script class for querying columnar archives of request partitions."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-a", "--archive-dir", dest="archive_dir", required=True,
+            help="directory with archives"
+        )
+        parser.add_argument(
+            "--from-time", dest="time_from", type=parse_time,
+            help="YYYY-MM-DD[THH:MM[:SS]] time of the first request"
+        )
+        parser.add_argument(
+            "--to-time", dest="time_to", type=parse_time,
+            help="YYYY-MM-DD[THH:MM[:SS]] time after the last request (exclusive)"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+',
+            help="only requests of the services (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "--source-ip", dest="networks", type=parse_network, nargs='+',
+            help="only requests from the addresses or networks"
+        )
+        parser.add_argument(
+            "--request-type", dest="request_types", type=int, nargs='+',
+            help="only requests of the request type ids"
+        )
+        parser.add_argument(
+            "--request-id", dest="request_ids", type=int, nargs='+',
+            help="only requests with the ids"
+        )
+        parser.add_argument(
+            "--columns", nargs='+',
+            help="printed columns (default all columns)"
+        )
+        parser.add_argument(
+            "--count", action='store_true',
+            help="print only the number of matching requests"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=os.cpu_count() or 1,
+            help="maximal number of archives scanned concurrently (default number of CPUs)"
+        )
+        parser.add_argument(
+            "--update-manifest", dest="update_manifest", action='store_true',
+            help="record archives missing in the manifest before the query"
+        )
+        self.args = parser.parse_args(args)
+
+    def get_archives(self):
+        """Return paths of columnar request archives which may contain matching requests."""
+        try:
+            if self.args.update_manifest:
+                logging.info("Recorded %d archives in the manifest", sync_manifest(self.args.archive_dir))
+            tables = list_archives(self.args.archive_dir)
+            manifest = load_manifest(self.args.archive_dir)
+        except (OSError, ValueError, ColumnarError) as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        time_from = self.args.time_from.strftime(TIME_FORMAT) if self.args.time_from is not None else None
+        time_to = self.args.time_to.strftime(TIME_FORMAT) if self.args.time_to is not None else None
+
+        paths = []
+        for table in tables:
+            month = get_table_month(table)
+            if not table.startswith('request_') or table.startswith(OTHER_REQUEST_TABLES) or month is None:
+                continue
+            if self.args.service is not None and get_table_service(table, 'request') not in self.args.service:
+                continue
+            if self.args.time_to is not None and datetime.combine(month, datetime.min.time()) >= self.args.time_to:
+                continue
+            end = add_months(month, get_table_span(table))
+            if self.args.time_from is not None and datetime.combine(end, datetime.min.time()) <= self.args.time_from:
+                continue
+            # Archives missing in the manifest are always scanned
+            entry = manifest.get(table)
+            if entry is not None and not any(may_contain(entry, time_from, time_to, request_id)
+                                             for request_id in self.args.request_ids or [None]):
+                continue
+            path = find_archive(self.args.archive_dir, table)
+            if read_meta(path).get('format') != COLUMNAR_FORMAT:
+                logging.warning("Archive %s is not columnar, restore it to query it", path)
+                continue
+            paths.append(path)
+        return paths
+
+    def execute(self):
+        """Print requests matching the query."""
+        paths = self.get_archives()
+        if not paths:
+            logging.info("No such archives")
+            return
+        query = Query(self.args.columns, self.args.time_from, self.args.time_to, self.args.networks,
+                      self.args.request_types, self.args.request_ids)
+
+        count = 0
+        failed = []
+        pool = multiprocessing.Pool(max(1, min(self.args.workers, len(paths))))
+        try:
+            # Results are printed in order of archives as soon as they are scanned
+            for path, rows, error in pool.imap(partial(scan, query), paths):
+                if error is not None:
+                    logging.error("Scan of %s failed: %s", path, error)
+                    failed.append(path)
+                    continue
+                count += len(rows)
+                if not self.args.count:
+                    for row in rows:
+                        print("\t".join("\\N" if value is None else value for value in row))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        if self.args.count:
+            print(count)
+        if failed:
+            message = "Scan failed for archives: " + ", ".join(failed)
+            logging.error(message)
+            raise FatalScriptError(ColumnarError(message), message)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = QueryArchivesScript(sys.argv[1:])
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for restoring archived db partitions.
+
+Recreates partitions for given dates in logger database and loads them from archive files
+created by `drop_parts.py --archive-dir`.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.archive import ArchiveError, list_archives, restore_table
+from logger_maintenance.catalog import get_services, get_table_month
+from logger_maintenance.common import DAY, ConnectionPool, DateAction, FatalScriptError, LoggerMaintenanceScript, \
+    create_parts_statements, execute_statements, is_monthly, range_end, run_on_pool
+
+
+class RestorePartsScript(LoggerMaintenanceScript):
+    """Script class for restoring archived db partitions."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-a", "--archive-dir", dest="archive_dir", required=True,
+            help="directory with archived partitions"
+        )
+        parser.add_argument(
+            "-s", "--service",
+            help="restore only partitions of the service (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "-d", "--from-date", dest="date_from", action=DateAction, required=True,
+            help="YYYY-MM or YYYY-MM-DD date of log partition to be restored (or the first one to be restored, "
+                 "if --date_to is supplied)"
+        )
+        parser.add_argument(
+            "--to-date", dest="date_to", action=DateAction,
+            help="YYYY-MM or YYYY-MM-DD date of last log partition to be restored"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="maximal number of tables loaded or indexes built concurrently (default 4)"
+        )
+        self.args = parser.parse_args(args)
+        self._set_default_args()
+
+    def _set_default_args(self):
+        """Set default values in case that command line arguments are not supplied."""
+        # If --to-date not set, let it be equal to --from-date
+        if self.args.date_to is None:
+            self.args.date_to = self.args.date_from
+
+        # --to-date cannot preceed --from-date
+        if self.args.date_to < self.args.date_from:
+            self.args.date_to = self.args.date_from
+
+    def get_tables(self):
+        """Return list of archived tables to be restored."""
+        try:
+            tables = list_archives(self.args.archive_dir)
+        except OSError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+
+        selected = []
+        date_to = range_end(self.args.date_to, DAY)
+        for table in tables:
+            month = get_table_month(table)
+            if month is None or not self.args.date_from <= month <= date_to:
+                continue
+            if self.args.service is not None and "_{}_".format(self.args.service) not in table:
+                continue
+            selected.append(table)
+        return selected
+
+    def create_parts(self):
+        """Create database partitions for restored months."""
+        self.check_granularity()
+        with self.connect_db() as conn:
+            with conn.cursor() as cursor:
+                try:
+                    services = [] if is_monthly(self.granularity) else get_services(cursor)
+                    for sql_func in create_parts_statements(
+                            cursor, self.args.date_from, self.args.date_to, self.granularity, services):
+                        logging.info(sql_func.decode())
+                        cursor.execute(sql_func)
+                except DatabaseError as err:
+                    logging.error("DatabaseError: " + str(err))
+                    conn.rollback()
+                    raise FatalScriptError(err)
+                else:
+                    conn.commit()
+
+    def execute(self):
+        """Restore database partitions from archive files."""
+        tables = self.get_tables()
+        if not tables:
+            logging.info("No such archived partitions")
+            return
+
+        self.create_parts()
+
+        indexes = {}
+
+        def restore(conn, table):
+            try:
+                indexes[table] = restore_table(conn, table, self.args.archive_dir)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+            except (OSError, ArchiveError) as err:
+                logging.error("Restore of %s failed: %s", table, err)
+                raise FatalScriptError(err)
+            logging.info("Restored %s", table)
+
+        pool = ConnectionPool(self.connect_db, max(1, self.args.workers))
+        try:
+            results = run_on_pool(pool, restore, tables)
+            # Indexes are created after all data are loaded
+            indexdefs = [indexdef for table in tables for indexdef in indexes.get(table, [])]
+            results.update(execute_statements(pool, indexdefs))
+        finally:
+            pool.closeall()
+
+        failed = [item for item, error in results.items() if error is not None]
+        if failed:
+            message = "Restore failed for: " + ", ".join(failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = RestorePartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
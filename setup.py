@@ -38,7 +38,10 @@ setup(name='fred-logger-maintenance',
       long_description=readme(),
       packages=find_packages(),
 
-      scripts=['create_parts.py', 'drop_parts.py'],
+      scripts=['create_parts.py', 'drop_parts.py', 'restore_parts.py', 'list_parts.py',
+               'maintain_parts.py', 'daemon_parts.py', 'multi_parts.py', 'vacuum_parts.py',
+               'audit_parts.py', 'compact_parts.py', 'tier_parts.py', 'merge_parts.py', 'purge_rows.py',
+               'query_archives.py', 'generate_logs.py'],
 
       classifiers=[
         'Development Status :: 5 - Production/Stable',
@@ -18,20 +18,68 @@
 
 """Test module for logger-maintenance."""
 
+import argparse
+import asyncio
 import json
+import logging
+import os
 import sys
+import tempfile
 import unittest.mock as mock
-from datetime import date
+from collections import OrderedDict
+from datetime import date, datetime
 from io import StringIO
 from unittest import TestCase
 from unittest.mock import patch
 
-from psycopg2 import DatabaseError, InterfaceError
+from psycopg2 import DatabaseError, InterfaceError, OperationalError, sql
+from psycopg2.extensions import POLL_OK
 from testfixtures import LogCapture
 
+from audit_parts import AuditPartsScript
+from benchmark import LockTimesHandler, Scale, parse_scale
+from compact_parts import CompactPartsScript
 from create_parts import CreatePartsScript
+from daemon_parts import DaemonPartsScript
 from drop_parts import DropPartsScript
-from logger_maintenance.common import ConfigError, FatalScriptError, add_months
+from generate_logs import weighted
+from list_parts import ListPartsScript
+from logger_maintenance.archive import ARCHIVE_FORMAT, COLUMNAR_FORMAT, ArchiveError, archive_table, archive_tables, \
+    get_drop_tables, list_archives, read_meta, restore_table, sync_manifest, verify_archive
+from logger_maintenance.audit import CONSTRAINT, INDEX, INHERITANCE, INVALID_INDEX, NOT_VALIDATED, OWNER, TABLESPACE, \
+    TIME_RANGE, Deviation, TableState, audit_tables, get_period, get_time_bounds, repair_tables, with_time_bounds
+from logger_maintenance.catalog import Partition, find_missing, get_partitions_cached, get_table_month, get_table_span
+from logger_maintenance.columnar import ColumnarError, ColumnarFile, ColumnarWriter, Query, scan_archive
+from logger_maintenance.common import DAY, GRANULARITY_FUNCTIONS, MONTH, RELATION_SIZES_SQL, WEEK, ConfigError, \
+    ConnectionPool, FatalScriptError, InstrumentedConnection, InstrumentedCursor, Metrics, RetentionPolicy, \
+    StatementMetrics, _finish_transaction, add_months, add_periods, backoff_delay, check_granularity_functions, \
+    create_parts_statements, drop_parts_sql, execute_short_transaction, parse_granularity, parse_retention, \
+    period_start, range_end, retry_canceled, run_on_pool
+from logger_maintenance.compact import CompactResult, IOBudget, _swap_sql, compact_table, plan_compact
+from logger_maintenance.detach import DetachedTablesDropper, detach_table, drop_detached_table
+from logger_maintenance.generator import Options, Throttle, Unit, count_sessions, generate_unit, plan_units, \
+    split_counts
+from logger_maintenance.journal import STARTED, Journal, JournalError
+from logger_maintenance.manifest import BloomFilter, load_manifest, may_contain, update_manifest
+from logger_maintenance.merge import DEFAULT_MERGE_POLICY, Merge, MergeError, MergePolicy, \
+    _swap_sql as _merge_swap_sql, get_merged_drops, merge_checks, merge_table, parse_merge, plan_merge
+from logger_maintenance.purge import Checkpoint, Criteria, PurgeError, check_replicas, get_partition_tables, \
+    plan_purge, purge_batch_sql, purge_table
+from logger_maintenance.retention import Action, plan_retention
+from logger_maintenance.rollup import DEFAULT_ROLLUP, Rollup, get_rollup_tables, parse_rollup, rollup_table
+from logger_maintenance.scheduler import Calendar, PersistentConnection, Scheduler, in_quiet_hours, parse_schedule
+from logger_maintenance.targets import Target, parse_targets, run_targets
+from logger_maintenance.tier import Tiering, TierPolicy, parse_tiering, plan_tier
+from logger_maintenance.vacuum import ANALYZE, FREEZE, VacuumCandidate, VacuumTask, plan_vacuum, vacuum_tables
+from logger_maintenance.watchdog import Watchdog
+from maintain_parts import MaintainPartsScript
+from merge_parts import MergePartsScript
+from multi_parts import MultiPartsScript
+from purge_rows import PurgeRowsScript
+from query_archives import QueryArchivesScript
+from restore_parts import RestorePartsScript
+from tier_parts import TierPartsScript
+from vacuum_parts import VacuumPartsScript
 
 
 class AddMonthTestCase(TestCase):
@@ -46,146 +94,2812 @@ class AddMonthTestCase(TestCase):
         self.assertEqual(add_months(d, 0), date(2017, 10, 1))
 
 
+class GranularityTestCase(TestCase):
+    """Test class for weekly and daily partitions."""
+
+    def test_parse_granularity(self):
+        """Test parsing granularity section of configuration."""
+        self.assertEqual(parse_granularity({}), {None: MONTH})
+        self.assertEqual(parse_granularity({"default": "week", "services": {"epp": "day"}}), {None: WEEK, "epp": DAY})
+        for config in ([], {"default": "year"}, {"services": {"epp": "hour"}}, {"services": []}):
+            with self.assertRaises(ConfigError):
+                parse_granularity(config)
+
+    def test_periods(self):
+        """Test computing periods of partitions."""
+        d = date(2017, 11, 30)
+        self.assertEqual(period_start(d, DAY), d)
+        self.assertEqual(period_start(d, WEEK), date(2017, 11, 27))
+        self.assertEqual(period_start(d, MONTH), date(2017, 11, 1))
+        self.assertEqual(add_periods(d, 2, DAY), date(2017, 12, 2))
+        self.assertEqual(add_periods(d, 1, WEEK), date(2017, 12, 4))
+        self.assertEqual(add_periods(d, -1, MONTH), date(2017, 10, 1))
+        self.assertEqual(range_end(date(2017, 2, 1), DAY), date(2017, 2, 28))
+        self.assertEqual(range_end(date(2017, 2, 3), DAY), date(2017, 2, 3))
+        self.assertEqual(range_end(date(2017, 2, 1), MONTH), date(2017, 2, 1))
+
+    def test_drop_parts_sql(self):
+        """Test dropping daily and weekly partitions passes their granularity."""
+        cursor = mock.Mock()
+        drop_parts_sql(cursor, date(2017, 1, 1), date(2017, 1, 1), "epp", False, DAY)
+        cursor.mogrify.assert_called_once_with(
+            "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s, %(granularity)s)",
+            {'from': '2017-01-01', 'to': '2017-01-31', 'service': 'epp', 'dry_run': False, 'granularity': DAY})
+        cursor.reset_mock()
+        drop_parts_sql(cursor, date(2017, 1, 4), date(2017, 1, 18), "epp", True, WEEK)
+        cursor.mogrify.assert_called_once_with(
+            "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s, %(granularity)s)",
+            {'from': '2017-01-02', 'to': '2017-01-16', 'service': 'epp', 'dry_run': True, 'granularity': WEEK})
+
+    def test_create_parts_statements(self):
+        """Test monthly partitions are not created for services with daily partitions."""
+        cursor = mock.Mock()
+        create_parts_statements(cursor, date(2017, 2, 1), date(2017, 2, 1), {None: MONTH, "epp": DAY},
+                                ["epp", "mojeid"])
+        self.assertEqual(cursor.mogrify.call_args_list, [
+            mock.call("SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp, %(skip)s::text[])",
+                      {'from': '2017-02-01', 'to': '2017-02-01', 'skip': ["epp"]}),
+            mock.call("SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(granularity)s)",
+                      {'from': '2017-02-01', 'to': '2017-02-28', 'service': "epp", 'granularity': DAY}),
+        ])
+        cursor.reset_mock()
+        create_parts_statements(cursor, date(2017, 2, 1), date(2017, 2, 1), {None: MONTH}, [])
+        cursor.mogrify.assert_called_once_with(
+            "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp)", {'from': '2017-02-01', 'to': '2017-02-01'})
+
+    def test_check_granularity_functions(self):
+        """Test overloads taking granularity are required only if some service is not monthly."""
+        check_granularity_functions([], {None: MONTH})
+        check_granularity_functions([(function, ) for function in GRANULARITY_FUNCTIONS], {None: MONTH, "epp": DAY})
+        with self.assertRaisesRegex(ConfigError, r"create_parts\(timestamp without time zone, "
+                                                 r"timestamp without time zone, text\[\]\)$"):
+            check_granularity_functions([(function, ) for function in GRANULARITY_FUNCTIONS[1:]], {None: WEEK})
+
+
+class LockNotAvailable(DatabaseError):
+    """Database error raised on lock timeout."""
+
+    pgcode = '55P03'
+
+
+class QueryCanceled(DatabaseError):
+    """Database error raised on canceled statement."""
+
+    pgcode = '57014'
+
+
+class ShortTransactionTestCase(TestCase):
+    """Test class for execute_short_transaction function."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_backoff_delay(self):
+        """Test backoff delay is bounded."""
+        for attempt in range(10):
+            self.assertLessEqual(backoff_delay(attempt, 0.5, cap=4), min(4, 0.5 * 2 ** attempt))
+
+    @patch('logger_maintenance.common.time.sleep')
+    def test_retry(self, mock_sleep):
+        """Test statement is retried after lock timeout."""
+        error = LockNotAvailable()
+        conn = mock.MagicMock()
+        conn.commit.side_effect = [error, None]
+        wait, hold = execute_short_transaction(conn, "DROP TABLE foo", 100, 3, 0.1)
+        self.assertEqual(conn.commit.call_count, 2)
+        self.assertEqual(conn.rollback.call_count, 1)
+        self.assertEqual(mock_sleep.call_count, 1)
+        conn.cursor().__enter__().execute.assert_any_call("SELECT set_config('lock_timeout', %s, true)", ('100', ))
+
+    @patch('logger_maintenance.common.time.sleep')
+    def test_retries_exhausted(self, mock_sleep):
+        """Test error is raised when retries are exhausted."""
+        error = LockNotAvailable()
+        conn = mock.MagicMock()
+        conn.commit.side_effect = error
+        with self.assertRaises(DatabaseError):
+            execute_short_transaction(conn, "DROP TABLE foo", 100, 2, 0.1)
+        self.assertEqual(conn.commit.call_count, 3)
+
+    @patch('logger_maintenance.common.time.sleep')
+    def test_retry_canceled_by_watchdog(self, mock_sleep):
+        """Test statement is retried after it is canceled by the watchdog."""
+        conn = mock.MagicMock()
+        conn.get_backend_pid.return_value = 42
+        conn.watchdog.consume_cancel.side_effect = lambda pid: pid == 42
+        conn.commit.side_effect = [QueryCanceled(), None]
+        execute_short_transaction(conn, "DROP TABLE foo", 100, 3, 0.1)
+        self.assertEqual(conn.commit.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    def test_other_error(self):
+        """Test other errors are not retried."""
+        conn = mock.MagicMock()
+        conn.commit.side_effect = DatabaseError()
+        with self.assertRaises(DatabaseError):
+            execute_short_transaction(conn, "DROP TABLE foo", 100, 2, 0.1)
+        self.assertEqual(conn.commit.call_count, 1)
+
+
+class WatchdogTestCase(TestCase):
+    """Test class for watchdog of blocked sessions."""
+
+    def setUp(self):
+        """Set up log handler and watchdog."""
+        self.log_handler = LogCapture()
+        self.conn = mock.MagicMock()
+        self.watchdog = Watchdog(self.conn, max_blocked=5, max_block_wait=10)
+        self.watchdog.add_backend(42)
+        self.watchdog.add_backend(43)
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_check(self):
+        """Test statement blocking too many sessions is canceled."""
+        cursor = self.conn.cursor().__enter__()
+        cursor.fetchall.return_value = [(42, 6, 1.0), (43, 2, 3.0)]
+
+        self.watchdog.check()
+
+        cursor.execute.assert_called_with("SELECT pg_cancel_backend(%s)", (42, ))
+        self.assertEqual(self.watchdog.report(), OrderedDict([
+            ('blocked_session_seconds', 4.0), ('max_blocked_sessions', 6), ('max_block_wait_seconds', 3.0),
+            ('watchdog_cancels', 1)]))
+        self.assertTrue(self.watchdog.consume_cancel(42))
+        self.assertFalse(self.watchdog.consume_cancel(42))
+        self.assertFalse(self.watchdog.consume_cancel(43))
+
+    def test_check_wait(self):
+        """Test statement blocking sessions for too long is canceled."""
+        cursor = self.conn.cursor().__enter__()
+        cursor.fetchall.return_value = [(43, 1, 11.0)]
+        self.watchdog.check()
+        cursor.execute.assert_called_with("SELECT pg_cancel_backend(%s)", (43, ))
+
+    @patch('logger_maintenance.common.time.sleep')
+    def test_retry_canceled(self, mock_sleep):
+        """Test function is retried only when the watchdog canceled its statement."""
+        conn = mock.Mock(watchdog=self.watchdog)
+        conn.get_backend_pid.return_value = 42
+        self.watchdog._canceled.add(42)
+        func = mock.Mock(side_effect=[FatalScriptError(QueryCanceled()), FatalScriptError(QueryCanceled()), 'ok'])
+
+        with self.assertRaises(FatalScriptError):
+            retry_canceled(conn, func, 3, 1.0)
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+
+class TargetsTestCase(TestCase):
+    """Test class for multi-target driver."""
+
+    def setUp(self):
+        """Set up log handler and targets."""
+        self.log_handler = LogCapture()
+        database = {"host": "myhost", "user": "myuser", "database": "db"}
+        self.targets = [Target("a", database, {}, 2, None), Target("b", database, {}, 2, 0.05),
+                        Target("c", database, {}, 2, None)]
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_parse_targets(self):
+        """Test parsing of targets from configuration."""
+        database = {"host": "myhost", "user": "myuser", "database": "db"}
+        self.assertEqual(parse_targets({"database": database, "session": {"work_mem": "1GB"}}),
+                         [Target("default", database, {"work_mem": "1GB"}, 2, None)])
+        self.assertEqual(
+            parse_targets({"session": {"work_mem": "1GB"}, "targets": [
+                {"name": "prod", "database": database, "concurrency": 4, "timeout": 60,
+                 "session": {"lock_timeout": 100}}]}),
+            [Target("prod", database, {"work_mem": "1GB", "lock_timeout": 100}, 4, 60)])
+        for config in ({"targets": []}, {"targets": [{"name": "x", "database": {"host": "h"}}]},
+                       {"targets": [{"name": "x", "database": database, "concurrency": 0}]},
+                       {"targets": [{"name": "x", "database": database}, {"name": "x", "database": database}]}):
+            with self.assertRaises(ConfigError):
+                parse_targets(config)
+
+    def test_run_targets(self):
+        """Test failure and timeout of a target do not affect others."""
+        async def operation(connect, target):
+            if target.name == "a":
+                raise DatabaseError("broken")
+            if target.name == "b":
+                await asyncio.sleep(1)
+            if target.name == "d":
+                raise KeyError("column")
+            return [("done", )]
+
+        results = run_targets(self.targets + [self.targets[0]._replace(name="d")], operation)
+
+        self.assertEqual([(result.target, result.status, result.rows, result.error) for result in results], [
+            ("a", "FAILED", [], "broken"),
+            ("b", "TIMEOUT", [], "Timed out after 0.05 s"),
+            ("c", "OK", [("done", )], None),
+            ("d", "FAILED", [], "KeyError: 'column'"),
+        ])
+
+    @patch('logger_maintenance.targets.psycopg2.connect')
+    def test_concurrency(self, mock_connect):
+        """Test number of open connections is limited by target concurrency."""
+        mock_connect.return_value.poll.return_value = POLL_OK
+        mock_connect.return_value.isexecuting.return_value = False
+        mock_connect.return_value.cursor().__enter__().fetchall.return_value = [(1, )]
+        open_connections = []
+        maximum = []
+
+        async def query(connect):
+            async with connect() as conn:
+                open_connections.append(conn)
+                maximum.append(len(open_connections))
+                await asyncio.sleep(0.01)
+                rows = await conn.execute("SELECT 1")
+                open_connections.remove(conn)
+            return rows
+
+        async def operation(connect, target):
+            return await asyncio.gather(*[query(connect) for _ in range(5)])
+
+        results = run_targets(self.targets[2:], operation)
+
+        self.assertEqual(results[0].status, "OK")
+        self.assertEqual(max(maximum), 2)
+        self.assertEqual(mock_connect.call_count, 5)
+        mock_connect.assert_called_with(async_=True, host="myhost", user="myuser", database="db")
+
+
+class SchedulerTestCase(TestCase):
+    """Test class for scheduler of the daemon."""
+
+    def setUp(self):
+        """Set up log handler and schedule."""
+        self.log_handler = LogCapture()
+        self.schedule = parse_schedule({
+            "quiet_hours": ["23:00-02:00"], "retries": 1, "backoff": 60,
+            "jobs": [{"name": "drop", "action": "drop", "calendar": {"hour": 22, "minute": 30}}]})
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_parse_schedule(self):
+        """Test parsing of the schedule and its errors."""
+        job = self.schedule.jobs[0]
+        self.assertEqual((job.name, job.action, job.services), ("drop", "drop", None))
+        self.assertEqual(job.calendar.fields, {'minute': {30}, 'hour': {22}})
+        self.assertEqual(self.schedule.quiet_hours, [(1380, 120)])
+        for config in ({"jobs": []}, {"jobs": [{"name": "x", "action": "vacuum"}]},
+                       {"jobs": [{"name": "x", "action": "drop", "calendar": {"hour": 24}}]},
+                       {"jobs": [{"name": "x", "action": "drop"}], "quiet_hours": ["1-2"]},
+                       {"jobs": [{"name": "x", "action": "create", "services": ["mojeid"]}]}):
+            with self.assertRaises(ConfigError):
+                parse_schedule(config)
+
+    def test_quiet_hours(self):
+        """Test quiet hours windows, including windows over midnight."""
+        self.assertTrue(in_quiet_hours([], datetime(2054, 1, 1, 12, 0)))
+        self.assertTrue(in_quiet_hours([(1380, 120)], datetime(2054, 1, 1, 23, 30)))
+        self.assertTrue(in_quiet_hours([(1380, 120)], datetime(2054, 1, 1, 1, 59)))
+        self.assertFalse(in_quiet_hours([(1380, 120)], datetime(2054, 1, 1, 2, 0)))
+        self.assertFalse(in_quiet_hours([(60, 120)], datetime(2054, 1, 1, 0, 30)))
+
+    def test_last_match(self):
+        """Test looking up the last calendar match."""
+        calendar = Calendar(minute={0}, hour={3}, weekday={6})
+        self.assertEqual(calendar.last_match(datetime(2054, 1, 1), datetime(2054, 1, 20, 12, 0)),
+                         datetime(2054, 1, 18, 3, 0))
+        self.assertIsNone(calendar.last_match(datetime(2054, 1, 18, 3, 0), datetime(2054, 1, 20, 12, 0)))
+
+    @patch('logger_maintenance.scheduler.backoff_delay', return_value=60)
+    def test_check(self, mock_backoff):
+        """Test job runs only in quiet hours, failed job is retried later and state is persisted."""
+        run_job = mock.Mock(side_effect=[FatalScriptError(DatabaseError("broken")), None])
+        connection = mock.Mock(connected=True)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_path = os.path.join(tmp_dir, "state.json")
+            scheduler = Scheduler(self.schedule, run_job, connection, state_path)
+
+            scheduler.check(datetime(2054, 1, 1, 22, 30))
+            run_job.assert_not_called()
+            self.assertEqual(scheduler.states["drop"].pending_since, datetime(2054, 1, 1, 22, 30))
+
+            scheduler.check(datetime(2054, 1, 1, 23, 0))
+            self.assertEqual(scheduler.states["drop"].next_attempt, datetime(2054, 1, 1, 23, 1))
+            self.assertEqual(scheduler.states["drop"].last_error, "broken")
+
+            # Restarted daemon continues from the saved state
+            scheduler = Scheduler(self.schedule, run_job, connection, state_path)
+            scheduler.check(datetime(2054, 1, 1, 23, 0, 30))
+            self.assertEqual(run_job.call_count, 1)
+            scheduler.check(datetime(2054, 1, 1, 23, 1))
+            self.assertEqual(run_job.call_count, 2)
+
+            with open(state_path) as fstate:
+                state = json.load(fstate)
+        self.assertEqual(state["jobs"]["drop"]["last_success"], "2054-01-01T23:01:00")
+        self.assertIsNone(state["jobs"]["drop"]["pending_since"])
+
+    @patch('logger_maintenance.scheduler.backoff_delay', return_value=60)
+    def test_connection_lost(self, mock_backoff):
+        """Test job failing on a lost connection is retried over a new connection."""
+        run_job = mock.Mock(side_effect=InterfaceError("connection already closed"))
+        connection = mock.Mock()
+        scheduler = Scheduler(self.schedule, run_job, connection)
+        scheduler.check(datetime(2054, 1, 1, 22, 30))
+        scheduler.check(datetime(2054, 1, 1, 23, 0))
+
+        connection.invalidate.assert_called_once_with()
+        state = scheduler.states["drop"]
+        self.assertEqual((state.attempts, state.next_attempt, state.last_error),
+                         (1, datetime(2054, 1, 1, 23, 1), "connection already closed"))
+
+    def test_give_up(self):
+        """Test job is not retried when retries are exhausted."""
+        run_job = mock.Mock(side_effect=FatalScriptError(DatabaseError("broken")))
+        scheduler = Scheduler(self.schedule._replace(retries=0), run_job, mock.Mock())
+        scheduler.check(datetime(2054, 1, 1, 22, 30))
+        scheduler.check(datetime(2054, 1, 1, 23, 0))
+        scheduler.check(datetime(2054, 1, 1, 23, 30))
+        self.assertEqual(run_job.call_count, 1)
+        self.assertIsNone(scheduler.states["drop"].pending_since)
+
+    @patch('logger_maintenance.scheduler.time.monotonic')
+    def test_persistent_connection(self, mock_monotonic):
+        """Test connection is checked when idle and reopened with backoff."""
+        conn = mock.MagicMock(closed=False)
+        connect = mock.Mock(side_effect=[FatalScriptError(None), conn, conn])
+        connection = PersistentConnection(connect, health_interval=60, backoff=10, cap=10)
+
+        mock_monotonic.return_value = 1000.0
+        with patch('logger_maintenance.scheduler.backoff_delay', return_value=5.0):
+            self.assertIsNone(connection.get())
+        mock_monotonic.return_value = 1004.0
+        self.assertIsNone(connection.get())
+        mock_monotonic.return_value = 1005.0
+        self.assertIs(connection.get(), conn)
+        conn.cursor().__enter__().execute.assert_not_called()
+
+        mock_monotonic.return_value = 2000.0
+        conn.cursor().__enter__().execute.side_effect = OperationalError("gone")
+        self.assertIs(connection.get(), conn)
+        conn.close.assert_called_once_with()
+        self.assertEqual(connect.call_count, 3)
+
+
+class ConnectionPoolTestCase(TestCase):
+    """Test class for ConnectionPool."""
+
+    def test_reuse(self):
+        """Test connections are reused and limited."""
+        connect = mock.Mock(side_effect=lambda: mock.Mock(closed=False))
+        pool = ConnectionPool(connect, 2)
+        with pool.connection() as conn_1:
+            with pool.connection() as conn_2:
+                self.assertIsNot(conn_1, conn_2)
+        with pool.connection() as conn_3:
+            self.assertIn(conn_3, (conn_1, conn_2))
+        self.assertEqual(connect.call_count, 2)
+        pool.closeall()
+        conn_1.close.assert_called_once_with()
+        conn_2.close.assert_called_once_with()
+
+    def test_broken(self):
+        """Test closed connection is replaced by a new one."""
+        connect = mock.Mock(side_effect=lambda: mock.Mock(closed=False))
+        pool = ConnectionPool(connect, 1)
+        with pool.connection() as conn_1:
+            conn_1.closed = True
+        with pool.connection() as conn_2:
+            self.assertIsNot(conn_1, conn_2)
+
+    def test_run_on_pool(self):
+        """Test run_on_pool collects errors."""
+        def func(conn, item):
+            if item == 2:
+                raise FatalScriptError(ValueError)
+            if item == 3:
+                raise KeyError('table')
+
+        pool = ConnectionPool(mock.Mock(side_effect=lambda: mock.Mock(closed=False)), 2)
+        with LogCapture() as log_handler:
+            results = run_on_pool(pool, func, [1, 2, 3, 4])
+        self.assertEqual(list(results.keys()), [1, 2, 3, 4])
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], FatalScriptError)
+        self.assertIsInstance(results[3], FatalScriptError)
+        self.assertIsInstance(results[3].error, KeyError)
+        self.assertEqual(results[3].message, "KeyError: 'table'")
+        self.assertIsNone(results[4])
+        log_handler.check(('root', 'ERROR', 'Unexpected error processing 3'))
+
+
+class MetricsTestCase(TestCase):
+    """Test class for statement metrics."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_measured(self):
+        """Test statement dropping a partition is measured when its transaction ends."""
+        metrics = Metrics('drop_parts', mock.Mock())
+        metrics.sampler.lock_wait.side_effect = [1.0, 1.5]
+        fake_cursor = mock.MagicMock()
+        fake_cursor.connection.metrics = metrics
+        fake_cursor.connection.autocommit = False
+        fake_cursor.connection.pending = []
+        fake_cursor.connection.cursor().__enter__().fetchall.return_value = [(101, ), (102, )]
+        func = mock.Mock(return_value='result')
+
+        result = InstrumentedCursor._measured(fake_cursor, b"DROP TABLE request_mojeid_54_01", func, 'arg')
+
+        self.assertEqual(result, 'result')
+        func.assert_called_once_with('arg')
+        self.assertEqual(metrics.statements, [])
+        statement, locks = fake_cursor.connection.pending[0]
+        self.assertEqual(statement.sql, "DROP TABLE request_mojeid_54_01")
+        self.assertEqual(statement.lock_wait, 0.5)
+        self.assertEqual(locks, {101, 102})
+        self.assertFalse(statement.error)
+
+    def test_finish_transaction(self):
+        """Test sizes of relations locked by measured statements are compared around commit."""
+        monitor = mock.MagicMock()
+        monitor.cursor().__enter__().fetchall.side_effect = [
+            [(101, "request_mojeid_54_01", 8192), (102, "request_mojeid_54_02", 16384)],
+            [(102, "request_mojeid_54_02", 24576), (103, "request_mojeid_54_03", 0)],
+        ]
+        metrics = Metrics('drop_parts', monitor=monitor)
+        fake_conn = mock.Mock(metrics=metrics, pending=[
+            (StatementMetrics("DROP TABLE request_mojeid_54_01", 0.25, 0, [], 0, 0, False), {1, 101}),
+            (StatementMetrics("CREATE TABLE request_mojeid_54_03", 0.25, 0, [], 0, 0, False), {1, 101, 103}),
+            (StatementMetrics("CREATE INDEX ON request_mojeid_54_02", 0.25, 0, [], 0, 0, False), {1, 101, 102, 103}),
+        ])
+        end = mock.Mock(return_value='result')
+
+        self.assertEqual(_finish_transaction(fake_conn, end, True), 'result')
+
+        end.assert_called_once_with()
+        self.assertEqual(fake_conn.pending, [])
+        monitor.cursor().__enter__().execute.assert_called_with(RELATION_SIZES_SQL, ([1, 101, 102, 103], ))
+        self.assertEqual([(s.relations, s.bytes_created, s.bytes_freed) for s in metrics.statements], [
+            (["request_mojeid_54_01"], 0, 8192),
+            (["request_mojeid_54_03"], 0, 0),
+            (["request_mojeid_54_02"], 8192, 0),
+        ])
+
+    def test_finish_transaction_rollback(self):
+        """Test statements of rolled back transaction are recorded without sizes."""
+        monitor = mock.MagicMock()
+        metrics = Metrics('drop_parts', monitor=monitor)
+        fake_conn = mock.Mock(metrics=metrics, pending=[
+            (StatementMetrics("DROP TABLE request_mojeid_54_01", 0.25, 0, [], 0, 0, False), {101}),
+        ])
+
+        _finish_transaction(fake_conn, mock.Mock(), False)
+
+        monitor.cursor.assert_not_called()
+        self.assertEqual([(s.relations, s.bytes_freed) for s in metrics.statements], [([], 0)])
+
+    def test_measured_error(self):
+        """Test failed statement is recorded without sizes."""
+        metrics = Metrics('create_parts')
+        fake_cursor = mock.Mock()
+        fake_cursor.connection.metrics = metrics
+
+        with self.assertRaises(DatabaseError):
+            InstrumentedCursor._measured(fake_cursor, "SELECT 1", mock.Mock(side_effect=DatabaseError), 'arg')
+
+        self.assertTrue(metrics.statements[0].error)
+        fake_cursor.connection.cursor.assert_not_called()
+
+    def test_textfile(self):
+        """Test metrics in Prometheus textfile format."""
+        metrics = Metrics('drop_parts')
+        metrics.record(StatementMetrics("DROP TABLE foo_54_01", 0.25, 0.125, ["foo_54_01"], 0, 8192, False))
+        metrics.finish(True)
+
+        lines = metrics.to_textfile().splitlines()
+
+        self.assertIn('# TYPE logger_maintenance_bytes_freed gauge', lines)
+        self.assertIn('logger_maintenance_bytes_freed{script="drop_parts"} 8192', lines)
+        self.assertIn('logger_maintenance_lock_wait_seconds{script="drop_parts"} 0.125', lines)
+        self.assertIn('logger_maintenance_last_run_success{script="drop_parts"} 1', lines)
+
+    @patch('psycopg2.connect')
+    def test_script(self, mock_connect):
+        """Test metrics are written at the end of the script run."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics_file = os.path.join(tmp_dir, 'metrics.prom')
+            report_file = os.path.join(tmp_dir, 'report.json')
+            script = CreatePartsScript(["-c", "whatever", "-d", "2054-01", "--metrics-file", metrics_file,
+                                        "--report-file", report_file])
+            with patch('builtins.open', mock.mock_open(
+                    read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}')):
+                script.read_config()
+            script.execute()
+
+            with open(report_file) as freport:
+                report = json.load(freport)
+            with open(metrics_file) as fmetrics:
+                self.assertIn('logger_maintenance_statements{script="create_parts"} 0\n', fmetrics.read())
+        self.assertEqual((report['script'], report['success']), ('create_parts', True))
+        self.assertIsNone(script.metrics)
+        self.assertEqual(mock_connect.call_args[1]['connection_factory'], InstrumentedConnection)
+
+    @patch('logger_maintenance.common.Watchdog')
+    @patch('psycopg2.connect')
+    def test_script_monitor_connections(self, mock_connect, mock_watchdog):
+        """Test connections of the lock wait sampler and of the watchdog are not instrumented."""
+        mock_watchdog().report.return_value = {
+            'blocked_session_seconds': 0, 'max_blocked_sessions': 0, 'max_block_wait_seconds': 0,
+            'watchdog_cancels': 0}
+        mock_watchdog.reset_mock()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            script = CreatePartsScript(["-c", "whatever", "-d", "2054-01", "--watchdog",
+                                        "--report-file", os.path.join(tmp_dir, 'report.json')])
+            with patch('builtins.open', mock.mock_open(
+                    read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}')):
+                script.read_config()
+            script.execute()
+
+        monitor = mock.call(host="myhost", user="myuser", database="db")
+        self.assertEqual(mock_connect.call_args_list[:2], [monitor, monitor])
+        self.assertEqual(mock_connect.call_args_list[2][1]['connection_factory'], InstrumentedConnection)
+        self.assertEqual(mock_watchdog.call_args[0][0], mock_connect.return_value)
+
+    @patch('psycopg2.connect')
+    def test_connect_db_settings_failed(self, mock_connect):
+        """Test connection is closed when its session settings fail."""
+        mock_connect().cursor().__enter__().execute.side_effect = DatabaseError("unrecognized parameter")
+        script = CreatePartsScript(["-c", "whatever", "-d", "2054-01"])
+        with patch('builtins.open', mock.mock_open(read_data=json.dumps({
+                "database": {"host": "myhost", "user": "myuser", "database": "db"},
+                "session": {"foo": "bar"}}))):
+            script.read_config()
+
+        with self.assertRaises(FatalScriptError):
+            script.connect_db()
+        mock_connect().close.assert_called_once_with()
+
+
+class ArchiveTestCase(TestCase):
+    """Test class for archive module."""
+
+    def setUp(self):
+        """Create temporary archive directory."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def _archive(self, rowcount=3, archive_format=ARCHIVE_FORMAT):
+        def copy_expert(sql, fileobj, size):
+            for i in range(3):
+                fileobj.write('{}\trow {}\n'.format(i, i).encode())
+            mock_cursor.rowcount = rowcount
+
+        conn = mock.MagicMock()
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.copy_expert.side_effect = copy_expert
+        mock_cursor.description = [("id", ), ("content", )]
+        return archive_table(conn, "request_mojeid_17_01", self.tmp_dir.name, chunk_size=4,
+                             archive_format=archive_format)
+
+    def test_get_drop_tables(self):
+        """Test parsing names of dropped tables."""
+        self.assertEqual(
+            get_drop_tables(["DROP TABLE request_mojeid_17_01;\ndrop table if exists session_17_01", "ANALYZE"]),
+            ["request_mojeid_17_01", "session_17_01"])
+        self.assertEqual(
+            get_drop_tables(['DROP TABLE public.request_mojeid_17_01', 'DROP TABLE "logger"."session_17_01"']),
+            ["request_mojeid_17_01", "session_17_01"])
+
+    def test_archive_table_fsync(self):
+        """Test archive, its metadata and the directory are flushed to disk before success is returned."""
+        with patch('logger_maintenance.archive.os.fsync', wraps=os.fsync) as mock_fsync:
+            self._archive()
+        self.assertEqual(mock_fsync.call_count, 3)
+
+    def test_archive_table(self):
+        """Test archive is written, verified and has metadata."""
+        meta = self._archive()
+        path = os.path.join(self.tmp_dir.name, "request_mojeid_17_01.copy.gz")
+        self.assertEqual(meta['rows'], 3)
+        self.assertEqual(read_meta(path), meta)
+        verify_archive(path, meta)
+
+    def test_archive_table_rowcount(self):
+        """Test archive is rejected when row count does not match."""
+        with self.assertRaises(ArchiveError):
+            self._archive(rowcount=4)
+        self.assertIsNone(read_meta(os.path.join(self.tmp_dir.name, "request_mojeid_17_01.copy.gz")))
+
+    def test_get_table_month(self):
+        """Test parsing month of partition."""
+        self.assertEqual(get_table_month("request_mojeid_17_01"), date(2017, 1, 1))
+        self.assertIsNone(get_table_month("request"))
+
+    def _restore(self, exists=False, data_limit=None):
+        data = []
+        self.copy_sql = []
+
+        def copy_expert(sql, fileobj, size):
+            self.copy_sql.append(sql)
+            for chunk in iter(lambda: fileobj.read(size), b''):
+                data.append(chunk)
+                if data_limit is not None and len(data) >= data_limit:
+                    break
+            mock_cursor.rowcount = b''.join(data).count(b'\n')
+
+        conn = mock.MagicMock()
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.fetchone.return_value = (exists, )
+        mock_cursor.fetchall.return_value = [("CREATE INDEX foo ON request_mojeid_17_01 (id)", "public", "foo")]
+        mock_cursor.copy_expert.side_effect = copy_expert
+        indexes = restore_table(conn, "request_mojeid_17_01", self.tmp_dir.name, chunk_size=4)
+        self.assertEqual(b''.join(data), b"0\trow 0\n1\trow 1\n2\trow 2\n")
+        conn.commit.assert_called_once_with()
+        return indexes
+
+    def test_restore_table(self):
+        """Test archive is loaded back and indexes are deferred."""
+        self._archive()
+        self.assertEqual(self._restore(), ["CREATE INDEX foo ON request_mojeid_17_01 (id)"])
+        columns = sql.SQL(', ').join([sql.Identifier("id"), sql.Identifier("content")])
+        self.assertEqual(self.copy_sql, [
+            sql.SQL("COPY {} ({}) FROM STDIN").format(sql.Identifier("request_mojeid_17_01"), columns)])
+
+    def test_restore_table_no_columns(self):
+        """Test archive without columns in its metadata is loaded into all columns."""
+        self._archive()
+        path = os.path.join(self.tmp_dir.name, "request_mojeid_17_01.copy.gz.json")
+        with open(path) as fmeta:
+            meta = json.load(fmeta)
+        del meta['columns']
+        with open(path, 'w') as fmeta:
+            json.dump(meta, fmeta)
+        self._restore()
+        self.assertEqual(self.copy_sql, [sql.SQL("COPY {} FROM STDIN").format(sql.Identifier("request_mojeid_17_01"))])
+
+    def test_restore_table_not_empty(self):
+        """Test non-empty table is not restored."""
+        self._archive()
+        with self.assertRaises(ArchiveError):
+            self._restore(exists=True)
+
+    def test_restore_table_incomplete(self):
+        """Test restore is rolled back when archive is not read completely."""
+        self._archive()
+        with self.assertRaises(ArchiveError):
+            self._restore(data_limit=1)
+
+    def test_verify_corrupted(self):
+        """Test corrupted archive is detected."""
+        meta = self._archive()
+        path = os.path.join(self.tmp_dir.name, "request_mojeid_17_01.copy.gz")
+        with open(path, 'r+b') as farchive:
+            farchive.truncate(meta['size'] - 1)
+        with self.assertRaises(ArchiveError):
+            verify_archive(path, meta)
+
+    def test_columnar(self):
+        """Test columnar archive is written, verified and loaded back."""
+        meta = self._archive(archive_format=COLUMNAR_FORMAT)
+        path = os.path.join(self.tmp_dir.name, "request_mojeid_17_01.col")
+        self.assertEqual((meta['rows'], meta['format']), (3, COLUMNAR_FORMAT))
+        self.assertEqual(read_meta(path), meta)
+        self.assertEqual(list_archives(self.tmp_dir.name), ["request_mojeid_17_01"])
+        self.assertEqual(self._restore(), ["CREATE INDEX foo ON request_mojeid_17_01 (id)"])
+        with open(path, 'r+b') as farchive:
+            farchive.truncate(meta['size'] - 1)
+        with self.assertRaises(ArchiveError):
+            verify_archive(path, meta)
+
+
+class ColumnarTestCase(TestCase):
+    """Test class for columnar module."""
+
+    ROWS = [
+        (1, "2017-01-01 10:00:00", "192.0.2.1", 1000), (2, "2017-01-01 11:00:00", "198.51.100.1", 1001),
+        (3, "2017-01-02 10:00:00.5", "192.0.2.7", 1001), (4, "2017-01-03 10:00:00", "\\N", 1000),
+        (5, "2017-01-03 12:00:00", "192.0.2.9", 1000),
+    ]
+
+    def setUp(self):
+        """Write columnar archive of requests."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "request_epp_17_01.col")
+        with open(self.path, 'wb') as farchive:
+            writer = ColumnarWriter(farchive, ["id", "time_begin", "source_ip", "request_type_id"], "time_begin",
+                                    block_rows=2)
+            writer.write("".join("{}\t{}\t{}\t{}\n".format(*row) for row in self.ROWS)[:50])
+            writer.write("".join("{}\t{}\t{}\t{}\n".format(*row) for row in self.ROWS)[50:])
+            writer.close()
+
+    def test_blocks(self):
+        """Test rows are split into blocks with their time range."""
+        with ColumnarFile(self.path) as archive:
+            self.assertEqual(archive.rows, 5)
+            self.assertEqual([(block['time_min'], block['time_max']) for block in archive.blocks], [
+                ("2017-01-01 10:00:00", "2017-01-01 11:00:00"), ("2017-01-02 10:00:00.5", "2017-01-03 10:00:00"),
+                ("2017-01-03 12:00:00", "2017-01-03 12:00:00")])
+            self.assertEqual(
+                [len(rows) for rows in archive.iter_blocks(["id"], "2017-01-02 00:00:00", "2017-01-03 11:00:00")],
+                [2])
+
+    def test_scan_archive(self):
+        """Test filtering rows of the archive."""
+        def scan(**kwargs):
+            query = Query(["id"], None, None, None, None, None)._replace(**kwargs)
+            return [int(row[0]) for row in scan_archive(self.path, query)]
+
+        self.assertEqual(scan(), [1, 2, 3, 4, 5])
+        self.assertEqual(scan(time_from=datetime(2017, 1, 1, 11), time_to=datetime(2017, 1, 3, 12)), [2, 3, 4])
+        self.assertEqual(scan(networks=["192.0.2.0/29"]), [1, 3])
+        self.assertEqual(scan(request_types=[1001], networks=["192.0.2.0/24"]), [3])
+        self.assertEqual(scan_archive(self.path, Query(["source_ip"], None, None, None, [1000], None)),
+                         [("192.0.2.1", ), (None, ), ("192.0.2.9", )])
+        with self.assertRaises(ColumnarError):
+            scan_archive(self.path, Query(["content"], None, None, None, None, None))
+
+    def test_truncated(self):
+        """Test truncated archive is refused."""
+        with open(self.path, 'r+b') as farchive:
+            farchive.truncate(os.path.getsize(self.path) - 1)
+        with self.assertRaises(ColumnarError):
+            ColumnarFile(self.path)
+
+
+class JournalTestCase(TestCase):
+    """Test class for journal module."""
+
+    def setUp(self):
+        """Create temporary directory for the journal."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "journal.json")
+        self.args = argparse.Namespace(date_from=date(2054, 1, 1), journal_file=self.path)
+
+    def test_resume(self):
+        """Test done steps are skipped and interrupted steps are executed again."""
+        journal = Journal(self.path, "drop_parts", self.args)
+        self.assertEqual(journal.run("a", lambda: 1), 1)
+        journal.start("b", tables=["foo"])
+
+        journal = Journal(self.path, "drop_parts", self.args)
+        func = mock.Mock(return_value=2)
+        self.assertIsNone(journal.run("a", func))
+        func.assert_not_called()
+        self.assertEqual(journal.state("b"), STARTED)
+        self.assertEqual(journal.data("b"), {"tables": ["foo"]})
+        self.assertEqual(journal.run("b", func), 2)
+        self.assertTrue(journal.is_done("b"))
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_other_run(self):
+        """Test journal of a run with other arguments is refused."""
+        Journal(self.path, "drop_parts", self.args).done("a")
+        with self.assertRaises(JournalError):
+            Journal(self.path, "drop_parts", argparse.Namespace(date_from=date(2054, 2, 1), journal_file=self.path))
+        with self.assertRaises(JournalError):
+            Journal(self.path, "create_parts", self.args)
+        # Path of the journal does not identify the run
+        Journal(self.path, "drop_parts", argparse.Namespace(date_from=date(2054, 1, 1), journal_file="other"))
+
+    def test_resolved(self):
+        """Test journal is bound to resolved arguments as passed and keeps their values of the interrupted run."""
+        Journal(self.path, "drop_parts", self.args, {"date_from": None}).done("a")
+
+        journal = Journal(self.path, "drop_parts", argparse.Namespace(date_from=date(2054, 2, 1),
+                                                                      journal_file=self.path), {"date_from": None})
+
+        self.assertEqual(journal.resolved, {"date_from": "2054-01-01"})
+        self.assertTrue(journal.is_done("a"))
+        with self.assertRaises(JournalError):
+            Journal(self.path, "drop_parts", self.args)
+
+
+class ManifestTestCase(TestCase):
+    """Test class for manifest module."""
+
+    def setUp(self):
+        """Create temporary archive directory."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.archive_dir = tmp_dir.name
+
+    def _connect(self):
+        conn = mock.MagicMock(closed=False)
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.description = [("id", ), ("time_begin", ), ("source_ip", )]
+        mock_cursor.copy_expert.side_effect = lambda sql, fileobj, size: fileobj.write(
+            b"7\t2017-01-15 10:00:00\t192.0.2.1\n8\t2017-01-02 10:00:00\t\\N\n")
+        mock_cursor.rowcount = 2
+        return conn
+
+    def test_bloom_filter(self):
+        """Test bloom filter contains added values and survives serialization."""
+        bloom = BloomFilter.for_capacity(1000)
+        for value in range(1000):
+            bloom.add(value)
+        bloom = BloomFilter.from_dict(json.loads(json.dumps(bloom.to_dict())))
+        self.assertTrue(all(value in bloom for value in range(1000)))
+        self.assertLess(sum(value in bloom for value in range(1000, 11000)), 300)
+
+    def test_archive_tables(self):
+        """Test archived tables are recorded in the manifest."""
+        pool = ConnectionPool(self._connect, 2)
+        results = archive_tables(pool, ["request_epp_17_01", "request_data_epp_17_01"], self.archive_dir)
+        self.assertEqual(list(results.values()), [None, None])
+        manifest = load_manifest(self.archive_dir)
+        self.assertEqual(sorted(manifest), ["request_data_epp_17_01", "request_epp_17_01"])
+        entry = manifest["request_epp_17_01"]
+        self.assertEqual((entry['service'], entry['month'], entry['rows'], entry['file']),
+                         ("epp", "2017-01-01", 2, "request_epp_17_01.copy.gz"))
+        self.assertEqual((entry['time_min'], entry['time_max']), ("2017-01-02 10:00:00", "2017-01-15 10:00:00"))
+        self.assertEqual(entry['sha256'], read_meta(os.path.join(self.archive_dir, entry['file']))['sha256'])
+        self.assertTrue(may_contain(entry, request_id=8))
+        self.assertFalse(may_contain(entry, request_id=9))
+        self.assertFalse(may_contain(entry, time_from="2017-01-16 00:00:00"))
+        self.assertFalse(may_contain(entry, time_to="2017-01-02 10:00:00"))
+        self.assertTrue(may_contain(entry, time_from="2017-01-15 00:00:00", time_to="2017-01-16 00:00:00"))
+        # Request data partitions have neither request ids nor request times
+        self.assertEqual((manifest["request_data_epp_17_01"]['time_min'], manifest["request_data_epp_17_01"]['bloom']),
+                         (None, None))
+
+    def test_update_manifest_fsync(self):
+        """Test manifest is flushed to disk before it replaces the previous one."""
+        with patch('logger_maintenance.manifest.os.fsync', wraps=os.fsync) as mock_fsync:
+            update_manifest(self.archive_dir, [{'table': "request_epp_17_01"}])
+        mock_fsync.assert_called_once_with(mock.ANY)
+        self.assertEqual(list(load_manifest(self.archive_dir)), ["request_epp_17_01"])
+
+    def test_sync_manifest(self):
+        """Test archives missing in the manifest are recorded and removed archives are forgotten."""
+        archive_table(self._connect(), "request_epp_17_01", self.archive_dir, archive_format=COLUMNAR_FORMAT)
+        self.assertEqual(load_manifest(self.archive_dir), {})
+        self.assertEqual(sync_manifest(self.archive_dir), 1)
+        self.assertEqual(load_manifest(self.archive_dir)["request_epp_17_01"]['time_min'], "2017-01-02 10:00:00")
+        self.assertEqual(sync_manifest(self.archive_dir), 0)
+
+        os.remove(os.path.join(self.archive_dir, "request_epp_17_01.col.json"))
+        self.assertEqual(sync_manifest(self.archive_dir), 0)
+        self.assertEqual(load_manifest(self.archive_dir), {})
+
+
+class RollupTestCase(TestCase):
+    """Test class for rollup module."""
+
+    def test_parse_rollup(self):
+        """Test parsing rollup section of configuration."""
+        self.assertEqual(parse_rollup({}), DEFAULT_ROLLUP)
+        self.assertEqual(
+            parse_rollup({"dimensions": ["service_id"], "aggregates": {"requests": "count(*)", "a": "max(id)"}}),
+            Rollup("request_rollup", "request", ["service_id"], [("a", "max(id)"), ("requests", "count(*)")]))
+
+    def test_parse_rollup_error(self):
+        """Test invalid rollup section of configuration."""
+        for config in ([], {"dimensions": "service_id"}, {"aggregates": {}}, {"aggregates": {"month": "count(*)"}},
+                       {"dimensions": ["requests"]}):
+            with self.assertRaises(ConfigError):
+                parse_rollup(config)
+
+    def test_get_rollup_tables(self):
+        """Test selecting partitions of the source table."""
+        self.assertEqual(
+            get_rollup_tables(DEFAULT_ROLLUP, ["request_mojeid_17_01", "request_data_mojeid_17_01", "session_17_01",
+                                               "request_epp_17_01"], "mojeid"),
+            ["request_mojeid_17_01"])
+
+    def test_rollup_table(self):
+        """Test rows of the partition are replaced in a single transaction."""
+        conn = mock.MagicMock()
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.rowcount = 7
+        rollup = Rollup("request_rollup", "request", ["service_id"], [("requests", "count(*)")])
+
+        self.assertEqual(rollup_table(conn, rollup, "request_mojeid_17_01"), 7)
+
+        (delete, delete_params), (insert, insert_params) = [c[0] for c in mock_cursor.execute.call_args_list]
+        self.assertEqual(delete, sql.SQL("DELETE FROM {} WHERE source = %s").format(
+            sql.Identifier("request_rollup")))
+        self.assertEqual(delete_params, ("request_mojeid_17_01", ))
+        self.assertEqual(insert_params, ("request_mojeid_17_01", "2017-01-01"))
+        conn.commit.assert_called_once_with()
+
+
+class VacuumTestCase(TestCase):
+    """Test class for vacuum module."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+        self.addCleanup(self.log_handler.uninstall)
+
+    def test_plan_vacuum(self):
+        """Test new partitions are analyzed first, closed ones frozen from the oldest."""
+        candidates = [
+            VacuumCandidate("request_mojeid_17_05", "mojeid", date(2017, 5, 1), 100, None),
+            VacuumCandidate("request_mojeid_17_04", "mojeid", date(2017, 4, 1), 100, "2017-04-01"),
+            VacuumCandidate("request_mojeid_17_03", "mojeid", date(2017, 3, 1), 5000, None),
+            VacuumCandidate("request_mojeid_17_02", "mojeid", date(2017, 2, 1), 9000, "2017-03-01"),
+            VacuumCandidate("request_mojeid_17_01", "mojeid", date(2017, 1, 1), 10, "2017-02-01"),
+        ]
+        self.assertEqual(plan_vacuum(candidates, date(2017, 4, 15), 1000), [
+            VacuumTask(ANALYZE, "request_mojeid_17_05", 100),
+            VacuumTask(FREEZE, "request_mojeid_17_02", 9000),
+            VacuumTask(FREEZE, "request_mojeid_17_03", 5000),
+        ])
+
+    def test_vacuum_tables(self):
+        """Test tasks run in autocommit mode with cost settings."""
+        conn = mock.MagicMock()
+        pool = ConnectionPool(lambda: conn, 1)
+        task = VacuumTask(FREEZE, "request_mojeid_17_02", 9000)
+
+        results, skipped = vacuum_tables(pool, [task], {'vacuum_cost_delay': 2})
+
+        self.assertEqual(results, OrderedDict([(task, None)]))
+        self.assertEqual(skipped, [])
+        self.assertTrue(conn.autocommit)
+        calls = [c[0] for c in conn.cursor().__enter__().execute.call_args_list]
+        self.assertEqual(calls, [
+            ("SELECT set_config(%s, %s, false)", ('vacuum_cost_delay', '2')),
+            ("SELECT set_config('statement_timeout', %s, false)", ('0', )),
+            (sql.SQL("VACUUM (FREEZE) {}").format(sql.Identifier("request_mojeid_17_02")), ),
+        ])
+
+    def test_vacuum_tables_deadline(self):
+        """Test tasks are not started after the deadline, canceled ones are skipped."""
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().execute.side_effect = [None, QueryCanceled]
+        pool = ConnectionPool(lambda: conn, 1)
+        tasks = [VacuumTask(FREEZE, "request_mojeid_17_02", 9000), VacuumTask(FREEZE, "request_mojeid_17_03", 50)]
+
+        with patch('logger_maintenance.vacuum.time.monotonic', side_effect=[0, 0, 20, 20]):
+            results, skipped = vacuum_tables(pool, tasks, {}, deadline=10)
+
+        self.assertEqual(list(results.values()), [None, None])
+        self.assertEqual(skipped, tasks)
+
+
+class AuditTestCase(TestCase):
+    """Test class for audit module."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+        self.addCleanup(self.log_handler.uninstall)
+
+    def _state(self, table, constraints=None, indexes=None, owner="logger", tablespace=None):
+        month = get_table_month(table)
+        check = ("CHECK (((time_begin >= '{}'::timestamp without time zone) AND (time_begin < '{}'::timestamp "
+                 "without time zone) AND (service_id = 3)))").format(month, add_months(month, 1))
+        if constraints is None:
+            constraints = [(table + "_check", "c", check, True), (table + "_pkey", "p", "PRIMARY KEY (id)", True)]
+        if indexes is None:
+            indexes = [(table + "_time_begin_idx",
+                        "CREATE INDEX {0}_time_begin_idx ON public.{0} USING btree (time_begin)".format(table), True)]
+        return TableState(table, "request", "epp", month, owner, tablespace, constraints, indexes)
+
+    def test_time_bounds(self):
+        """Test reading and replacing bounds of time range in CHECK constraints."""
+        definition = self._state("request_epp_17_01").constraints[0][2]
+        self.assertEqual(get_time_bounds(definition, "time_begin"), ("2017-01-01", "2017-02-01"))
+        self.assertIsNone(get_time_bounds(definition, "login_date"))
+        self.assertEqual(with_time_bounds(definition, "time_begin", date(2017, 1, 1), date(2017, 4, 1)),
+                         definition.replace("2017-02-01", "2017-04-01"))
+        self.assertEqual(get_period("request_epp_17_01_m3", "epp"), (date(2017, 1, 1), date(2017, 4, 1)))
+        self.assertEqual(get_period("request_epp_17_01_02", "epp", {None: WEEK}), (date(2017, 1, 2), date(2017, 1, 9)))
+
+    def test_audit_tables(self):
+        """Test partitions are compared with the template of their service."""
+        broken = self._state("request_epp_17_03", indexes=[], owner="postgres", tablespace="fast",
+                             constraints=[("request_epp_17_03_pkey", "p", "PRIMARY KEY (id)", False)])
+        states = [self._state("request_epp_17_01"), self._state("request_epp_17_02", tablespace="archive"), broken,
+                  self._state("request_epp_17_04", indexes=[(
+                      "request_epp_17_04_time_begin_idx",
+                      "CREATE INDEX request_epp_17_04_time_begin_idx ON public.request_epp_17_04 USING btree "
+                      "(time_begin)", False)])]
+
+        deviations = audit_tables(states, {"request": ("logger", None)}, "archive")
+
+        self.assertEqual([(deviation.table, deviation.kind) for deviation in deviations], [
+            ("request_epp_17_03", INDEX), ("request_epp_17_03", CONSTRAINT), ("request_epp_17_03", NOT_VALIDATED),
+            ("request_epp_17_03", OWNER), ("request_epp_17_03", TABLESPACE), ("request_epp_17_04", INVALID_INDEX)])
+        index = sql.SQL("CREATE {}INDEX CONCURRENTLY IF NOT EXISTS {} ON {} {}").format(
+            sql.SQL(""), sql.Identifier("request_epp_17_03_time_begin_idx"), sql.Identifier("request_epp_17_03"),
+            sql.SQL("USING btree (time_begin)"))
+        self.assertEqual(deviations[0].repair, ((index, True), ))
+        check = self._state("request_epp_17_03").constraints[0][2]
+        self.assertEqual(deviations[1].detail, "request_epp_17_03_check " + check)
+        self.assertEqual([statement for statement, _ in deviations[1].repair], [
+            sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID").format(
+                sql.Identifier("request_epp_17_03"), sql.Identifier("request_epp_17_03_check"), sql.SQL(check)),
+            sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(
+                sql.Identifier("request_epp_17_03"), sql.Identifier("request_epp_17_03_check"))])
+        self.assertEqual(deviations[4].repair, ())
+        self.assertEqual([concurrently for _, concurrently in deviations[5].repair], [True, True])
+
+    def test_audit_tables_time_range(self):
+        """Test partitions without CHECK of their time range or with a wrong one."""
+        states = [
+            self._state("request_epp_17_01", constraints=[]),
+            self._state("request_epp_17_02", constraints=[]),
+            TableState("session_17_01", "session", "", date(2017, 1, 1), "logger", None, [(
+                "session_17_01_check", "c", "CHECK (((login_date >= '2017-01-01') AND (login_date < '2017-03-01')))",
+                True)], []),
+        ]
+
+        deviations = audit_tables(states, {"request": ("logger", None), "session": ("logger", None)})
+
+        self.assertEqual([(deviation.table, deviation.kind) for deviation in deviations], [
+            ("request_epp_17_01", TIME_RANGE), ("request_epp_17_02", TIME_RANGE), ("session_17_01", TIME_RANGE)])
+        self.assertEqual(deviations[0].detail, "missing request_epp_17_01_time_check CHECK (time_begin >= "
+                                               "'2017-01-01' AND time_begin < '2017-02-01')")
+        self.assertEqual(len(deviations[0].repair), 2)
+        self.assertEqual(deviations[2].detail, "session_17_01_check covers 2017-01-01..2017-03-01 instead of "
+                                               "2017-01-01..2017-02-01")
+        self.assertEqual(deviations[2].repair, ())
+
+    def test_repair_tables(self):
+        """Test concurrent steps run outside a transaction, others in short transactions."""
+        conn = mock.MagicMock()
+        mock_cursor = conn.cursor().__enter__()
+        pool = ConnectionPool(lambda: conn, 1)
+        index = sql.SQL("CREATE INDEX CONCURRENTLY ...")
+        deviations = [
+            Deviation("request_epp_17_03", INDEX, "", ((index, True), )),
+            Deviation("request_epp_17_03", OWNER, "", (("ALTER TABLE ...", False), )),
+            Deviation("request_epp_17_03", TABLESPACE, "", ()),
+            Deviation("request_epp_17_04", INHERITANCE, "", ()),
+        ]
+        autocommit = []
+        mock_cursor.execute.side_effect = lambda query, *args: autocommit.append((query, conn.autocommit))
+
+        results = repair_tables(pool, deviations, backoff=0)
+
+        self.assertEqual(results, OrderedDict([("request_epp_17_03", None)]))
+        self.assertIn((index, True), autocommit)
+        self.assertIn(("ALTER TABLE ...", False), autocommit)
+        self.assertFalse(conn.autocommit)
+
+
+class CompactTestCase(TestCase):
+    """Test class for compact module."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+        self.addCleanup(self.log_handler.uninstall)
+
+    def test_plan_compact(self):
+        """Test only closed months of selected services not compacted before are planned."""
+        partitions = [
+            Partition("request_mojeid_17_03", "request", "mojeid", date(2017, 3, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_17_02", "request", "mojeid", date(2017, 2, 1), 1, 1, 1, None, None),
+            Partition("request_epp_17_02", "request", "epp", date(2017, 2, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None),
+            Partition("session_17_01", "session", "", date(2017, 1, 1), 1, 1, 1, None, None),
+            Partition("other_mojeid_17_01", "other", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None),
+        ]
+        self.assertEqual(
+            [part.table for part in plan_compact(partitions, date(2017, 3, 10), {"request_mojeid_17_01"})],
+            ["session_17_01", "request_epp_17_02", "request_mojeid_17_02"])
+        self.assertEqual(
+            [part.table for part in plan_compact(partitions, date(2017, 3, 10), services=["mojeid"],
+                                                 date_from=date(2017, 1, 1), date_to=date(2017, 1, 1))],
+            ["request_mojeid_17_01"])
+
+    def test_compact_table(self):
+        """Test partition is rewritten ordered by time and swapped, swap is retried under savepoint."""
+        table = "request_mojeid_17_01"
+        swap = _swap_sql(table, table + "_compact", "request", None, [
+            ("request_mojeid_17_01_compact_0", "request_mojeid_17_01_pkey"),
+            ("request_mojeid_17_01_compact_i0", "request_mojeid_17_01_time_begin_idx")])
+        attempts = []
+
+        def execute(query, params=None):
+            if query == swap:
+                attempts.append(query)
+                if len(attempts) == 1:
+                    raise LockNotAvailable
+
+        conn = mock.MagicMock(server_version=140000)
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.execute.side_effect = execute
+        mock_cursor.rowcount = 10
+        mock_cursor.fetchone.side_effect = [("logger", False, False), (None, ), (8192, ), (4096, )]
+        mock_cursor.fetchall.side_effect = [
+            [("request_mojeid_17_01_pkey", True, "PRIMARY KEY (id)")],
+            [("request_mojeid_17_01_time_begin_idx",
+              "CREATE INDEX request_mojeid_17_01_time_begin_idx ON public.request_mojeid_17_01 USING btree "
+              "(time_begin)")],
+            [(True, None, "SELECT")],
+        ]
+
+        with patch('logger_maintenance.compact.time.sleep'):
+            result = compact_table(conn, table, "request", fillfactor=90, backoff=0)
+
+        self.assertEqual((result.size_before, result.size_after, result.rows), (8192, 4096, 10))
+        self.assertEqual(len(attempts), 2)
+        queries = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        self.assertIn(sql.SQL("INSERT INTO {} SELECT * FROM {}{}").format(
+            sql.Identifier(table + "_compact"), sql.Identifier(table),
+            sql.SQL(" ORDER BY {}").format(sql.Identifier("time_begin"))), queries)
+        self.assertIn(sql.SQL("CREATE {}INDEX {} ON {} {}").format(
+            sql.SQL(""), sql.Identifier(table + "_compact_i0"), sql.Identifier(table + "_compact"),
+            sql.SQL("USING btree (time_begin)")), queries)
+        self.assertIn("ROLLBACK TO SAVEPOINT swap", queries)
+        conn.commit.assert_called_once_with()
+        conn.rollback.assert_not_called()
+
+    def test_io_budget(self):
+        """Test rewrites are delayed to keep the rate."""
+        budget = IOBudget(100)
+        with patch('logger_maintenance.compact.time.monotonic', return_value=budget._next), \
+                patch('logger_maintenance.compact.time.sleep') as mock_sleep:
+            budget.reserve(200)
+            budget.reserve(100)
+        mock_sleep.assert_called_once_with(2.0)
+
+
+class MergeTestCase(TestCase):
+    """Test class for merge module."""
+
+    def _partitions(self, service, year, months, size=1, parents=("request", "request_data", "request_property_value")):
+        return [Partition("{}_{}_{:02}_{:02}".format(parent, service, year % 100, month), parent, service,
+                          date(year, month, 1), size, 1, 1, None, None) for parent in parents for month in months]
+
+    def test_parse_merge(self):
+        """Test parsing merge section of configuration."""
+        merge = parse_merge({"default": {"max_size_mb": 1}, "services": {"mojeid": {"period": "year"}}})
+        self.assertEqual(merge[None], MergePolicy("quarter", 1024 * 1024))
+        self.assertEqual(merge["mojeid"], MergePolicy("year", 1024 * 1024))
+        self.assertEqual(parse_merge({}), {None: DEFAULT_MERGE_POLICY})
+
+    def test_parse_merge_error(self):
+        """Test invalid merge section of configuration."""
+        for config in ({"default": {"period": "month"}}, {"default": {"max_size_mb": 0}}, {"services": []},
+                       {"services": {"epp": {"max_size_mb": True}}}, []):
+            with self.assertRaises(ConfigError):
+                parse_merge(config)
+
+    def test_plan_merge(self):
+        """Test only closed complete periods of small partitions are merged."""
+        partitions = (
+            self._partitions("mojeid", 2016, range(1, 13)) + self._partitions("epp", 2017, range(1, 4))
+            + self._partitions("epp", 2017, range(4, 7)) + self._partitions("fred", 2017, (1, 3))
+            + self._partitions("big", 2017, range(1, 4), size=DEFAULT_MERGE_POLICY.max_size)
+            + [Partition("request_epp_16_10_m3", "request", "epp", date(2016, 10, 1), 1, 1, 1, None, None),
+               Partition("request_epp_16_12_31", "request", "epp", date(2016, 12, 1), 1, 1, 1, None, None)])
+        policies = parse_merge({"services": {"mojeid": {"period": "year"}}})
+
+        merges = [merge for merge in plan_merge(partitions, policies, date(2017, 6, 30)) if merge.parent == "request"]
+
+        self.assertEqual([merge.table for merge in merges], ["request_mojeid_16_01_m12", "request_epp_17_01_m3"])
+        self.assertEqual(merges[1], Merge("request_epp_17_01_m3", "request", "epp", date(2017, 1, 1), 3,
+                                          ("request_epp_17_01", "request_epp_17_02", "request_epp_17_03"), 3, 3))
+        self.assertIn("request_epp_17_04_m3",
+                      [merge.table for merge in plan_merge(partitions, policies, date(2017, 7, 1), ["epp"])])
+
+    def test_plan_merge_request_tables(self):
+        """Test partitions of requests, their data and property values of a period are merged together or not."""
+        partitions = (
+            self._partitions("epp", 2017, range(1, 4), parents=("request", "request_property_value"))
+            + self._partitions("epp", 2017, range(1, 4), size=DEFAULT_MERGE_POLICY.max_size, parents=("request_data", ))
+            + self._partitions("epp", 2017, range(4, 7)))
+
+        self.assertEqual([merge.table for merge in plan_merge(partitions, parse_merge({}), date(2017, 7, 1))],
+                         ["request_data_epp_17_04_m3", "request_epp_17_04_m3", "request_property_value_epp_17_04_m3"])
+
+    def test_get_merged_drops(self):
+        """Test merged partitions of the service are dropped once their whole period is dropped."""
+        rows = [("request_epp_17_01_m3", ), ("request_property_value_epp_17_01_m3", ), ("request_epp_17_04_m3", ),
+                ("request_epp_17_07_m12", ), ("request_data_epp_x_17_01_m3", ), ("request_epp_17_02", )]
+        self.assertEqual(get_merged_drops(rows, "epp", date(2017, 1, 1), date(2017, 3, 1)),
+                         ["DROP TABLE request_property_value_epp_17_01_m3", "DROP TABLE request_epp_17_01_m3"])
+        self.assertEqual(get_merged_drops(rows, "epp", date(2017, 2, 1), date(2017, 6, 1)),
+                         ["DROP TABLE request_epp_17_04_m3"])
+        self.assertEqual(get_merged_drops(rows, "epp", date(2017, 1, 1), date(2017, 5, 1)),
+                         ["DROP TABLE request_property_value_epp_17_01_m3", "DROP TABLE request_epp_17_01_m3"])
+        # The first day of a month stands for the whole month of daily partitions
+        self.assertEqual(get_merged_drops(rows, "epp", date(2017, 4, 1), date(2017, 6, 1), DAY),
+                         ["DROP TABLE request_epp_17_04_m3"])
+        self.assertEqual(get_merged_drops(rows, "epp", date(2017, 4, 1), date(2017, 6, 29), DAY), [])
+        self.assertEqual(get_merged_drops(rows, "epp_x", date(2017, 1, 1), date(2017, 3, 1)),
+                         ["DROP TABLE request_data_epp_x_17_01_m3"])
+
+    def test_merge_checks(self):
+        """Test time range of CHECK constraints is extended to the whole period."""
+        self.assertEqual(
+            merge_checks("CHECK (((time_begin >= '2017-01-01'::date) AND (time_begin < '2017-02-01'::date) "
+                         "AND (service_id = 'x')))",
+                         "CHECK (((time_begin >= '2017-03-01'::date) AND (time_begin < '2017-04-01'::date) "
+                         "AND (service_id = 'x')))"),
+            "CHECK (((time_begin >= '2017-01-01'::date) AND (time_begin < '2017-04-01'::date) "
+            "AND (service_id = 'x')))")
+        with self.assertRaises(MergeError):
+            merge_checks("CHECK ((service_id = 1))", "CHECK ((service_id = 2))")
+
+    def test_merge_table(self):
+        """Test partitions are copied into the merged table and replaced by it in a single transaction."""
+        merge = Merge("request_epp_17_01_m3", "request", "epp", date(2017, 1, 1), 3,
+                      ("request_epp_17_01", "request_epp_17_02", "request_epp_17_03"), 3, 3)
+        conn = mock.MagicMock(server_version=140000)
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.rowcount = 10
+        mock_cursor.fetchone.side_effect = [
+            ("logger", False, False), ("FOR VALUES FROM ('2017-01-01') TO ('2017-02-01')", ),
+            ("logger", False, False), ("FOR VALUES FROM ('2017-02-01') TO ('2017-03-01')", ),
+            ("logger", False, False), ("FOR VALUES FROM ('2017-03-01') TO ('2017-04-01')", ),
+            (None, ), (8192, ), (4096, )]
+        mock_cursor.fetchall.side_effect = [
+            [("request_epp_17_01_time_check", "CHECK ((time_begin < '2017-02-01'::date))")],
+            [("request_epp_17_03_time_check", "CHECK ((time_begin < '2017-04-01'::date))")],
+            [("request_epp_17_01_pkey", True, "PRIMARY KEY (id)")],
+            [],
+            [],
+        ]
+
+        result = merge_table(conn, merge, backoff=0)
+
+        self.assertEqual(result, CompactResult("request_epp_17_01_m3", 8192, 4096, 30, 0.0, result.hold))
+        queries = [c[0][0] for c in mock_cursor.execute.call_args_list]
+        self.assertIn(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            sql.Identifier("request_epp_17_01_m3"), sql.Identifier("request_epp_17_01_m3_time_check"),
+            sql.SQL("CHECK ((time_begin < '2017-04-01'::date))")), queries)
+        self.assertIn(_merge_swap_sql(merge, "FOR VALUES FROM ('2017-01-01') TO ('2017-04-01')"), queries)
+        conn.commit.assert_called_once_with()
+
+    def test_merge_table_triggers(self):
+        """Test partitions with triggers are not merged."""
+        merge = Merge("request_epp_17_01_m3", "request", "epp", date(2017, 1, 1), 3,
+                      ("request_epp_17_01", "request_epp_17_02", "request_epp_17_03"), 3, 3)
+        conn = mock.MagicMock(server_version=140000)
+        conn.cursor().__enter__().fetchone.return_value = ("logger", True, False)
+
+        with self.assertRaises(MergeError):
+            merge_table(conn, merge)
+        conn.rollback.assert_called_once_with()
+
+
+class TierTestCase(TestCase):
+    """Test class for tier module."""
+
+    def test_parse_tiering(self):
+        """Test parsing tiering section of configuration."""
+        self.assertEqual(
+            parse_tiering({"tablespace": "archive", "quiet_hours": ["01:00-05:00"], "default": {"keep_months": 2},
+                           "services": {"epp": {"keep_months": 12}}}),
+            Tiering("archive", {None: TierPolicy(2), "epp": TierPolicy(12)}, [(60, 300)]))
+        for config in (None, {}, {"tablespace": "archive", "default": {"keep_months": 0}},
+                       {"tablespace": "archive", "quiet_hours": "01:00-05:00"}):
+            with self.assertRaises(ConfigError):
+                parse_tiering(config)
+
+    def test_plan_tier(self):
+        """Test pending partitions older than the policy are planned, the oldest first."""
+        partitions = [
+            Partition("request_epp_17_02", "request", "epp", date(2017, 2, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_17_02", "request", "mojeid", date(2017, 2, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_16_12", "request", "mojeid", date(2016, 12, 1), 1, 1, 1, None, None),
+            Partition("session_17_01", "session", "", date(2017, 1, 1), 1, 1, 1, None, None),
+        ]
+        tiering = Tiering("archive", {None: TierPolicy(2), "epp": TierPolicy(12)}, [])
+        pending = {"request_epp_17_02", "request_mojeid_17_02", "request_mojeid_17_01", "session_17_01"}
+        self.assertEqual(
+            [part.table for part in plan_tier(partitions, tiering, pending, date(2017, 3, 10))],
+            ["request_mojeid_17_01", "session_17_01"])
+        self.assertEqual(
+            [part.table for part in plan_tier(partitions, tiering, pending, date(2017, 3, 10), ["mojeid"])],
+            ["request_mojeid_17_01"])
+
+
+class PurgeTestCase(TestCase):
+    """Test class for purge module."""
+
+    def setUp(self):
+        """Set up log handler."""
+        log_handler = LogCapture()
+        self.addCleanup(log_handler.uninstall)
+        self.criteria = Criteria(datetime(2017, 1, 31, 22, 0), datetime(2017, 2, 1, 2, 0), ["192.0.2.0/24"])
+
+    def test_plan_purge(self):
+        """Test request partitions overlapping the time window are planned."""
+        partitions = [
+            Partition(table, parent, service, get_table_month(table), 1, 1, 1, None, None)
+            for table, parent, service in (
+                ("request_mojeid_17_02", "request", "mojeid"), ("request_mojeid_17_01", "request", "mojeid"),
+                ("request_mojeid_16_12", "request", "mojeid"), ("request_epp_17_01_31", "request", "epp"),
+                ("request_data_mojeid_17_01", "request_data", "mojeid"), ("session_17_01", "session", ""))]
+        self.assertEqual(
+            [part.table for part in plan_purge(partitions, self.criteria)],
+            ["request_mojeid_17_01", "request_epp_17_01_31", "request_mojeid_17_02"])
+        self.assertEqual([part.table for part in plan_purge(partitions, self.criteria, ["epp"])],
+                         ["request_epp_17_01_31"])
+
+    def test_plan_purge_merged(self):
+        """Test merged request partitions are planned for windows inside any of their months."""
+        partitions = [Partition("request_epp_17_01_m3", "request", "epp", date(2017, 1, 1), 1, 1, 1, None, None)]
+        criteria = Criteria(datetime(2017, 3, 5), datetime(2017, 3, 6), [])
+        self.assertEqual([part.table for part in plan_purge(partitions, criteria)], ["request_epp_17_01_m3"])
+
+    def test_get_partition_tables(self):
+        """Test data and property values of requests are found by time range if they were merged differently."""
+        partitions = [
+            Partition(table, parent, "epp", get_table_month(table), 1, 1, 1, None, None)
+            for table, parent in (
+                ("request_epp_17_01_m3", "request"), ("request_epp_17_04", "request"),
+                ("request_data_epp_17_01", "request_data"), ("request_data_epp_17_02", "request_data"),
+                ("request_data_epp_17_03", "request_data"), ("request_data_epp_17_04", "request_data"),
+                ("request_property_value_epp_17_01_m3", "request_property_value"),
+                ("request_property_value_epp_17_04", "request_property_value"))]
+        self.assertEqual(get_partition_tables("request_epp_17_01_m3", partitions), [
+            "request_property_value_epp_17_01_m3", "request_data_epp_17_01", "request_data_epp_17_02",
+            "request_data_epp_17_03", "request_epp_17_01_m3"])
+        self.assertEqual(get_partition_tables("request_epp_17_04", partitions), [
+            "request_property_value_epp_17_04", "request_data_epp_17_04", "request_epp_17_04"])
+
+        statement = purge_batch_sql(get_partition_tables("request_epp_17_01_m3", partitions), self.criteria)
+        self.assertEqual(repr(statement).count("DELETE FROM "), 5)
+
+    @patch('logger_maintenance.purge.time.sleep')
+    def test_purge_table(self, mock_sleep):
+        """Test batches are committed, checkpointed and wait for replicas."""
+        conn = mock.MagicMock()
+        cursor = conn.cursor().__enter__()
+        # id range, lag, batch, lag, lag, batch
+        cursor.fetchone.side_effect = [(1, 150), (0, ), (3, 7), (20, ), (0, ), (1, 2)]
+        checkpoint = Checkpoint(None, self.criteria)
+        throttle = mock.Mock()
+
+        self.assertEqual(purge_table(conn, "request_mojeid_17_01", self.criteria, checkpoint, throttle, 100, 10),
+                         (4, 9))
+
+        self.assertEqual(checkpoint.next_id("request_mojeid_17_01"), 201)
+        self.assertEqual(throttle.wait.call_args_list, [mock.call(10), mock.call(3)])
+        mock_sleep.assert_called_once_with(1.0)
+        params = cursor.execute.call_args_list[-1][0][1]
+        self.assertEqual((params['low'], params['high'], params['networks']), (101, 201, ["192.0.2.0/24"]))
+        self.assertEqual(conn.commit.call_count, 6)
+        # Id range is bounded by the criteria
+        bounds, bounds_params = cursor.execute.call_args_list[0][0]
+        self.assertIn("time_begin >= %(from)s AND time_begin < %(to)s AND source_ip <<= ANY(%(networks)s::inet[])",
+                      repr(bounds))
+        self.assertEqual((bounds_params['from'], bounds_params['networks']),
+                         (self.criteria.time_from.strftime("%Y-%m-%dT%H:%M:%S"), ["192.0.2.0/24"]))
+
+    def test_check_replicas(self):
+        """Test purge with lag limit is refused when standbys are hidden."""
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().fetchone.side_effect = [(2, 0), (0, 0), (2, 1)]
+        check_replicas(conn)
+        with LogCapture() as log_handler:
+            check_replicas(conn)
+        log_handler.check(('root', 'WARNING', 'No standbys found, replication lag is not limited'))
+        with self.assertRaises(PurgeError):
+            check_replicas(conn)
+
+    def test_checkpoint(self):
+        """Test checkpoint is resumed only by a purge with the same criteria."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "purge.json")
+            with patch('logger_maintenance.purge.os.fsync', wraps=os.fsync) as mock_fsync:
+                Checkpoint(path, self.criteria).update("request_mojeid_17_01", next_id=101)
+            mock_fsync.assert_called_once_with(mock.ANY)
+            checkpoint = Checkpoint(path, self.criteria)
+            self.assertEqual(checkpoint.next_id("request_mojeid_17_01"), 101)
+            self.assertFalse(checkpoint.is_vacuumed("request_mojeid_17_01"))
+            with self.assertRaises(PurgeError):
+                Checkpoint(path, self.criteria._replace(networks=[]))
+
+
+class DetachTestCase(TestCase):
+    """Test class for detach module."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def _detach(self, server_version, parents):
+        conn = mock.MagicMock(server_version=server_version)
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.fetchall.return_value = parents
+        detach_table(conn, "request_mojeid_17_01", 100, 0, 0.1)
+        return [c[0][0] for c in mock_cursor.execute.call_args_list[1:] if not isinstance(c[0][0], str)]
+
+    def test_detach_inherited(self):
+        """Test inherited table is detached and marked in one transaction."""
+        statements = self._detach(90600, [("request_mojeid", False, False)])
+        self.assertEqual(len(statements), 1)
+        table = sql.Identifier("request_mojeid_17_01")
+        self.assertEqual(
+            repr(statements[0]),
+            repr(sql.SQL("ALTER TABLE {} NO INHERIT {}; ").format(table, sql.Identifier("request_mojeid"))
+                 + sql.SQL("COMMENT ON TABLE {} IS {}").format(table, sql.Literal("logger-maintenance: detached"))))
+
+    def test_detach_concurrently(self):
+        """Test declarative partition is marked first and detached concurrently."""
+        statements = self._detach(140000, [("request_mojeid", True, False)])
+        self.assertEqual(len(statements), 2)
+        table = sql.Identifier("request_mojeid_17_01")
+        self.assertEqual(
+            repr(statements[0]),
+            repr(sql.SQL("COMMENT ON TABLE {} IS {}").format(table, sql.Literal("logger-maintenance: detached"))))
+        self.assertEqual(
+            repr(statements[1]),
+            repr(sql.SQL("ALTER TABLE {} DETACH PARTITION {} CONCURRENTLY").format(
+                sql.Identifier("request_mojeid"), table)))
+
+    @patch('logger_maintenance.common.time.sleep')
+    def test_detach_concurrently_retried(self, mock_sleep):
+        """Test concurrent detach is retried after lock timeout and finalized when left pending."""
+        def execute(statement, *args):
+            if isinstance(statement, sql.Composed) and "CONCURRENTLY" in repr(statement):
+                raise LockNotAvailable("lock timeout")
+
+        conn = mock.MagicMock(server_version=140000)
+        mock_cursor = conn.cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("request_mojeid", True, False)]
+        mock_cursor.fetchone.return_value = (True, )
+        mock_cursor.execute.side_effect = execute
+        detach_table(conn, "request_mojeid_17_01", 100, 2, 0.1)
+
+        statements = [repr(c[0][0]) for c in mock_cursor.execute.call_args_list if isinstance(c[0][0], sql.Composed)]
+        self.assertEqual(len([statement for statement in statements if "CONCURRENTLY" in statement]), 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertIn("FINALIZE", statements[-1])
+        mock_cursor.execute.assert_any_call("RESET lock_timeout")
+        self.assertFalse(conn.autocommit)
+
+    def test_drop_not_detached(self):
+        """Test table which is not detached is not dropped."""
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().fetchone.return_value = (False, )
+        self.assertFalse(drop_detached_table(conn, "request_mojeid_17_01"))
+        conn.commit.assert_not_called()
+
+    def test_dropper(self):
+        """Test background dropper."""
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().fetchone.side_effect = [(True, ), (False, ), DatabaseError]
+        dropper = DetachedTablesDropper(lambda: conn, 0)
+        dropper.start()
+        for table in ("table_1", "table_2", "table_3"):
+            dropper.add(table)
+        dropper.finish()
+        self.assertEqual(dropper.dropped, ["table_1"])
+        self.assertEqual(dropper.failed, ["table_3"])
+        conn.close.assert_called_once_with()
+
+    def test_dropper_connection_lost(self):
+        """Test dropper reconnects after its connection is lost."""
+        broken = mock.MagicMock()
+        broken.cursor().__enter__().execute.side_effect = OperationalError("server closed the connection")
+        broken.rollback.side_effect = InterfaceError("connection already closed")
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().fetchone.return_value = (True, )
+        connections = [broken, conn]
+        dropper = DetachedTablesDropper(lambda: connections.pop(0), 0)
+        dropper.start()
+        for table in ("table_1", "table_2"):
+            dropper.add(table)
+        dropper.finish()
+        self.assertEqual(dropper.failed, ["table_1"])
+        self.assertEqual(dropper.dropped, ["table_2"])
+        broken.close.assert_called_once_with()
+
+
+class CatalogTestCase(TestCase):
+    """Test class for catalog module."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def _connect(self):
+        conn = mock.MagicMock()
+        conn.__enter__().cursor().__enter__().fetchall.return_value = [
+            ("request_mojeid_17_01", "request", 8192, 16384, 10, None, None),
+            ("request_mojeid_17_03", "request", 8192, 16384, -1, None, None),
+            ("session_17_02", "session", 0, 8192, 0, None, None),
+        ]
+        return conn
+
+    def test_get_partitions(self):
+        """Test reading partitions and finding missing ones."""
+        partitions = get_partitions_cached(self._connect)
+        self.assertEqual(
+            partitions[0],
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 8192, 16384, 10, None, None))
+        self.assertEqual(partitions[1].rows, 0)
+        self.assertEqual(partitions[2].service, "")
+        self.assertEqual(find_missing(partitions), [("request", "mojeid", date(2017, 2, 1))])
+
+    def test_find_missing_submonthly(self):
+        """Test finding missing daily and weekly partitions."""
+        partitions = [
+            Partition(table, "request", service, get_table_month(table), 0, 0, 0, None, None)
+            for service, table in (("epp", "request_epp_17_01"), ("epp", "request_epp_17_02_27"),
+                                   ("epp", "request_epp_17_03_01"), ("mojeid", "request_mojeid_17_01_02"),
+                                   ("mojeid", "request_mojeid_17_01_16"))]
+        self.assertEqual(find_missing(partitions, {None: DAY, "mojeid": WEEK}), [
+            ("request", "epp", date(2017, 2, 28)), ("request", "mojeid", date(2017, 1, 9))])
+
+    def test_find_missing_merged(self):
+        """Test months covered by merged partitions are not missing."""
+        partitions = [
+            Partition(table, "request", "epp", get_table_month(table), 0, 0, 0, None, None)
+            for table in ("request_epp_16_01_m12", "request_epp_17_01_m3", "request_epp_17_05")]
+        self.assertEqual(get_table_span("request_epp_16_01_m12"), 12)
+        self.assertEqual(get_table_span("request_epp_17_01_02"), 1)
+        self.assertEqual(find_missing(partitions), [("request", "epp", date(2017, 4, 1))])
+
+    def test_snapshot(self):
+        """Test snapshot is used while it is fresh."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "snapshot.json")
+            connect = mock.Mock(side_effect=self._connect)
+            partitions = get_partitions_cached(connect, path, 60)
+            self.assertEqual(get_partitions_cached(connect, path, 60), partitions)
+            self.assertEqual(connect.call_count, 1)
+            get_partitions_cached(connect, path, -1)
+            self.assertEqual(connect.call_count, 2)
+
+
+class RetentionTestCase(TestCase):
+    """Test class for retention policies."""
+
+    def test_parse_retention(self):
+        """Test parsing retention section of configuration."""
+        retention = parse_retention({
+            "default": {"keep_months": 12},
+            "services": {"mojeid": {"keep_months": 3}, "epp": {"create_months": 2}},
+        })
+        self.assertEqual(retention[None], RetentionPolicy(12, 1))
+        self.assertEqual(retention["mojeid"], RetentionPolicy(3, 1))
+        self.assertEqual(retention["epp"], RetentionPolicy(12, 2))
+        self.assertEqual(parse_retention({}), {None: RetentionPolicy(6, 1)})
+
+    def test_parse_retention_error(self):
+        """Test invalid retention section of configuration."""
+        for config in ({"default": {"keep_months": 0}}, {"services": {"epp": {"create_months": "1"}}},
+                       {"services": []}):
+            with self.assertRaises(ConfigError):
+                parse_retention(config)
+
+    def test_plan_retention(self):
+        """Test computing create and drop plan."""
+        def part(parent, service, year, month):
+            return Partition(
+                "{}_{}_{:02}_{:02}".format(parent, service, year % 100, month).replace("__", "_"), parent, service,
+                date(year, month, 1), 0, 0, 0, None, None)
+
+        partitions = [
+            part("request", "mojeid", 2017, 1), part("request", "mojeid", 2017, 2), part("request", "mojeid", 2017, 6),
+            part("request", "epp", 2016, 1), part("request", "epp", 2017, 6), part("request", "epp", 2017, 7),
+            part("session", "", 2017, 6),
+            # inactive
+            part("request", "old", 2015, 1),
+        ]
+        retention = parse_retention({"services": {"mojeid": {"keep_months": 4}, "epp": {"create_months": 3}}})
+        self.assertEqual(plan_retention(partitions, retention, date(2017, 6, 15)), [
+            Action("create", None, date(2017, 7, 1), date(2017, 9, 1)),
+            Action("drop", "epp", date(2016, 1, 1), date(2016, 1, 1)),
+            Action("drop", "mojeid", date(2017, 1, 1), date(2017, 2, 1)),
+            Action("drop", "old", date(2015, 1, 1), date(2015, 1, 1)),
+        ])
+
+    def test_plan_retention_submonthly(self):
+        """Test computing plan of daily and weekly partitions."""
+        partitions = [
+            Partition(table, "request", service, get_table_month(table), 0, 0, 0, None, None)
+            for service, table in (("epp", "request_epp_17_01_31"), ("epp", "request_epp_17_06_14"),
+                                   ("epp", "request_epp_17_06_15"), ("mojeid", "request_mojeid_17_06"),
+                                   ("mojeid", "request_mojeid_17_07"), ("fred", "request_fred_17_06"))]
+        retention = parse_retention({"default": {"keep_months": 4}})
+        granularity = parse_granularity({"services": {"epp": "day", "mojeid": "week"}})
+        self.assertEqual(plan_retention(partitions, retention, date(2017, 6, 15), granularity), [
+            Action("create", None, date(2017, 7, 1), date(2017, 7, 1)),
+            Action("create", "epp", date(2017, 6, 16), date(2017, 7, 31)),
+            Action("create", "mojeid", date(2017, 6, 12), date(2017, 7, 31)),
+            Action("drop", "epp", date(2017, 1, 31), date(2017, 1, 31)),
+        ])
+
+    def test_plan_retention_merged(self):
+        """Test merged partitions are active and expire with their last month."""
+        partitions = [
+            Partition(table, "request", "epp", get_table_month(table), 0, 0, 0, None, None)
+            for table in ("request_epp_16_10_m3", "request_epp_17_01_m12")]
+        retention = parse_retention({"default": {"keep_months": 6}})
+        self.assertEqual(plan_retention(partitions, retention, date(2017, 6, 15)), [
+            Action("drop", "epp", date(2016, 10, 1), date(2016, 12, 1)),
+        ])
+
+
+class BenchmarkTestCase(TestCase):
+    """Test class for benchmark helpers."""
+
+    def test_parse_scale(self):
+        """Test parsing of benchmark scale."""
+        self.assertEqual(parse_scale("2x12X1000"), Scale(2, 12, 1000))
+        for value in ("2x12", "2x1x1000", "axbxc"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_scale(value)
+
+    def test_lock_times(self):
+        """Test collecting lock times from log records."""
+        handler = LockTimesHandler()
+        with LogCapture():
+            logger = logging.getLogger("benchmark-test")
+            logger.addHandler(handler)
+            logger.info("%s (lock wait %.3f s, hold %.3f s)", "DROP TABLE foo", 0.5, 0.25)
+            logger.info("DROP TABLE foo")
+            logger.removeHandler(handler)
+        self.assertEqual((handler.waits, handler.holds), ([0.5], [0.25]))
+
+
+class GeneratorTestCase(TestCase):
+    """Test class for synthetic data generator."""
+
+    def setUp(self):
+        """Set up generator options."""
+        self.options = Options(payload_size=10, properties=2, request_types={3: [30, 31]}, property_names=[7],
+                               rate=None, session_size=0)
+
+    def test_split_counts(self):
+        """Test splitting counts by weights."""
+        self.assertEqual(split_counts(10, [('a', 1), ('b', 1), ('c', 1)]), [('a', 3), ('b', 4), ('c', 3)])
+        self.assertEqual(split_counts(5, [('a', 0), ('b', 2)]), [('a', 0), ('b', 5)])
+
+    def test_plan_units(self):
+        """Test splitting requests into units with disjoint ids."""
+        units = plan_units([((3, 'mojeid_', date(2017, 1, 1)), 5), ((3, 'mojeid_', date(2017, 2, 1)), 1)],
+                           100, 1000, 2, 3, 50, 2)
+        self.assertEqual(units, [
+            Unit(3, 'mojeid_', date(2017, 1, 1), 5, 0, 3, 100, 1000, 50),
+            Unit(3, 'mojeid_', date(2017, 1, 1), 5, 3, 2, 103, 1006, 50),
+            Unit(3, 'mojeid_', date(2017, 2, 1), 1, 0, 1, 105, 1010, 53),
+        ])
+
+    def test_count_sessions(self):
+        """Test sessions are counted in the units of their first requests."""
+        self.assertEqual([count_sessions(0, 3, 2), count_sessions(3, 2, 2), count_sessions(3, 4, 0)], [2, 1, 0])
+
+    def test_generate_unit(self):
+        """Test rows of the unit are loaded by COPY."""
+        data = {}
+
+        def copy_expert(query, reader):
+            data[query.seq[1].strings[0]] = b''.join(iter(lambda: reader.read(8192), b''))
+
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().copy_expert.side_effect = copy_expert
+        unit = Unit(3, 'mojeid_', date(2017, 2, 1), 4, 2, 2, 100, 1000, 50)
+
+        counts = generate_unit(conn, unit, self.options)
+
+        self.assertEqual(counts, {'request_mojeid_17_02': 2, 'request_data_mojeid_17_02': 4,
+                                  'request_property_value_mojeid_17_02': 4})
+        self.assertEqual(data['request_mojeid_17_02'], (
+            b'100\t2017-02-15 00:00:00\t2017-02-15 00:00:00.5\t10.0.0.2\t3\t30\tuser2\t\\N\tf\n'
+            b'101\t2017-02-22 00:00:00\t2017-02-22 00:00:00.5\t10.0.0.3\t3\t31\tuser3\t\\N\tf\n'))
+        self.assertEqual(data['request_property_value_mojeid_17_02'].splitlines()[-1],
+                         b'2017-02-22 00:00:00\t3\tf\t1003\t101\t7\tvalue-3-1\tt')
+        self.assertEqual(len(data['request_data_mojeid_17_02'].splitlines()), 4)
+        conn.commit.assert_called_once_with()
+
+    def test_generate_unit_sessions(self):
+        """Test sessions of the unit are loaded and rows of all tables are throttled."""
+        data = {}
+
+        def copy_expert(query, reader):
+            data[query.seq[1].strings[0]] = b''.join(iter(lambda: reader.read(8192), b''))
+
+        conn = mock.MagicMock()
+        conn.cursor().__enter__().copy_expert.side_effect = copy_expert
+        unit = Unit(3, 'mojeid_', date(2017, 2, 1), 4, 1, 3, 100, 1000, 50)
+        throttle = mock.Mock()
+
+        counts = generate_unit(conn, unit, self.options._replace(session_size=2), throttle)
+
+        self.assertEqual(counts['session_17_02'], 1)
+        self.assertEqual(data['session_17_02'], b'51\tuser2\t2017-02-15 00:00:00\t2017-02-22 00:00:00.5\n')
+        self.assertEqual([line.split(b'\t')[6:8] for line in data['request_mojeid_17_02'].splitlines()],
+                         [[b'user0', b'50'], [b'user2', b'51'], [b'user2', b'51']])
+        self.assertEqual(sum(call[0][0] for call in throttle.wait.call_args_list), sum(counts.values()))
+
+    def test_weighted(self):
+        """Test parsing of weighted service names."""
+        self.assertEqual(weighted("mojeid"), ("mojeid", 1.0))
+        self.assertEqual(weighted("epp=2.5"), ("epp", 2.5))
+        for value in ("epp=x", "epp=-1"):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                weighted(value)
+
+    @patch('logger_maintenance.generator.time')
+    def test_throttle(self, mock_time):
+        """Test throttle sleeps to keep the rate."""
+        mock_time.monotonic.side_effect = [10.0, 10.5, 13.0]
+        throttle = Throttle(100)
+        throttle.wait(100)
+        throttle.wait(100)
+        mock_time.sleep.assert_called_once_with(0.5)
+
+
 @patch('drop_parts.sys.stdout', new=StringIO())
 @patch('create_parts.sys.stdout', new=StringIO())
 class ScriptTestCase(object):
     """Common tests for all scripts."""
 
-    script_args = []
-    script_class = None
+    script_args = []
+    script_class = None
+
+    @patch('drop_parts.sys.stderr', new=StringIO())
+    @patch('create_parts.sys.stderr', new=StringIO())
+    def test_init_fail(self):
+        """Test init with wrong arguments."""
+        with self.assertRaises(SystemExit):
+            self.script_class([])
+        self.assertRegex(sys.stderr.getvalue().strip(), "^usage: ")
+        with self.assertRaises(FatalScriptError):
+            with self.assertRaises(ValueError):
+                self.script_class(self.script_args + ["-d", "0000-00-00"])
+
+    def test_init_ok(self):
+        """Test standard init."""
+        self.script_class(self.script_args)
+
+    @patch('builtins.open', mock.mock_open(read_data='foo\nbar\nbaz\n'))
+    def test_config_wrong_json(self):
+        """Test wrong format of configuration file."""
+        with self.assertRaises(FatalScriptError) as err:
+            script = self.script_class(self.script_args)
+            script.read_config()
+        self.assertEqual(type(err.exception.error), json.JSONDecodeError)
+
+    @patch('builtins.open', mock.mock_open(read_data='{"database": {"host": "host", "user": "user"}}'))
+    def test_config_missing_items(self):
+        """Test configuration file in right format, but with mandatory items missing."""
+        with self.assertRaises(FatalScriptError) as err:
+            script = self.script_class(self.script_args)
+            script.read_config()
+        self.assertEqual(type(err.exception.error), ConfigError)
+
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_config_ok(self):
+        """Test that configuration loaded properly."""
+        script = self.script_class(
+            self.script_args + ["--from-date", "2017-06", "--to-date", "2015-01"]
+        )
+        script.read_config()
+        self.assertEqual(script.args.date_from, date(2017, 6, 1))
+        self.assertEqual(script.args.date_to, date(2017, 6, 1))
+        self.assertEqual(script.config["database"]["host"], "myhost")
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_db_ok(self, mock_connect):
+        """Test OK connection to database."""
+        script = self.script_class(self.script_args)
+        script.read_config()
+        script.connect_db()
+
+    @patch('psycopg2.connect', side_effect=InterfaceError('if_error'))
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_db_error(self, mock_connect):
+        """Test error while connecting to database."""
+        script = self.script_class(self.script_args)
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.connect_db()
+        self.assertEqual(type(err.exception.error), InterfaceError)
+
+
+class DropPartsScriptTestCase(ScriptTestCase, TestCase):
+    """Test class for DropPartsScript."""
+
+    def setUp(self):
+        """Set default args and set up log handler."""
+        self.script_args = ["-c", "whatever", "-s", "mojeid"]
+        self.script_class = DropPartsScript
+
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def execute(self, result, error, mock_connect):
+        """Call script execute function with various results and/or errors."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchone.return_value = result
+        if error is not None:
+            mock_cursor.execute.side_effect = error
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01"])
+        script.read_config()
+
+        if error is not None:
+            with self.assertRaises(FatalScriptError) as err:
+                script.execute()
+            self.assertEqual(type(err.exception.error), error)
+        else:
+            script.execute()
+
+            mock_cursor.mogrify.assert_called_once_with(
+                "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s)",
+                {
+                    'from': '2054-01-01',
+                    'to': '2054-01-01',
+                    'service': 'mojeid',
+                    'dry_run': False
+                }
+            )
+
+            mock_cursor.execute.assert_called_with(mock_cursor.mogrify.return_value)
+
+    def test_execute_ok(self):
+        """Test execute() that deleted some parts."""
+        self.execute(["sql_1\nsql_2"], None)
+
+    def test_execute_empty(self):
+        """Test execute() that didn't delete any parts."""
+        self.execute([""], None)
+
+    def test_execute_error(self):
+        """Test execute() that throws DatabaseError."""
+        self.execute([""], DatabaseError)
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_merged(self, mock_connect):
+        """Test execute() drops expired merged partitions in the transaction of `drop_parts`."""
+        mock_conn = mock_connect().__enter__()
+        mock_cursor = mock_conn.cursor().__enter__()
+        mock_cursor.fetchall.side_effect = [
+            [("request_mojeid_54_01_m3", ), ("request_mojeid_54_04_m3", )], [("DROP TABLE request_mojeid_54_03", )]]
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--to-date", "2054-03"])
+        script.read_config()
+        script.execute()
+
+        self.assertEqual(mock_cursor.execute.call_args_list[-2:], [
+            mock.call(mock_cursor.mogrify.return_value), mock.call("DROP TABLE request_mojeid_54_01_m3")])
+        mock_conn.commit.assert_called_once_with()
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_per_partition(self, mock_connect):
+        """Test execute() dropping each partition in its own transaction."""
+        mock_conn = mock_connect().__enter__()
+        mock_cursor = mock_conn.cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", ), ("DROP TABLE session_54_01", )]
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--per-partition", "--lock-timeout", "200"])
+        script.read_config()
+        script.execute()
+
+        mock_cursor.mogrify.assert_called_once_with(
+            "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s)",
+            {'from': '2054-01-01', 'to': '2054-01-01', 'service': 'mojeid', 'dry_run': True}
+        )
+        mock_cursor.execute.assert_any_call("DROP TABLE request_mojeid_54_01")
+        mock_cursor.execute.assert_any_call("DROP TABLE session_54_01")
+        self.assertEqual(mock_conn.commit.call_count, 2)
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_per_partition_dry_run(self, mock_connect):
+        """Test dry run of execute() in per-partition mode prints the plan."""
+        mock_conn = mock_connect().__enter__()
+        mock_cursor = mock_conn.cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", )]
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--per-partition", "--dry-run"])
+        script.read_config()
+        with LogCapture() as log_handler:
+            script.execute()
+
+        self.assertNotIn(mock.call("DROP TABLE request_mojeid_54_01"), mock_cursor.execute.call_args_list)
+        mock_conn.commit.assert_not_called()
+        log_handler.check_present(
+            ('root', 'INFO', 'Plan: DROP TABLE request_mojeid_54_01 in its own transaction (lock timeout 1000 ms, '
+                             '5 retries)'))
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_per_partition_error(self, mock_connect):
+        """Test execute() in per-partition mode that throws DatabaseError."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", )]
+        mock_connect().__enter__().commit.side_effect = DatabaseError
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--per-partition"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+        self.assertEqual(type(err.exception.error), DatabaseError)
+
+    @patch('psycopg2.connect')
+    def test_execute_journal(self, mock_connect):
+        """Test execute() skips steps done by an interrupted run and removes the journal."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        journal_file = os.path.join(tmp_dir.name, "journal.json")
+        mock_conn = mock_connect().__enter__()
+        mock_cursor = mock_conn.cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", ), ("DROP TABLE session_54_01", )]
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--per-partition", "--journal", journal_file])
+        with patch('builtins.open', mock.mock_open(
+                read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}')):
+            script.read_config()
+        Journal(journal_file, "drop_parts", script.args).done("drop:DROP TABLE request_mojeid_54_01")
+        script.execute()
+
+        self.assertNotIn(mock.call("DROP TABLE request_mojeid_54_01"), mock_cursor.execute.call_args_list)
+        mock_cursor.execute.assert_any_call("DROP TABLE session_54_01")
+        self.assertFalse(os.path.exists(journal_file))
+
+    def test_journal_resolved_dates(self):
+        """Test run resumed without --from-date reuses dates of the interrupted run."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        journal_file = os.path.join(tmp_dir.name, "journal.json")
+        script = DropPartsScript(self.script_args + ["--journal", journal_file])
+        interrupted = argparse.Namespace(**vars(script.args))
+        interrupted.date_from = interrupted.date_to = date(2054, 1, 1)
+        Journal(journal_file, "drop_parts", interrupted, script.passed_dates).done("drop")
+
+        script.open_journal("drop_parts")
+
+        self.assertEqual((script.args.date_from, script.args.date_to), (date(2054, 1, 1), date(2054, 1, 1)))
+        self.assertTrue(script.journal.is_done("drop"))
+
+    @patch('psycopg2.connect')
+    def test_execute_journal_failed(self, mock_connect):
+        """Test journal is kept when the run fails."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        journal_file = os.path.join(tmp_dir.name, "journal.json")
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", ), ("DROP TABLE session_54_01", )]
+        mock_cursor.execute.side_effect = lambda sql, *args: None if sql != "DROP TABLE session_54_01" else 1 / 0
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--per-partition", "--journal", journal_file])
+        with patch('builtins.open', mock.mock_open(
+                read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}')):
+            script.read_config()
+        with self.assertRaises(ZeroDivisionError):
+            script.execute()
+        journal = Journal(journal_file, "drop_parts", script.args)
+        self.assertTrue(journal.is_done("drop:DROP TABLE request_mojeid_54_01"))
+        self.assertEqual(journal.state("drop:DROP TABLE session_54_01"), STARTED)
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_all_services(self, mock_connect):
+        """Test execute() for all services on a connection pool."""
+        mock_cursor = mock_connect().cursor().__enter__()
+        mock_connect().__enter__().cursor().__enter__().fetchall.return_value = [
+            ("mojeid", "MojeID"), ("epp", "EPP"), ("mojeid", "MojeID")]
+
+        script = DropPartsScript(["-c", "whatever", "-s", "all", "-d", "2054-01", "-w", "2"])
+        script.read_config()
+        script.execute()
+
+        self.assertEqual(
+            sorted(c[0][1]['service'] for c in mock_cursor.mogrify.call_args_list), ['epp', 'mojeid'])
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_services_error(self, mock_connect):
+        """Test execute() for multiple services with one service failing."""
+        def execute(sql, *args):
+            if sql == b'epp':
+                raise DatabaseError
+
+        mock_cursor = mock_connect().cursor().__enter__()
+        mock_cursor.mogrify.side_effect = lambda sql, params: params['service'].encode()
+        mock_cursor.execute.side_effect = execute
+
+        script = DropPartsScript(["-c", "whatever", "-s", "mojeid", "epp", "-d", "2054-01"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+        self.assertEqual(type(err.exception.error), DatabaseError)
+        self.assertEqual(err.exception.message, "Dropping partitions failed for services: epp")
+
+    @patch('drop_parts.archive_tables')
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_archive_error(self, mock_connect, mock_archive):
+        """Test partitions are not dropped when archiving fails."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", )]
+        mock_archive.return_value = {"request_mojeid_54_01": FatalScriptError(ArchiveError("broken"))}
+
+        script = DropPartsScript(
+            self.script_args + ["-d", "2054-01", "--archive-dir", "/tmp", "--archive-format", "columnar"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+        self.assertEqual(type(err.exception.error), ArchiveError)
+        self.assertEqual(mock_archive.call_args[0][1:], (["request_mojeid_54_01"], "/tmp"))
+        self.assertEqual(mock_archive.call_args[1], {'archive_format': COLUMNAR_FORMAT})
+        self.assertEqual(mock_cursor.mogrify.call_count, 1)
+        mock_connect().__enter__().commit.assert_not_called()
+
+    @patch('drop_parts.archive_tables')
+    @patch('drop_parts.rollup_tables')
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_rollup_error(self, mock_connect, mock_rollup, mock_archive):
+        """Test partitions are neither archived nor dropped when rollup fails."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01;\nDROP TABLE session_54_01", )]
+        mock_rollup.return_value = {"request_mojeid_54_01": FatalScriptError(DatabaseError("broken"))}
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--rollup", "--archive-dir", "/tmp"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+        self.assertEqual(type(err.exception.error), DatabaseError)
+        self.assertEqual(mock_rollup.call_args[0][1:], (DEFAULT_ROLLUP, ["request_mojeid_54_01"]))
+        mock_archive.assert_not_called()
+
+    @patch('drop_parts.get_detached_tables', return_value=["request_mojeid_53_12"])
+    @patch('drop_parts.detach_table', return_value=(0.0, 0.1))
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_detach(self, mock_connect, mock_detach, mock_detached):
+        """Test execute() detaching partitions and dropping them in background."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.return_value = [("DROP TABLE request_mojeid_54_01", )]
+        mock_connect().cursor().__enter__().fetchone.return_value = (True, )
+
+        script = DropPartsScript(self.script_args + ["-d", "2054-01", "--detach", "--drop-delay", "0"])
+        script.read_config()
+        script.execute()
+
+        self.assertEqual(mock_detach.call_args[0][1], "request_mojeid_54_01")
+        self.assertEqual(script.dropper.dropped, ["request_mojeid_53_12", "request_mojeid_54_01"])
+
+    @patch('drop_parts.sys.stdout', new=StringIO())
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_list_services(self, mock_connect):
+        """Test listing services when --service argument missing."""
+        script = self.script_class(["-c", "whatever.conf"])
+        script.read_config()
+        script.list_services()
+        self.assertRegex(sys.stdout.getvalue().strip(), "^You have to pass ")
+
+
+class RestorePartsScriptTestCase(ScriptTestCase, TestCase):
+    """Test class for RestorePartsScript."""
+
+    def setUp(self):
+        """Set default args and set up log handler."""
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        for table in ("request_mojeid_54_01", "request_epp_54_01", "request_mojeid_54_02", "service"):
+            with open(os.path.join(self.tmp_dir.name, table + ".copy.gz.json"), "w") as fmeta:
+                fmeta.write("{}")
+        self.script_args = ["-c", "whatever", "-a", self.tmp_dir.name, "-d", "2054-01"]
+        self.script_class = RestorePartsScript
+
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_get_tables(self):
+        """Test selection of archived tables."""
+        script = RestorePartsScript(self.script_args)
+        self.assertEqual(script.get_tables(), ["request_epp_54_01", "request_mojeid_54_01"])
+        script = RestorePartsScript(self.script_args + ["-s", "mojeid", "--to-date", "2054-02"])
+        self.assertEqual(script.get_tables(), ["request_mojeid_54_01", "request_mojeid_54_02"])
+
+    @patch('restore_parts.restore_table')
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute(self, mock_connect, mock_restore):
+        """Test parts are created, loaded and indexed."""
+        mock_restore.side_effect = lambda conn, table, directory: ["CREATE INDEX ON " + table]
+        mock_cursor = mock_connect().cursor().__enter__()
+
+        script = RestorePartsScript(self.script_args + ["-w", "2"])
+        script.read_config()
+        script.execute()
+
+        mock_connect().__enter__().cursor().__enter__().mogrify.assert_called_once_with(
+            "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp)", {'from': '2054-01-01', 'to': '2054-01-01'})
+        self.assertEqual(mock_restore.call_count, 2)
+        mock_cursor.execute.assert_any_call("CREATE INDEX ON request_epp_54_01")
+        mock_cursor.execute.assert_any_call("CREATE INDEX ON request_mojeid_54_01")
+
+    @patch('restore_parts.restore_table', side_effect=ArchiveError("Table is not empty"))
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_error(self, mock_connect, mock_restore):
+        """Test failed restore."""
+        script = RestorePartsScript(self.script_args)
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+        self.assertEqual(type(err.exception.error), ArchiveError)
+
+
+class VacuumPartsScriptTestCase(TestCase):
+    """Test class for VacuumPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    @patch('vacuum_parts.vacuum_tables')
+    @patch('vacuum_parts.date')
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute(self, mock_connect, mock_date, mock_vacuum):
+        """Test partitions of selected services are processed with cost settings."""
+        mock_date.today.return_value = date(2017, 4, 15)
+        mock_connect().__enter__().cursor().__enter__().fetchall.return_value = [
+            ("request_epp_17_01", "request", 10 ** 8, "2017-02-01"),
+            ("request_mojeid_17_01", "request", 10 ** 8, "2017-02-01"),
+            ("request_mojeid_17_05", "request", 10, None),
+        ]
+        task = VacuumTask(FREEZE, "request_mojeid_17_01", 10 ** 8)
+        mock_vacuum.return_value = (OrderedDict([(task, FatalScriptError(QueryCanceled()))]), [])
+
+        script = VacuumPartsScript(["-c", "whatever", "-s", "mojeid", "--cost-limit", "500"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+
+        self.assertEqual(err.exception.message, "Vacuum failed for tables: request_mojeid_17_01")
+        tasks, settings, deadline = mock_vacuum.call_args[0][1:]
+        self.assertEqual(tasks, [VacuumTask(ANALYZE, "request_mojeid_17_05", 10), task])
+        self.assertEqual(settings, {'vacuum_cost_delay': 2, 'vacuum_cost_limit': 500})
+        self.assertIsNone(deadline)
+
+
+class AuditPartsScriptTestCase(TestCase):
+    """Test class for AuditPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+        self.addCleanup(self.log_handler.uninstall)
+
+    def _run(self, args, deviations, repaired, orphans=(("request_epp_16_12", "request"), )):
+        partitions = [
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None),
+            Partition("request_epp_17_01", "request", "epp", date(2017, 1, 1), 1, 1, 1, None, None),
+        ]
+        with patch('audit_parts.get_partitions', return_value=partitions), \
+                patch('audit_parts.get_orphans', return_value=list(orphans)), \
+                patch('audit_parts.get_parents', return_value={"request": ("logger", None)}), \
+                patch('audit_parts.get_table_states', return_value=(OrderedDict(), [])) as mock_states, \
+                patch('audit_parts.audit_tables', return_value=deviations) as mock_audit, \
+                patch('audit_parts.repair_tables', return_value=repaired) as mock_repair, \
+                patch('audit_parts.sys.stdout', new_callable=StringIO) as mock_stdout, \
+                patch('psycopg2.connect'):
+            with patch('builtins.open', mock.mock_open(
+                    read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}, '
+                              '"tiering": {"tablespace": "archive"}}')):
+                script = AuditPartsScript(args)
+                script.read_config()
+            try:
+                script.execute()
+            finally:
+                self.stdout = mock_stdout.getvalue()
+        return mock_states, mock_audit, mock_repair
+
+    def test_execute(self):
+        """Test deviations are reported and exit status is non-zero."""
+        deviations = [Deviation("request_mojeid_17_01", OWNER, "postgres instead of logger", (("ALTER", False), ))]
+        with self.assertRaises(FatalScriptError) as err:
+            mock_states, mock_audit, mock_repair = self._run(["-c", "whatever", "-s", "mojeid"], deviations, {})
+
+        self.assertEqual(err.exception.message, "Partitions deviate from the template: request_mojeid_17_01")
+        self.assertRegex(self.stdout, "request_mojeid_17_01 +owner +repairable +postgres instead of logger")
+        self.assertNotIn("request_epp_16_12", self.stdout)
+
+    def test_execute_repair(self):
+        """Test deviations are repaired, those which can't be repaired are left."""
+        deviations = [Deviation("request_mojeid_17_01", OWNER, "postgres instead of logger", (("ALTER", False), ))]
+        with self.assertRaises(FatalScriptError) as err:
+            mock_states, mock_audit, mock_repair = self._run(
+                ["-c", "whatever", "--repair", "--lock-timeout", "200"], deviations,
+                OrderedDict([("request_mojeid_17_01", None)]))
+
+        self.assertEqual(err.exception.message, "Partitions deviate from the template: request_epp_16_12")
+        self.assertIsNone(err.exception.error)
+        self.assertRegex(self.stdout, "request_mojeid_17_01 +owner +repaired")
+        self.assertRegex(self.stdout, "request_epp_16_12 +inheritance +manual +does not inherit from request")
+
+    def test_execute_clean(self):
+        """Test partitions without deviations."""
+        mock_states, mock_audit, mock_repair = self._run(["-c", "whatever", "--repair"], [], {}, orphans=())
 
-    @patch('drop_parts.sys.stderr', new=StringIO())
-    @patch('create_parts.sys.stderr', new=StringIO())
-    def test_init_fail(self):
-        """Test init with wrong arguments."""
-        with self.assertRaises(SystemExit):
-            self.script_class([])
-        self.assertRegex(sys.stderr.getvalue().strip(), "^usage: ")
-        with self.assertRaises(FatalScriptError):
-            with self.assertRaises(ValueError):
-                self.script_class(self.script_args + ["-d", "0000-00-00"])
+        self.assertEqual(len(mock_states.call_args[0][1]), 2)
+        self.assertEqual(mock_audit.call_args[0][2], "archive")
+        mock_repair.assert_not_called()
+        self.log_handler.check_present(('root', 'INFO', 'No deviations found'))
 
-    def test_init_ok(self):
-        """Test standard init."""
-        self.script_class(self.script_args)
 
-    @patch('builtins.open', mock.mock_open(read_data='foo\nbar\nbaz\n'))
-    def test_config_wrong_json(self):
-        """Test wrong format of configuration file."""
+class CompactPartsScriptTestCase(TestCase):
+    """Test class for CompactPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    @patch('compact_parts.sys.stdout', new_callable=StringIO)
+    @patch('compact_parts.compact_tables')
+    @patch('compact_parts.get_compacted_tables', return_value={"request_mojeid_17_01"})
+    @patch('compact_parts.get_partitions')
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute(self, mock_connect, mock_partitions, mock_compacted, mock_compact, mock_stdout):
+        """Test sizes are reported and failures raised."""
+        partitions = [
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_17_02", "request", "mojeid", date(2017, 2, 1), 4096, 1, 1, None, None),
+            Partition("request_epp_17_02", "request", "epp", date(2017, 2, 1), 1, 1, 1, None, None),
+        ]
+        mock_partitions.return_value = partitions
+        mock_compact.return_value = (
+            OrderedDict([(partitions[2], FatalScriptError(DatabaseError())), (partitions[1], None)]),
+            [CompactResult("request_mojeid_17_02", 4096, 2048, 10, 0.0, 0.1)], [])
+
+        script = CompactPartsScript(["-c", "whatever", "--fillfactor", "90", "--io-budget", "2"])
+        script.read_config()
         with self.assertRaises(FatalScriptError) as err:
-            script = self.script_class(self.script_args)
-            script.read_config()
-        self.assertEqual(type(err.exception.error), json.JSONDecodeError)
+            script.execute()
 
-    @patch('builtins.open', mock.mock_open(read_data='{"database": {"host": "host", "user": "user"}}'))
-    def test_config_missing_items(self):
-        """Test configuration file in right format, but with mandatory items missing."""
+        self.assertEqual(err.exception.message, "Compacting failed for tables: request_epp_17_02")
+        pool, planned, budget, _ = mock_compact.call_args[0]
+        self.assertEqual(planned, [partitions[2], partitions[1]])
+        self.assertEqual(budget.rate, 2 * 1024 * 1024)
+        self.assertEqual(mock_compact.call_args[1]['fillfactor'], 90)
+        self.assertRegex(mock_stdout.getvalue(), "request_mojeid_17_02 +4 kB +2 kB")
+
+
+class TierPartsScriptTestCase(TestCase):
+    """Test class for TierPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    @patch('compact_parts.sys.stdout', new_callable=StringIO)
+    @patch('compact_parts.compact_tables')
+    @patch('tier_parts.get_pending_tables', return_value={"request_mojeid_16_01"})
+    @patch('tier_parts.get_partitions')
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(
+        read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}, '
+                  '"tiering": {"tablespace": "archive", "quiet_hours": ["01:00-05:00"]}}'))
+    def test_execute(self, mock_connect, mock_partitions, mock_pending, mock_compact, mock_stdout):
+        """Test pending partitions are moved to the tablespace inside quiet hours."""
+        partitions = [
+            Partition("request_mojeid_16_01", "request", "mojeid", date(2016, 1, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_16_02", "request", "mojeid", date(2016, 2, 1), 1, 1, 1, None, None),
+        ]
+        mock_partitions.return_value = partitions
+        mock_compact.return_value = (OrderedDict([(partitions[0], None)]), [], [partitions[0]])
+
+        script = TierPartsScript(["-c", "whatever"])
+        script.read_config()
+        script.execute()
+
+        mock_pending.assert_called_once_with(mock.ANY, "archive")
+        self.assertEqual(mock_compact.call_args[0][1], [partitions[0]])
+        self.assertEqual(mock_compact.call_args[1]['tablespace'], "archive")
+        with patch('tier_parts.datetime') as mock_datetime:
+            mock_datetime.now.return_value = datetime(2017, 1, 1, 3, 0)
+            self.assertTrue(mock_compact.call_args[0][3]())
+            mock_datetime.now.return_value = datetime(2017, 1, 1, 12, 0)
+            self.assertFalse(mock_compact.call_args[0][3]())
+
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_config_missing_tiering(self):
+        """Test tiering section is required."""
+        script = TierPartsScript(["-c", "whatever"])
         with self.assertRaises(FatalScriptError) as err:
-            script = self.script_class(self.script_args)
             script.read_config()
         self.assertEqual(type(err.exception.error), ConfigError)
 
-    @patch('builtins.open',
-           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
-    def test_config_ok(self):
-        """Test that configuration loaded properly."""
-        script = self.script_class(
-            self.script_args + ["--from-date", "2017-06", "--to-date", "2015-01"]
-        )
+
+class MergePartsScriptTestCase(TestCase):
+    """Test class for MergePartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    @patch('compact_parts.sys.stdout', new_callable=StringIO)
+    @patch('merge_parts.merge_tables')
+    @patch('merge_parts.get_partitions')
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(
+        read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}, '
+                  '"merge": {"services": {"epp": {"period": "year"}}}}'))
+    def test_execute(self, mock_connect, mock_partitions, mock_merge, mock_stdout):
+        """Test closed periods are merged and sizes reported."""
+        partitions = [
+            Partition("session_{:02}_{:02}".format(year % 100, month), "session", "", date(year, month, 1), 1024, 1024,
+                      1, None, None)
+            for year, month in ((2016, 10), (2016, 11), (2016, 12), (2017, 1))]
+        mock_partitions.return_value = partitions
+        mock_merge.side_effect = lambda pool, merges, *args, **kwargs: (
+            OrderedDict((merge, None) for merge in merges),
+            [CompactResult("session_16_10_m3", 6144, 3072, 30, 0.0, 0.1)], [])
+
+        script = MergePartsScript(["-c", "whatever", "--lock-timeout", "500"])
         script.read_config()
-        self.assertEqual(script.args.date_from, date(2017, 6, 1))
-        self.assertEqual(script.args.date_to, date(2017, 6, 1))
-        self.assertEqual(script.config["database"]["host"], "myhost")
+        with patch('merge_parts.date') as mock_date:
+            mock_date.today.return_value = date(2017, 2, 1)
+            script.execute()
+
+        merges = mock_merge.call_args[0][1]
+        self.assertEqual([merge.tables for merge in merges],
+                         [("session_16_10", "session_16_11", "session_16_12")])
+        self.assertEqual(mock_merge.call_args[1]['lock_timeout'], 500)
+        self.assertRegex(mock_stdout.getvalue(), "session_16_10_m3 +6 kB +3 kB")
+        self.log_handler.check_present(
+            ('root', 'INFO', 'Plan: merge session_16_10, session_16_11, session_16_12 into '
+                             'session_16_10_m3'))
+
+    @patch('builtins.open', mock.mock_open(
+        read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}, '
+                  '"merge": {"default": {"period": "week"}}}'))
+    def test_config_error(self):
+        """Test invalid merge section is fatal."""
+        script = MergePartsScript(["-c", "whatever"])
+        with self.assertRaises(FatalScriptError) as err:
+            script.read_config()
+        self.assertEqual(type(err.exception.error), ConfigError)
+
 
+class PurgeRowsScriptTestCase(TestCase):
+    """Test class for PurgeRowsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        log_handler = LogCapture()
+        self.addCleanup(log_handler.uninstall)
+
+    @patch('purge_rows.vacuum_purged')
+    @patch('purge_rows.purge_table')
+    @patch('purge_rows.get_partitions')
     @patch('psycopg2.connect')
     @patch('builtins.open',
            mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
-    def test_db_ok(self, mock_connect):
-        """Test OK connection to database."""
-        script = self.script_class(self.script_args)
+    def test_execute(self, mock_connect, mock_partitions, mock_purge, mock_vacuum):
+        """Test planned partitions are purged and vacuumed."""
+        mock_connect().__enter__().cursor().__enter__().fetchone.return_value = (1, 0)
+        mock_partitions.return_value = [
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None),
+            Partition("request_mojeid_17_02", "request", "mojeid", date(2017, 2, 1), 1, 1, 1, None, None),
+        ]
+        script = PurgeRowsScript(["-c", "whatever", "--from-time", "2017-01-10", "--to-time", "2017-01-20T12:30",
+                                  "--source-ip", "192.0.2.1", "--no-vacuum"])
         script.read_config()
-        script.connect_db()
+        script.execute()
 
-    @patch('psycopg2.connect', side_effect=InterfaceError('if_error'))
+        criteria = Criteria(datetime(2017, 1, 10), datetime(2017, 1, 20, 12, 30), ["192.0.2.1/32"])
+        mock_purge.assert_called_once_with(mock.ANY, "request_mojeid_17_01", criteria, mock.ANY, mock.ANY, 10000, 10,
+                                           mock.ANY)
+        mock_vacuum.assert_not_called()
+
+    @patch('purge_rows.purge_table')
+    @patch('purge_rows.get_partitions')
+    @patch('psycopg2.connect')
     @patch('builtins.open',
            mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
-    def test_db_error(self, mock_connect):
-        """Test error while connecting to database."""
-        script = self.script_class(self.script_args)
+    def test_execute_hidden_replicas(self, mock_connect, mock_partitions, mock_purge):
+        """Test purge with lag limit is refused when lag of standbys is not visible, allowed without limit."""
+        mock_connect().__enter__().cursor().__enter__().fetchone.return_value = (1, 1)
+        mock_partitions.return_value = [
+            Partition("request_mojeid_17_01", "request", "mojeid", date(2017, 1, 1), 1, 1, 1, None, None)]
+        args = ["-c", "whatever", "--from-time", "2017-01-10", "--to-time", "2017-01-20", "--no-vacuum"]
+        script = PurgeRowsScript(args)
         script.read_config()
         with self.assertRaises(FatalScriptError) as err:
-            script.connect_db()
-        self.assertEqual(type(err.exception.error), InterfaceError)
+            script.execute()
+        self.assertIsInstance(err.exception.error, PurgeError)
+        mock_purge.assert_not_called()
 
+        script = PurgeRowsScript(args + ["--max-lag", "0"])
+        script.read_config()
+        script.execute()
+        self.assertIsNone(mock_purge.call_args[0][6])
+
+    @patch('purge_rows.sys.stderr', new=StringIO())
+    def test_init_fail(self):
+        """Test invalid criteria are refused."""
+        with self.assertRaises(SystemExit):
+            PurgeRowsScript(["-c", "whatever", "--from-time", "2017-01", "--to-time", "2017-02-01"])
+        with self.assertRaises(SystemExit):
+            PurgeRowsScript(["-c", "whatever", "--from-time", "2017-01-01", "--to-time", "2017-02-01",
+                             "--source-ip", "192.0.2"])
+        with self.assertRaises(FatalScriptError):
+            PurgeRowsScript(["-c", "whatever", "--from-time", "2017-02-01", "--to-time", "2017-01-01"])
 
-class DropPartsScriptTestCase(ScriptTestCase, TestCase):
-    """Test class for DropPartsScript."""
+
+class QueryArchivesScriptTestCase(TestCase):
+    """Test class for QueryArchivesScript."""
 
     def setUp(self):
-        """Set default args and set up log handler."""
-        self.script_args = ["-c", "whatever", "-s", "mojeid"]
-        self.script_class = DropPartsScript
+        """Archive request partitions in both formats."""
+        log_handler = LogCapture()
+        self.addCleanup(log_handler.uninstall)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.archive_dir = tmp_dir.name
 
+        for table, archive_format in (("request_epp_17_01", COLUMNAR_FORMAT), ("request_mojeid_17_01", COLUMNAR_FORMAT),
+                                      ("request_epp_17_02", COLUMNAR_FORMAT), ("request_epp_16_12", ARCHIVE_FORMAT),
+                                      ("request_data_epp_17_01", COLUMNAR_FORMAT)):
+            conn = mock.MagicMock()
+            mock_cursor = conn.cursor().__enter__()
+            mock_cursor.description = [("id", ), ("time_begin", ), ("source_ip", ), ("request_type_id", )]
+            mock_cursor.copy_expert.side_effect = lambda sql, fileobj, size: fileobj.write(
+                b"1\t2017-01-15 10:00:00\t192.0.2.1\t1000\n2\t2017-01-20 10:00:00\t192.0.2.2\t1000\n")
+            mock_cursor.rowcount = 2
+            archive_table(conn, table, self.archive_dir, archive_format=archive_format)
+
+    def test_get_archives(self):
+        """Test only columnar request archives of selected services and months are scanned."""
+        script = QueryArchivesScript(["-a", self.archive_dir, "-s", "epp", "--from-time", "2016-12-31T23:00",
+                                      "--to-time", "2017-02-01"])
+        self.assertEqual(script.get_archives(), [os.path.join(self.archive_dir, "request_epp_17_01.col")])
+
+    @patch('query_archives.sys.stdout', new_callable=StringIO)
+    def test_execute(self, mock_stdout):
+        """Test matching requests of all archives are printed."""
+        script = QueryArchivesScript(["-a", self.archive_dir, "--source-ip", "192.0.2.2", "--columns", "id",
+                                      "source_ip", "-w", "2"])
+        script.execute()
+        self.assertEqual(mock_stdout.getvalue(), "2\t192.0.2.2\n" * 3)
+
+    @patch('query_archives.sys.stdout', new_callable=StringIO)
+    def test_manifest(self, mock_stdout):
+        """Test archives are selected by the manifest."""
+        script = QueryArchivesScript(["-a", self.archive_dir, "--from-time", "2017-01-21"])
+        self.assertEqual(len(script.get_archives()), 3)
+        script = QueryArchivesScript(["-a", self.archive_dir, "--update-manifest", "--from-time", "2017-01-21"])
+        self.assertEqual(script.get_archives(), [])
+        self.assertIn("request_epp_16_12", load_manifest(self.archive_dir))
+        script = QueryArchivesScript(["-a", self.archive_dir, "--request-id", "3"])
+        self.assertEqual(script.get_archives(), [])
+        script = QueryArchivesScript(["-a", self.archive_dir, "--request-id", "1", "3", "-s", "mojeid", "--count"])
+        script.execute()
+        self.assertEqual(mock_stdout.getvalue(), "1\n")
+
+
+class ListPartsScriptTestCase(TestCase):
+    """Test class for ListPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
         self.log_handler = LogCapture()
 
     def tearDown(self):
         """Throw away log handler."""
         self.log_handler.uninstall()
 
+    @patch('list_parts.sys.stdout', new_callable=StringIO)
     @patch('psycopg2.connect')
     @patch('builtins.open',
            mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
-    def execute(self, result, error, mock_connect):
-        """Call script execute function with various results and/or errors."""
-        mock_cursor = mock_connect().__enter__().cursor().__enter__()
-        mock_cursor.fetchone.return_value = result
-        if error is not None:
-            mock_cursor.execute.side_effect = error
-
-        script = DropPartsScript(self.script_args + ["-d", "2054-01"])
+    def execute(self, args, mock_connect, mock_stdout):
+        """Call script execute function and return its output."""
+        mock_connect().__enter__().cursor().__enter__().fetchall.return_value = [
+            ("request_epp_17_01", "request", 8192, 16384, 10, None, None),
+            ("request_mojeid_17_01", "request", 8192, 16384, 10, None, None),
+            ("request_mojeid_17_03", "request", 1 << 30, 16384, 10, None, None),
+        ]
+        script = ListPartsScript(["-c", "whatever"] + args)
         script.read_config()
+        script.execute()
+        return mock_stdout.getvalue()
 
-        if error is not None:
-            with self.assertRaises(FatalScriptError) as err:
-                script.execute()
-            self.assertEqual(type(err.exception.error), error)
-        else:
+    def test_execute_table(self):
+        """Test table output."""
+        output = self.execute(["-s", "mojeid"])
+        self.assertIn("request_mojeid_17_03", output)
+        self.assertIn("1 GB", output)
+        self.assertNotIn("request_epp_17_01", output)
+        self.assertRegex(output, "Missing partitions:\n  request +mojeid +2017-02")
+
+    def test_execute_json(self):
+        """Test JSON output."""
+        output = json.loads(self.execute(["-f", "json"]))
+        self.assertEqual(len(output["partitions"]), 3)
+        self.assertEqual(output["partitions"][0]["month"], "2017-01-01")
+        self.assertEqual(output["missing"], [{"parent": "request", "service": "mojeid", "month": "2017-02-01"}])
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open',
+           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
+    def test_execute_error(self, mock_connect):
+        """Test execute() that throws DatabaseError."""
+        mock_connect().__enter__().cursor().__enter__().execute.side_effect = DatabaseError
+        script = ListPartsScript(["-c", "whatever"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
             script.execute()
+        self.assertEqual(type(err.exception.error), DatabaseError)
 
-            mock_cursor.mogrify.assert_called_once_with(
-                "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s)",
-                {
-                    'from': '2054-01-01',
-                    'to': '2054-01-01',
-                    'service': 'mojeid',
-                    'dry_run': False
-                }
-            )
 
-            mock_cursor.execute.assert_called_with(mock_cursor.mogrify.return_value)
+class MaintainPartsScriptTestCase(TestCase):
+    """Test class for MaintainPartsScript."""
 
-    def test_execute_ok(self):
-        """Test execute() that deleted some parts."""
-        self.execute(["sql_1\nsql_2"], None)
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
 
-    def test_execute_empty(self):
-        """Test execute() that didn't delete any parts."""
-        self.execute([""], None)
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
 
-    def test_execute_error(self):
-        """Test execute() that throws DatabaseError."""
-        self.execute([""], DatabaseError)
+    @patch('maintain_parts.date')
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "retention": {"services": {"mojeid": {"keep_months": 2}}}})))
+    def test_execute(self, mock_connect, mock_date):
+        """Test plan is executed."""
+        mock_date.today.return_value = date(2054, 3, 10)
+        mock_connect().__enter__().cursor().__enter__().fetchall.return_value = [
+            ("request_mojeid_54_01", "request", 0, 0, 0, None, None),
+            ("request_mojeid_54_03", "request", 0, 0, 0, None, None),
+        ]
+        mock_cursor = mock_connect().cursor().__enter__()
 
-    @patch('drop_parts.sys.stdout', new=StringIO())
+        script = MaintainPartsScript(["-c", "whatever"])
+        script.read_config()
+        script.execute()
+
+        mock_connect().__enter__().cursor().__enter__().mogrify.assert_called_with(
+            "SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp)", {'from': '2054-04-01', 'to': '2054-04-01'})
+        mock_cursor.mogrify.assert_called_once_with(
+            "SELECT drop_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(dry_run)s)",
+            {'from': '2054-01-01', 'to': '2054-01-01', 'service': 'mojeid', 'dry_run': False})
+
+    @patch('maintain_parts.date')
     @patch('psycopg2.connect')
-    @patch('builtins.open',
-           mock.mock_open(read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}'))
-    def test_list_services(self, mock_connect):
-        """Test listing services when --service argument missing."""
-        script = self.script_class(["-c", "whatever.conf"])
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "granularity": {"services": {"epp": "day"}}})))
+    def test_execute_daily(self, mock_connect, mock_date):
+        """Test daily partitions are created by their own call."""
+        mock_date.today.return_value = date(2054, 3, 30)
+        mock_connect().__enter__().cursor().__enter__().fetchall.side_effect = [[
+            ("request_mojeid_54_03", "request", 0, 0, 0, None, None),
+            ("request_epp_54_03_30", "request", 0, 0, 0, None, None),
+        ], [(function, ) for function in GRANULARITY_FUNCTIONS]]
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+
+        script = MaintainPartsScript(["-c", "whatever"])
         script.read_config()
-        script.list_services()
-        self.assertRegex(sys.stdout.getvalue().strip(), "^You have to pass ")
+        script.execute()
+
+        self.assertEqual(mock_cursor.mogrify.call_args_list, [
+            mock.call("SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp, %(skip)s::text[])",
+                      {'from': '2054-04-01', 'to': '2054-04-01', 'skip': ['epp']}),
+            mock.call("SELECT create_parts(%(from)s::timestamp, %(to)s::timestamp, %(service)s, %(granularity)s)",
+                      {'from': '2054-03-31', 'to': '2054-04-30', 'service': 'epp', 'granularity': 'day'}),
+        ])
+        self.log_handler.check_present(
+            ('root', 'INFO', 'Plan: create all services 2054-04 - 2054-04'),
+            ('root', 'INFO', 'Plan: create epp 2054-03-31 - 2054-04-30'))
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "retention": {"default": {"keep_months": -1}}})))
+    def test_config_error(self, mock_connect):
+        """Test invalid retention configuration."""
+        script = MaintainPartsScript(["-c", "whatever"])
+        with self.assertRaises(FatalScriptError) as err:
+            script.read_config()
+        self.assertEqual(type(err.exception.error), ConfigError)
+
+
+class DaemonPartsScriptTestCase(TestCase):
+    """Test class for DaemonPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    @patch('daemon_parts.date')
+    @patch('daemon_parts.get_partitions')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "retention": {"default": {"keep_months": 2}},
+        "schedule": {"jobs": [{"name": "drop", "action": "drop", "services": ["mojeid"]}]}})))
+    def test_run_job(self, mock_get_partitions, mock_date):
+        """Test job runs only its actions of the retention plan."""
+        mock_date.today.return_value = date(2054, 3, 10)
+        mock_get_partitions.return_value = [
+            Partition("request_{}_54_{:02}".format(service, month), "request", service, date(2054, month, 1), 0, 0, 0,
+                      None, None)
+            for service in ("mojeid", "epp") for month in (1, 3)]
+        conn = mock.Mock()
+
+        script = DaemonPartsScript(["-c", "whatever"])
+        script.read_config()
+        with patch.object(script, 'run_action') as mock_run_action:
+            script.run_job(conn, script.schedule.jobs[0])
+
+        mock_run_action.assert_called_once_with(conn, Action("drop", "mojeid", date(2054, 1, 1), date(2054, 1, 1)))
+
+    @patch('daemon_parts.get_partitions', side_effect=OperationalError("server closed the connection"))
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "schedule": {"jobs": [{"name": "drop", "action": "drop"}]}})))
+    def test_run_job_connection_lost(self, mock_get_partitions):
+        """Test closed connection is not rolled back."""
+        conn = mock.Mock(closed=2)
+
+        script = DaemonPartsScript(["-c", "whatever"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError):
+            script.run_job(conn, script.schedule.jobs[0])
+
+        conn.rollback.assert_not_called()
+
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"}})))
+    def test_missing_schedule(self):
+        """Test configuration without schedule is rejected."""
+        script = DaemonPartsScript(["-c", "whatever"])
+        with self.assertRaises(FatalScriptError) as err:
+            script.read_config()
+        self.assertEqual(type(err.exception.error), ConfigError)
+
+
+class MultiPartsScriptTestCase(TestCase):
+    """Test class for MultiPartsScript."""
+
+    def setUp(self):
+        """Set up log handler."""
+        self.log_handler = LogCapture()
+
+    def tearDown(self):
+        """Throw away log handler."""
+        self.log_handler.uninstall()
+
+    def test_drop_without_service(self):
+        """Test services are required for drop."""
+        with self.assertRaises(FatalScriptError):
+            MultiPartsScript(["drop", "-c", "whatever"])
+
+    @patch('multi_parts.sys.stdout', new_callable=StringIO)
+    @patch('logger_maintenance.targets.psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({"targets": [
+        {"name": "prod", "database": {"host": "db1", "user": "myuser", "database": "db"}},
+        {"name": "mojeid", "database": {"host": "db2", "user": "myuser", "database": "db"}}]})))
+    def test_create(self, mock_connect, mock_stdout):
+        """Test partitions are created on all targets, one failing target does not affect the other."""
+        def connect(host, **kwargs):
+            if host == "db2":
+                raise DatabaseError("connection refused")
+            conn = mock.MagicMock()
+            conn.poll.return_value = POLL_OK
+            conn.isexecuting.return_value = False
+            conn.cursor().__enter__().mogrify.return_value = b"SELECT create_parts('2054-01-01', '2054-01-01')"
+            return conn
+        mock_connect.side_effect = connect
+
+        script = MultiPartsScript(["create", "-c", "whatever", "-d", "2054-01"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+
+        self.assertEqual(err.exception.message, "Operation create failed for targets: mojeid")
+        lines = mock_stdout.getvalue().splitlines()
+        self.assertRegex(lines[1], r"^prod +OK +\d+\.\d{3}  partitions created$")
+        self.assertRegex(lines[2], r"^mojeid +FAILED +\d+\.\d{3}  connection refused$")
+
+    @patch('multi_parts.sys.stdout', new_callable=StringIO)
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({"targets": [
+        {"name": "prod", "database": {"host": "db1", "user": "myuser", "database": "db"}}]})))
+    def test_drop_service_failed(self, mock_stdout):
+        """Test a failing service does not cancel dropping of other services on the target."""
+        dropped = []
+
+        async def drop_service(connect, target, service):
+            if service == "epp":
+                raise DatabaseError("broken")
+            await asyncio.sleep(0.01)
+            dropped.append(service)
+            return [("DROP TABLE request_mojeid_54_01", )]
+
+        script = MultiPartsScript(["drop", "-c", "whatever", "-s", "epp", "mojeid", "-d", "2054-01"])
+        script.read_config()
+        script.drop_service = drop_service
+        with patch('logger_maintenance.targets.psycopg2.connect') as mock_connect, \
+                self.assertRaises(FatalScriptError):
+            mock_connect.return_value.poll.return_value = POLL_OK
+            mock_connect.return_value.isexecuting.return_value = False
+            script.execute()
+
+        self.assertEqual(dropped, ["mojeid"])
+        self.assertRegex(mock_stdout.getvalue().splitlines()[1], r"^prod +FAILED +\d+\.\d{3}  broken$")
 
 
 class CreatePartsScriptTestCase(ScriptTestCase, TestCase):
@@ -234,6 +2948,107 @@ class CreatePartsScriptTestCase(ScriptTestCase, TestCase):
         """Test execute() that runs OK."""
         self.execute(None)
 
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "session": {"maintenance_work_mem": "1GB", "max_parallel_maintenance_workers": 4}})))
+    def test_execute_chunked(self, mock_connect):
+        """Test execute() creating partitions month by month."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.side_effect = [
+            # 2054-01: one partition created
+            [("request_54_01", )], [("request_54_01", ), ("request_mojeid_54_01", )],
+            [("CREATE INDEX foo ON request_mojeid_54_01 (id)", "public", "foo")],
+            # 2054-02: nothing created
+            [("request_54_02", )], [("request_54_02", )],
+        ]
+        mock_pool_cursor = mock_connect().cursor().__enter__()
+
+        script = CreatePartsScript(self.script_args + ["-d", "2054-01", "--to-date", "2054-02", "--chunked"])
+        script.read_config()
+        script.execute()
+
+        self.assertEqual(
+            [c[0][1] for c in mock_cursor.mogrify.call_args_list],
+            [{'from': '2054-01-01', 'to': '2054-01-01'}, {'from': '2054-02-01', 'to': '2054-02-01'}])
+        mock_pool_cursor.execute.assert_any_call(
+            "SELECT set_config(%s, %s, false)", ("max_parallel_maintenance_workers", "4"))
+        mock_pool_cursor.execute.assert_called_with("CREATE INDEX foo ON request_mojeid_54_01 (id)")
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "granularity": {"services": {"epp": "day"}}})))
+    def test_execute_chunked_days(self, mock_connect):
+        """Test execute() clips chunks of daily partitions to the selected days."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.side_effect = [
+            [(function, ) for function in GRANULARITY_FUNCTIONS],
+            # 2026-10 and 2026-11: existing partitions, services, partitions after create_parts
+            [], [("epp", )], [],
+            [], [("epp", )], [],
+        ]
+
+        script = CreatePartsScript(self.script_args + ["-d", "2026-10-15", "--to-date", "2026-11-20", "--chunked"])
+        script.read_config()
+        script.execute()
+
+        self.assertEqual([c[0][1] for c in mock_cursor.mogrify.call_args_list], [
+            {'from': '2026-10-01', 'to': '2026-10-01', 'skip': ['epp']},
+            {'from': '2026-10-15', 'to': '2026-10-31', 'service': 'epp', 'granularity': DAY},
+            {'from': '2026-11-01', 'to': '2026-11-01', 'skip': ['epp']},
+            {'from': '2026-11-01', 'to': '2026-11-20', 'service': 'epp', 'granularity': DAY},
+        ])
+
+    @patch('psycopg2.connect')
+    def test_execute_chunked_journal(self, mock_connect):
+        """Test execute() builds indexes deferred by an interrupted run."""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        journal_file = os.path.join(tmp_dir.name, "journal.json")
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.side_effect = [
+            # 2054-02: nothing created
+            [("request_54_02", )], [("request_54_02", )],
+        ]
+        mock_pool_cursor = mock_connect().cursor().__enter__()
+
+        script = CreatePartsScript(self.script_args + ["-d", "2054-01", "--to-date", "2054-02", "--chunked",
+                                                       "--journal", journal_file])
+        with patch('builtins.open', mock.mock_open(
+                read_data='{"database": {"host": "myhost", "user": "myuser", "database": "db"}}')):
+            script.read_config()
+        journal = Journal(journal_file, "create_parts", script.args)
+        journal.done("create:2054-01-01", indexdefs=["CREATE INDEX foo ON request_mojeid_54_01 (id)",
+                                                     "CREATE UNIQUE INDEX bar ON request_mojeid_54_01 (id)"])
+        journal.done("index:CREATE INDEX foo ON request_mojeid_54_01 (id)")
+        journal.start("index:CREATE UNIQUE INDEX bar ON request_mojeid_54_01 (id)")
+        script.execute()
+
+        self.assertEqual([c[0][1] for c in mock_cursor.mogrify.call_args_list],
+                         [{'from': '2054-02-01', 'to': '2054-02-01'}])
+        self.assertEqual(mock_pool_cursor.execute.call_args_list,
+                         [mock.call("CREATE UNIQUE INDEX IF NOT EXISTS bar ON request_mojeid_54_01 (id)")])
+        self.assertFalse(os.path.exists(journal_file))
+
+    @patch('psycopg2.connect')
+    @patch('builtins.open', mock.mock_open(read_data=json.dumps({
+        "database": {"host": "myhost", "user": "myuser", "database": "db"},
+        "granularity": {"services": {"epp": "day"}}})))
+    def test_execute_missing_functions(self, mock_connect):
+        """Test execute() refuses daily partitions if the database lacks functions taking granularity."""
+        mock_cursor = mock_connect().__enter__().cursor().__enter__()
+        mock_cursor.fetchall.return_value = [
+            ("create_parts(timestamp without time zone, timestamp without time zone)", ),
+            ("drop_parts(timestamp without time zone, timestamp without time zone, text, boolean)", )]
+
+        script = CreatePartsScript(self.script_args + ["-d", "2054-01"])
+        script.read_config()
+        with self.assertRaises(FatalScriptError) as err:
+            script.execute()
+        self.assertEqual(type(err.exception.error), ConfigError)
+        mock_cursor.mogrify.assert_not_called()
+
     def test_execute_error(self):
         """Test execute() that throws DatabaseError."""
         self.execute(DatabaseError)
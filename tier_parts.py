@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for moving aged logger partitions to an archive tablespace.
+
+Moves partitions and their indexes older than the age policy from `tiering` section of the configuration file.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+from datetime import date, datetime
+
+from psycopg2 import DatabaseError
+
+from compact_parts import CompactPartsScript
+from logger_maintenance.catalog import get_partitions
+from logger_maintenance.common import ConfigError, FatalScriptError
+from logger_maintenance.scheduler import in_quiet_hours
+from logger_maintenance.tier import get_pending_tables, parse_tiering, plan_tier
+
+
+class TierPartsScript(CompactPartsScript):
+    """Script class for moving aged logger partitions to an archive tablespace."""
+
+    operation = "Moving"
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        self.add_rewrite_arguments(parser)
+        self.args = parser.parse_args(args)
+
+    def read_config(self, config_filename=None):
+        """Read configuration including the tiering policy."""
+        config = super(TierPartsScript, self).read_config(config_filename)
+        try:
+            self.tiering = parse_tiering(config.get("tiering"))
+        except ConfigError as err:
+            logging.error(err)
+            raise FatalScriptError(err)
+        return config
+
+    def get_plan(self):
+        """Return list of partitions to be moved."""
+        with self.connect_db() as conn:
+            try:
+                partitions = get_partitions(conn)
+                pending = get_pending_tables(conn, self.tiering.tablespace)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+        return plan_tier(partitions, self.tiering, pending, date.today(), self.args.service)
+
+    def rewrite_options(self):
+        """Move partitions to the archive tablespace."""
+        return {'tablespace': self.tiering.tablespace}
+
+    def may_start(self):
+        """Start moves only inside quiet hours."""
+        return in_quiet_hours(self.tiering.quiet_hours, datetime.now())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = TierPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017-2021  CZ.NIC, z. s. p. o.
+#
+# This file is part of FRED.
+#
+# FRED is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# FRED is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with FRED.  If not, see <https://www.gnu.org/licenses/>.
+
+"""Script for vacuuming and analyzing logger partitions.
+
+Analyzes new partitions which were never analyzed and freezes closed partitions, oldest first.
+
+Run with -h option to print all available options.
+"""
+import argparse
+import logging
+import sys
+import time
+from datetime import date
+
+from psycopg2 import DatabaseError
+
+from logger_maintenance.common import ConnectionPool, FatalScriptError, LoggerMaintenanceScript
+from logger_maintenance.vacuum import DEFAULT_MIN_FREEZE_AGE, get_vacuum_candidates, plan_vacuum, vacuum_tables
+
+
+class VacuumPartsScript(LoggerMaintenanceScript):
+    """Script class for vacuuming and analyzing logger partitions."""
+
+    def process_args(self, args):
+        """Set up long opts and their default values."""
+        parser = argparse.ArgumentParser()
+        parser.add_argument(
+            "-c", "--config_file", dest="config_filename", required=True,
+            help="json config file"
+        )
+        parser.add_argument(
+            "-s", "--service", nargs='+',
+            help="process only partitions of the services (i.e. `mojeid`)"
+        )
+        parser.add_argument(
+            "--dry-run", dest="dry_run", action='store_true',
+            help="Just print the plan"
+        )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=2,
+            help="maximal number of partitions processed concurrently (default 2)"
+        )
+        parser.add_argument(
+            "--min-freeze-age", dest="min_freeze_age", type=int, default=DEFAULT_MIN_FREEZE_AGE,
+            help="minimal age of relfrozenxid of a closed partition to be frozen (default {})".format(
+                DEFAULT_MIN_FREEZE_AGE)
+        )
+        parser.add_argument(
+            "--cost-delay", dest="cost_delay", type=float, default=2,
+            help="vacuum_cost_delay in milliseconds (default 2)"
+        )
+        parser.add_argument(
+            "--cost-limit", dest="cost_limit", type=int, default=200,
+            help="vacuum_cost_limit (default 200)"
+        )
+        parser.add_argument(
+            "--time-budget", dest="time_budget", type=float,
+            help="maximal duration in seconds, remaining partitions are left for the next run (default no limit)"
+        )
+        self.args = parser.parse_args(args)
+
+    def get_plan(self):
+        """Return list of tasks ordered by priority."""
+        with self.connect_db() as conn:
+            try:
+                candidates = get_vacuum_candidates(conn)
+            except DatabaseError as err:
+                logging.error("DatabaseError: " + str(err))
+                raise FatalScriptError(err)
+        if self.args.service is not None:
+            candidates = [part for part in candidates if part.service in self.args.service]
+        return plan_vacuum(candidates, date.today(), self.args.min_freeze_age)
+
+    def execute(self):
+        """Vacuum and analyze database partitions."""
+        if self.args.dry_run:
+            logging.info("=== DRY-RUN ===")
+
+        start = time.monotonic()
+        tasks = self.get_plan()
+        if not tasks:
+            logging.info("Nothing to do")
+        for task in tasks:
+            logging.info("Plan: %s %s (frozen age %d)", task.kind, task.table, task.frozen_age)
+        if self.args.dry_run or not tasks:
+            return
+
+        deadline = start + self.args.time_budget if self.args.time_budget is not None else None
+        settings = {'vacuum_cost_delay': self.args.cost_delay, 'vacuum_cost_limit': self.args.cost_limit}
+        pool = ConnectionPool(self.connect_db, max(1, min(self.args.workers, len(tasks))))
+        try:
+            results, skipped = vacuum_tables(pool, tasks, settings, deadline)
+        finally:
+            pool.closeall()
+
+        if skipped:
+            logging.warning("Time budget exhausted, left for the next run: %s",
+                            ", ".join(task.table for task in skipped))
+        failed = [task for task, error in results.items() if error is not None]
+        if failed:
+            message = "Vacuum failed for tables: " + ", ".join(task.table for task in failed)
+            logging.error(message)
+            raise FatalScriptError(results[failed[0]].error, message)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        script = VacuumPartsScript(sys.argv[1:])
+        script.read_config()
+        script.execute()
+    except FatalScriptError:
+        sys.exit(1)